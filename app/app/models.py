@@ -3,6 +3,7 @@ import pytils, base64
 import urllib.request, urllib.error
 
 from django.db import models
+from django.db.models.functions import Floor
 from django.utils.translation import gettext_lazy as _
 from django.apps import apps
 get_model = apps.get_model
@@ -12,6 +13,7 @@ from django.templatetags.static import static
 from app.utils import ServiceException
 
 from restthumbnails.files import ThumbnailContentFile
+from restthumbnails.queue import ThumbnailQueue
 
 from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
@@ -472,6 +474,27 @@ class BaseModelInsertUpdateTimestamp(BaseModelInsertTimestamp):
         self.fill_update_timestamp()
         return super(BaseModelInsertUpdateTimestamp, self).save(*args, **kwargs)
 
+class GeoPointInRectangle(models.Func):
+    """
+    point(longitude, latitude) <@ box(point(lng_west, lat_south), point(lng_east, lat_north))
+
+    Условие для filter(). Для профилей есть GiST индекс по
+    point(longitude, latitude), см. миграцию users 0059_profile_geo_point_gist
+    """
+    template = '%(expressions)s'
+    arg_joiner = ' <@ '
+    output_field = models.BooleanField()
+
+    def __init__(self, lat_south, lat_north, lng_west, lng_east):
+        point = lambda lng, lat: models.Func(lng, lat, function='point')
+        super().__init__(
+            point(models.F('longitude'), models.F('latitude')),
+            models.Func(
+                point(models.Value(float(lng_west)), models.Value(float(lat_south))),
+                point(models.Value(float(lng_east)), models.Value(float(lat_north))),
+                function='box',
+        ))
+
 class GeoPointModel(models.Model):
     """
     Базовая GEO модель
@@ -479,6 +502,42 @@ class GeoPointModel(models.Model):
     latitude = models.FloatField(_("Широта"), blank=True, null=True)
     longitude = models.FloatField(_("Долгота"), blank=True, null=True)
 
+    @classmethod
+    def in_rectangle(cls, lat_south, lat_north, lng_west, lng_east):
+        """
+        Условие: точка в прямоугольнике карты
+        """
+        return GeoPointInRectangle(lat_south, lat_north, lng_west, lng_east)
+
+    @classmethod
+    def clusters(cls, qs, cell_size):
+        """
+        Сгруппировать точки qs по квадратам сетки cell_size градусов
+
+        Группировка в базе, возвращается не больше точек,
+        чем квадратов сетки. Для каждого квадрата:
+            latitude, longitude     центр точек в квадрате
+            count                   число точек
+            pk                      pk единственной точки, если count == 1
+        """
+        result = []
+        for rec in qs.order_by().annotate(
+                cell_x=Floor(models.F('longitude') / cell_size),
+                cell_y=Floor(models.F('latitude') / cell_size),
+            ).values('cell_x', 'cell_y').annotate(
+                count=models.Count('pk'),
+                lat=models.Avg('latitude'),
+                lng=models.Avg('longitude'),
+                pk_min=models.Min('pk'),
+            ):
+            result.append(dict(
+                latitude=rec['lat'],
+                longitude=rec['lng'],
+                count=rec['count'],
+                pk=rec['pk_min'] if rec['count'] == 1 else None,
+            ))
+        return result
+
     class Meta:
         abstract = True
 
@@ -700,6 +759,7 @@ class PhotoModel(FilesMixin, models.Model):
                     )
                     if content:
                         self.photo.save(PhotoModel.DEFAULT_FNAME, content)
+                        PhotoModel.queue_thumbnails(self.photo.name)
                         result = True
             except urllib.error.URLError:
                 pass
@@ -747,20 +807,44 @@ class PhotoModel(FilesMixin, models.Model):
         if not fname and put_default_avatar:
             fname = default_avatar_in_media
         if fname:
-            if mark_dead:
-                # Если отметить как умершего, то в рамке размером 1/16 ребра прямоугольника,
-                method='crop-black-frame-%s' % int((width + height)/2/16)
-            path = '%(path_to_media)s%(fname)s/%(width)sx%(height)s~%(method)s~12.jpg'  % dict(
-                    path_to_media=settings.THUMBNAILS_STORAGE_BASE_PATH,
-                    fname=fname,
-                    width=width,
-                    height=height,
-                    method=method,
+            path = cls.image_thumb_path(fname,
+                width=width, height=height, method=method, mark_dead=mark_dead,
             )
             return request.build_absolute_uri(path)
         else:
             return ''
 
+    @classmethod
+    def image_thumb_path(cls, fname,
+            width=THUMB_WIDTH, height=THUMB_HEIGHT,
+            method=THUMB_METHOD,
+            mark_dead=False,
+        ):
+        if mark_dead:
+            # Если отметить как умершего, то в рамке размером 1/16 ребра прямоугольника,
+            method='crop-black-frame-%s' % int((width + height)/2/16)
+        return '%(path_to_media)s%(fname)s/%(width)sx%(height)s~%(method)s~12.jpg'  % dict(
+                path_to_media=settings.THUMBNAILS_STORAGE_BASE_PATH,
+                fname=fname,
+                width=width,
+                height=height,
+                method=method,
+        )
+
+    @classmethod
+    def queue_thumbnails(cls, fname, high=True, r=None):
+        """
+        Поставить в очередь генерации стандартный набор thumbnails фото fname
+
+        См. restthumbnails/queue.py, settings.THUMBNAILS_PREGENERATE
+        """
+        items = []
+        for parms in settings.THUMBNAILS_PREGENERATE:
+            item = ThumbnailQueue.item_from_path(cls.image_thumb_path(fname, **parms))
+            if item:
+                items.append(item)
+        return ThumbnailQueue.put(items, high=high, r=r)
+
     def choose_thumb(self, request,
         width=THUMB_WIDTH, height=THUMB_HEIGHT,
         method=THUMB_METHOD,
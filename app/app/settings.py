@@ -268,6 +268,27 @@ MAX_RECURSION_DEPTH_IN_GROUP = 10
 #   максимальное число выборки из группы для очередной страницы
 #
 MAX_RECURSION_COUNT_IN_GROUP = 50
+#
+#   максимальное число путей доверия между двумя пользователями,
+#   если запрошены не только кратчайшие
+#
+MAX_TRUST_PATHS_COUNT = 10
+
+# Снимок (snapshot) всего графа для 3d-force-graph фронта.
+# См. contact/snapshot.py и команду build_graph_snapshot
+#
+#   Папка снимков. Пустая строка: снимков нет, все строится из базы
+#
+GRAPH_SNAPSHOT_ROOT = ''
+#
+#   Полный адрес api, для ссылок на фото в снимке,
+#   например, 'https://api.blagodarie.org'
+#
+GRAPH_SNAPSHOT_API_ROOT = ''
+#
+#   Снимок старше этого (в секундах) не отдается
+#
+GRAPH_SNAPSHOT_MAX_AGE = 900
 
 # Сколько последних пользователей показываем на главной странице.
 # Или сколько пользователй по умолчанию на странице.
@@ -288,11 +309,56 @@ TELEGRAM_BOT_TOKEN = None
 #
 TELEGRAM_AUTH_DATA_OUTDATED = 3600
 
+# Сколько секунд считать свежими данные бота (getMe), в т.ч. имя бота.
+# Устаревшие данные обновляются в фоне, до обновления отдаются
+# последние известные
+#
+TELEGRAM_BOT_DATA_TTL = 3600
+
+# Сколько секунд хранить в кэше (redis, CACHES['default']) ответы
+# о профилях и деревьях родни, см. users/profile_cache.py.
+# Ответы сбрасываются и раньше, при изменении данных.
+# 0: без кэша
+#
+PROFILE_CACHE_TIMEOUT = 3600
+
 # В процессе отладки нехорошо мучать других пользователей
 # сообщениями. Это можно в local_settings запретить.
 #
 SEND_TO_TELEGRAM = True
 
+# Очередь исходящих сообщений в телеграм, см. users/tg_queue.py.
+# Сообщения из очереди отправляет ./manage.py tg_queue_worker.
+# Если очередь отключена, сообщения отправляются сразу,
+# в обработчике запроса к апи
+#
+TG_QUEUE_ON = True
+TG_QUEUE_REDIS_CONNECT = dict(
+    # Параметры redis.Redis()
+    host='127.0.0.1',
+    port=6379,
+    db=3,
+    decode_responses=True,
+)
+TG_QUEUE_API = 'https://api.telegram.org'
+# Не больше стольких сообщений в секунду всего
+TG_QUEUE_RATE = 30
+# Не чаще, чем раз в столько секунд, в один чат
+TG_QUEUE_CHAT_INTERVAL = 1.0
+# Сколько запросов к телеграму одновременно
+TG_QUEUE_CONCURRENCY = 50
+# Сколько сообщений брать из redis сразу: отправляются, ждут своей
+# очереди в чат (TG_QUEUE_CHAT_INTERVAL) или повтора
+TG_QUEUE_HELD_MAX = 1000
+# Таймаут запроса к телеграму, секунд
+TG_QUEUE_TIMEOUT = 20
+# Повторов при ошибках сети, 5xx, 429, и задержка перед первым
+# повтором, секунд. Далее задержка удваивается
+TG_QUEUE_RETRIES = 5
+TG_QUEUE_RETRY_DELAY = 2
+# Сколько последних не отправленных сообщений хранить
+TG_QUEUE_DEAD_MAX = 10000
+
 # ------------------------------------------------
 
 # front-end stuff
@@ -331,6 +397,15 @@ GRAPH_MEET_URL = 'https://mgraph.doverabot.ru'
 #
 MAP_URL = 'https://map.doverabot.ru'
 
+# Кластеры точек на карте, см. ApiUserPointsClusters:
+#   MAP_CLUSTER_CELLS_PER_TILE  на сколько квадратов делить тайл карты
+#                               по ширине, чем больше, тем мельче кластеры
+#   MAP_CLUSTER_MAX_CELLS       больше скольких квадратов в прямоугольнике карты
+#                               не делать, чтоб ответ был ограничен
+#
+MAP_CLUSTER_CELLS_PER_TILE = 4
+MAP_CLUSTER_MAX_CELLS = 2000
+
 MEET_URL = 'https://doverabot.ru'
 
 # Для кнопок loginUrl в телеграме
@@ -421,6 +496,34 @@ THUMBNAILS_PROXY_BASE_URL = '/thumb/'
 # возможные длины и высоты:
 THUMBNAILS_ALLOWED_SIZE_RANGE = dict(min=20, max=2000)
 
+# Очередь генерации thumbnails, см. restthumbnails/queue.py.
+# Thumbnails из очереди делает ./manage.py thumbnails_worker.
+# Если очередь отключена или обработчик не запущен, thumbnail
+# делается, как раньше, при первом запросе к нему
+#
+THUMBNAILS_QUEUE_ON = True
+THUMBNAILS_QUEUE_REDIS_CONNECT = dict(
+    # Параметры redis.Redis()
+    host='127.0.0.1',
+    port=6379,
+    db=4,
+    decode_responses=True,
+)
+# Сколько процессов делают thumbnails. None: по числу процессоров
+THUMBNAILS_QUEUE_WORKERS = None
+# Сколько секунд запрос к thumbnail ждет, пока его сделает обработчик
+# очереди или другой запрос. Не больше ThumbnailView.MAX_WAIT_TIMEOUT:
+# ожидающий запрос занимает процесс сервера
+THUMBNAILS_WAIT_TIMEOUT = 0.3
+# Какие thumbnails делать заранее, при загрузке фото и в
+# ./manage.py thumbnails_warmup. Параметры PhotoModel.image_thumb_path()
+THUMBNAILS_PREGENERATE = (
+    dict(width=64, height=64),
+    dict(width=64, height=64, mark_dead=True),
+    dict(width=128, height=128),
+    dict(width=128, height=128, mark_dead=True),
+)
+
 # Минимальный размер сообщения для полнотекстового поиска из бота:
 #
 MIN_LEN_SEARCHED_TEXT = 3
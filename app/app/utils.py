@@ -167,6 +167,18 @@ class Misc(object):
             result += ' ' + str_tz
         return result
 
+    # Шкала времени и эфемериды skyfield: (timescale, sun, moon, earth).
+    # Загружаются один раз в процессе, а не при каждом расчете
+    #
+    _skyfield = None
+
+    @classmethod
+    def skyfield(cls):
+        if Misc._skyfield is None:
+            eph = load('de421.bsp')
+            Misc._skyfield = (load.timescale(), eph['sun'], eph['moon'], eph['earth'],)
+        return Misc._skyfield
+
     @classmethod
     def get_moon_day(cls, utc_time=None):
         """
@@ -175,21 +187,37 @@ class Misc(object):
 
         if not utc_time:
             utc_time = int(time.time())
+        return cls.get_moon_days([utc_time])[0]
 
-        ts = load.timescale()
-        d = datetime.datetime.utcfromtimestamp(utc_time)
-        t = ts.utc(d.year, d.month, d.day, d.hour, d.minute, d.second)
-
-        eph = load('de421.bsp')
-        sun, moon, earth = eph['sun'], eph['moon'], eph['earth']
+    @classmethod
+    def get_moon_days(cls, utc_times):
+        """
+        Номера дней по лунному календарю для списка unix timestamp,
+        одним (векторным) расчетом skyfield на весь список
+        """
+        if not utc_times:
+            return []
+        ts, sun, moon, earth = cls.skyfield()
+        dts = [datetime.datetime.utcfromtimestamp(utc_time) for utc_time in utc_times]
+        t = ts.utc(
+            [d.year for d in dts],
+            [d.month for d in dts],
+            [d.day for d in dts],
+            [d.hour for d in dts],
+            [d.minute for d in dts],
+            [d.second for d in dts],
+        )
 
         e = earth.at(t)
         _, slon, _ = e.observe(sun).apparent().frame_latlon(ecliptic_frame)
         _, mlon, _ = e.observe(moon).apparent().frame_latlon(ecliptic_frame)
-        phase = (mlon.degrees - slon.degrees) % 360.0
-        if phase >= 360:
-            phase = phase % 360.
-        elif phase < 0:
-            phase = 0
-        return int(phase * 30 / 360)
+        result = []
+        for phase in (mlon.degrees - slon.degrees) % 360.0:
+            phase = float(phase)
+            if phase >= 360:
+                phase = phase % 360.
+            elif phase < 0:
+                phase = 0
+            result.append(int(phase * 30 / 360))
+        return result
 
@@ -21,3 +21,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
 
 application = get_wsgi_application()
+
+# Данные бота получаем заранее, чтобы первые запросы к апи
+# не ждали ответа от телеграма
+#
+from users.models import TelegramApiMixin
+TelegramApiMixin().refresh_bot_data_background()
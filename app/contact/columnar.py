@@ -0,0 +1,358 @@
+"""
+Компактный (колоночный) формат графов: fmt=columnar
+
+Большие графы (все профили и связи, деревья родни, графы голосований)
+в обычном json повторяют в каждом узле и каждой связи имена ключей,
+в d3js формате в связях еще и uuid узлов, а в узлах полные адреса фото.
+В колоночном формате:
+
+    {
+        "format": "columnar",
+        "nodes": {
+            "count": <число узлов>,
+            "columns": {<ключ>: <колонка>, ...},
+            "flag_names": [<ключ>, ...],
+            "flags": [<число>, ...]
+        },
+        "links": {
+            "count": <число связей>,
+            "source": {"counts": <сколько связей у каждого узла>},
+            "target": <колонка номеров узлов в nodes>,
+            "columns": ..., "flag_names": ..., "flags": ...
+        },
+        ... прочие ключи ответа (bot_username, root_node...) как есть
+    }
+
+Колонка: значения ключа у всех элементов по порядку, одно из:
+    [v0, v1, ...]                               как есть
+    {"values": [...], "index": [i0, i1, ...]}   значение: values[i]
+    {"prefix": p, "suffix": s, "rest": [...], "nulls": [i, ...]}
+                                                значение: p + rest[i] + s,
+                                                если rest[i] не null, иначе "",
+                                                или null, если i в nulls
+                                                (nulls может не быть)
+    {"delta": [v0, d1, d2, ...]}                целые: v0, v0 + d1, v0 + d1 + d2...
+    {"uuid": <base64>}                          uuid: подряд по 16 байт в base64
+    {"counts": [c0, c1, ...]}                   c0 раз 0, затем c1 раз 1...
+    "0120..."                                   целые от 0 до 9: [0, 1, 2, 0...]
+Так же, строкой цифр, могут быть index, counts и flags.
+Логические ключи, у которых во всех элементах true или false, упакованы
+в flags: ключ flag_names[k] элемента i это (flags[i] >> k) & 1.
+Отсутствие ключа в элементе: null. ColumnarGraph.decode() восстанавливает
+ответ из колоночного формата.
+
+Узлы и связи: nodes/links (3d-force-graph, узел: id) или
+users/connections (d3js, узел: uuid). source, target: номера узлов
+в массивах nodes, а не id/uuid. Связи упорядочены по source, затем
+по target: порядок связей исходного ответа не сохраняется.
+
+Отдается компактным json или, при pack=msgpack, в MessagePack,
+если установлен msgpack. Узлы строятся как в fmt=3d-force-graph.
+
+Насколько меньше: contact/management/commands/bench_columnar.py.
+На графе из 20 тыс. узлов и 60 тыс. связей json в 5 раз меньше, чем
+в fmt=3d-force-graph (1.6 МБ против 8), кодируется в 1.5 раза дольше.
+Больше не ужать без сжатия как такового: 80% остатка -- то, что у
+каждого узла или связи свое: uuid (16 случайных байт, в base64 22 знака),
+username (10 случайных знаков), имя файла фото и номер узла target.
+Gzip на веб-сервере ужимает и обычный json, после него разница 1.8 раза.
+"""
+
+import json, uuid, base64
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+
+class ColumnarGraph(object):
+
+    FMT = 'columnar'
+    FMT_NODES = '3d-force-graph'
+
+    # Кодировать строки словарем, если разных значений
+    # не больше такой доли от их числа
+    #
+    DICT_RATIO = 0.5
+
+    # Выносить общие начало и конец строк, если их длина не меньше
+    #
+    AFFIX_MIN = 8
+
+    # (ключ узлов, ключ связей, ключ id узла)
+    #
+    LAYOUTS = (
+        ('nodes', 'links', 'id',),
+        ('users', 'connections', 'uuid',),
+    )
+
+    @classmethod
+    def get_fmt(cls, request, default='d3js'):
+        """
+        (fmt, columnar): fmt для построения ответа и нужен ли колоночный формат
+        """
+        fmt = request.GET.get('fmt', default)
+        if fmt == cls.FMT:
+            return cls.FMT_NODES, True
+        return fmt, False
+
+    @classmethod
+    def common_affix(cls, strings):
+        prefix = suffix = strings[0]
+        for s in strings[1:]:
+            while not s.startswith(prefix):
+                prefix = prefix[:-1]
+            while not s.endswith(suffix):
+                suffix = suffix[1:]
+        shortest = min(len(s) for s in strings)
+        if len(prefix) + len(suffix) > shortest:
+            suffix = suffix[len(prefix) + len(suffix) - shortest:]
+        return prefix, suffix
+
+    @classmethod
+    def digits(cls, numbers):
+        """
+        Целые от 0 до 9 строкой цифр, иначе как есть
+        """
+        if numbers and 0 <= min(numbers) and max(numbers) <= 9:
+            return ''.join(map(str, numbers))
+        return numbers
+
+    @classmethod
+    def undigits(cls, numbers):
+        if isinstance(numbers, str):
+            return [int(n) for n in numbers]
+        return numbers
+
+    @classmethod
+    def uuid_bytes(cls, value):
+        """
+        16 байт uuid, если value: uuid или строка, как str(uuid), иначе None
+        """
+        if isinstance(value, uuid.UUID):
+            return value.bytes
+        if isinstance(value, str) and len(value) == 36 and \
+           value[8] == value[13] == value[18] == value[23] == '-' and value == value.lower():
+            try:
+                packed = bytes.fromhex(value.replace('-', ''))
+            except ValueError:
+                return None
+            if len(packed) == 16:
+                return packed
+        return None
+
+    @classmethod
+    def encode_int_column(cls, values):
+        """
+        Колонка целых: разницами соседних, если так короче
+        """
+        digits = cls.digits(values)
+        if isinstance(digits, str):
+            return digits
+        deltas = [b - a for a, b in zip(values, values[1:])]
+        if values and len(''.join(map(str, deltas))) < len(''.join(map(str, values[1:]))):
+            return dict(delta=values[:1] + deltas)
+        return values
+
+    @classmethod
+    def encode_column(cls, values):
+        if values and all(type(v) is int for v in values):
+            return cls.encode_int_column(values)
+        packed = []
+        for v in values:
+            v = cls.uuid_bytes(v)
+            if v is None:
+                break
+            packed.append(v)
+        else:
+            if packed:
+                return dict(uuid=base64.b64encode(b''.join(packed)).decode())
+        values = [
+            str(v) if v is not None and not isinstance(v, (str, int, float, bool, dict, list)) else v \
+            for v in values
+        ]
+        strings = [v for v in values if isinstance(v, str)]
+        if len(strings) != len([v for v in values if v is not None]):
+            return values
+        distinct = list(dict.fromkeys(values))
+        if len(distinct) <= len(values) * cls.DICT_RATIO:
+            index = dict((v, i) for i, v in enumerate(distinct))
+            return dict(values=distinct, index=cls.digits([index[v] for v in values]))
+        filled = [s for s in strings if s]
+        if len(filled) > 1:
+            prefix, suffix = cls.common_affix(filled)
+            if len(prefix) + len(suffix) >= cls.AFFIX_MIN:
+                end = len(suffix)
+                column = dict(prefix=prefix, suffix=suffix, rest=[
+                    v[len(prefix):len(v) - end] if v else None for v in values
+                ])
+                nulls = [i for i, v in enumerate(values) if v is None]
+                if nulls:
+                    column.update(nulls=nulls)
+                return column
+        return values
+
+    @classmethod
+    def decode_column(cls, column):
+        if isinstance(column, (list, str)):
+            return cls.undigits(column)
+        if 'index' in column:
+            return [column['values'][i] for i in cls.undigits(column['index'])]
+        if 'delta' in column:
+            values = []
+            value = 0
+            for delta in column['delta']:
+                value += delta
+                values.append(value)
+            return values
+        if 'counts' in column:
+            values = []
+            for i, count in enumerate(cls.undigits(column['counts'])):
+                values.extend([i] * count)
+            return values
+        if 'uuid' in column:
+            packed = base64.b64decode(column['uuid'])
+            return [str(uuid.UUID(bytes=packed[i:i + 16])) for i in range(0, len(packed), 16)]
+        prefix, suffix = column['prefix'], column['suffix']
+        values = [prefix + rest + suffix if rest is not None else '' for rest in column['rest']]
+        for i in column.get('nulls', ()):
+            values[i] = None
+        return values
+
+    @classmethod
+    def encode_items(cls, items, skip=()):
+        """
+        Колонки и флаги списка словарей
+        """
+        keys = [key for key in dict.fromkeys(key for item in items for key in item) if key not in skip]
+        columns = dict()
+        flag_names = []
+        flags = [0] * len(items)
+        for key in keys:
+            values = [item.get(key) for item in items]
+            if all(isinstance(v, bool) for v in values):
+                bit = 1 << len(flag_names)
+                flag_names.append(key)
+                for i, v in enumerate(values):
+                    if v:
+                        flags[i] |= bit
+            else:
+                columns[key] = cls.encode_column(values)
+        result = dict(count=len(items), columns=columns)
+        if flag_names:
+            result.update(flag_names=flag_names, flags=cls.digits(flags))
+        return result
+
+    @classmethod
+    def decode_items(cls, encoded):
+        """
+        Список словарей из колонок и флагов, см. encode_items()
+        """
+        items = [dict() for i in range(encoded['count'])]
+        for key, column in encoded['columns'].items():
+            for item, value in zip(items, cls.decode_column(column)):
+                item[key] = value
+        for k, key in enumerate(encoded.get('flag_names', ())):
+            for item, flags in zip(items, cls.undigits(encoded['flags'])):
+                item[key] = bool(flags >> k & 1)
+        return items
+
+    @classmethod
+    def node_index(cls, value, nodes, index, id_key):
+        """
+        Номер узла с id value (или str(id)) в nodes. Нет такого: добавить узел только с id
+        """
+        i = index.get(value)
+        if i is None:
+            i = index.get(str(value))
+        if i is None:
+            i = index[value] = index[str(value)] = len(nodes)
+            nodes.append({id_key: value})
+        return i
+
+    @classmethod
+    def encode(cls, data):
+        """
+        Ответ графа в колоночном формате. Если в data нет графа, data как есть
+        """
+        for nodes_key, links_key, id_key in cls.LAYOUTS:
+            if nodes_key in data and links_key in data:
+                break
+        else:
+            return data
+        nodes = list(data[nodes_key])
+        links = data[links_key]
+        index = dict((node.get(id_key), i) for i, node in enumerate(nodes))
+        sources = [index.get(link['source']) for link in links]
+        targets = [index.get(link['target']) for link in links]
+        if None in sources or None in targets:
+            # В связях id может быть строкой, а может и не быть такого узла
+            index.update((str(node.get(id_key)), i) for i, node in enumerate(nodes))
+            for ends, end in ((sources, 'source',), (targets, 'target',)):
+                for i, link in enumerate(links):
+                    if ends[i] is None:
+                        ends[i] = cls.node_index(link[end], nodes, index, id_key)
+        n_nodes = len(nodes)
+        keys = [source * n_nodes + target for source, target in zip(sources, targets)]
+        order = sorted(range(len(links)), key=keys.__getitem__)
+        counts = [0] * n_nodes
+        for source in sources:
+            counts[source] += 1
+        result = dict((k, v) for k, v in data.items() if k not in (nodes_key, links_key))
+        links = cls.encode_items([links[i] for i in order], skip=('source', 'target',))
+        links.update(
+            source=dict(counts=cls.digits(counts)),
+            target=cls.encode_int_column([targets[i] for i in order]),
+        )
+        result.update({
+            'format': cls.FMT,
+            'nodes': cls.encode_items(nodes),
+            'links': links,
+        })
+        return result
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Ответ графа из колоночного формата, обратное encode()
+
+        Значения, что не str, int, float, bool, dict, list (например, uuid),
+        восстанавливаются строками
+        """
+        if data.get('format') != cls.FMT:
+            return data
+        for nodes_key, links_key, id_key in cls.LAYOUTS:
+            if id_key in data['nodes']['columns']:
+                break
+        else:
+            nodes_key, links_key, id_key = cls.LAYOUTS[0]
+        nodes = cls.decode_items(data['nodes'])
+        links = cls.decode_items(data['links'])
+        sources = cls.decode_column(data['links']['source'])
+        targets = cls.decode_column(data['links']['target'])
+        for link, source, target in zip(links, sources, targets):
+            link.update(source=nodes[source][id_key], target=nodes[target][id_key])
+        result = dict((k, v) for k, v in data.items() if k not in ('format', 'nodes', 'links',))
+        result.update({nodes_key: nodes, links_key: links})
+        return result
+
+    @classmethod
+    def response(cls, request, data, status=200):
+        """
+        Ответ апи: колоночный json или msgpack (pack=msgpack)
+        """
+        data = cls.encode(data)
+        if msgpack and request.GET.get('pack') == 'msgpack':
+            return HttpResponse(
+                msgpack.packb(data, default=str),
+                content_type='application/x-msgpack',
+                status=status,
+            )
+        return HttpResponse(
+            json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':',)),
+            content_type='application/json',
+            status=status,
+        )
@@ -0,0 +1,577 @@
+"""
+Графы связей между пользователями в памяти процесса (worker'а)
+
+Заменяют рекурсивные postgresql функции поиска по связям, которые
+на каждый запрос материализуют все пути во временной таблице.
+
+Граф загружается из CurrentState один раз на процесс, при первом
+обращении, и хранится как словарь:
+    user_from_id: array('q') упакованных связей от user_from_id
+
+Синхронизация между процессами:
+    После изменения связей (в транзакции, после commit) вызывается
+    users_changed(user_ids). Это увеличивает номер версии графа в кэше
+    django (settings.CACHES, в работе redis) и запоминает в кэше
+    под этим номером user_ids. Процесс, обнаружив при обращении к графу,
+    что версия в кэше больше его версии, перечитывает из базы только
+    связи затронутых пользователей. Если изменений набралось слишком
+    много или они пропали из кэша, граф перечитывается полностью.
+"""
+
+import threading
+from array import array
+
+from django.core.cache import cache
+from django.db.models.query_utils import Q
+from django.apps import apps
+get_model = apps.get_model
+
+class GraphIndex(object):
+    """
+    Базовый класс графа связей в памяти процесса
+
+    В наследнике определить:
+        CACHE_PREFIX:   префикс ключей в кэше
+        q_edges():      Q - условие на связь в CurrentState
+        EDGE_FIELDS:    поля CurrentState для values_list(),
+                        первые два из них: 'user_from_id', 'user_to_id'
+        pack(row):      упаковать строку values_list() в целое
+        unpack_user_to(code):
+                        user_to_id из упакованной связи
+        WITH_EDGES_IN:  True, если нужны и входящие связи,
+                        self.edges_in: user_to_id: array('q') из user_from_id
+    """
+
+    CACHE_PREFIX = None
+    EDGE_FIELDS = ('user_from_id', 'user_to_id',)
+    WITH_EDGES_IN = False
+
+    # Сколько секунд хранить в кэше сведения об изменении версии графа
+    #
+    CHANGE_TIMEOUT = 3600
+
+    # Если процесс отстал более чем на столько версий, перечитать весь граф
+    #
+    MAX_CHANGES_BEHIND = 500
+
+    LOAD_CHUNK_SIZE = 20000
+
+    # Вместо user_ids в сведениях об изменении: перечитать весь граф
+    #
+    ALL_CHANGED = 'all'
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.edges = dict()
+        self.edges_in = dict()
+        # None: граф еще не загружен
+        self.version = None
+
+    @classmethod
+    def get(cls):
+        """
+        Граф процесса, загруженный и синхронизированный с базой
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        cls._instance.sync()
+        return cls._instance
+
+    @classmethod
+    def q_edges(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def pack(cls, row):
+        return row[1]
+
+    @classmethod
+    def unpack_user_to(cls, code):
+        return code
+
+    @classmethod
+    def version_key(cls):
+        return '%s_version' % cls.CACHE_PREFIX
+
+    @classmethod
+    def change_key(cls, version):
+        return '%s_change_%s' % (cls.CACHE_PREFIX, version,)
+
+    @classmethod
+    def shared_version(cls):
+        version = cache.get(cls.version_key())
+        if version is None:
+            cache.add(cls.version_key(), 0, None)
+            version = cache.get(cls.version_key(), 0)
+        return version
+
+    @classmethod
+    def graph_changed(cls):
+        """
+        Отметить, что изменилось слишком много связей: граф перечитать полностью
+
+        Например, после импорта родословной. Вызывать, как и users_changed()
+        """
+        cls.users_changed(cls.ALL_CHANGED)
+
+    @classmethod
+    def users_changed(cls, user_ids):
+        """
+        Отметить, что изменились связи пользователей user_ids
+
+        Вызывать после commit транзакции, в которой менялись связи,
+        например, через transaction.on_commit()
+        """
+        if user_ids != cls.ALL_CHANGED:
+            user_ids = set(user_ids)
+        if not user_ids:
+            return
+        try:
+            version = cache.incr(cls.version_key())
+        except ValueError:
+            cache.add(cls.version_key(), 0, None)
+            version = cache.incr(cls.version_key())
+        cache.set(cls.change_key(version), user_ids, cls.CHANGE_TIMEOUT)
+        if cls._instance is not None:
+            cls._instance.sync()
+
+    def edge_rows(self, q=Q()):
+        CurrentState = get_model('contact', 'CurrentState')
+        return CurrentState.objects.filter(self.q_edges() & q).values_list(*self.EDGE_FIELDS)
+
+    def load(self):
+        """
+        Загрузить весь граф
+        """
+        # Версию берем до чтения из базы: изменения, сделанные
+        # во время чтения, будут перечитаны при следующем sync()
+        version = self.shared_version()
+        edges = dict()
+        for row in self.edge_rows().iterator(chunk_size=self.LOAD_CHUNK_SIZE):
+            try:
+                edges[row[0]].append(self.pack(row))
+            except KeyError:
+                edges[row[0]] = array('q', (self.pack(row),))
+        edges_in = dict()
+        if self.WITH_EDGES_IN:
+            for user_from_id, codes in edges.items():
+                for code in codes:
+                    self.add_edge_in(edges_in, user_from_id, self.unpack_user_to(code))
+        with self.lock:
+            self.edges = edges
+            self.edges_in = edges_in
+            self.version = version
+
+    @classmethod
+    def add_edge_in(cls, edges_in, user_from_id, user_to_id):
+        try:
+            edges_in[user_to_id].append(user_from_id)
+        except KeyError:
+            edges_in[user_to_id] = array('q', (user_from_id,))
+
+    def reload_users(self, user_ids):
+        """
+        Перечитать из базы связи от и к пользователям user_ids
+        """
+        user_ids = set(user_ids)
+        with self.lock:
+            affected = set(user_ids)
+            for user_id in user_ids:
+                affected.update(self.neighbors(user_id))
+                affected.update(self.edges_in.get(user_id, ()))
+        affected.update(
+            self.edge_rows(Q(user_to__pk__in=user_ids)).values_list('user_from_id', flat=True)
+        )
+        edges = dict()
+        for row in self.edge_rows(Q(user_from__pk__in=affected)):
+            try:
+                edges[row[0]].append(self.pack(row))
+            except KeyError:
+                edges[row[0]] = array('q', (self.pack(row),))
+        with self.lock:
+            for user_id in affected:
+                if self.WITH_EDGES_IN:
+                    for user_to_id in self.neighbors(user_id):
+                        try:
+                            self.edges_in[user_to_id].remove(user_id)
+                        except (KeyError, ValueError,):
+                            pass
+                    for code in edges.get(user_id, ()):
+                        self.add_edge_in(self.edges_in, user_id, self.unpack_user_to(code))
+                if user_id in edges:
+                    self.edges[user_id] = edges[user_id]
+                else:
+                    self.edges.pop(user_id, None)
+
+    def sync(self):
+        """
+        Синхронизировать граф процесса с изменениями из других процессов
+        """
+        if self.version is None:
+            with self.lock:
+                if self.version is None:
+                    self.load()
+            return
+        version = self.shared_version()
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            if version < self.version or version - self.version > self.MAX_CHANGES_BEHIND:
+                # Кэш был очищен или процесс сильно отстал
+                self.load()
+                return
+            keys = [self.change_key(v) for v in range(self.version + 1, version + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) != len(keys) or self.ALL_CHANGED in changes.values():
+                self.load()
+                return
+            user_ids = set()
+            for ids in changes.values():
+                user_ids.update(ids)
+            self.reload_users(user_ids)
+            self.version = version
+
+    def neighbors(self, user_id):
+        """
+        Id пользователей, к которым есть связи от user_id
+        """
+        return [self.unpack_user_to(code) for code in self.edges.get(user_id, ())]
+
+class GenesisGraph(GraphIndex):
+    """
+    Граф родственных связей
+
+    Связь user_from -> user_to упакована в целое:
+        user_to_id << 2 | is_child << 1 | is_mother
+    Связи в CurrentState для родства хранятся в обе стороны:
+    родитель -> ребенок (is_child) и ребенок -> родитель.
+
+    Методы повторяют результаты postgresql функций
+    find_genesis_tree, find_genesis_path_shortest, find_group_genesis_tree
+    """
+
+    CACHE_PREFIX = 'genesis_graph'
+    EDGE_FIELDS = ('user_from_id', 'user_to_id', 'is_child', 'is_mother',)
+
+    @classmethod
+    def q_edges(cls):
+        return Q(user_to__isnull=False) & (Q(is_father=True) | Q(is_mother=True))
+
+    @classmethod
+    def pack(cls, row):
+        return row[1] << 2 | bool(row[2]) << 1 | bool(row[3])
+
+    @classmethod
+    def unpack_user_to(cls, code):
+        return code >> 2
+
+    def tree(self, user_id, recursion_depth, v_all, v_is_child):
+        """
+        Родственное дерево, начиная с пользователя user_id
+
+        Как postgresql функция find_genesis_tree:
+            recursion_depth:
+                максимальное число итераций при проходе по дереву связей
+            v_all:
+                показывать ли все связи, то есть проходим и по потомкам,
+                и по предкам, получаем в т.ч. тетей, двоюродных и т.д.
+                Если True, то v_is_child роли не играет
+            v_is_child:
+                При v_all == False:
+                    v_is_child == True:     проходим только по детям.
+                    v_is_child == False:    проходим только по предкам.
+        Возвращает список словарей с ключами:
+            level, user_from_id, user_to_id, is_father, is_mother, is_child
+        упорядоченный по level.
+        """
+        recs = []
+        if recursion_depth <= 0:
+            return recs
+        is_child_bit = 2 if v_is_child else 0
+        # user_from_id уже найденных связей: от них и к ним не идем
+        passed = set()
+        frontier = (user_id,)
+        with self.lock:
+            for level in range(1, recursion_depth + 1):
+                found = []
+                next_frontier = set()
+                for user_from_id in frontier:
+                    if user_from_id in passed:
+                        continue
+                    for code in self.edges.get(user_from_id, ()):
+                        if not v_all and code & 2 != is_child_bit:
+                            continue
+                        user_to_id = code >> 2
+                        if user_to_id in passed:
+                            continue
+                        found.append(user_from_id)
+                        next_frontier.add(user_to_id)
+                        recs.append(dict(
+                            level=level,
+                            user_from_id=user_from_id,
+                            user_to_id=user_to_id,
+                            is_father=not code & 1,
+                            is_mother=bool(code & 1),
+                            is_child=bool(code & 2),
+                        ))
+                if not found:
+                    break
+                passed.update(found)
+                frontier = next_frontier
+        return recs
+
+    def shortest_path_user_ids(self, user_from_id, user_to_id, recursion_depth):
+        """
+        Id пользователей во всех кратчайших путях родства от user_from_id к user_to_id
+
+        Как объединение path из
+            find_genesis_path_shortest(user_from_id, user_to_id, recursion_depth)
+            where path @> array[user_from_id, user_to_id]
+        Если путь не длиннее recursion_depth не найден, пустое множество.
+        Поиск в ширину, с запоминанием всех предшественников узла
+        на предыдущем уровне.
+        """
+        if user_from_id == user_to_id or recursion_depth <= 0:
+            return set()
+        with self.lock:
+            preds = {user_from_id: ()}
+            frontier = [user_from_id]
+            for level in range(recursion_depth):
+                level_preds = dict()
+                for user_id in frontier:
+                    for code in self.edges.get(user_id, ()):
+                        next_id = code >> 2
+                        if next_id in preds:
+                            continue
+                        try:
+                            level_preds[next_id].append(user_id)
+                        except KeyError:
+                            level_preds[next_id] = [user_id]
+                if not level_preds:
+                    return set()
+                preds.update(level_preds)
+                if user_to_id in level_preds:
+                    break
+                frontier = list(level_preds)
+            else:
+                return set()
+        result = set()
+        stack = [user_to_id]
+        while stack:
+            user_id = stack.pop()
+            if user_id not in result:
+                result.add(user_id)
+                stack.extend(preds[user_id])
+        return result
+
+    def group_user_ids(self, user_page_pks, recursion_depth):
+        """
+        Id пользователей в цепочках родства между user_page_pks
+
+        Как внутренние узлы path из
+            find_group_genesis_tree(user_page_pks, recursion_depth)
+            where path[array_length(path, 1)] = any(user_page_pks)
+            and path[1] != path[array_length(path, 1)]
+        Лучи идут от каждого из user_page_pks. Луч не продолжается
+        от участника user_page_pks, не заходит в свои же узлы и в концы
+        лучей от того же начала, что были найдены двумя итерациями ранее.
+        """
+        members = set(user_page_pks)
+        result = set()
+        if recursion_depth <= 0:
+            return result
+        with self.lock:
+            rays = []
+            for root in members:
+                for code in self.edges.get(root, ()):
+                    rays.append((root, code >> 2,))
+            # Концы лучей по их началам: на предыдущей итерации и до нее
+            ends_before = dict((root, {root}) for root in members)
+            ends_prev = dict()
+            for ray in rays:
+                ends_prev.setdefault(ray[0], set()).add(ray[-1])
+            level = 1
+            while True:
+                for ray in rays:
+                    if ray[-1] in members and ray[0] != ray[-1]:
+                        result.update(ray[1:-1])
+                level += 1
+                if level > recursion_depth or not rays:
+                    break
+                new_rays = []
+                ends = dict()
+                for ray in rays:
+                    user_from_id = ray[-1]
+                    if user_from_id in members:
+                        continue
+                    root = ray[0]
+                    pruned = ends_before.get(root, ())
+                    for code in self.edges.get(user_from_id, ()):
+                        user_to_id = code >> 2
+                        if user_to_id in pruned or user_to_id in ray:
+                            continue
+                        new_rays.append(ray + (user_to_id,))
+                        ends.setdefault(root, set()).add(user_to_id)
+                ends_before = ends_prev
+                ends_prev = ends
+                rays = new_rays
+        return result
+
+class TrustGraph(GraphIndex):
+    """
+    Граф связей доверия и знакомства
+
+    Как в postgresql функции find_trust_path_shortest, связь user_from -> user_to
+    есть, если attitude: доверие или знакомство, в т.ч. в обратной
+    (is_reverse) записи. Связь упакована в целое: user_to_id.
+    Хранятся и входящие связи, для поиска в ширину с двух сторон.
+    """
+
+    CACHE_PREFIX = 'trust_graph'
+    WITH_EDGES_IN = True
+
+    @classmethod
+    def q_edges(cls):
+        CurrentState = get_model('contact', 'CurrentState')
+        return Q(user_to__isnull=False) & Q(attitude__in=(CurrentState.TRUST, CurrentState.ACQ,))
+
+    def search(self, user_from_id, user_to_id, max_hops, blocked_users=(), blocked_edges=()):
+        """
+        Поиск в ширину с двух сторон: от user_from_id и к user_to_id
+
+        Каждый шаг - проход на один уровень с той стороны, у которой
+        меньше узлов на краю. Заканчиваем, как только стороны встретились
+        или сумма глубин дошла до max_hops.
+            blocked_users:  через этих не идем
+            blocked_edges:  по этим (user_from_id, user_to_id) не идем
+        Возвращает (длина пути, узлы встречи, предшественники, последователи)
+        или None, если пути не длиннее max_hops нет.
+        Предшественники: {user_id: [id на уровень ближе к user_from_id]},
+        последователи: {user_id: [id на уровень ближе к user_to_id]}
+        """
+        if user_from_id == user_to_id or max_hops <= 0 or \
+           user_from_id in blocked_users or user_to_id in blocked_users:
+            return None
+        # Глубины и края с обеих сторон
+        depth_f, depth_b = {user_from_id: 0}, {user_to_id: 0}
+        preds, succs = {user_from_id: []}, {user_to_id: []}
+        frontier_f, frontier_b = [user_from_id], [user_to_id]
+        level_f = level_b = 0
+        with self.lock:
+            while frontier_f and frontier_b and level_f + level_b < max_hops:
+                forward = len(frontier_f) <= len(frontier_b)
+                if forward:
+                    edges, depth, links, frontier = self.edges, depth_f, preds, frontier_f
+                    level_f += 1
+                    level, other_depth = level_f, depth_b
+                else:
+                    edges, depth, links, frontier = self.edges_in, depth_b, succs, frontier_b
+                    level_b += 1
+                    level, other_depth = level_b, depth_f
+                new_frontier = []
+                for user_id in frontier:
+                    for code in edges.get(user_id, ()):
+                        next_id = self.unpack_user_to(code)
+                        if next_id in blocked_users:
+                            continue
+                        if blocked_edges and \
+                           ((user_id, next_id) if forward else (next_id, user_id)) in blocked_edges:
+                            continue
+                        next_depth = depth.get(next_id)
+                        if next_depth is None:
+                            depth[next_id] = level
+                            links[next_id] = [user_id]
+                            new_frontier.append(next_id)
+                        elif next_depth == level:
+                            links[next_id].append(user_id)
+                if forward:
+                    frontier_f = new_frontier
+                else:
+                    frontier_b = new_frontier
+                met = [user_id for user_id in new_frontier if user_id in other_depth]
+                if met:
+                    length = level + min(other_depth[user_id] for user_id in met)
+                    meet = [user_id for user_id in met if level + other_depth[user_id] == length]
+                    return length, meet, preds, succs
+        return None
+
+    def shortest_path_user_ids(self, user_from_id, user_to_id, max_hops):
+        """
+        Id пользователей во всех кратчайших путях доверия от user_from_id к user_to_id
+
+        Как объединение path из
+            find_trust_path_shortest(user_from_id, user_to_id, max_hops)
+            where path @> array[user_from_id, user_to_id]
+        """
+        result = set()
+        found = self.search(user_from_id, user_to_id, max_hops)
+        if not found:
+            return result
+        length, meet, preds, succs = found
+        for links in (preds, succs,):
+            stack = list(meet)
+            passed = set()
+            while stack:
+                user_id = stack.pop()
+                if user_id not in passed:
+                    passed.add(user_id)
+                    stack.extend(links[user_id])
+            result.update(passed)
+        return result
+
+    def shortest_path(self, user_from_id, user_to_id, max_hops, blocked_users=(), blocked_edges=()):
+        """
+        Один из кратчайших путей доверия: кортеж id или None
+        """
+        found = self.search(user_from_id, user_to_id, max_hops, blocked_users, blocked_edges)
+        if not found:
+            return None
+        length, meet, preds, succs = found
+        path = [meet[0]]
+        while preds[path[0]]:
+            path.insert(0, preds[path[0]][0])
+        while succs[path[-1]]:
+            path.append(succs[path[-1]][0])
+        return tuple(path)
+
+    def k_shortest_paths(self, user_from_id, user_to_id, max_hops, k):
+        """
+        До k кратчайших путей доверия без повторов узлов, не длиннее max_hops
+
+        Алгоритм Йена (Yen): очередной путь ищется как ответвление
+        от одного из узлов предыдущего пути, с запретом уже найденных
+        ответвлений. Возвращает список кортежей id, по возрастанию длины.
+        """
+        path = self.shortest_path(user_from_id, user_to_id, max_hops)
+        if not path:
+            return []
+        paths = [path]
+        candidates = []
+        while len(paths) < k:
+            prev_path = paths[-1]
+            for i in range(len(prev_path) - 1):
+                root = prev_path[:i + 1]
+                blocked_edges = set(
+                    (p[i], p[i + 1]) for p in paths if p[:i + 1] == root
+                )
+                spur = self.shortest_path(
+                    root[-1], user_to_id, max_hops - i,
+                    blocked_users=set(root[:-1]),
+                    blocked_edges=blocked_edges,
+                )
+                if spur:
+                    candidate = root[:-1] + spur
+                    if candidate not in paths and candidate not in candidates:
+                        candidates.append(candidate)
+            if not candidates:
+                break
+            candidates.sort(key=len)
+            paths.append(candidates.pop(0))
+        return paths
@@ -0,0 +1,140 @@
+# bench_add_user_symptoms.py
+#
+# Замер вставки симптомов пользователя (ApiAddUserSymptom): симптомов
+# в секунду при пакетной вставке json и ndjson против прежней вставки
+# по одному симптому.
+#
+# Прежняя вставка, как было до пакетной: на каждый симптом запрос
+# Symptom, UserSymptom.objects.create(), а в нем день луны, для
+# которого каждый раз заново загружались эфемериды skyfield.
+#
+# Симптомы, как при отправке накопленного без связи: с timestamp
+# в прошлом, по --batch в запросе json, все --records одним запросом
+# ndjson. Еще один запрос ndjson с теми же симптомами: все повторы.
+# Запросы через RequestFactory, прямо в ApiAddUserSymptom, без
+# middleware. Все в транзакции, которая в конце откатывается.
+#
+# Параметры:
+#   --records       Сколько симптомов, по умолчанию 100000
+#   --old-records   Сколько симптомов вставить по-прежнему, по одному,
+#                   по умолчанию 1000
+#   --batch         Сколько симптомов в запросе json, по умолчанию 1000
+#   --symptoms      Сколько разных симптомов в справочнике, по умолчанию 50
+
+import json, time, random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from app.utils import Misc
+from contact.models import SymptomGroup, Symptom, UserSymptom, SymptomStat
+from contact.views import ApiAddUserSymptom
+
+URL = '/api/addincognitosymptom'
+
+class Command(BaseCommand):
+    help = 'Benchmark user symptom ingestion: bulk json and ndjson against the old one by one insert'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=100000, help='number of symptoms')
+        parser.add_argument('--old-records', type=int, default=1000,
+                            help='number of symptoms to insert the old way, one by one')
+        parser.add_argument('--batch', type=int, default=1000, help='symptoms per json request')
+        parser.add_argument('--symptoms', type=int, default=50, help='number of symptoms in the dictionary')
+
+    def user_symptoms(self, symptom_ids, n, seed):
+        rnd = random.Random(seed)
+        now = int(time.time())
+        return [
+            dict(
+                symptom_id=rnd.choice(symptom_ids),
+                timestamp=now - i * 60 - rnd.randrange(60),
+                timezone='+0300',
+                latitude=round(55 + rnd.random(), 4),
+                longitude=round(37 + rnd.random(), 4),
+            ) for i in range(n)
+        ]
+
+    def post(self, body, content_type):
+        request = RequestFactory().post(URL, data=body, content_type=content_type)
+        response = ApiAddUserSymptom.as_view()(request, auth=False)
+        if response.status_code != 200:
+            raise Exception('%s: %s' % (response.status_code, response.data))
+        return response.data
+
+    def old_insert(self, incognito_id, user_symptoms):
+        """
+        Как было: по одному симптому, эфемериды загружаются на каждый
+        """
+        incognitouser = ApiAddUserSymptom().get_incognitouser(dict(incognito_id=incognito_id))
+        usersymptom_ids = []
+        for user_symptom in user_symptoms:
+            symptom = Symptom.objects.get(pk=user_symptom['symptom_id'])
+            Misc._skyfield = None
+            usersymptom = UserSymptom.objects.create(
+                incognitouser=incognitouser,
+                symptom=symptom,
+                insert_timestamp=user_symptom['timestamp'],
+                latitude=user_symptom['latitude'],
+                longitude=user_symptom['longitude'],
+                timezone=int(user_symptom['timezone']),
+            )
+            usersymptom_ids.append(usersymptom.pk)
+        SymptomStat.add_usersymptoms(usersymptom_ids)
+
+    def json_insert(self, incognito_id, user_symptoms, batch, partial=False):
+        for start in range(0, len(user_symptoms), batch):
+            data = dict(incognito_id=incognito_id, user_symptoms=user_symptoms[start:start + batch])
+            if partial:
+                data.update(partial=True)
+            self.post(json.dumps(data), 'application/json')
+
+    def ndjson_insert(self, incognito_id, user_symptoms):
+        lines = [json.dumps(dict(incognito_id=incognito_id))]
+        lines += [json.dumps(user_symptom) for user_symptom in user_symptoms]
+        return self.post('\n'.join(lines) + '\n', ApiAddUserSymptom.NDJSON_CONTENT_TYPE)
+
+    def report(self, title, n, took, extra=''):
+        print('%-28s %7s symptoms, %6.1f sec, %8.0f symptoms/sec%s' % (title + ':', n, took, n / took, extra))
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        group = SymptomGroup.objects.create(name='bench_add_user_symptoms')
+        symptom_ids = [
+            Symptom.objects.create(name='bench %s' % i, group=group, order=i).pk
+            for i in range(kwargs['symptoms'])
+        ]
+        stamp = int(time.time())
+        n, batch = kwargs['records'], kwargs['batch']
+        # Эфемериды загружены заранее: в замерах пакетной вставки их загрузки нет
+        Misc.skyfield()
+
+        user_symptoms = self.user_symptoms(symptom_ids, kwargs['old_records'], 1)
+        time_started = time.time()
+        self.old_insert('bench-old-%s' % stamp, user_symptoms)
+        self.report('one by one (old)', len(user_symptoms), time.time() - time_started)
+        Misc.skyfield()
+
+        user_symptoms = self.user_symptoms(symptom_ids, n, 2)
+        time_started = time.time()
+        self.json_insert('bench-json-%s' % stamp, user_symptoms, batch)
+        self.report('json, %s per request' % batch, n, time.time() - time_started)
+
+        user_symptoms = self.user_symptoms(symptom_ids, n, 3)
+        time_started = time.time()
+        self.json_insert('bench-partial-%s' % stamp, user_symptoms, batch, partial=True)
+        self.report('json partial', n, time.time() - time_started)
+
+        user_symptoms = self.user_symptoms(symptom_ids, n, 4)
+        incognito_id = 'bench-ndjson-%s' % stamp
+        time_started = time.time()
+        data = self.ndjson_insert(incognito_id, user_symptoms)
+        self.report('ndjson', n, time.time() - time_started, ', inserted %s' % data['count'])
+
+        time_started = time.time()
+        data = self.ndjson_insert(incognito_id, user_symptoms)
+        self.report('ndjson, same again', n, time.time() - time_started,
+                    ', duplicates %s' % len(data['duplicates']))
+
+        transaction.set_rollback(True)
@@ -0,0 +1,155 @@
+# bench_columnar.py
+#
+# Размер и время выдачи графа в колоночном формате (fmt=columnar,
+# contact/columnar.py) против обычного fmt=3d-force-graph, который
+# отдает JSONRenderer rest framework.
+#
+# Граф по умолчанию сгенерирован, без базы, узлы и связи как в
+# ApiProfileGenesisAll (withalone, dover): у узла id, uuid, username
+# из 10 случайных знаков, имя, фото (у части пользователей) с адресом
+# иконки, пол, is_dead; у связи source, target, thanks_count, attitude.
+# С --db граф берется из базы, ответом ApiProfileGenesisAll
+# (fmt=3d-force-graph, withalone, dover, rod).
+#
+# Размер: как есть, после gzip и, если установлен msgpack, при
+# pack=msgpack. Время: лучшее из --repeat, для колоночного формата
+# вместе с кодированием. Затем сколько байт в колоночном json
+# занимает каждая колонка: видно, что остается после упаковки.
+# Проверяется, что ColumnarGraph.decode() восстанавливает ответ.
+#
+# Параметры:
+#   --nodes     Сколько узлов, по умолчанию 20000
+#   --links     Сколько связей, по умолчанию 60000
+#   --photos    Доля узлов с фото, по умолчанию 0.6
+#   --repeat    Сколько раз повторить каждый замер
+#   --db        Граф из базы, а не сгенерированный
+
+import json, time, gzip, uuid, random
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from rest_framework.renderers import JSONRenderer
+
+from users.models import TelegramApiMixin
+from contact.views import ApiProfileGenesisAll
+from contact.columnar import ColumnarGraph, msgpack
+
+FIRST_NAMES = ('Иван', 'Петр', 'Сергей', 'Андрей', 'Мария', 'Анна', 'Елена', 'Ольга')
+LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов')
+USERNAME_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+def graph_generate(n_nodes, n_links, photos, seed=1):
+    """
+    Граф, как в ответе ApiProfileGenesisAll с fmt=3d-force-graph
+    """
+    rnd = random.Random(seed)
+    ids = sorted(rnd.sample(range(1, n_nodes * 5), n_nodes))
+    nodes = []
+    for pk in ids:
+        photo = ''
+        if rnd.random() < photos:
+            photo = 'https://api.blagodarie.org/thumb/profile-photo/%s/%02d/%02d/%s/img-%s.jpg/128x128~crop~12.jpg' % (
+                rnd.randrange(2020, 2025), rnd.randrange(1, 13), rnd.randrange(1, 29), pk, rnd.randrange(10 ** 6),
+            )
+        nodes.append(dict(
+            id=pk,
+            uuid=uuid.UUID(int=rnd.getrandbits(128), version=4),
+            username=''.join(rnd.choice(USERNAME_CHARS) for i in range(10)),
+            first_name='%s %s' % (rnd.choice(LAST_NAMES), rnd.choice(FIRST_NAMES)),
+            photo=photo,
+            gender=rnd.choice(('m', 'f', None)),
+            is_dead=rnd.random() < 0.05,
+        ))
+    pairs = set()
+    while len(pairs) < min(n_links, n_nodes * (n_nodes - 1)):
+        pairs.add(tuple(rnd.sample(ids, 2)))
+    links = [
+        dict(source=source, target=target, thanks_count=rnd.choice((0, 0, 0, 1, 2, 5)), attitude=rnd.choice('ttma'))
+        for source, target in pairs
+    ]
+    return dict(bot_username='bench_bot', nodes=nodes, links=links)
+
+class Command(BaseCommand):
+    help = 'Benchmark size and serialization time of the columnar graph format against 3d-force-graph json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=20000, help='number of nodes')
+        parser.add_argument('--links', type=int, default=60000, help='number of links')
+        parser.add_argument('--photos', type=float, default=0.6, help='share of nodes with a photo')
+        parser.add_argument('--repeat', type=int, default=5, help='runs of each measurement')
+        parser.add_argument('--db', action='store_true', help='take the graph from the database')
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            time_started = time.perf_counter()
+            result = func()
+            took = time.perf_counter() - time_started
+            if best is None or took < best:
+                best = took
+        return result, best
+
+    def db_graph(self):
+        get_bot_username = TelegramApiMixin.get_bot_username
+        TelegramApiMixin.get_bot_username = lambda self: 'bench_bot'
+        try:
+            request = RequestFactory().get('/api/profile_genesis/all', dict(
+                fmt='3d-force-graph', withalone='on', dover='on', rod='on',
+            ))
+            return ApiProfileGenesisAll.as_view()(request).data
+        finally:
+            TelegramApiMixin.get_bot_username = get_bot_username
+
+    def handle(self, *args, **kwargs):
+        repeat = kwargs['repeat']
+        if kwargs['db']:
+            data = self.db_graph()
+        else:
+            data = graph_generate(kwargs['nodes'], kwargs['links'], kwargs['photos'])
+        print('Nodes: %s, links: %s%s' % (len(data['nodes']), len(data['links']), ' (database)' if kwargs['db'] else ''))
+
+        request = RequestFactory().get('/api/profile_genesis/all', dict(fmt=ColumnarGraph.FMT))
+        results = [
+            ('3d-force-graph',) + self.measure(lambda: JSONRenderer().render(data), repeat),
+            ('columnar',) + self.measure(lambda: ColumnarGraph.response(request, data).content, repeat),
+        ]
+        if msgpack:
+            request_msgpack = RequestFactory().get('/api/profile_genesis/all', dict(
+                fmt=ColumnarGraph.FMT, pack='msgpack',
+            ))
+            results.append(('columnar msgpack',) + self.measure(
+                lambda: ColumnarGraph.response(request_msgpack, data).content, repeat,
+            ))
+        else:
+            print('msgpack is not installed, pack=msgpack skipped')
+        plain_size = len(results[0][1])
+        plain_gzip = len(gzip.compress(results[0][1]))
+        for title, content, took in results:
+            gzipped = len(gzip.compress(content))
+            print('%-18s %9.0f KB (x%4.1f), gzip %8.0f KB (x%4.1f), %7.1f ms' % (
+                title + ':', len(content) / 1024, plain_size / len(content),
+                gzipped / 1024, plain_gzip / gzipped, took * 1000,
+            ))
+
+        columnar = results[1][1]
+        encoded = json.loads(columnar)
+        print('Columnar json by column:')
+        for part in ('nodes', 'links'):
+            columns = dict(encoded[part]['columns'])
+            for key in ('source', 'target', 'flags'):
+                if key in encoded[part]:
+                    columns[key] = encoded[part][key]
+            for key, column in sorted(columns.items(), key=lambda item: -len(json.dumps(item[1]))):
+                size = len(json.dumps(column, ensure_ascii=False, separators=(',', ':',)).encode('utf-8'))
+                print('    %-5s %-12s %9.0f KB %5.1f%%  %s' % (
+                    part, key, size / 1024, size * 100.0 / len(columnar),
+                    next(iter(column)) if isinstance(column, dict) else type(column).__name__,
+                ))
+
+        expected = json.loads(results[0][1])
+        decoded, took = self.measure(lambda: ColumnarGraph.decode(json.loads(columnar)), repeat)
+        key = lambda link: (str(link['source']), str(link['target']))
+        ok = decoded['nodes'] == expected['nodes'] and \
+            sorted(decoded['links'], key=key) == sorted(expected['links'], key=key)
+        print('Decode: %.1f ms, round trip %s' % (took * 1000, 'ok' if ok else 'FAILED'))
@@ -0,0 +1,129 @@
+# bench_genesis_stream.py
+#
+# Замер памяти и времени выдачи всех профилей и связей
+# (ApiProfileGenesisAll, withalone, dover): потоком (stream=json,
+# stream=ndjson) против прежнего ответа, собранного в памяти целиком.
+#
+# Пользователи и связи доверия создаются в транзакции, которая
+# в конце откатывается. Ответ вычитывается, как при отдаче клиенту,
+# но никуда не пишется.
+#
+# Память: пиковый RSS процесса за время ответа сверх RSS до него
+# (опрос /proc/self/statm в отдельном потоке, только Linux), а с
+# --tracemalloc еще и пик выделенного python. tracemalloc замедляет
+# ответ в разы и сам занимает память. Потоковые ответы замеряются
+# первыми: освобожденное python память не всегда отдает системе.
+#
+# Параметры:
+#   --users     Сколько пользователей, по умолчанию 100000
+#   --links     Сколько связей доверия на пользователя, по умолчанию 2
+#   --fmt       d3js или 3d-force-graph (по умолчанию)
+#   --tracemalloc   Замерять и пик выделенного python
+
+import os, gc, time, random, threading, tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django.contrib.auth.models import User
+
+from users.models import Profile, TelegramApiMixin
+from contact.models import CurrentState
+from contact.views import ApiProfileGenesisAll
+
+class RssSampler(object):
+    """
+    Пиковый RSS процесса, пока открыт with
+    """
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def sample(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.start = self.peak = self.rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+class Command(BaseCommand):
+    help = 'Benchmark peak memory of streamed against buffered ApiProfileGenesisAll output'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000, help='number of users')
+        parser.add_argument('--links', type=int, default=2, help='trust links per user')
+        parser.add_argument('--fmt', default='3d-force-graph', choices=('d3js', '3d-force-graph'))
+        parser.add_argument('--tracemalloc', action='store_true', help='measure python peak allocation too')
+
+    def fill(self, n_users, n_links):
+        stamp = int(time.time())
+        users = User.objects.bulk_create([
+            User(username='bench_%s_%s' % (stamp, i), first_name='Bench %s' % i)
+            for i in range(n_users)
+        ], batch_size=5000)
+        Profile.objects.bulk_create([Profile(user=user) for user in users], batch_size=5000)
+        random.seed(1)
+        pairs = set()
+        while len(pairs) < min(n_links * n_users, n_users * (n_users - 1)):
+            user_from, user_to = random.sample(users, 2)
+            pairs.add((user_from.pk, user_to.pk,))
+        CurrentState.objects.bulk_create([
+            CurrentState(user_from_id=user_from_id, user_to_id=user_to_id, attitude=CurrentState.TRUST)
+            for user_from_id, user_to_id in pairs
+        ], batch_size=5000)
+        return len(pairs)
+
+    def measure(self, params, traced):
+        request = RequestFactory().get('/api/profile_genesis/all', params)
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+        size = 0
+        with RssSampler() as rss:
+            time_started = time.time()
+            response = ApiProfileGenesisAll.as_view()(request)
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    size += len(chunk)
+            else:
+                response.render()
+                size = len(response.content)
+            took = time.time() - time_started
+            del response
+        if traced:
+            traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return dict(took=took, size=size, rss=rss.peak - rss.start, traced=traced)
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        n_links = self.fill(kwargs['users'], kwargs['links'])
+        print('Users: %s, links: %s, fmt: %s' % (kwargs['users'], n_links, kwargs['fmt']))
+        params = dict(fmt=kwargs['fmt'], withalone='on', dover='on')
+        get_bot_username = TelegramApiMixin.get_bot_username
+        TelegramApiMixin.get_bot_username = lambda self: 'bench_bot'
+        try:
+            for title, stream in (('stream=ndjson', 'ndjson'), ('stream=json', 'json'), ('buffered', None)):
+                result = self.measure(dict(params, stream=stream) if stream else params, kwargs['tracemalloc'])
+                print('%-14s %6.1f sec, %7.1f MB out, peak RSS +%7.1f MB%s' % (
+                    title + ':', result['took'], result['size'] / 1e6, result['rss'] / 1e6,
+                    ', python peak %7.1f MB' % (result['traced'] / 1e6) if kwargs['tracemalloc'] else '',
+                ))
+        finally:
+            TelegramApiMixin.get_bot_username = get_bot_username
+        transaction.set_rollback(True)
@@ -0,0 +1,137 @@
+# bench_get_symptoms.py
+#
+# Замер справочника симптомов (ApiGetSymptoms): запросов в секунду
+# и запросов к базе на каждый. Справочник из кэша
+# (SymptomChecksumManage.get_catalog()), GET с ETag и ответом 304
+# против прежнего POST, который на каждый запрос читал из базы
+# контрольную сумму, а если она не совпала, то и весь справочник.
+#
+# Запросы:
+#   -   POST, как было: контрольная сумма и справочник из базы
+#   -   POST, из кэша: клиент с прежней контрольной суммой (весь
+#       справочник) и с текущей (changed: false)
+#   -   GET: без If-None-Match (весь справочник) и с ETag (304)
+# Запросы через RequestFactory, прямо в представление, без middleware,
+# ответ отрисовывается, как при отдаче клиенту.
+#
+# К справочнику в базе добавляются --groups групп и --symptoms
+# симптомов в транзакции, которая в конце откатывается. Кэш справочника
+# заполняется ими, а в конце чистится: процессы перечитают справочник
+# из базы.
+#
+# Параметры:
+#   --requests  Сколько запросов каждого вида, по умолчанию 2000
+#   --groups    Сколько групп симптомов добавить, по умолчанию 20
+#   --symptoms  Сколько симптомов добавить, по умолчанию 300
+
+import json, time
+
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from django.db import transaction, connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework import status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+from app.utils import ServiceException
+from contact.models import SymptomGroup, Symptom, SymptomChecksumManage
+from contact.views import ApiGetSymptoms
+
+URL = '/api/getsymptoms'
+
+class OldApiGetSymptoms(APIView):
+    """
+    Как было: контрольная сумма и справочник из базы на каждый запрос
+    """
+
+    def post(self, request):
+        try:
+            if 'checksum' not in request.data:
+                raise ServiceException('Не задана checksum')
+            checksum_got = request.data.get("checksum")
+            checksum_here = SymptomChecksumManage.get_symptoms_checksum().value
+            changed = checksum_got != checksum_here
+            data = dict(changed=changed)
+            if changed:
+                data.update(checksum=checksum_here)
+                data.update(SymptomChecksumManage.get_symptoms_dict())
+            status_code = status.HTTP_200_OK
+        except ServiceException as excpt:
+            data = dict(message=excpt.args[0])
+            status_code = status.HTTP_400_BAD_REQUEST
+        return Response(data=data, status=status_code)
+
+class Command(BaseCommand):
+    help = 'Benchmark the symptom dictionary: cached GET with ETag and 304 against the old POST'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='number of requests of each kind')
+        parser.add_argument('--groups', type=int, default=20, help='number of symptom groups to add')
+        parser.add_argument('--symptoms', type=int, default=300, help='number of symptoms to add')
+
+    def fill(self, n_groups, n_symptoms):
+        stamp = int(time.time())
+        groups = [
+            SymptomGroup.objects.create(name='bench_get_symptoms %s %s' % (stamp, i))
+            for i in range(max(1, n_groups))
+        ]
+        Symptom.objects.bulk_create([
+            Symptom(name='bench_get_symptoms %s %s' % (stamp, i), group=groups[i % len(groups)], order=i)
+            for i in range(n_symptoms)
+        ])
+        SymptomChecksumManage.compute_checksum()
+        # compute_checksum() обновит кэш только после commit, а его не будет
+        return SymptomChecksumManage.set_catalog(
+            SymptomChecksumManage.get_symptoms_checksum().value,
+            SymptomChecksumManage.get_symptoms_dict(),
+        )
+
+    def run(self, title, view, make_request, n_requests):
+        size = 0
+        with CaptureQueriesContext(connection) as queries:
+            time_started = time.perf_counter()
+            for i in range(n_requests):
+                response = view(make_request())
+                response.render()
+                size = len(response.content)
+            took = time.perf_counter() - time_started
+        print('%-34s %8.0f req/sec, %5.2f ms, status %s, %7s bytes, %4.1f db queries per request' % (
+            title + ':', n_requests / took, took * 1000 / n_requests,
+            response.status_code, size, len(queries) / n_requests,
+        ))
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        factory = RequestFactory()
+        n = kwargs['requests']
+        try:
+            catalog = self.fill(kwargs['groups'], kwargs['symptoms'])
+            print('Symptom groups: %s, symptoms: %s' % (
+                len(catalog['data']['symptom_groups']), len(catalog['data']['symptoms']),
+            ))
+            etag = '"%s"' % catalog['checksum']
+            old_view = OldApiGetSymptoms.as_view()
+            view = ApiGetSymptoms.as_view()
+
+            def post(checksum):
+                return lambda: factory.post(
+                    URL, data=json.dumps(dict(checksum=checksum)), content_type='application/json',
+                )
+
+            self.run('POST, old, stale checksum', old_view, post('stale'), n)
+            self.run('POST, old, current checksum', old_view, post(catalog['checksum']), n)
+            self.run('POST, cached, stale checksum', view, post('stale'), n)
+            self.run('POST, cached, current checksum', view, post(catalog['checksum']), n)
+            self.run('GET', view, lambda: factory.get(URL), n)
+            self.run('GET, If-None-Match: ETag', view, lambda: factory.get(URL, HTTP_IF_NONE_MATCH=etag), n)
+        finally:
+            cache.delete_many((
+                SymptomChecksumManage.SYMPTOM_CHECKSUM_CACHE_KEY,
+                SymptomChecksumManage.SYMPTOM_CATALOG_CACHE_KEY,
+                SymptomChecksumManage.SYMPTOM_IDS_CACHE_KEY,
+            ))
+            SymptomChecksumManage._catalog = dict(checksum=None, data=None)
+        transaction.set_rollback(True)
@@ -0,0 +1,110 @@
+# bench_graph_links.py
+#
+# Замер времени построения связей графа: CurrentState.graph_links()
+# против прежнего прохода по объектам CurrentState с обращением
+# к user_from, user_to. Связи (и пользователи для них) создаются
+# в транзакции, которая в конце откатывается.
+#
+# Параметры:
+#   --links     Сколько связей создать, по умолчанию 10000
+#   --repeat    Сколько раз повторить замер, берется лучший
+
+import time, random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection, reset_queries
+from django.contrib.auth.models import User
+
+from contact.models import CurrentState
+
+class Command(BaseCommand):
+    help = 'Benchmark CurrentState.graph_links() against per-object link building'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--links', type=int, default=10000, help='number of links to create')
+        parser.add_argument('--repeat', type=int, default=3, help='take the best of this number of runs')
+
+    def links_old(self, qs):
+        """
+        Как прежний ApiMeetgamers.make_cs()
+        """
+        links = []
+        for cs in qs.distinct():
+            link_pattern = dict(source=cs.user_from.pk, target=cs.user_to.pk)
+            if cs.attitude is not None and not cs.is_reverse:
+                link = link_pattern.copy()
+                link.update(attitude=cs.attitude)
+                links.append(link)
+            if cs.is_invite_meet and not cs.is_invite_meet_reverse:
+                link = link_pattern.copy()
+                link.update(is_invite_meet=True)
+                links.append(link)
+            if cs.is_sympa and not cs.is_sympa_reverse and cs.is_sympa_confirmed:
+                link = link_pattern.copy()
+                link.update(is_sympa=True)
+                links.append(link)
+            if cs.is_hide_meet:
+                link = link_pattern.copy()
+                link.update(is_hide_meet=True)
+                links.append(link)
+            # Как прежний get_shortest_path(), через data_dict(show_child=True)
+            if cs.is_father or cs.is_mother:
+                link = link_pattern.copy()
+                link.update(is_child=cs.is_child)
+                links.append(link)
+        return links
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            reset_queries()
+            time_started = time.time()
+            result = func()
+            took = time.time() - time_started
+            if best is None or took < best[0]:
+                best = (took, len(connection.queries), result)
+        return best
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        n_links = kwargs['links']
+        n_users = max(2, n_links // 10)
+        random.seed(1)
+        stamp = int(time.time())
+        users = User.objects.bulk_create([
+            User(username='bench_%s_%s' % (stamp, i), is_active=False) for i in range(n_users)
+        ])
+        pairs = set()
+        while len(pairs) < n_links:
+            user_from, user_to = random.sample(users, 2)
+            pairs.add((user_from.pk, user_to.pk,))
+        CurrentState.objects.bulk_create([
+            CurrentState(
+                user_from_id=user_from_id,
+                user_to_id=user_to_id,
+                attitude=random.choice((CurrentState.TRUST, CurrentState.ACQ, None,)),
+                is_invite_meet=random.random() < 0.1,
+                is_sympa=random.random() < 0.1,
+                is_sympa_confirmed=True,
+                is_hide_meet=random.random() < 0.05,
+                is_father=random.random() < 0.05,
+            ) for user_from_id, user_to_id in pairs
+        ], batch_size=5000)
+        qs = CurrentState.objects.filter(user_from__in=users)
+
+        debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        try:
+            old = self.measure(lambda: self.links_old(qs), kwargs['repeat'])
+            new = self.measure(
+                lambda: CurrentState.graph_links(qs, kinds=CurrentState.LINK_KINDS_MEET + (CurrentState.LINK_CHILD,)),
+                kwargs['repeat'],
+            )
+        finally:
+            connection.force_debug_cursor = debug_cursor
+        key = lambda link: sorted(link.items())
+        same = sorted(old[2], key=key) == sorted(new[2], key=key)
+        print('Links in database: %s, links built: %s, same result: %s' % (n_links, len(new[2]), same))
+        print('CurrentState objects: %.3f sec, %s queries' % (old[0], old[1]))
+        print('graph_links():        %.3f sec, %s queries' % (new[0], new[1]))
+        transaction.set_rollback(True)
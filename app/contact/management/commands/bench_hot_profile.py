@@ -0,0 +1,147 @@
+# bench_hot_profile.py
+#
+# Нагрузочный тест одновременных операций доверия, недоверия,
+# знакомства и отмены отношения к одному и тому же профилю
+# (ApiAddOperationMixin.add_operation(), как в ApiAddOperationView:
+# в транзакции, профиль, к кому операция, под select_for_update).
+#
+# Счетчики профиля: изменение на разницу (Profile.apply_attitude_delta())
+# против прежнего пересчета по CurrentState (recount_trust_fame())
+# при каждой операции. После каждого замера счетчики профиля сверяются
+# с CurrentState.
+#
+# Запросы из --threads потоков, у каждого свое соединение с базой.
+# Потому пользователи создаются не в транзакции, а удаляются в конце.
+#
+# Параметры:
+#   --threads   Сколько потоков, по умолчанию 16
+#   --ops       Сколько операций в каждом потоке, по умолчанию 200
+#   --users     Сколько пользователей с операциями у каждого потока,
+#               по умолчанию 20
+#   --base      Сколько доверий у профиля до замера, по умолчанию 10000
+
+import time, random, threading
+
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+from django.contrib.auth.models import User
+
+from app.utils import ServiceException
+from users.models import Profile
+from contact.models import CurrentState, OperationType, ApiAddOperationMixin
+
+OPERATIONS = (
+    OperationType.TRUST, OperationType.MISTRUST,
+    OperationType.ACQ, OperationType.NULLIFY_ATTITUDE,
+)
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class Command(BaseCommand):
+    help = 'Load test of concurrent trust operations on one hot profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='number of threads')
+        parser.add_argument('--ops', type=int, default=200, help='operations in each thread')
+        parser.add_argument('--users', type=int, default=20, help='users with operations in each thread')
+        parser.add_argument('--base', type=int, default=10000, help='trusts the profile has before the run')
+
+    def create_users(self, prefix, n):
+        users = User.objects.bulk_create([
+            User(username='%s_%s' % (prefix, i), first_name='Bench %s' % i, is_active=False)
+            for i in range(n)
+        ], batch_size=5000)
+        Profile.objects.bulk_create([Profile(user=user) for user in users], batch_size=5000)
+        return users
+
+    def worker(self, hot_pk, user_ids, n_ops, seed, results):
+        rnd = random.Random(seed)
+        mixin = ApiAddOperationMixin()
+        users = dict((user.pk, user) for user in User.objects.select_related('profile').filter(pk__in=user_ids))
+        latencies, errors = [], 0
+        try:
+            for i in range(n_ops):
+                user_from = users[rnd.choice(user_ids)]
+                operationtype_id = rnd.choice(OPERATIONS)
+                time_started = time.perf_counter()
+                try:
+                    with transaction.atomic():
+                        profile_to = Profile.objects.select_for_update().select_related('user').get(user__pk=hot_pk)
+                        mixin.add_operation(user_from, profile_to, operationtype_id, None, int(time.time()))
+                except ServiceException:
+                    # Уже есть такое отношение или нечего отменять
+                    errors += 1
+                latencies.append(time.perf_counter() - time_started)
+        finally:
+            connection.close()
+        results.append((latencies, errors))
+
+    def drift(self, profile):
+        profile.refresh_from_db()
+        qs = CurrentState.objects.filter(user_to=profile.user, is_reverse=False)
+        expected = dict(
+            trust_count=qs.filter(attitude=CurrentState.TRUST).count(),
+            mistrust_count=qs.filter(attitude=CurrentState.MISTRUST).count(),
+            acq_count=qs.filter(attitude=CurrentState.ACQ).count(),
+        )
+        return dict(
+            (f, (getattr(profile, f), v)) for f, v in expected.items() if getattr(profile, f) != v
+        )
+
+    def run(self, title, hot, user_ids, kwargs):
+        results = []
+        threads = [
+            threading.Thread(
+                target=self.worker,
+                args=(hot.user.pk, user_ids[n], kwargs['ops'], n, results),
+            ) for n in range(kwargs['threads'])
+        ]
+        time_started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        took = time.time() - time_started
+        latencies = [latency for result in results for latency in result[0]]
+        errors = sum(result[1] for result in results)
+        print('%-24s %7.1f ops/sec, p50 %7.1f ms, p99 %7.1f ms, already: %s, drift: %s' % (
+            title, len(latencies) / took, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, errors, self.drift(hot) or 'none',
+        ))
+
+    def handle(self, *args, **kwargs):
+        prefix = 'bench_hot_%s' % int(time.time())
+        n_threads, n_users = kwargs['threads'], kwargs['users']
+        hot_user = self.create_users(prefix + '_hot', 1)[0]
+        hot = Profile.objects.select_related('user').get(user=hot_user)
+        created = [hot_user]
+        try:
+            base = self.create_users(prefix + '_base', kwargs['base'])
+            created += base
+            CurrentState.objects.bulk_create([
+                CurrentState(user_from=user, user_to=hot_user, attitude=CurrentState.TRUST)
+                for user in base
+            ], batch_size=5000)
+            hot.recount_trust_fame()
+            users = self.create_users(prefix + '_from', n_threads * n_users)
+            created += users
+            user_ids = [[user.pk for user in users[n * n_users:(n + 1) * n_users]] for n in range(n_threads)]
+            print('Threads: %s, operations: %s, profile trusts before: %s' % (
+                n_threads, n_threads * kwargs['ops'], kwargs['base'],
+            ))
+
+            self.run('apply_attitude_delta():', hot, user_ids, kwargs)
+
+            # Как было: пересчет по CurrentState и запись профиля
+            apply_attitude_delta = Profile.apply_attitude_delta
+            Profile.apply_attitude_delta = lambda self, attitude_previous, attitude: self.recount_trust_fame()
+            try:
+                self.run('recount_trust_fame():', hot, user_ids, kwargs)
+            finally:
+                Profile.apply_attitude_delta = apply_attitude_delta
+        finally:
+            User.objects.filter(pk__in=[user.pk for user in created]).delete()
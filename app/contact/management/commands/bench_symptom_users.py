@@ -0,0 +1,138 @@
+# bench_symptom_users.py
+#
+# Замер ApiGetStats(only=users): прежний подсчет пользователей
+# distinct по всем почасовым счетчикам UserSymptomStat против
+# SymptomTotal.counts(). Еще: сколько добавляет SymptomTotal
+# к добавлению симптомов (SymptomStat.add_usersymptoms()).
+#
+# Счетчики (--rows записей UserSymptomStat от --users пользователей
+# инкогнито) вставляются одним запросом в транзакции, которая в конце
+# откатывается. 50 млн записей вставляются десятки минут и требуют
+# места на диске под таблицу и ее индексы.
+#
+# Параметры:
+#   --rows      Сколько записей UserSymptomStat, по умолчанию 50000000
+#   --users     Сколько пользователей инкогнито, по умолчанию 1000000
+#   --adds      Сколько раз добавить симптомы, по умолчанию 200
+#   --batch     Сколько симптомов за раз, по умолчанию 10
+#   --repeat    Сколько раз повторить замер подсчета, берется лучший
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+
+from contact.models import SymptomGroup, Symptom, UserSymptom, SymptomStat, \
+                           UserSymptomStat, SymptomUser, SymptomTotal
+from users.models import IncognitoUser
+
+class Command(BaseCommand):
+    help = 'Benchmark the count of users with symptoms: distinct over counters against SymptomTotal'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000000, help='number of UserSymptomStat rows')
+        parser.add_argument('--users', type=int, default=1000000, help='number of incognito users')
+        parser.add_argument('--adds', type=int, default=200, help='number of symptom additions to time')
+        parser.add_argument('--batch', type=int, default=10, help='symptoms per addition')
+        parser.add_argument('--repeat', type=int, default=3, help='take the best of this number of runs')
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            time_started = time.time()
+            result = func()
+            took = time.time() - time_started
+            if best is None or took < best[0]:
+                best = (took, result)
+        return best
+
+    def fill(self, symptom, n_rows, n_users):
+        stamp = int(time.time())
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO users_incognitouser (private_key, insert_timestamp, update_timestamp)
+                SELECT %s || i, %s, %s FROM generate_series(0, %s - 1) i
+            """, ['bench-%s-' % stamp, stamp, stamp, n_users])
+            cursor.execute("""
+                CREATE TEMPORARY TABLE bench_users ON COMMIT DROP AS
+                SELECT row_number() OVER (ORDER BY id) - 1 AS n, id
+                FROM users_incognitouser WHERE private_key LIKE %s
+            """, ['bench-%s-%%' % stamp])
+            cursor.execute('CREATE INDEX ON bench_users (n)')
+            # У каждого пользователя свой час на каждую запись: счетчики не совпадают
+            cursor.execute("""
+                INSERT INTO %(table)s (incognitouser_id, symptom_id, hour, moon_day, local_hour, count)
+                SELECT u.id, %%s, (i / %%s) * 3600, 0, 0, 1
+                FROM generate_series(0, %%s - 1) i JOIN bench_users u ON u.n = i %%%% %%s
+            """ % dict(table=UserSymptomStat._meta.db_table), [symptom.pk, n_users, n_rows, n_users])
+            cursor.execute("""
+                INSERT INTO %(user_table)s (incognitouser_id) SELECT id FROM bench_users
+                ON CONFLICT DO NOTHING
+            """ % dict(user_table=SymptomUser._meta.db_table))
+            cursor.execute("""
+                INSERT INTO %(table)s (id, users, symptoms)
+                VALUES (%%s, (SELECT count(*) FROM %(user_table)s), %%s)
+                ON CONFLICT (id) DO UPDATE SET users = EXCLUDED.users, symptoms = EXCLUDED.symptoms
+            """ % dict(
+                table=SymptomTotal._meta.db_table,
+                user_table=SymptomUser._meta.db_table,
+            ), [SymptomTotal.ID, n_rows])
+            cursor.execute('ANALYZE %s' % UserSymptomStat._meta.db_table)
+            cursor.execute('SELECT id FROM bench_users ORDER BY n LIMIT %s', [n_users])
+            return [row[0] for row in cursor.fetchall()]
+
+    def add_symptoms(self, symptom, user_ids, n_adds, batch, with_total):
+        """
+        Время добавления симптомов к счетчикам, с SymptomTotal или без
+        """
+        took = 0
+        timestamp = int(time.time())
+        for i in range(n_adds):
+            # Половина добавлений от новых пользователей
+            incognitouser = IncognitoUser.objects.create(
+                private_key='bench-add-%s-%s-%s' % (timestamp, with_total, i)
+            ) if i % 2 else None
+            usersymptoms = UserSymptom.objects.bulk_create([
+                UserSymptom(
+                    incognitouser_id=incognitouser.pk if incognitouser else user_ids[(i * batch + j) % len(user_ids)],
+                    symptom=symptom,
+                    insert_timestamp=timestamp + i,
+                    moon_day=0,
+                ) for j in range(batch)
+            ])
+            ids = [usersymptom.pk for usersymptom in usersymptoms]
+            time_started = time.time()
+            if with_total:
+                SymptomStat.add_usersymptoms(ids)
+            else:
+                with connection.cursor() as cursor:
+                    for model in SymptomStat.stat_models():
+                        cursor.execute(model.insert_select('id = ANY(%s)'), [ids])
+            took += time.time() - time_started
+        return took / n_adds
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        n_rows, n_users = kwargs['rows'], max(1, min(kwargs['users'], kwargs['rows']))
+        group = SymptomGroup.objects.create(name='bench_symptom_users')
+        symptom = Symptom.objects.create(name='bench_symptom_users', group=group, order=1)
+
+        time_started = time.time()
+        user_ids = self.fill(symptom, n_rows, n_users)
+        print('Inserted %s counters of %s users in %.1f sec' % (n_rows, n_users, time.time() - time_started))
+
+        old = self.measure(
+            lambda: UserSymptomStat.objects.all().distinct('incognitouser').count(),
+            kwargs['repeat'],
+        )
+        new = self.measure(SymptomTotal.counts, kwargs['repeat'])
+        print('distinct over UserSymptomStat: %9.1f ms, users: %s' % (old[0] * 1000, old[1]))
+        print('SymptomTotal.counts():         %9.1f ms, users: %s' % (new[0] * 1000, new[1]['users']))
+
+        if kwargs['adds']:
+            without_total = self.add_symptoms(symptom, user_ids, kwargs['adds'], kwargs['batch'], False)
+            with_total = self.add_symptoms(symptom, user_ids, kwargs['adds'], kwargs['batch'], True)
+            print('Add %s symptoms to counters: %.2f ms, with SymptomTotal: %.2f ms' % (
+                kwargs['batch'], without_total * 1000, with_total * 1000,
+            ))
+        transaction.set_rollback(True)
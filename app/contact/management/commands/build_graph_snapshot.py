@@ -0,0 +1,39 @@
+# build_graph_snapshot.py
+#
+# Построить снимок всего графа для 3d-force-graph фронта,
+# см. contact/snapshot.py. Запускать по cron, например, раз в 5 минут,
+# чаще, чем settings.GRAPH_SNAPSHOT_MAX_AGE
+#
+# Параметры:
+#   --api-root  Полный адрес api, для ссылок на фото,
+#               по умолчанию settings.GRAPH_SNAPSHOT_API_ROOT
+#   --full      Перечитать все связи, а не только изменения.
+#               Удаленные связи убираются и без него, раз в час
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from contact.snapshot import GraphSnapshot
+
+class Command(BaseCommand):
+    help = 'Build 3d-force-graph snapshot of all users and links in settings.GRAPH_SNAPSHOT_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--api-root', type=str, default=settings.GRAPH_SNAPSHOT_API_ROOT,
+            help='full url of api, e.g. https://api.blagodarie.org, for photo links')
+        parser.add_argument('--full', action='store_true', help='rebuild all links, not only changed')
+
+    def handle(self, *args, **kwargs):
+        if not settings.GRAPH_SNAPSHOT_ROOT:
+            print('settings.GRAPH_SNAPSHOT_ROOT is not set')
+            exit()
+        if not kwargs['api_root']:
+            print('Neither --api-root nor settings.GRAPH_SNAPSHOT_API_ROOT is set')
+            exit()
+        time_started = time.time()
+        version, changed_count = GraphSnapshot().build(kwargs['api_root'], full=kwargs['full'])
+        print('Snapshot version %s, links re-read: %s, took %.1f sec' % (
+            version, changed_count, time.time() - time_started,
+        ))
@@ -0,0 +1,62 @@
+# rebuild_symptom_stats.py
+#
+# Перестроить почасовые счетчики симптомов (SymptomStat, UserSymptomStat)
+# и итоги (SymptomTotal) по всем UserSymptom. Запускать после миграций
+# 0098_symptom_stats, 0099_symptom_total, и если счетчики разошлись
+# с симптомами (например, симптомы удаляли из админки).
+#
+# Перестраивается порциями по --window-days дней, каждая в своей
+# транзакции: на это время добавление симптомов ждет.
+#
+# Параметры:
+#   --window-days   Сколько дней симптомов в одной порции, по умолчанию 30
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max
+from django.db.models.query_utils import Q
+
+from contact.models import UserSymptom, SymptomStat, UserSymptomStat, SymptomTotal
+
+class Command(BaseCommand):
+    help = 'Rebuild hourly symptom counters used by symptom statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window-days', type=int, default=30, help='days of symptoms per transaction')
+
+    def handle(self, *args, **kwargs):
+        time_started = time.time()
+        window = max(kwargs['window_days'], 1) * 24 * 3600
+        bounds = UserSymptom.objects.aggregate(time_min=Min('insert_timestamp'), time_max=Max('insert_timestamp'))
+        if bounds['time_min'] is None:
+            with transaction.atomic():
+                for model in SymptomStat.stat_models():
+                    model.objects.all().delete()
+                SymptomTotal.rebuild()
+            print('No symptoms')
+            return
+        time_from = (bounds['time_min'] // 3600) * 3600
+        time_to = (bounds['time_max'] // 3600) * 3600 + 3600
+
+        with transaction.atomic():
+            for model in SymptomStat.stat_models():
+                model.objects.filter(Q(hour__lt=time_from) | Q(hour__gte=time_to)).delete()
+
+        t = time_from
+        while t < time_to:
+            with transaction.atomic():
+                SymptomStat.rebuild(t, min(t + window, time_to))
+            t += window
+            print('Rebuilt up to %s' % time.strftime('%Y-%m-%d', time.gmtime(min(t, time_to))))
+
+        with transaction.atomic():
+            SymptomTotal.rebuild()
+
+        print('Counters: %s, per user: %s, totals: %s, took %.1f sec' % (
+            SymptomStat.objects.count(),
+            UserSymptomStat.objects.count(),
+            SymptomTotal.counts(),
+            time.time() - time_started,
+        ))
@@ -0,0 +1,53 @@
+# Полнотекстовый поиск по возможностям и желаниям:
+# хранимый tsvector, GIN индекс, триггер в базе, заполнение имеющихся
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+TRIGGER_SQL = """
+    CREATE TRIGGER %(table)s_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF text ON %(table)s
+    FOR EACH ROW EXECUTE FUNCTION
+    tsvector_update_trigger(search_vector, 'pg_catalog.russian', text);
+    UPDATE %(table)s SET search_vector = to_tsvector('pg_catalog.russian', text);
+"""
+
+TRIGGER_REVERSE_SQL = """
+    DROP TRIGGER IF EXISTS %(table)s_search_vector_trigger ON %(table)s;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact', '0096_journal_offer_answer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ability',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='wish',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ability',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='ability_search_vector_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='wish',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='wish_search_vector_gin'),
+        ),
+        migrations.RunSQL(
+            TRIGGER_SQL % dict(table='contact_ability'),
+            TRIGGER_REVERSE_SQL % dict(table='contact_ability'),
+        ),
+        migrations.RunSQL(
+            TRIGGER_SQL % dict(table='contact_wish'),
+            TRIGGER_REVERSE_SQL % dict(table='contact_wish'),
+        ),
+    ]
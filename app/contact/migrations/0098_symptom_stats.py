@@ -0,0 +1,45 @@
+# Почасовые счетчики симптомов для статистики.
+# Заполняются командой ./manage.py rebuild_symptom_stats
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0059_profile_geo_point_gist'),
+        ('contact', '0097_wish_ability_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SymptomStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.BigIntegerField(db_index=True, verbose_name='Час')),
+                ('moon_day', models.IntegerField(verbose_name='День лунного календаря')),
+                ('local_hour', models.IntegerField(verbose_name='Час местного времени')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Число симптомов')),
+                ('symptom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contact.symptom', verbose_name='Симптом')),
+            ],
+            options={
+                'unique_together': {('symptom', 'hour', 'moon_day', 'local_hour')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UserSymptomStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.BigIntegerField(db_index=True, verbose_name='Час')),
+                ('moon_day', models.IntegerField(verbose_name='День лунного календаря')),
+                ('local_hour', models.IntegerField(verbose_name='Час местного времени')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Число симптомов')),
+                ('incognitouser', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.incognitouser', verbose_name='Пользователь инкогнито')),
+                ('symptom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contact.symptom', verbose_name='Симптом')),
+            ],
+            options={
+                'unique_together': {('incognitouser', 'symptom', 'hour', 'moon_day', 'local_hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Всего пользователей с симптомами и симптомов для статистики.
+# Заполняются командой ./manage.py rebuild_symptom_stats
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0059_profile_geo_point_gist'),
+        ('contact', '0098_symptom_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SymptomTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('users', models.PositiveIntegerField(default=0, verbose_name='Пользователей с симптомами')),
+                ('symptoms', models.BigIntegerField(default=0, verbose_name='Симптомов')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SymptomUser',
+            fields=[
+                ('incognitouser', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='users.incognitouser', verbose_name='Пользователь инкогнито')),
+            ],
+        ),
+    ]
@@ -5,10 +5,13 @@ from collections import OrderedDict
 from app.utils import Misc, ServiceException
 
 from django.conf import settings
-from django.db import models, connection
+from django.core.cache import cache
+from django.db import models, connection, transaction
 from django.utils.translation import gettext_lazy as _
 from django.db.models.query_utils import Q
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.indexes import GinIndex
 
 from django.contrib.auth.models import User
 
@@ -20,6 +23,8 @@ from django.contrib.auth.models import User
 #
 from app.models import BaseModelInsertTimestamp, BaseModelInsertUpdateTimestamp, \
                        GeoPointModel, GenderMixin
+from contact.graph import GenesisGraph, TrustGraph
+from users.profile_cache import ProfileCache
 
 class KeyType(models.Model):
 
@@ -267,13 +272,96 @@ class CurrentState(BaseModelInsertUpdateTimestamp):
             result.update(is_hide_meet=self.is_hide_meet)
         return result
 
+    # Виды связей для graph_links()
+    #
+    LINK_ATTITUDE = 'attitude'
+    LINK_INVITE_MEET = 'invite_meet'
+    LINK_SYMPA = 'sympa'
+    LINK_HIDE_MEET = 'hide_meet'
+    LINK_CHILD = 'child'
+
+    LINK_KINDS_MEET = (LINK_ATTITUDE, LINK_INVITE_MEET, LINK_SYMPA, LINK_HIDE_MEET, )
+
+    GRAPH_LINK_FIELDS = (
+        'user_from_id', 'user_to_id', 'attitude', 'thanks_count', 'is_reverse',
+        'is_invite_meet', 'is_invite_meet_reverse',
+        'is_sympa', 'is_sympa_reverse', 'is_sympa_confirmed',
+        'is_hide_meet', 'is_father', 'is_mother', 'is_child',
+    )
+
+    @classmethod
+    def graph_links(cls, qs, kinds=(LINK_ATTITUDE,), show_thanks=False):
+        """
+        Связи для графов в формате 3d-force-graph (source, target: id пользователей)
+
+        Одним запросом, без выборки объектов CurrentState и без обращений
+        к user_from, user_to: только значения полей из qs.values_list().
+        Из одной записи может получиться несколько связей, по одной на вид:
+            LINK_ATTITUDE:      {attitude: ...}, (и thanks_count, если show_thanks),
+                                если есть отношение и запись не обратная
+            LINK_INVITE_MEET:   {is_invite_meet: True}, прямое приглашение в игру знакомств
+            LINK_SYMPA:         {is_sympa: True}, прямая подтвержденная симпатия
+            LINK_HIDE_MEET:     {is_hide_meet: True}
+            LINK_CHILD:         {is_child: ...}, родственная связь, как data_dict(show_child=True)
+        """
+        links = []
+        for (
+            user_from_id, user_to_id, attitude, thanks_count, is_reverse,
+            is_invite_meet, is_invite_meet_reverse,
+            is_sympa, is_sympa_reverse, is_sympa_confirmed,
+            is_hide_meet, is_father, is_mother, is_child,
+        ) in qs.filter(user_to__isnull=False).values_list(*cls.GRAPH_LINK_FIELDS).distinct():
+            for kind in kinds:
+                if kind == cls.LINK_ATTITUDE:
+                    if attitude is None or is_reverse:
+                        continue
+                    link = dict(source=user_from_id, target=user_to_id)
+                    if show_thanks:
+                        link.update(thanks_count=thanks_count)
+                    link.update(attitude=attitude)
+                elif kind == cls.LINK_INVITE_MEET:
+                    if not is_invite_meet or is_invite_meet_reverse:
+                        continue
+                    link = dict(source=user_from_id, target=user_to_id, is_invite_meet=True)
+                elif kind == cls.LINK_SYMPA:
+                    if not is_sympa or is_sympa_reverse or not is_sympa_confirmed:
+                        continue
+                    link = dict(source=user_from_id, target=user_to_id, is_sympa=True)
+                elif kind == cls.LINK_HIDE_MEET:
+                    if not is_hide_meet:
+                        continue
+                    link = dict(source=user_from_id, target=user_to_id, is_hide_meet=True)
+                elif kind == cls.LINK_CHILD:
+                    if not is_father and not is_mother:
+                        continue
+                    link = dict(source=user_from_id, target=user_to_id, is_child=is_child)
+                else:
+                    continue
+                links.append(link)
+        return links
+
     class Meta:
         unique_together = (
             ('user_from', 'user_to', ),
             ('user_from', 'anytext', ),
         )
 
-class Key(BaseModelInsertTimestamp):
+class ProfileCacheOwnerMixin(object):
+    """
+    Запись, удаление меняют данные профиля владельца: сброс его в ProfileCache
+    """
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        ProfileCache.on_commit_users_changed((self.owner_id,))
+
+    def delete(self, *args, **kwargs):
+        owner_id = self.owner_id
+        result = super().delete(*args, **kwargs)
+        ProfileCache.on_commit_users_changed((owner_id,))
+        return result
+
+class Key(ProfileCacheOwnerMixin, BaseModelInsertTimestamp):
 
     owner = models.ForeignKey('auth.User', verbose_name=_("Владелец"), on_delete=models.CASCADE)
     type = models.ForeignKey(KeyType, on_delete=models.CASCADE)
@@ -300,6 +388,42 @@ class SymptomChecksumManage(object):
     """
     SYMPTOM_CHECKSUM_CLASS = 'symptom'
 
+    # id всех симптомов, в кэше django. Сбрасывается в compute_checksum(),
+    # то есть при любом изменении симптомов и их групп
+    #
+    SYMPTOM_IDS_CACHE_KEY = 'symptom_ids'
+
+    # Справочник симптомов для ApiGetSymptoms: в кэше django (общем
+    # для процессов) и в памяти процесса. Ключ справочника -- значение
+    # контрольной суммы из Checksum. В кэше django отдельно лежит
+    # контрольная сумма, по ней процесс проверяет свою копию справочника,
+    # не читая справочник из кэша и не обращаясь к таблицам.
+    # Всё обновляется в compute_checksum()
+    #
+    SYMPTOM_CHECKSUM_CACHE_KEY = 'symptom_checksum'
+    SYMPTOM_CATALOG_CACHE_KEY = 'symptom_catalog'
+    _catalog = dict(checksum=None, data=None)
+
+    # Сколько секунд всё это живет в кэше django. compute_checksum()
+    # пишет в кэш только после commit, но get_catalog() и get_symptom_ids()
+    # могут прочитать базу внутри транзакции, которую потом откатят
+    #
+    CACHE_TIMEOUT = 3600
+
+    @classmethod
+    def get_symptom_ids(cls, symptom_ids=()):
+        """
+        Множество id всех симптомов, из кэша
+
+        Если кого-то из symptom_ids нет в кэше, кэш перечитывается:
+        симптомы могли добавить мимо save(), например, миграцией
+        """
+        result = cache.get(cls.SYMPTOM_IDS_CACHE_KEY)
+        if result is None or not set(symptom_ids) <= result:
+            result = set(Symptom.objects.values_list('pk', flat=True))
+            cache.set(cls.SYMPTOM_IDS_CACHE_KEY, result, cls.CACHE_TIMEOUT)
+        return result
+
     @classmethod
     def get_symptoms_checksum(cls):
         checksum, created_ = Checksum.objects.get_or_create(
@@ -334,8 +458,51 @@ class SymptomChecksumManage(object):
         all_dict['symptoms'] = symptoms
         return all_dict
 
+    @classmethod
+    def set_catalog(cls, checksum, data):
+        """
+        Положить справочник симптомов с его контрольной суммой в кэши
+        """
+        catalog = dict(checksum=checksum, data=data)
+        cache.set_many({
+            cls.SYMPTOM_CATALOG_CACHE_KEY: catalog,
+            cls.SYMPTOM_CHECKSUM_CACHE_KEY: checksum,
+        }, cls.CACHE_TIMEOUT)
+        SymptomChecksumManage._catalog = catalog
+        return catalog
+
+    @classmethod
+    def get_catalog(cls):
+        """
+        Справочник симптомов: dict(checksum=..., data=get_symptoms_dict())
+
+        Сначала из памяти процесса, если его контрольная сумма совпадает
+        с той, что в кэше django, затем из кэша django, в последнюю
+        очередь из базы
+        """
+        checksum = cache.get(cls.SYMPTOM_CHECKSUM_CACHE_KEY)
+        catalog = SymptomChecksumManage._catalog
+        if checksum is not None and catalog['checksum'] == checksum:
+            return catalog
+        if checksum is not None:
+            catalog = cache.get(cls.SYMPTOM_CATALOG_CACHE_KEY)
+            if catalog and catalog['checksum'] == checksum:
+                SymptomChecksumManage._catalog = catalog
+                return catalog
+        return cls.set_catalog(
+            cls.get_symptoms_checksum().value,
+            cls.get_symptoms_dict(),
+        )
+
     @classmethod
     def compute_checksum(cls):
+        """
+        Пересчитать контрольную сумму симптомов и обновить кэши
+
+        Кэши обновляются после commit транзакции, в которой изменены
+        симптомы: при откате в кэше останется прежний справочник
+        """
+        cache.delete(SymptomChecksumManage.SYMPTOM_IDS_CACHE_KEY)
         checksum = SymptomChecksumManage.get_symptoms_checksum()
         all_dict = SymptomChecksumManage.get_symptoms_dict()
         all_str = json.dumps(all_dict, separators=(',', ':',), ensure_ascii=False)
@@ -344,6 +511,12 @@ class SymptomChecksumManage(object):
             checksum.value = md5sum
             checksum.save()
 
+        def update_cache():
+            cache.delete(SymptomChecksumManage.SYMPTOM_IDS_CACHE_KEY)
+            SymptomChecksumManage.set_catalog(md5sum, all_dict)
+
+        transaction.on_commit(update_cache)
+
 class Checksum(models.Model):
 
     name = models.CharField(_("Класс"), max_length=255, unique=True, editable=False)
@@ -425,12 +598,238 @@ class UserSymptom(BaseModelInsertTimestamp, GeoPointModel):
             self.moon_day = Misc.get_moon_day(self.insert_timestamp)
         return super(UserSymptom, self).save(*args, **kwargs)
 
-class Wish(BaseModelInsertUpdateTimestamp):
+class BaseSymptomStat(models.Model):
+    """
+    Почасовые счетчики симптомов (UserSymptom) для статистики, ApiGetStats
+
+    hour:       начало часа insert_timestamp, в секундах
+    moon_day:   moon_day симптомов
+    local_hour: час суток по местному времени симптомов, 0..23
+
+    Пополняются при добавлении симптомов (add_usersymptoms), в той же
+    транзакции. Перестраиваются командой rebuild_symptom_stats
+    """
+
+    class Meta:
+        abstract = True
+
+    symptom = models.ForeignKey(Symptom, verbose_name=_("Симптом"), on_delete=models.CASCADE)
+    hour = models.BigIntegerField(_("Час"), db_index=True)
+    moon_day = models.IntegerField(_("День лунного календаря"))
+    local_hour = models.IntegerField(_("Час местного времени"))
+    count = models.PositiveIntegerField(_("Число симптомов"), default=0)
+
+    # Разрезы, по которым считаются счетчики, кроме symptom
+    #
+    KEY_COLUMNS = ('symptom_id', 'hour', 'moon_day', 'local_hour',)
+
+    # Больше любого insert_timestamp: для перестроения за все время
+    #
+    TIME_MAX = 2 ** 62
+
+    # Как в базе считаются hour, local_hour из contact_usersymptom
+    #
+    HOUR_SQL = '(insert_timestamp / 3600) * 3600'
+    LOCAL_HOUR_SQL = '((insert_timestamp + timezone * 3600/100 + (timezone %% 100) * 60)/3600) %% 24'
+
+    @classmethod
+    def key_columns(cls):
+        return cls.KEY_COLUMNS
+
+    @classmethod
+    def insert_select(cls, where):
+        """
+        Добавить к счетчикам симптомы из contact_usersymptom, отобранные по where
+        """
+        columns = ', '.join(cls.key_columns())
+        select = ', '.join(
+            '%s AS hour' % cls.HOUR_SQL if c == 'hour' else \
+            '%s AS local_hour' % cls.LOCAL_HOUR_SQL if c == 'local_hour' else c \
+            for c in cls.key_columns()
+        )
+        return """
+            INSERT INTO %(table)s (%(columns)s, count)
+            SELECT %(select)s, count(*)
+            FROM contact_usersymptom
+            WHERE %(where)s
+            GROUP BY %(columns)s
+            ON CONFLICT (%(columns)s) DO UPDATE
+            SET count = %(table)s.count + EXCLUDED.count
+        """ % dict(
+            table=cls._meta.db_table,
+            columns=columns,
+            select=select,
+            where=where,
+        )
+
+class SymptomStat(BaseSymptomStat):
+    """
+    Почасовые счетчики симптомов всех пользователей
+    """
+
+    class Meta:
+        unique_together = ('symptom', 'hour', 'moon_day', 'local_hour', )
+
+    @classmethod
+    def stat_models(cls):
+        return (SymptomStat, UserSymptomStat,)
+
+    @classmethod
+    def add_usersymptoms(cls, usersymptom_ids):
+        """
+        Добавить к счетчикам только что вставленные симптомы
+        """
+        if not usersymptom_ids:
+            return
+        with connection.cursor() as cursor:
+            for model in cls.stat_models():
+                cursor.execute(model.insert_select('id = ANY(%s)'), [list(usersymptom_ids)])
+            SymptomTotal.add_usersymptoms(cursor, usersymptom_ids)
+
+    @classmethod
+    def rebuild(cls, time_from, time_to, symptom_ids=None):
+        """
+        Перестроить счетчики симптомов с insert_timestamp от time_from до time_to,
+        (оба кратны часу), возможно только по symptom_ids
+
+        Вызывать в транзакции. Пока строится, добавление симптомов ждет:
+        иначе добавленный в это время симптом попал бы и в add_usersymptoms(),
+        и в перестроение
+        """
+        where = 'insert_timestamp >= %s AND insert_timestamp < %s'
+        parms = [time_from, time_to]
+        q = Q(hour__gte=time_from, hour__lt=time_to)
+        if symptom_ids is not None:
+            where += ' AND symptom_id = ANY(%s)'
+            parms.append(list(symptom_ids))
+            q &= Q(symptom__pk__in=symptom_ids)
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE contact_usersymptom IN SHARE MODE')
+            for model in cls.stat_models():
+                model.objects.filter(q).delete()
+                cursor.execute(model.insert_select(where), parms)
+
+class UserSymptomStat(BaseSymptomStat):
+    """
+    Почасовые счетчики симптомов по пользователям инкогнито
+    """
+
+    class Meta:
+        unique_together = ('incognitouser', 'symptom', 'hour', 'moon_day', 'local_hour', )
+
+    incognitouser = models.ForeignKey('users.IncognitoUser',
+                                      verbose_name=_("Пользователь инкогнито"),
+                                      on_delete=models.CASCADE)
+
+    @classmethod
+    def key_columns(cls):
+        return ('incognitouser_id',) + cls.KEY_COLUMNS
+
+class SymptomUser(models.Model):
+    """
+    Пользователи инкогнито, у которых есть симптомы: по ним
+    считается SymptomTotal.users
+    """
+
+    incognitouser = models.OneToOneField('users.IncognitoUser',
+                                         primary_key=True,
+                                         verbose_name=_("Пользователь инкогнито"),
+                                         on_delete=models.CASCADE)
+
+class SymptomTotal(models.Model):
+    """
+    Всего пользователей с симптомами и симптомов, одна запись (pk=ID)
+
+    Для ApiGetStats(only=users), вместо distinct по всем счетчикам.
+    Пополняется в add_usersymptoms(), в той же транзакции, что и
+    симптомы. Перестраивается командой rebuild_symptom_stats
+    """
+
+    ID = 1
+
+    users = models.PositiveIntegerField(_("Пользователей с симптомами"), default=0)
+    symptoms = models.BigIntegerField(_("Симптомов"), default=0)
+
+    @classmethod
+    def add_usersymptoms(cls, cursor, usersymptom_ids):
+        """
+        Добавить только что вставленные симптомы. Новые пользователи:
+        те, кого еще не было в SymptomUser. Если тот же новый пользователь
+        добавляется в параллельной транзакции, insert ждет ее commit
+        и не вставляет ничего
+        """
+        cursor.execute("""
+            WITH new_users AS (
+                INSERT INTO %(user_table)s (incognitouser_id)
+                SELECT DISTINCT incognitouser_id
+                FROM contact_usersymptom
+                WHERE id = ANY(%%s) AND incognitouser_id IS NOT NULL
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            )
+            INSERT INTO %(table)s (id, users, symptoms)
+            VALUES (%%s, (SELECT count(*) FROM new_users), %%s)
+            ON CONFLICT (id) DO UPDATE
+            SET users = %(table)s.users + EXCLUDED.users,
+                symptoms = %(table)s.symptoms + EXCLUDED.symptoms
+        """ % dict(
+            table=cls._meta.db_table,
+            user_table=SymptomUser._meta.db_table,
+        ), [list(usersymptom_ids), cls.ID, len(usersymptom_ids)])
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Перестроить по всем UserSymptom. Вызывать в транзакции
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE contact_usersymptom IN SHARE MODE')
+            cursor.execute('DELETE FROM %s' % SymptomUser._meta.db_table)
+            cursor.execute("""
+                INSERT INTO %(user_table)s (incognitouser_id)
+                SELECT DISTINCT incognitouser_id
+                FROM contact_usersymptom
+                WHERE incognitouser_id IS NOT NULL
+            """ % dict(user_table=SymptomUser._meta.db_table))
+            cursor.execute("""
+                INSERT INTO %(table)s (id, users, symptoms)
+                VALUES (
+                    %%s,
+                    (SELECT count(*) FROM %(user_table)s),
+                    (SELECT count(*) FROM contact_usersymptom)
+                )
+                ON CONFLICT (id) DO UPDATE
+                SET users = EXCLUDED.users, symptoms = EXCLUDED.symptoms
+            """ % dict(
+                table=cls._meta.db_table,
+                user_table=SymptomUser._meta.db_table,
+            ), [cls.ID])
+
+    @classmethod
+    def counts(cls):
+        total = cls.objects.filter(pk=cls.ID).first()
+        return dict(
+            users=total.users if total else 0,
+            symptoms=total.symptoms if total else 0,
+        )
+
+class Wish(ProfileCacheOwnerMixin, BaseModelInsertUpdateTimestamp):
 
     uuid = models.UUIDField(default=uuid4, editable=False, primary_key=True)
     owner = models.ForeignKey('auth.User', verbose_name=_("Владелец"), on_delete=models.CASCADE)
     text = models.TextField(verbose_name=_("Текст"), db_index=True)
 
+    # to_tsvector('russian', text), для полнотекстового поиска.
+    # Заполняется триггером в базе при insert, update,
+    # см. миграцию contact 0097_wish_ability_search_vector
+    #
+    search_vector = SearchVectorField(editable=False, null=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='wish_search_vector_gin'),
+        ]
+
     def data_dict(self):
         return dict(
         uuid=str(self.uuid),
@@ -438,12 +837,23 @@ class Wish(BaseModelInsertUpdateTimestamp):
         last_edit=self.update_timestamp,
     )
 
-class Ability(BaseModelInsertUpdateTimestamp):
+class Ability(ProfileCacheOwnerMixin, BaseModelInsertUpdateTimestamp):
 
     uuid = models.UUIDField(default=uuid4, editable=False, primary_key=True)
     owner = models.ForeignKey('auth.User', verbose_name=_("Владелец"), on_delete=models.CASCADE)
     text = models.TextField(verbose_name=_("Текст"), db_index=True)
 
+    # to_tsvector('russian', text), для полнотекстового поиска.
+    # Заполняется триггером в базе при insert, update,
+    # см. миграцию contact 0097_wish_ability_search_vector
+    #
+    search_vector = SearchVectorField(editable=False, null=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='ability_search_vector_gin'),
+        ]
+
     def data_dict(self):
         return dict(
             uuid=str(self.uuid),
@@ -515,6 +925,9 @@ class ApiAddOperationMixin(object):
         already_code = 'already'
         profile_from = user_from.profile
 
+        # Данные обоих в кэше профилей после commit неверны
+        ProfileCache.on_commit_users_changed((user_from.pk, user_to.pk,))
+
         if operationtype_id == OperationType.THANK:
             currentstate, created_ = CurrentState.objects.select_for_update().get_or_create(
                 user_from=user_from,
@@ -531,8 +944,7 @@ class ApiAddOperationMixin(object):
                 thanks_count=currentstate.thanks_count,
                 attitude=currentstate.attitude,
             ))
-            profile_to.sum_thanks_count += 1
-            profile_to.save()
+            profile_to.add_sum_thanks_count(1)
 
         elif operationtype_id == OperationType.ACQ:
             attitude_previous = None
@@ -569,7 +981,7 @@ class ApiAddOperationMixin(object):
                 reverse_cs.attitude = CurrentState.ACQ
                 reverse_cs.save()
 
-            profile_to.recount_trust_fame()
+            profile_to.apply_attitude_delta(attitude_previous, CurrentState.ACQ)
             data.update(currentstate=dict(
                 thanks_count=currentstate.thanks_count,
                 attitude=currentstate.attitude,
@@ -610,7 +1022,7 @@ class ApiAddOperationMixin(object):
                 reverse_cs.attitude = CurrentState.MISTRUST
                 reverse_cs.save()
 
-            profile_to.recount_trust_fame()
+            profile_to.apply_attitude_delta(attitude_previous, CurrentState.MISTRUST)
             data.update(currentstate=dict(
                 thanks_count=currentstate.thanks_count,
                 attitude=currentstate.attitude,
@@ -651,7 +1063,7 @@ class ApiAddOperationMixin(object):
                 reverse_cs.attitude = CurrentState.TRUST
                 reverse_cs.save()
 
-            profile_to.recount_trust_fame()
+            profile_to.apply_attitude_delta(attitude_previous, CurrentState.TRUST)
             data.update(currentstate=dict(
                 thanks_count=currentstate.thanks_count,
                 attitude=currentstate.attitude,
@@ -691,9 +1103,8 @@ class ApiAddOperationMixin(object):
                 reverse_cs.save()
 
             if attitude_previous == CurrentState.TRUST:
-                profile_to.sum_thanks_count += 1
-            profile_to.save()
-            profile_to.recount_trust_fame()
+                profile_to.add_sum_thanks_count(1)
+            profile_to.apply_attitude_delta(attitude_previous, CurrentState.TRUST)
             data.update(currentstate=dict(
                 thanks_count=currentstate.thanks_count,
                 attitude=currentstate.attitude,
@@ -716,7 +1127,8 @@ class ApiAddOperationMixin(object):
                 raise ServiceException(err_message, already_code)
             else:
                 # TRUST, MISTRUST или ACQ
-                data.update(previousstate=dict(attitude=currentstate.attitude))
+                attitude_previous = currentstate.attitude
+                data.update(previousstate=dict(attitude=attitude_previous))
                 currentstate.update_timestamp = update_timestamp
                 currentstate.attitude = None
                 currentstate.save()
@@ -728,7 +1140,7 @@ class ApiAddOperationMixin(object):
                     attitude__isnull=False,
                 ).update(attitude=None, update_timestamp=update_timestamp)
 
-                profile_to.recount_trust_fame()
+                profile_to.apply_attitude_delta(attitude_previous, None)
                 data.update(currentstate=dict(
                     thanks_count=currentstate.thanks_count,
                     attitude=None,
@@ -768,6 +1180,7 @@ class ApiAddOperationMixin(object):
                     is_father=False,
                     is_mother=False,
                     is_child=False,
+                    update_timestamp=update_timestamp,
                 )
                 q_to = Q(user_to=user_from, is_child=True) & ~Q(user_from=user_to)
                 if is_father:
@@ -778,6 +1191,7 @@ class ApiAddOperationMixin(object):
                     is_father=False,
                     is_mother=False,
                     is_child=False,
+                    update_timestamp=update_timestamp,
                 )
             else:
                 try:
@@ -822,6 +1236,11 @@ class ApiAddOperationMixin(object):
                 reverse_cs.is_mother = is_mother
                 reverse_cs.save()
 
+            # Графы родства в процессах перечитают связи этих двоих
+            # и тех, с кем у них были связи, после commit
+            #
+            transaction.on_commit(lambda: GenesisGraph.users_changed((user_from.pk, user_to.pk,)))
+
         elif operationtype_id == OperationType.NOT_PARENT:
             q = Q(user_from=user_from, user_to=user_to, is_child=False)
             q &= Q(is_mother=True) | Q(is_father=True)
@@ -844,6 +1263,7 @@ class ApiAddOperationMixin(object):
                 is_child=False,
                 update_timestamp=update_timestamp,
             )
+            transaction.on_commit(lambda: GenesisGraph.users_changed((user_from.pk, user_to.pk,)))
 
         elif operationtype_id == OperationType.SET_SYMPA:
             if profile_from.r_sympa and profile_from.r_sympa != user_to:
@@ -1052,6 +1472,12 @@ class ApiAddOperationMixin(object):
         else:
             raise ServiceException('Неизвестный operation_type_id')
 
+        if operationtype_id in (
+                OperationType.ACQ, OperationType.MISTRUST, OperationType.TRUST,
+                OperationType.TRUST_OR_THANK, OperationType.NULLIFY_ATTITUDE,
+           ):
+            transaction.on_commit(lambda: TrustGraph.users_changed((user_from.pk, user_to.pk,)))
+
         journal = Journal.objects.create(
             user_from=user_from,
             user_to=user_to,
@@ -0,0 +1,313 @@
+"""
+Снимок (snapshot) всего графа для 3d-force-graph фронта
+
+Что отдает ApiProfileGenesisAll при fmt=3d-force-graph&withalone=on
+без from и number, с rod и/или dover, заранее сериализованное
+в json, сжатое gzip и brotli (если установлен brotli), в папке
+settings.GRAPH_SNAPSHOT_ROOT. Строится командой build_graph_snapshot,
+например, по cron.
+
+Связи перестраиваются по изменениям: перечитываются только те
+записи CurrentState, у которых update_timestamp не раньше предыдущего
+построения. Поэтому всякое изменение связи в CurrentState, в т.ч.
+через queryset.update(), должно менять и update_timestamp. Удаленные
+записи находятся сверкой pk связей, раз в PKS_CHECK_INTERVAL и при
+полном построении. Узлы (профили) строятся каждый раз полностью:
+у профиля нет отметки времени изменения. Связи, у которых нет
+хотя бы одного из узлов, отбрасываются при каждом построении.
+
+Файлы в settings.GRAPH_SNAPSHOT_ROOT:
+    meta.json                       версия (время построения), etag вариантов
+    state.pickle                    связи с предыдущего построения
+    <вариант>-<версия>.json[.gz|.br]
+"""
+
+import os, time, json, gzip, hashlib, pickle
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.conf import settings
+from django.db.models.query_utils import Q
+from django.http import FileResponse, HttpResponseNotModified
+from django.core.serializers.json import DjangoJSONEncoder
+from django.apps import apps
+get_model = apps.get_model
+
+from users.models import Profile, TelegramApiMixin
+
+class SnapshotRequest(object):
+    """
+    Вместо request при построении снимка: для полных адресов фото
+    """
+    def __init__(self, api_root):
+        self.api_root = api_root.rstrip('/')
+
+    def build_absolute_uri(self, path):
+        return self.api_root + path
+
+class GraphSnapshot(object):
+
+    FMT = '3d-force-graph'
+
+    # Варианты: (имя, rod, dover)
+    #
+    VARIANTS = (
+        ('nodes', False, False,),
+        ('rod', True, False,),
+        ('dover', False, True,),
+        ('rod-dover', True, True,),
+    )
+
+    META_FNAME = 'meta.json'
+    STATE_FNAME = 'state.pickle'
+
+    # Сжатия и расширения файлов для них, в порядке предпочтения
+    #
+    ENCODINGS = (('br', '.br',), ('gzip', '.gz',),)
+
+    CHUNK_SIZE = 2000
+
+    # Записи CurrentState, измененные в транзакции, что началась до
+    # предыдущего построения, а закончилась после, могут иметь
+    # update_timestamp немного раньше since. Перечитываем с запасом
+    #
+    SINCE_MARGIN = 60
+
+    # Как часто сверять pk связей, чтобы убрать удаленные записи, секунд
+    #
+    PKS_CHECK_INTERVAL = 3600
+
+    def __init__(self, root=None):
+        self.root = root or settings.GRAPH_SNAPSHOT_ROOT
+
+    def path(self, fname):
+        return os.path.join(self.root, fname)
+
+    def variant_fname(self, variant, version):
+        return '%s-%s.json' % (variant, version,)
+
+    def read_meta(self):
+        try:
+            with open(self.path(self.META_FNAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError,):
+            return None
+
+    def write_file(self, fname, content, mode='wb'):
+        """
+        Записать файл атомарно: сначала во временный
+        """
+        path = self.path(fname)
+        with open(path + '.tmp', mode) as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def q_connections(cls, rod, dover):
+        # Как в ApiProfileGenesisAll
+        q = Q(pk=0)
+        if rod:
+            q = Q(is_child=True)
+        if dover:
+            q |= Q(attitude__isnull=False, user_to__isnull=False, is_reverse=False)
+        return q
+
+    @classmethod
+    def link_dict(cls, row, rod, dover):
+        """
+        Как CurrentState.data_dict() для 3d-force-graph
+        """
+        pk, user_from_id, user_to_id, is_child, attitude, is_reverse, thanks_count = row
+        result = dict(source=user_from_id, target=user_to_id)
+        if rod:
+            result.update(is_child=is_child)
+        if dover:
+            result.update(thanks_count=thanks_count, attitude=attitude)
+        return result
+
+    @classmethod
+    def row_matches(cls, row, rod, dover):
+        pk, user_from_id, user_to_id, is_child, attitude, is_reverse, thanks_count = row
+        return rod and is_child or \
+               dover and attitude is not None and user_to_id is not None and not is_reverse
+
+    def update_links(self, state, full=False):
+        """
+        Обновить связи в state: {'since': timestamp, 'pks_checked': timestamp, 'rows': {pk: row}}
+
+        Перечитываются записи CurrentState с update_timestamp не раньше
+        since, все, а не только подходящие под q_connections(): запись
+        могла перестать быть связью. Удаленные записи не имеют отметки
+        времени, их находим сверкой одних pk связей, при full или
+        не реже, чем раз в PKS_CHECK_INTERVAL.
+        Возвращает (state, число перечитанных записей)
+        """
+        CurrentState = get_model('contact', 'CurrentState')
+        rows = dict() if full else state.get('rows', dict())
+        since = 0 if full or not rows else state.get('since', 0)
+        pks_checked = 0 if full else state.get('pks_checked', 0)
+        time_started = int(time.time())
+
+        changed_count = 0
+        for row in CurrentState.objects.filter(
+                    self.q_connections(True, True) if not since else Q(update_timestamp__gte=since)
+                ).values_list(
+                    'pk', 'user_from_id', 'user_to_id', 'is_child', 'attitude', 'is_reverse', 'thanks_count',
+                ).iterator(chunk_size=self.CHUNK_SIZE):
+            changed_count += 1
+            if self.row_matches(row, True, True):
+                rows[row[0]] = row
+            else:
+                rows.pop(row[0], None)
+
+        if since and time_started - pks_checked >= self.PKS_CHECK_INTERVAL:
+            current_pks = set(CurrentState.objects.filter(
+                self.q_connections(True, True)
+            ).values_list('pk', flat=True).iterator(chunk_size=self.CHUNK_SIZE))
+            for pk in list(rows.keys()):
+                if pk not in current_pks:
+                    del rows[pk]
+            pks_checked = time_started
+        elif not since:
+            pks_checked = time_started
+
+        return dict(
+            since=time_started - self.SINCE_MARGIN,
+            pks_checked=pks_checked,
+            rows=rows,
+        ), changed_count
+
+    def nodes(self, request):
+        profiles = []
+        for profile in Profile.objects.select_related('user').filter(
+                    user__is_superuser=False,
+                ).distinct().iterator(chunk_size=self.CHUNK_SIZE):
+            profiles.append(profile)
+            if len(profiles) >= self.CHUNK_SIZE:
+                yield from Profile.data_dicts(profiles, request=request, fmt=self.FMT)
+                profiles = []
+        if profiles:
+            yield from Profile.data_dicts(profiles, request=request, fmt=self.FMT)
+
+    def build(self, api_root, full=False):
+        """
+        Построить снимок. Возвращает (версия, число перечитанных связей)
+
+        Если ни один вариант не изменился, новая версия не пишется
+        """
+        os.makedirs(self.root, exist_ok=True)
+        state = dict()
+        if not full:
+            try:
+                with open(self.path(self.STATE_FNAME), 'rb') as f:
+                    state = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError,):
+                pass
+        state, changed_count = self.update_links(state, full=full)
+
+        request = SnapshotRequest(api_root)
+        nodes = list(self.nodes(request))
+        bot_username = TelegramApiMixin().get_bot_username()
+        # Связь с удаленным (или ставшим суперпользователем) профилем
+        # остается в state до сверки pk, но в снимок не попадает
+        node_ids = set(node['id'] for node in nodes)
+        rows = sorted(
+            row for row in state['rows'].values()
+            if row[1] in node_ids and row[2] in node_ids
+        )
+
+        meta_old = self.read_meta() or dict()
+        version = int(time.time())
+        variants = dict()
+        contents = dict()
+        for variant, rod, dover in self.VARIANTS:
+            links = [self.link_dict(row, rod, dover) for row in rows if self.row_matches(row, rod, dover)]
+            content = json.dumps(
+                dict(bot_username=bot_username, nodes=nodes, links=links),
+                cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':',),
+            ).encode('utf-8')
+            variants[variant] = dict(etag=hashlib.sha1(content).hexdigest())
+            contents[variant] = content
+
+        if meta_old.get('variants') == variants and not full:
+            # Ничего не изменилось, старые файлы остаются
+            version = meta_old['version']
+        else:
+            for variant, content in contents.items():
+                fname = self.variant_fname(variant, version)
+                self.write_file(fname, content)
+                self.write_file(fname + '.gz', gzip.compress(content))
+                if brotli:
+                    self.write_file(fname + '.br', brotli.compress(content))
+            self.write_file(self.META_FNAME, json.dumps(dict(
+                version=version, variants=variants,
+                encodings=[encoding for encoding, ext in self.ENCODINGS if encoding != 'br' or brotli],
+            )), mode='w')
+            self.remove_old(version, meta_old.get('version'))
+
+        # Связи сохраняем и тогда, когда снимок не изменился: since сдвинулось
+        self.write_file(self.STATE_FNAME, pickle.dumps(state))
+        return version, changed_count
+
+    def remove_old(self, *versions):
+        """
+        Удалить файлы вариантов, кроме версий versions
+
+        Предыдущую версию оставляем: ее может еще отдавать
+        запрос, прочитавший старый meta.json
+        """
+        keep = set(self.variant_fname(variant, version) for version in versions if version \
+                   for variant, rod, dover in self.VARIANTS)
+        for fname in os.listdir(self.root):
+            if not fname.endswith(('.json', '.json.gz', '.json.br',)) or fname == self.META_FNAME:
+                continue
+            if fname.rsplit('.json', 1)[0] + '.json' not in keep:
+                try:
+                    os.remove(self.path(fname))
+                except OSError:
+                    pass
+
+    def response(self, request):
+        """
+        Ответ из снимка на запрос к ApiProfileGenesisAll или None,
+        если снимок не подходит для запроса, устарел или его нет
+        """
+        if not self.root:
+            return None
+        get = request.GET
+        if get.get('fmt') != self.FMT or not get.get('withalone') or \
+           get.get('from') is not None or get.get('number') is not None or get.get('stream'):
+            return None
+        rod, dover = bool(get.get('rod')), bool(get.get('dover'))
+        variant = [v for v, v_rod, v_dover in self.VARIANTS if (v_rod, v_dover) == (rod, dover)][0]
+        meta = self.read_meta()
+        if not meta or time.time() - meta['version'] > settings.GRAPH_SNAPSHOT_MAX_AGE:
+            return None
+        etag = '"%s"' % meta['variants'][variant]['etag']
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [e.strip() for e in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response = HttpResponseNotModified()
+        else:
+            fname = self.variant_fname(variant, meta['version'])
+            accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+            accepted = set(e.split(';')[0].strip() for e in accept_encoding.split(','))
+            content_encoding = None
+            for encoding, ext in self.ENCODINGS:
+                if encoding in accepted and encoding in meta.get('encodings', ()):
+                    content_encoding = encoding
+                    fname += ext
+                    break
+            try:
+                f = open(self.path(fname), 'rb')
+            except OSError:
+                return None
+            response = FileResponse(f, content_type='application/json')
+            if content_encoding:
+                response['Content-Encoding'] = content_encoding
+        response['ETag'] = etag
+        response['Vary'] = 'Accept-Encoding'
+        return response
@@ -1,3 +1,518 @@
-from django.test import TestCase
+import io, json, uuid
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, \
+                        override_settings
+from django.urls import resolve
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.contrib.auth.models import User
+
+from contact.models import CurrentState, SymptomGroup, Symptom, UserSymptom, \
+                           SymptomChecksumManage, SymptomTotal, Key, KeyType, Ability, Wish
+from users.models import CreateUserMixin
+from contact.graph import GenesisGraph, TrustGraph
+from contact.columnar import ColumnarGraph
+
+class SqlFunctionMixin(object):
+    """
+    Вызов рекурсивных postgresql функций поиска по связям
+
+    Функции создают временную таблицу tmp ... on commit delete rows,
+    у разных функций она разной структуры. Поэтому тесты с ними
+    в TransactionTestCase, где каждый запрос в своей транзакции,
+    и перед каждым вызовом таблица tmp удаляется.
+    """
+
+    def sql_rows(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('drop table if exists tmp')
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def sql_path_user_ids(self, sql, params):
+        result = set()
+        for rec in self.sql_rows(sql, params):
+            result.update(rec[0])
+        return result
+
+class GenesisGraphTest(SqlFunctionMixin, TransactionTestCase):
+    """
+    GenesisGraph дает те же результаты, что postgresql функции
+    find_genesis_tree, find_genesis_path_shortest, find_group_genesis_tree
+    """
+
+    DEPTHS = (1, 2, 3, 4, 6)
+
+    def setUp(self):
+        # Родословная с циклами: 6 -- отец 1 и сын 4, 4 -- сын 0, 0 -- сын 1;
+        # 7 и 8 -- отцы друг друга. 9 ни с кем не в родстве
+        #
+        self.u = [User.objects.create(username='genesis_%s' % i) for i in range(10)]
+        for child, parent, is_mother in (
+                (0, 1, False), (0, 2, True),
+                (3, 1, False), (3, 2, True),
+                (4, 0, False),
+                (5, 3, True),
+                (1, 6, False),
+                (6, 4, False),
+                (7, 8, False), (8, 7, False),
+            ):
+            self.parent(self.u[child], self.u[parent], is_mother)
+        self.graph = GenesisGraph()
+        self.graph.load()
+
+    def parent(self, child, parent, is_mother):
+        """
+        Связи родства в обе стороны, как их делает add_operation()
+        """
+        kwargs = dict(is_father=not is_mother, is_mother=is_mother)
+        CurrentState.objects.create(user_from=child, user_to=parent, is_child=False, **kwargs)
+        CurrentState.objects.create(user_from=parent, user_to=child, is_child=True, **kwargs)
+
+    def test_tree(self):
+        for user in self.u:
+            for depth in self.DEPTHS:
+                for v_all, v_is_child in ((True, False), (False, True), (False, False)):
+                    sql = sorted(self.sql_rows(
+                        'select level, user_from_id, user_to_id, is_father, is_mother, is_child '
+                        'from find_genesis_tree(%s, %s, %s, %s)',
+                        (user.pk, depth, v_all, v_is_child,)
+                    ))
+                    graph = sorted(
+                        (r['level'], r['user_from_id'], r['user_to_id'],
+                         r['is_father'], r['is_mother'], r['is_child'],)
+                        for r in self.graph.tree(user.pk, depth, v_all, v_is_child)
+                    )
+                    self.assertEqual(graph, sql, msg='user %s, depth %s, all %s, is_child %s' % (
+                        user.username, depth, v_all, v_is_child
+                    ))
+
+    def test_shortest_path(self):
+        for user_from in self.u:
+            for user_to in self.u:
+                if user_from == user_to:
+                    continue
+                for depth in self.DEPTHS:
+                    sql = self.sql_path_user_ids(
+                        'select path from find_genesis_path_shortest(%s, %s, %s) '
+                        'where path @> array[%s, %s]',
+                        (user_from.pk, user_to.pk, depth, user_from.pk, user_to.pk,)
+                    )
+                    self.assertEqual(
+                        self.graph.shortest_path_user_ids(user_from.pk, user_to.pk, depth),
+                        sql,
+                        msg='%s -> %s, depth %s' % (user_from.username, user_to.username, depth),
+                    )
+
+    def test_group(self):
+        for members in ((4, 5, 9), (0, 3), (5, 6), (0, 7), (1, 4, 8)):
+            user_page_pks = [self.u[i].pk for i in members]
+            for depth in self.DEPTHS:
+                sql = set()
+                for rec in self.sql_rows(
+                        'select path from find_group_genesis_tree(%s, %s) '
+                        'where path[array_length(path, 1)] = any(%s) '
+                        'and path[1] != path[array_length(path, 1)]',
+                        (user_page_pks, depth, user_page_pks,)
+                    ):
+                    sql.update(rec[0][1:-1])
+                self.assertEqual(
+                    self.graph.group_user_ids(user_page_pks, depth),
+                    sql,
+                    msg='members %s, depth %s' % (members, depth),
+                )
+
+class TrustGraphTest(SqlFunctionMixin, TransactionTestCase):
+    """
+    TrustGraph дает те же кратчайшие пути, что postgresql функция
+    find_trust_path_shortest
+    """
+
+    DEPTHS = (1, 2, 3, 4, 6)
+
+    def setUp(self):
+        # Цикл 0 -> 1 -> 2 -> 0, знакомства и обратные (is_reverse)
+        # связи, недоверие 1 -> 7 в путь не входит
+        #
+        self.u = [User.objects.create(username='trust_%s' % i) for i in range(8)]
+        for user_from, user_to, attitude, is_reverse in (
+                (0, 1, CurrentState.TRUST, False),
+                (1, 2, CurrentState.TRUST, False),
+                (2, 0, CurrentState.TRUST, False),
+                (2, 3, CurrentState.ACQ, False),
+                (3, 2, CurrentState.ACQ, True),
+                (0, 4, CurrentState.TRUST, False),
+                (4, 3, CurrentState.TRUST, False),
+                (3, 5, CurrentState.TRUST, False),
+                (5, 6, CurrentState.TRUST, False),
+                (6, 5, CurrentState.TRUST, True),
+                (1, 7, CurrentState.MISTRUST, False),
+                (7, 6, CurrentState.TRUST, False),
+            ):
+            CurrentState.objects.create(
+                user_from=self.u[user_from],
+                user_to=self.u[user_to],
+                attitude=attitude,
+                is_reverse=is_reverse,
+            )
+        self.graph = TrustGraph()
+        self.graph.load()
+
+    def test_shortest_path(self):
+        for user_from in self.u:
+            for user_to in self.u:
+                if user_from == user_to:
+                    continue
+                for depth in self.DEPTHS:
+                    sql = self.sql_path_user_ids(
+                        'select path from find_trust_path_shortest(%s, %s, %s) '
+                        'where path @> array[%s, %s]',
+                        (user_from.pk, user_to.pk, depth, user_from.pk, user_to.pk,)
+                    )
+                    self.assertEqual(
+                        self.graph.shortest_path_user_ids(user_from.pk, user_to.pk, depth),
+                        sql,
+                        msg='%s -> %s, depth %s' % (user_from.username, user_to.username, depth),
+                    )
+
+    def test_k_shortest_paths(self):
+        user_from, user_to = self.u[0].pk, self.u[6].pk
+        paths = self.graph.k_shortest_paths(user_from, user_to, 6, 5)
+        # 0-4-3-5-6, 0-1-2-3-5-6
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(paths[0], tuple(self.u[i].pk for i in (0, 4, 3, 5, 6)))
+        self.assertEqual(paths[1], tuple(self.u[i].pk for i in (0, 1, 2, 3, 5, 6)))
+        self.assertEqual(self.graph.k_shortest_paths(user_from, user_to, 3, 5), [])
+
+class GraphLinksTest(TestCase):
+    """
+    CurrentState.graph_links(): один запрос на любое число связей
+    """
+
+    def setUp(self):
+        u = [User.objects.create(username='links_%s' % i) for i in range(6)]
+        for user_from, user_to, kwargs in (
+                (0, 1, dict(attitude=CurrentState.TRUST, thanks_count=2)),
+                (1, 0, dict(attitude=CurrentState.TRUST, is_reverse=True)),
+                (2, 3, dict(is_invite_meet=True)),
+                (3, 2, dict(is_invite_meet=True, is_invite_meet_reverse=True)),
+                (3, 4, dict(is_sympa=True, is_sympa_confirmed=True, attitude=CurrentState.ACQ)),
+                (4, 3, dict(is_sympa=True, is_sympa_confirmed=True, is_sympa_reverse=True)),
+                (4, 5, dict(is_hide_meet=True)),
+                (5, 0, dict(is_sympa=True)),
+                # 0 -- отец 2, 1 -- бывшая мать 2
+                (2, 0, dict(is_father=True)),
+                (0, 2, dict(is_father=True, is_child=True)),
+                (2, 1, dict()),
+            ):
+            CurrentState.objects.create(user_from=u[user_from], user_to=u[user_to], **kwargs)
+        self.u = u
+
+    def test_num_queries(self):
+        for n in (10, 100):
+            users = [User.objects.create(username='links_more_%s_%s' % (n, i)) for i in range(n)]
+            CurrentState.objects.bulk_create([
+                CurrentState(user_from=users[i], user_to=users[(i + 1) % n], attitude=CurrentState.ACQ)
+                for i in range(n)
+            ])
+            with self.assertNumQueries(1):
+                links = CurrentState.graph_links(
+                    CurrentState.objects.filter(user_from__in=users),
+                    kinds=CurrentState.LINK_KINDS_MEET,
+                )
+            self.assertEqual(len(links), n)
+
+    def test_links(self):
+        u = self.u
+        links = CurrentState.graph_links(
+            CurrentState.objects.filter(user_from__in=u),
+            kinds=CurrentState.LINK_KINDS_MEET,
+        )
+        key = lambda link: sorted(link.items())
+        self.assertEqual(sorted(links, key=key), sorted([
+            dict(source=u[0].pk, target=u[1].pk, attitude=CurrentState.TRUST),
+            dict(source=u[2].pk, target=u[3].pk, is_invite_meet=True),
+            dict(source=u[3].pk, target=u[4].pk, attitude=CurrentState.ACQ),
+            dict(source=u[3].pk, target=u[4].pk, is_sympa=True),
+            dict(source=u[4].pk, target=u[5].pk, is_hide_meet=True),
+        ], key=key))
+        self.assertEqual(
+            CurrentState.graph_links(CurrentState.objects.filter(user_from=u[0]), show_thanks=True),
+            [dict(source=u[0].pk, target=u[1].pk, thanks_count=2, attitude=CurrentState.TRUST)],
+        )
+        self.assertEqual(sorted(CurrentState.graph_links(
+            CurrentState.objects.filter(user_from__in=u),
+            kinds=(CurrentState.LINK_CHILD,),
+        ), key=key), sorted([
+            dict(source=u[2].pk, target=u[0].pk, is_child=False),
+            dict(source=u[0].pk, target=u[2].pk, is_child=True),
+        ], key=key))
+
+class ColumnarGraphTest(SimpleTestCase):
+    """
+    ColumnarGraph.decode(ColumnarGraph.encode(x)) == x
+    """
+
+    def round_trip(self, data):
+        encoded = json.loads(json.dumps(ColumnarGraph.encode(data)))
+        self.assertEqual(ColumnarGraph.decode(encoded), data)
+        return encoded
+
+    def test_nulls(self):
+        photo = 'https://api.blagodarie.org/thumb/profile-photo/2024/01/%s.jpg/64x64~crop~12.jpg'
+        nodes = [
+            dict(id=i, first_name=name, photo=photo_, comment=None, is_dead=is_dead, gender=gender)
+            for i, name, photo_, is_dead, gender in (
+                (1, 'Иван', photo % 'a1', False, 'm'),
+                (2, '', '', True, None),
+                (3, 'Мария', None, False, 'f'),
+                (4, None, photo % 'b22', False, 'f'),
+                (5, 'Петр', photo % 'c333', True, 'm'),
+            )
+        ]
+        links = [
+            dict(source=1, target=2, attitude='t', is_child=None),
+            dict(source=2, target=3, attitude=None, is_child=True),
+            dict(source=3, target=1, attitude='', is_child=False),
+        ]
+        encoded = self.round_trip(dict(bot_username='bot', nodes=nodes, links=links))
+        # фото: общие начало и конец, '' и null различаются
+        self.assertIn('prefix', encoded['nodes']['columns']['photo'])
+        self.assertEqual(encoded['nodes']['columns']['photo']['nulls'], [2])
+        # колонка только из null -- не флаг
+        self.assertNotIn('comment', encoded['nodes'].get('flag_names', ()))
+        self.assertIn('is_dead', encoded['nodes']['flag_names'])
+
+    def test_all_null(self):
+        self.round_trip(dict(
+            users=[dict(uuid='u%s' % i, photo=None, is_active=None) for i in range(4)],
+            connections=[dict(source='u0', target='u1', thanks_count=None)],
+        ))
+
+    def test_empty(self):
+        self.round_trip(dict(nodes=[], links=[]))
+
+    def test_packed(self):
+        uuids = [str(uuid.UUID(int=i * 7919 + 1, version=4)) for i in range(12)]
+        users = [dict(uuid=u, user_id=1000 + i * 3, gender='mf'[i % 2]) for i, u in enumerate(uuids)]
+        connections = [
+            dict(source=uuids[s], target=uuids[t], attitude='tma'[(s + t) % 3])
+            for s, t in ((5, 1), (0, 11), (5, 0), (0, 3), (11, 5))
+        ]
+        data = dict(users=users, connections=connections)
+        encoded = json.loads(json.dumps(ColumnarGraph.encode(data)))
+        columns = encoded['nodes']['columns']
+        self.assertIn('uuid', columns['uuid'])
+        self.assertEqual(columns['user_id'], dict(delta=[1000] + [3] * 11))
+        self.assertEqual(columns['gender']['index'], '010101010101')
+        # связи по порядку source, target; source: число связей каждого узла
+        self.assertEqual(encoded['links']['source'], dict(counts='200002000001'))
+        decoded = ColumnarGraph.decode(encoded)
+        self.assertEqual(decoded['users'], users)
+        key = lambda link: (uuids.index(link['source']), uuids.index(link['target']))
+        self.assertEqual(decoded['connections'], sorted(connections, key=key))
+
+class ApiAddUserSymptomTest(TestCase):
+    """
+    Вставка симптомов и проверка повторов
+    """
+
+    URL = '/api/addincognitosymptom'
+    INCOGNITO_ID = '2b0cdb0a-544d-406a-b832-6821c63f5d45'
+
+    def setUp(self):
+        group = SymptomGroup.objects.create(name='Тест')
+        self.symptom = Symptom.objects.create(name='Тест', group=group, order=1)
+
+    def post(self, user_symptoms, **kwargs):
+        data = dict(incognito_id=self.INCOGNITO_ID, user_symptoms=user_symptoms, **kwargs)
+        return self.client.post(self.URL, data=json.dumps(data), content_type='application/json')
+
+    def test_no_timestamp_not_duplicate(self):
+        response = self.post([dict(symptom_id=self.symptom.pk), dict(symptom_id=self.symptom.pk)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(UserSymptom.objects.filter(symptom=self.symptom).count(), 2)
+
+    def test_timestamp_duplicate(self):
+        symptom = dict(symptom_id=self.symptom.pk, timestamp=1700000000)
+        response = self.post([symptom, symptom], partial=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [r['status'] for r in response.json()['results']],
+            ['ok', 'duplicate'],
+        )
+        response = self.post([symptom, dict(symptom_id=self.symptom.pk)], partial=True)
+        self.assertEqual(
+            [r['status'] for r in response.json()['results']],
+            ['duplicate', 'ok'],
+        )
+        self.assertEqual(UserSymptom.objects.filter(symptom=self.symptom).count(), 2)
+
+    def test_totals(self):
+        # Число пользователей и симптомов из SymptomTotal, как и по самим симптомам
+        self.post([dict(symptom_id=self.symptom.pk), dict(symptom_id=self.symptom.pk)])
+        self.post([dict(symptom_id=self.symptom.pk)])
+        self.client.post(self.URL, data=json.dumps(dict(
+            incognito_id='0c7b6bd6-3f5d-4f3e-9d0b-6c2b3f1e7a11',
+            user_symptoms=[dict(symptom_id=self.symptom.pk)],
+        )), content_type='application/json')
+        expected = dict(users=2, symptoms=4)
+        self.assertEqual(self.client.get('/api/getstats/users').json(), expected)
+        SymptomTotal.rebuild()
+        self.assertEqual(SymptomTotal.counts(), expected)
+
+    def post_chunked(self, body, terminated=True):
+        """
+        ndjson без Content-Length, как при Transfer-Encoding: chunked
+        """
+        meta = {'wsgi.input': io.BytesIO(body)}
+        if terminated:
+            meta['wsgi.input_terminated'] = True
+        request = RequestFactory().generic(
+            'POST', self.URL, body,
+            content_type='application/x-ndjson',
+            HTTP_TRANSFER_ENCODING='chunked',
+            **meta
+        )
+        del request.META['CONTENT_LENGTH']
+        return resolve(self.URL).func(request)
+
+    def ndjson(self, *items):
+        return ''.join(json.dumps(item) + '\n' for item in items).encode()
+
+    def test_ndjson_chunked(self):
+        body = self.ndjson(
+            dict(incognito_id=self.INCOGNITO_ID),
+            dict(symptom_id=self.symptom.pk),
+            dict(symptom_id=self.symptom.pk),
+        )
+        response = self.post_chunked(body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(UserSymptom.objects.filter(symptom=self.symptom).count(), 2)
+
+    def test_ndjson_chunked_not_terminated(self):
+        body = self.ndjson(dict(incognito_id=self.INCOGNITO_ID), dict(symptom_id=self.symptom.pk))
+        response = self.post_chunked(body, terminated=False)
+        self.assertEqual(response.status_code, 411)
+        self.assertFalse(UserSymptom.objects.exists())
+
+class SymptomCatalogCacheTest(TestCase):
+    """
+    Справочник симптомов в кэше обновляется только после commit
+    """
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            SymptomGroup.objects.create(name='Тест')
+        catalog = SymptomChecksumManage.get_catalog()
+        self.assertEqual(cache.get(SymptomChecksumManage.SYMPTOM_CHECKSUM_CACHE_KEY), catalog['checksum'])
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    SymptomGroup.objects.create(name='Откат')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(SymptomChecksumManage.get_catalog(), catalog)
+        self.assertEqual(
+            [g['name'] for g in SymptomChecksumManage.get_catalog()['data']['symptom_groups']],
+            ['Тест'],
+        )
+
+    def test_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            group = SymptomGroup.objects.create(name='Тест')
+        checksum = SymptomChecksumManage.get_catalog()['checksum']
+        with self.captureOnCommitCallbacks(execute=True):
+            Symptom.objects.create(name='Тест', group=group, order=1)
+        catalog = SymptomChecksumManage.get_catalog()
+        self.assertNotEqual(catalog['checksum'], checksum)
+        self.assertEqual([s['name'] for s in catalog['data']['symptoms']], ['Тест'])
+
+@override_settings(TELEGRAM_BOT_TOKEN='123:test', PROFILE_CACHE_TIMEOUT=600)
+class ProfileCacheInvalidationTest(TestCase):
+    """
+    Запись и удаление ключей, возможностей, желаний, и по одной
+    (ProfileCacheOwnerMixin), и queryset'ом, сбрасывают закэшированный
+    ответ /api/profile
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = CreateUserMixin().create_user(first_name='Test')
+        self.uuid = str(self.user.profile.uuid)
+        self.keytype, created_ = KeyType.objects.get_or_create(
+            pk=KeyType.OTHER_ID,
+            defaults=dict(title='other'),
+        )
+
+    def tearDown(self):
+        cache.clear()
+
+    def wak(self):
+        response = self.client.get('/api/profile', dict(uuid=self.uuid, fields='wak'))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return (
+            [key['value'] for key in data['keys']],
+            [ability['text'] for ability in data['abilities']],
+            [wish['text'] for wish in data['wishes']],
+        )
+
+    def test_instance(self):
+        self.assertEqual(self.wak(), ([], [], []))
+        with self.captureOnCommitCallbacks(execute=True):
+            key = Key.objects.create(owner=self.user, type=self.keytype, value='key-1')
+            ability = Ability.objects.create(owner=self.user, text='ability')
+        self.assertEqual(self.wak(), (['key-1'], ['ability'], []))
+        with self.captureOnCommitCallbacks(execute=True):
+            Wish.objects.create(owner=self.user, text='wish')
+            ability.text = 'ability-2'
+            ability.save()
+        self.assertEqual(self.wak(), (['key-1'], ['ability-2'], ['wish']))
+        with self.captureOnCommitCallbacks(execute=True):
+            key.delete()
+        self.assertEqual(self.wak(), ([], ['ability-2'], ['wish']))
+
+    def test_addkey(self):
+        # Прежние ключи того же типа удаляются queryset'ом
+        with self.captureOnCommitCallbacks(execute=True):
+            Key.objects.create(owner=self.user, type=self.keytype, value='key-1')
+        self.assertEqual(self.wak()[0], ['key-1'])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/addkey', dict(
+                tg_token='123:test',
+                owner_uuid=self.uuid,
+                user_uuid=self.uuid,
+                keytype_id=KeyType.OTHER_ID,
+                keys=['key-2'],
+            ), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.wak()[0], ['key-2'])
+
+    def test_depersonalize(self):
+        # Ключи, возможности, желания удаляются queryset'ами
+        with self.captureOnCommitCallbacks(execute=True):
+            Key.objects.create(owner=self.user, type=self.keytype, value='key-1')
+            Ability.objects.create(owner=self.user, text='ability')
+            Wish.objects.create(owner=self.user, text='wish')
+        self.assertEqual(self.wak(), (['key-1'], ['ability'], ['wish']))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/profile', dict(
+                tg_token='123:test',
+                owner_id=self.user.pk,
+                uuid=self.uuid,
+            ), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.wak(), ([], [], []))
+
+    def test_bulk_without_invalidation(self):
+        # Кэш и правда используется: запись мимо ProfileCache не видна
+        with self.captureOnCommitCallbacks(execute=True):
+            Key.objects.create(owner=self.user, type=self.keytype, value='key-1')
+        self.assertEqual(self.wak()[0], ['key-1'])
+        Key.objects.filter(owner=self.user).update(value='key-2')
+        self.assertEqual(self.wak()[0], ['key-1'])
@@ -1,4 +1,4 @@
-import os, datetime, time, json, re, html, uuid
+import os, io, datetime, time, json, re, html, uuid
 from urllib.parse import urlencode
 from uuid import uuid4
 
@@ -6,9 +6,11 @@ from django.shortcuts import redirect
 from django.db import transaction, IntegrityError, connection
 from django.db.models import F, Sum, Max, Min
 from django.db.models.query_utils import Q
+from django.db.models.functions import Coalesce
 from django.views.generic.base import View
 from django.views.decorators.cache import cache_page
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import ValidationError
 
 from django.conf import settings
@@ -28,9 +30,14 @@ from app.models import UnclearDate, PhotoModel, GenderMixin
 
 from contact.models import KeyType, Key, \
                            Symptom, UserSymptom, SymptomChecksumManage, \
+                           SymptomStat, UserSymptomStat, SymptomTotal, \
                            Journal, CurrentState, OperationType, Wish, \
                            AnyText, Ability, TgJournal, TgMessageJournal, \
                            ApiAddOperationMixin
+from contact.graph import GenesisGraph, TrustGraph
+from users.profile_cache import ProfileCache
+from contact.snapshot import GraphSnapshot
+from contact.columnar import ColumnarGraph
 from users.models import CreateUserMixin, IncognitoUser, Profile, \
                          TempToken, Oauth, UuidMixin, TgGroup, TelegramApiMixin, TgDesc
 
@@ -1100,7 +1107,22 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
 
         Что получать, определяется в словаре kwargs
         """
-        return Response(data=self.get_stats(request, *args, **kwargs), status=status.HTTP_200_OK)
+        data = self.get_stats(request, *args, **kwargs)
+        if kwargs.get('only') == 'user_connections_graph' and ColumnarGraph.get_fmt(request)[1]:
+            return ColumnarGraph.response(request, data)
+        return Response(data=data, status=status.HTTP_200_OK)
+
+    def symptom_stats(self, symptom_ids=None, incognitouser=None, **filters):
+        """
+        Почасовые счетчики симптомов: всех или пользователя incognitouser
+        """
+        if incognitouser:
+            qs = UserSymptomStat.objects.filter(incognitouser=incognitouser)
+        else:
+            qs = SymptomStat.objects.all()
+        if symptom_ids is not None:
+            qs = qs.filter(symptom__pk__in=symptom_ids)
+        return qs.filter(**filters)
 
     def get_stats(self, request, *args, **kwargs):
 
@@ -1170,9 +1192,10 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
             #
             #   Учитывается также get параметр fmt, особенно при tg_group_chat_id,
             #   если fmt == '3d-force-graph', то формат вывода связей и юзеров
-            #   короткий
+            #   короткий, а если fmt == 'columnar', то тот же короткий в
+            #   колоночном формате, см. contact/columnar.py
 
-            fmt = request.GET.get('fmt', 'd3js')
+            fmt, columnar = ColumnarGraph.get_fmt(request)
             q_users = Q(is_superuser=False)
 
             tg_group_id, tggroup = self.get_tg_group_id(request)
@@ -1218,10 +1241,9 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
                 users_selected = users_selected[from_:from_ + number_]
             else:
                 users_selected = users_selected[from_:]
-            for user in users_selected:
-                profile = user.profile
-                users.append(profile.data_dict(request, fmt=fmt))
-                user_pks.append(user.pk)
+            users_selected = list(users_selected)
+            users = Profile.data_dicts([user.profile for user in users_selected], request, fmt=fmt)
+            user_pks = [user.pk for user in users_selected]
 
             if request.user and request.user.is_authenticated:
                 if request.user.pk not in user_pks:
@@ -1254,10 +1276,7 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
         if kwargs.get('only') == 'users':
             # Вернуть число пользователей и симтомов
             #
-            return dict(
-                users=UserSymptom.objects.all().distinct('incognitouser').count(),
-                symptoms=UserSymptom.objects.all().count(),
-            )
+            return SymptomTotal.counts()
 
         time_current = int(time.time())
         time_last = int(((time_current + 3599) / 3600)) * 3600
@@ -1279,7 +1298,6 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
         selected_ids_str = request.GET.get('selected_ids_str', '')
         m = re.search(r'\((\S*)\)', selected_ids_str)
         selected_ids_list = []
-        selected_ids_where = ''
         if m:
             m_group = m.group(1)
             if m_group:
@@ -1294,16 +1312,12 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
             selected_ids_str = ''
         if len(selected_ids_list) == symptom_by_name.count():
             selected_ids_str = ''
-        if selected_ids_str:
-            selected_ids_where = ' AND symptom_id IN %s ' % selected_ids_str
 
         public_key = request.GET.get('public_key', '')
         incognitouser = None
-        incognitouser_where = ''
         if public_key:
             try:
                 incognitouser = IncognitoUser.objects.get(public_key=public_key)
-                incognitouser_where = ' AND incognitouser_id = %s ' % incognitouser.pk
             except IncognitoUser.DoesNotExist:
                 pass
 
@@ -1345,106 +1359,21 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
 
             s_dict = dict()
             if selected_ids_str != '()':
-                req_str = """
-                    SELECT
-                        contact_symptom.name AS name,
-                        count(contact_usersymptom.id) as count
-                    FROM
-                        contact_usersymptom
-                    LEFT JOIN
-                        contact_symptom
-                    ON
-                        symptom_id=contact_symptom.id
-                    WHERE
-                        insert_timestamp < %(time_last)s
-                        %(selected_ids_where)s
-                        %(incognitouser_where)s
-                    GROUP BY
-                        name
-                    ORDER BY
-                        count
-                """ % dict(
-                    time_last=time_last,
-                    selected_ids_where=selected_ids_where,
-                    incognitouser_where=incognitouser_where,
-                )
-                with connection.cursor() as cursor:
-                    cursor.execute(req_str)
-                    symptoms = self.dictfetchall(cursor)
-                for symptom in symptoms:
-                    s_dict[symptom['name']] = dict(
-                        count_all=symptom['count'],
+                for symptom in self.symptom_stats(
+                            selected_ids_list if selected_ids_str else None,
+                            incognitouser,
+                            hour__lt=time_last,
+                        ).values('symptom__name').annotate(
+                            count_all=Coalesce(Sum('count'), 0),
+                            count_48h=Coalesce(Sum('count', filter=Q(hour__gte=time_1st)), 0),
+                            count_24h=Coalesce(Sum('count', filter=Q(hour__gte=time_24h)), 0),
+                        ).order_by('count_all'):
+                    s_dict[symptom['symptom__name']] = dict(
+                        count_all=symptom['count_all'],
+                        count_48h=symptom['count_48h'],
+                        count_24h=symptom['count_24h'],
                     )
 
-            if selected_ids_str != '()':
-                req_str = """
-                    SELECT
-                        contact_symptom.name AS name,
-                        count(contact_usersymptom.id) as count
-                    FROM
-                        contact_usersymptom
-                    LEFT JOIN
-                        contact_symptom
-                    ON
-                        symptom_id=contact_symptom.id
-                    WHERE
-                        insert_timestamp < %(time_last)s AND
-                        insert_timestamp >= %(time_1st)s
-                        %(selected_ids_where)s
-                        %(incognitouser_where)s
-                    GROUP BY
-                        name
-                    ORDER BY
-                        count
-                """ % dict(
-                    time_last=time_last,
-                    time_1st=time_1st,
-                    selected_ids_where=selected_ids_where,
-                    incognitouser_where=incognitouser_where,
-                )
-                with connection.cursor() as cursor:
-                    cursor.execute(req_str)
-                    symptoms = self.dictfetchall(cursor)
-                for symptom in symptoms:
-                    s_dict[symptom['name']]['count_48h'] = symptom['count']
-                for name in s_dict:
-                    if not s_dict[name].get('count_48h'):
-                        s_dict[name]['count_48h'] = 0
-
-                req_str = """
-                    SELECT
-                        contact_symptom.name AS name,
-                        count(contact_usersymptom.id) as count
-                    FROM
-                        contact_usersymptom
-                    LEFT JOIN
-                        contact_symptom
-                    ON
-                        symptom_id=contact_symptom.id
-                    WHERE
-                        insert_timestamp < %(time_last)s AND
-                        insert_timestamp >= %(time_24h)s
-                        %(selected_ids_where)s
-                        %(incognitouser_where)s
-                    GROUP BY
-                        name
-                    ORDER BY
-                        count
-                """ % dict(
-                    time_last=time_last,
-                    time_24h=time_24h,
-                    selected_ids_where=selected_ids_where,
-                    incognitouser_where=incognitouser_where,
-                )
-                with connection.cursor() as cursor:
-                    cursor.execute(req_str)
-                    symptoms = self.dictfetchall(cursor)
-                for symptom in symptoms:
-                    s_dict[symptom['name']]['count_24h'] = symptom['count']
-                for name in s_dict:
-                    if not s_dict[name].get('count_24h'):
-                        s_dict[name]['count_24h'] = 0
-
             s_list = []
             for name in s_dict:
                 title = '%s (%s, %s, %s)' % (
@@ -1491,8 +1420,10 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
                 q &= Q(symptom__pk__in=selected_ids_list)
             if incognitouser:
                 q &= Q(incognitouser=incognitouser)
-            for usersymptom in UserSymptom.objects.filter(q).select_related('symptom'):
-                times[symptom_ids[usersymptom.symptom.pk]].append(usersymptom.insert_timestamp)
+            for symptom_id, insert_timestamp in UserSymptom.objects.filter(q).values_list(
+                        'symptom_id', 'insert_timestamp',
+                    ):
+                times[symptom_ids[symptom_id]].append(insert_timestamp)
 
             return dict(
                 time_1st=time_1st,
@@ -1518,27 +1449,10 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
             moon_bars = []
             if selected_ids_str != '()':
                 moon_bars = [[0 for j in range(30)] for i in range(len(symptom_ids))]
-                where = selected_ids_where + incognitouser_where
-                if where:
-                    where = re.sub(r'^\s*AND', '', where, flags=re.I)
-                    where = 'WHERE ' + where
-                req_str = """
-                    SELECT
-                        moon_day,
-                        symptom_id,
-                        Count(symptom_id) as count
-                    FROM
-                        contact_usersymptom
-                    %(where)s
-                    GROUP BY
-                        moon_day,
-                        symptom_id
-                """ % dict(
-                    where=where,
-                )
-                with connection.cursor() as cursor:
-                    cursor.execute(req_str)
-                    m = self.dictfetchall(cursor)
+                m = self.symptom_stats(
+                        selected_ids_list if selected_ids_str else None,
+                        incognitouser,
+                    ).values('moon_day', 'symptom_id').annotate(count=Sum('count'))
                 for r in m:
                     moon_bars[symptom_ids[ r['symptom_id']] ] [r['moon_day']] = r['count']
                 for i, symptom_bar in enumerate(moon_bars):
@@ -1574,28 +1488,12 @@ class ApiGetStats(SQL_Mixin, TelegramApiMixin, ApiTgGroupConnectionsMixin, APIVi
                 #                   симптом, он будет располагаться посреди
                 #                   "квадратика" для 4-го часа 5-го дня.
                 #
-                req_str = """
-                    SELECT
-                        moon_day,
-                        ((insert_timestamp + timezone * 3600/100 + (timezone %% 100) * 60)/3600) %% 24 as hour,
-                        symptom_id,
-                        Count(DISTINCT id) as count
-                    FROM
-                        contact_usersymptom
-                    %(where)s
-                    GROUP BY
-                        moon_day,
-                        hour,
-                        symptom_id
-                    ORDER BY
-                        count
-                    DESC
-                """ % dict(
-                    where=where,
-                )
-                with connection.cursor() as cursor:
-                    cursor.execute(req_str)
-                    m = self.dictfetchall(cursor)
+                m = self.symptom_stats(
+                        selected_ids_list if selected_ids_str else None,
+                        incognitouser,
+                    ).values('moon_day', 'symptom_id', hour=F('local_hour')).annotate(
+                        count=Sum('count')
+                    ).order_by('-count')
                 s_d_h = [ [ [{'count': 0, 'pos': 0.5} for i in range(24)] for j in range(30) ] for k in range(len(symptom_ids)) ]
                 d_h_s = [ [[] for i in range(24)] for j in range(30) ]
                 for r in m:
@@ -1645,7 +1543,18 @@ api_get_stats = ApiGetStats.as_view()
 
 class ApiAddUserSymptom(APIView):
 
-    @transaction.atomic
+    # По сколько симптомов вставлять в базу за раз
+    #
+    BULK_CHUNK_SIZE = 1000
+
+    NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+    # Статусы симптомов в ответе при partial или ndjson
+    #
+    STATUS_OK = 'ok'
+    STATUS_DUPLICATE = 'duplicate'
+    STATUS_ERROR = 'error'
+
     def post(self, request, *args, **kwargs,):
         """
         Добавление симптома пользователя (новая версия)
@@ -1675,85 +1584,299 @@ class ApiAddUserSymptom(APIView):
                     "latitude": 22.4321,
                     "longitude": 32.2212
                 }
-            ]
+            ],
+            // необязательно:
+            "partial": true
         }
         Возвращает: {}
+
+        Симптомы вставляются в базу пачками. Повтор симптома с заданным
+        timestamp, уже имеющегося у пользователя (тот же symptom_id
+        и timestamp), например, при повторной отправке накопленного
+        без связи, не вставляется. Симптомы без timestamp получают
+        текущее время и не проверяются на повтор.
+
+        Если ошибка хоть в одном симптоме, то не вставляется ни один,
+        возвращается ошибка (400). Если же задано "partial": true,
+        вставляются верные симптомы, а возвращается статус каждого:
+        {
+            "results": [
+                {"status": "ok"},
+                {"status": "duplicate"},
+                {"status": "error", "message": "..."},
+                ...
+            ]
+        }
+
+        Для больших объемов: Content-Type: application/x-ndjson,
+        в первой строке {"incognito_id": ...} или {"private_key": ...},
+        далее по симптому на строку, как элементы user_symptoms.
+        Каждая пачка в своей транзакции, ошибки в симптомах не прерывают
+        вставку. Тело без Content-Length (Transfer-Encoding: chunked)
+        принимается, если сервер сам находит его конец, см. ndjson_stream(),
+        иначе ошибка 411. Возвращает:
+        {
+            "count": <вставлено>,
+            "duplicates": [<номер строки симптома, начиная с 0>, ...],
+            "errors": [{"line": <номер>, "message": "..."}, ...]
+        }
         """
         try:
             auth_only = kwargs.get('auth')
             if auth_only and not request.user.is_authenticated:
                 raise AuthenticationFailed
-
-            incognito_id = request.data.get("incognito_id")
-            private_key = request.data.get("private_key")
-            if not incognito_id and not private_key:
-                raise ServiceException("Не задано ни incognito_id, ни private_key")
-            if incognito_id and private_key:
-                raise ServiceException("Заданы и incognito_id, и private_key")
-            if private_key:
-                private_key = private_key.lower()
-                try:
-                    incognitouser = IncognitoUser.objects.get(
-                        private_key=private_key
+            if request.content_type == self.NDJSON_CONTENT_TYPE:
+                stream = self.ndjson_stream(request)
+                if stream is None:
+                    return Response(
+                        data=dict(message='Не задан Content-Length'),
+                        status=status.HTTP_411_LENGTH_REQUIRED,
                     )
-                except IncognitoUser.DoesNotExist:
-                    raise ServiceException("Не найден private_key среди incognito пользователей")
+                data = self.post_ndjson(stream)
             else:
-                # got incognito_id
-                incognito_id = incognito_id.lower()
-                incognitouser, created_ = IncognitoUser.objects.get_or_create(
-                    private_key=incognito_id
+                data = self.post_json(request)
+            status_code = status.HTTP_200_OK
+        except ServiceException as excpt:
+            data = dict(message=excpt.args[0])
+            status_code = status.HTTP_400_BAD_REQUEST
+        return Response(data=data, status=status_code)
+
+    def get_incognitouser(self, data):
+        incognito_id = data.get("incognito_id")
+        private_key = data.get("private_key")
+        if not incognito_id and not private_key:
+            raise ServiceException("Не задано ни incognito_id, ни private_key")
+        if incognito_id and private_key:
+            raise ServiceException("Заданы и incognito_id, и private_key")
+        if private_key:
+            private_key = private_key.lower()
+            try:
+                incognitouser = IncognitoUser.objects.get(
+                    private_key=private_key
                 )
+            except IncognitoUser.DoesNotExist:
+                raise ServiceException("Не найден private_key среди incognito пользователей")
+        else:
+            # got incognito_id
+            incognito_id = incognito_id.lower()
+            incognitouser, created_ = IncognitoUser.objects.get_or_create(
+                private_key=incognito_id
+            )
+        return incognitouser
+
+    def parse_symptom(self, user_symptom, n_key, symptom_ids):
+        """
+        Проверить симптом из запроса, вернуть поля для UserSymptom
+        """
+        try:
+            symptom_id = int(user_symptom['symptom_id'])
+        except (KeyError, TypeError, ValueError,):
+            raise ServiceException(MSG_NO_PARM % n_key)
+        if symptom_id not in symptom_ids:
+            raise ServiceException(
+                "Не найден symptom_id, элемент списка %s (начиная с нуля)" % n_key
+            )
+        try:
+            insert_timestamp = user_symptom.get('timestamp')
+            insert_timestamp = int(insert_timestamp) if insert_timestamp else int(time.time())
+            latitude = user_symptom.get('latitude')
+            latitude = None if latitude is None else float(latitude)
+            longitude = user_symptom.get('longitude')
+            longitude = None if longitude is None else float(longitude)
+        except (TypeError, ValueError,):
+            raise ServiceException(MSG_NO_PARM % n_key)
+        timezone = user_symptom.get(
+            'timezone',
+            UserSymptom._meta.get_field('timezone').default
+        )
+        try:
+            timezone = int(timezone)
+        except (TypeError, ValueError,):
+            raise ServiceException(
+                "Неверная timezone, элемент списка %s (начиная с нуля)" % n_key
+            )
+        return dict(
+            symptom_id=symptom_id,
+            insert_timestamp=insert_timestamp,
+            latitude=latitude,
+            longitude=longitude,
+            timezone=timezone,
+            # Не поле UserSymptom: время задано клиентом, проверять на повтор
+            check_duplicate=bool(user_symptom.get('timestamp')),
+        )
+
+    def parse_symptoms(self, user_symptoms, n_start=0):
+        """
+        Проверить пачку симптомов. Возвращает список: поля для UserSymptom
+        или ServiceException, если симптом с ошибкой
+        """
+        symptom_ids = set()
+        for user_symptom in user_symptoms:
+            try:
+                symptom_ids.add(int(user_symptom['symptom_id']))
+            except (KeyError, TypeError, ValueError,):
+                pass
+        symptom_ids = SymptomChecksumManage.get_symptom_ids(symptom_ids)
+        result = []
+        for n, user_symptom in enumerate(user_symptoms):
+            try:
+                if not isinstance(user_symptom, dict):
+                    raise ServiceException(MSG_NO_PARM % (n_start + n))
+                result.append(self.parse_symptom(user_symptom, n_start + n, symptom_ids))
+            except ServiceException as excpt:
+                result.append(excpt)
+        return result
+
+    def insert_symptoms(self, incognitouser, items):
+        """
+        Вставить симптомы (из parse_symptom()), кроме уже имеющихся
 
+        Повтором считается симптом с check_duplicate, у которого тот же
+        symptom_id и insert_timestamp, что у имеющегося или предыдущего
+        в items. Возвращает список из True (вставлен) или False (повтор) для items
+        """
+        timestamps = set(item['insert_timestamp'] for item in items if item['check_duplicate'])
+        existing = set(UserSymptom.objects.filter(
+                incognitouser=incognitouser,
+                insert_timestamp__in=timestamps,
+            ).values_list('symptom_id', 'insert_timestamp')) if timestamps else set()
+        result = []
+        usersymptoms = []
+        for item in items:
+            fields = dict(item)
+            check_duplicate = fields.pop('check_duplicate')
+            key = (item['symptom_id'], item['insert_timestamp'],)
+            if check_duplicate and key in existing:
+                result.append(False)
+            else:
+                if check_duplicate:
+                    existing.add(key)
+                result.append(True)
+                usersymptoms.append(UserSymptom(incognitouser=incognitouser, **fields))
+        for usersymptom, moon_day in zip(
+                usersymptoms,
+                Misc.get_moon_days([usersymptom.insert_timestamp for usersymptom in usersymptoms]),
+            ):
+            usersymptom.moon_day = moon_day
+        usersymptoms = UserSymptom.objects.bulk_create(usersymptoms, batch_size=self.BULK_CHUNK_SIZE)
+        SymptomStat.add_usersymptoms([usersymptom.pk for usersymptom in usersymptoms])
+        return result
+
+    @transaction.atomic
+    def post_json(self, request):
+        try:
+            incognitouser = self.get_incognitouser(request.data)
             user_symptoms = request.data.get("user_symptoms")
             if not isinstance(user_symptoms, list):
                 raise ServiceException("Не заданы user_symptoms")
-            n_key = 0
-            for user_symptom in user_symptoms:
-                try:
-                    symptom_id = user_symptom['symptom_id']
-                except KeyError:
-                    raise ServiceException(MSG_NO_PARM % n_key)
-                try:
-                    symptom = Symptom.objects.get(pk=symptom_id)
-                except Symptom.DoesNotExist:
-                    raise ServiceException(
-                        "Не найден symptom_id, элемент списка %s (начиная с нуля)" % n_key
-                    )
-                insert_timestamp = user_symptom.get('timestamp')
-                latitude = user_symptom.get('latitude')
-                longitude = user_symptom.get('longitude')
-                timezone = user_symptom.get(
-                    'timezone',
-                    UserSymptom._meta.get_field('timezone').default
-                )
+            partial = bool(request.data.get("partial"))
+            parsed = self.parse_symptoms(user_symptoms)
+            errors = [item for item in parsed if isinstance(item, ServiceException)]
+            if errors and not partial:
+                raise errors[0]
+            items = [item for item in parsed if not isinstance(item, ServiceException)]
+            inserted = iter(self.insert_symptoms(incognitouser, items))
+        except ServiceException:
+            transaction.set_rollback(True)
+            raise
+        if not partial:
+            return dict()
+        results = []
+        for item in parsed:
+            if isinstance(item, ServiceException):
+                results.append(dict(status=self.STATUS_ERROR, message=item.args[0]))
+            else:
+                results.append(dict(status=self.STATUS_OK if next(inserted) else self.STATUS_DUPLICATE))
+        return dict(results=results)
+
+    def ndjson_stream(self, request):
+        """
+        Тело ndjson запроса, из которого можно читать строки, или None
+
+        request.stream нет, если не задан Content-Length, так бывает
+        и при Transfer-Encoding: chunked. Тогда читаем прямо wsgi.input,
+        если сервер (gunicorn, uwsgi) отмечает конец тела
+        (wsgi.input_terminated), иначе тело не прочитать
+        """
+        if request.stream is not None:
+            return request.stream
+        if 'chunked' not in request.META.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # Пустое тело
+            return io.BytesIO()
+        if request.META.get('wsgi.input_terminated') and request.META.get('wsgi.input'):
+            return request.META['wsgi.input']
+        return None
+
+    def post_ndjson(self, stream):
+        lines = iter(stream.readline, b'')
+        try:
+            header = json.loads(next(lines))
+        except (StopIteration, ValueError,):
+            raise ServiceException("Не задана первая строка: incognito_id или private_key")
+        if not isinstance(header, dict):
+            raise ServiceException("Не задана первая строка: incognito_id или private_key")
+        incognitouser = self.get_incognitouser(header)
+        data = dict(count=0, duplicates=[], errors=[])
+        n_line = 0
+        chunk = []
+        for line in lines:
+            if line.strip():
                 try:
-                    timezone = int(timezone)
+                    chunk.append(json.loads(line))
                 except ValueError:
-                    raise ServiceException(
-                        "Неверная timezone, элемент списка %s (начиная с нуля)" % n_key
-                    )
-                usersymptom = UserSymptom.objects.create(
-                    incognitouser=incognitouser,
-                    symptom=symptom,
-                    insert_timestamp=insert_timestamp,
-                    latitude=latitude,
-                    longitude=longitude,
-                    timezone=timezone,
-                )
-                n_key += 1
-
-            data = dict()
-            status_code = status.HTTP_200_OK
-        except ServiceException as excpt:
-            transaction.set_rollback(True)
-            data = dict(message=excpt.args[0])
-            status_code = status.HTTP_400_BAD_REQUEST
-        return Response(data=data, status=status_code)
+                    chunk.append(None)
+            if len(chunk) >= self.BULK_CHUNK_SIZE:
+                n_line = self.insert_ndjson_chunk(incognitouser, chunk, n_line, data)
+                chunk = []
+        if chunk:
+            self.insert_ndjson_chunk(incognitouser, chunk, n_line, data)
+        return data
+
+    def insert_ndjson_chunk(self, incognitouser, chunk, n_line, data):
+        parsed = self.parse_symptoms(chunk, n_start=n_line)
+        items = []
+        lines = []
+        for n, item in enumerate(parsed, start=n_line):
+            if isinstance(item, ServiceException):
+                data['errors'].append(dict(line=n, message=item.args[0]))
+            else:
+                items.append(item)
+                lines.append(n)
+        with transaction.atomic():
+            inserted = self.insert_symptoms(incognitouser, items)
+        for n, is_inserted in zip(lines, inserted):
+            if is_inserted:
+                data['count'] += 1
+            else:
+                data['duplicates'].append(n)
+        return n_line + len(chunk)
 
 api_add_user_symptom = ApiAddUserSymptom.as_view()
 
 class ApiGetSymptoms(APIView):
+    """
+    Справочник симптомов берется из кэша, см. SymptomChecksumManage.get_catalog().
+    ETag ответа -- контрольная сумма справочника
+    """
+
+    def get(self, request):
+        """
+        Получить группы симптомов, симптомы, их контрольную сумму
+
+        Если в заголовке If-None-Match передан ETag текущего
+        справочника, то ответ 304 без данных
+        """
+        catalog = SymptomChecksumManage.get_catalog()
+        etag = '"%s"' % catalog['checksum']
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [e.strip() for e in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = dict(changed=True, checksum=catalog['checksum'])
+            data.update(catalog['data'])
+            response = Response(data=data, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
 
     def post(self, request):
         """
@@ -1765,21 +1888,27 @@ class ApiGetSymptoms(APIView):
         Symptom и SymptomGroup
         """
 
+        etag = None
         try:
             if 'checksum' not in request.data:
                 raise ServiceException('Не задана checksum')
             checksum_got = request.data.get("checksum")
-            checksum_here = SymptomChecksumManage.get_symptoms_checksum().value
+            catalog = SymptomChecksumManage.get_catalog()
+            checksum_here = catalog['checksum']
+            etag = '"%s"' % checksum_here
             changed = checksum_got != checksum_here
             data = dict(changed=changed)
             if changed:
                 data.update(checksum=checksum_here)
-                data.update(SymptomChecksumManage.get_symptoms_dict())
+                data.update(catalog['data'])
             status_code = status.HTTP_200_OK
         except ServiceException as excpt:
             data = dict(message=excpt.args[0])
             status_code = status.HTTP_400_BAD_REQUEST
-        return Response(data=data, status=status_code)
+        response = Response(data=data, status=status_code)
+        if etag:
+            response['ETag'] = etag
+        return response
 
 api_getsymptoms = ApiGetSymptoms.as_view()
 
@@ -2021,6 +2150,7 @@ class MergeSymptomsView(View):
             raise Http404
         UserSymptom.objects.filter(symptom=src).update(symptom=dst)
         src.delete()
+        SymptomStat.rebuild(0, SymptomStat.TIME_MAX, symptom_ids=[dst.pk])
         return redirect('/admin/contact/symptom/')
 
 merge_symptoms = MergeSymptomsView.as_view()
@@ -2159,6 +2289,8 @@ class ApiAddKeyView(UuidMixin, APIView):
                         raise ServiceException('Профиль user_uuid не подлежит правке пользователем owner_uuid')
                 keytype_id = request.data.get("keytype_id") or KeyType.BANKING_DETAILS_ID
                 Key.objects.filter(type__pk=keytype_id, owner=user).delete()
+                # Удаление queryset'ом идет мимо ProfileCacheOwnerMixin
+                ProfileCache.on_commit_users_changed((user.pk,))
                 for value in request.data['keys']:
                     key, created_ = Key.objects.get_or_create(
                         type_id=keytype_id,
@@ -3117,7 +3249,7 @@ class GetTrustGenesisMixin(object):
     def get(self, request):
         try:
             is_request_genesis = 'genesis' in request.path.lower()
-            fmt = request.GET.get('fmt', 'd3js')
+            fmt, columnar = ColumnarGraph.get_fmt(request)
             try:
                 recursion_depth = int(request.GET.get('depth', 0) or 0)
             except (TypeError, ValueError,):
@@ -3136,6 +3268,8 @@ class GetTrustGenesisMixin(object):
                 if len_ids == 1:
                     if is_request_genesis and request.GET.get('new'):
                         data = self.get_tree_new(request, ids[0], recursion_depth, fmt)
+                    elif is_request_genesis:
+                        data = self.get_tree_cached(request, ids[0], recursion_depth, fmt)
                     else:
                         data = self.get_tree(request, ids[0], recursion_depth, fmt)
                 elif len_ids == 2:
@@ -3146,6 +3280,8 @@ class GetTrustGenesisMixin(object):
                 data = self.get_chat_mesh(request, chat_id, recursion_depth)
             else:
                 raise ServiceException('Не заданы параметры необходимые параметры')
+            if columnar:
+                return ColumnarGraph.response(request, data)
             status_code = status.HTTP_200_OK
         except ServiceException as excpt:
             data = dict(message=excpt.args[0])
@@ -3160,6 +3296,8 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
     Форматы выдачи fmt = 3d-force-graph:
         - d3js (по умолчанию)
         - 3d-force-graph
+        - columnar: 3d-force-graph в колоночном формате, см. contact/columnar.py,
+                    без stream
     Возможные выборки (get параметры):
         - dover :   показать доверия
         - rod   :   показать родственные связи
@@ -3169,13 +3307,86 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
                     начиная с from, в порядке убывания дат их присоединения
                     к сообществу.
                     Если заданы from и/или number, по полагается withalone=on
+        - stream:   json или ndjson. При withalone без from и number
+                    отдавать всех не собирая в памяти, а потоком, по мере
+                    выборки из базы порциями по STREAM_CHUNK_SIZE:
+                        json:   тот же json, что и без stream
+                        ndjson: по строке на каждый элемент, вида
+                                {"nodes": {...}}, {"links": {...}} для 3d-force-graph,
+                                {"users": {...}}, {"connections": {...}} для d3js,
+                                первой строкой {"bot_username": ...} для 3d-force-graph
 
     Также отдается профиль авторизованного пользователя, даже если его нет в выборке.
     """
     # permission_classes = (IsAuthenticated,)
 
+    STREAM_CHUNK_SIZE = 1000
+
+    def json_dumps(self, data):
+        return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':',))
+
+    def stream_profiles(self, request, fmt):
+        """
+        data_dict() всех профилей, порциями из базы
+        """
+        profiles = []
+        for profile in Profile.objects.select_related('user').filter(
+                    user__is_superuser=False,
+                ).distinct().iterator(chunk_size=self.STREAM_CHUNK_SIZE):
+            profiles.append(profile)
+            if len(profiles) >= self.STREAM_CHUNK_SIZE:
+                yield from Profile.data_dicts(profiles, request=request, fmt=fmt)
+                profiles = []
+        if profiles:
+            yield from Profile.data_dicts(profiles, request=request, fmt=fmt)
+
+    def stream_connections(self, q_connections, rod, dover, fmt):
+        for cs in CurrentState.objects.filter(q_connections).select_related(
+                    'user_from__profile', 'user_to__profile',
+                ).distinct().iterator(chunk_size=self.STREAM_CHUNK_SIZE):
+            yield cs.data_dict(
+                show_child=bool(rod),
+                show_attitude=bool(dover),
+                fmt=fmt
+            )
+
+    def stream_all(self, request, fmt, q_connections, rod, dover, ndjson):
+        """
+        Все профили и связи потоком json или ndjson
+        """
+        if fmt == '3d-force-graph':
+            header = dict(bot_username=self.get_bot_username())
+            users_key, connections_key, footer = 'nodes', 'links', dict()
+        else:
+            header = dict()
+            users_key, connections_key, footer = 'users', 'connections', dict(trust_connections=[])
+        parts = (
+            (users_key, self.stream_profiles(request, fmt)),
+            (connections_key, self.stream_connections(q_connections, rod, dover, fmt) if rod or dover else ()),
+        )
+        if ndjson:
+            if header:
+                yield self.json_dumps(header) + '\n'
+            for key, items in parts:
+                for item in items:
+                    yield self.json_dumps({key: item}) + '\n'
+        else:
+            yield self.json_dumps(header)[:-1]
+            comma = ',' if header else ''
+            for key, items in parts:
+                yield '%s%s:[' % (comma, self.json_dumps(key),)
+                comma = ''
+                for item in items:
+                    yield comma + self.json_dumps(item)
+                    comma = ','
+                yield ']'
+                comma = ','
+            for key, value in footer.items():
+                yield ',%s:%s' % (self.json_dumps(key), self.json_dumps(value),)
+            yield '}'
+
     def get(self, request):
-        fmt = request.GET.get('fmt', 'd3js')
+        fmt, columnar = ColumnarGraph.get_fmt(request)
         withalone = request.GET.get('withalone')
         dover = request.GET.get('dover')
         rod = request.GET.get('rod')
@@ -3205,11 +3416,17 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
         if dover:
             q_connections |= Q(attitude__isnull=False, user_to__isnull=False, is_reverse=False)
         if withalone:
+            stream = request.GET.get('stream')
+            if from_ is None and stream in ('json', 'ndjson',) and not columnar:
+                return StreamingHttpResponse(
+                    self.stream_all(request, fmt, q_connections, rod, dover, ndjson=stream == 'ndjson'),
+                    content_type='application/x-ndjson' if stream == 'ndjson' else 'application/json',
+                )
             if from_ is None:
-                users = [
-                    profile.data_dict(request=request, fmt=fmt) \
-                    for profile in Profile.objects.select_related('user').filter(user__is_superuser=False).distinct()
-                ]
+                users = Profile.data_dicts(
+                    Profile.objects.select_related('user').filter(user__is_superuser=False).distinct(),
+                    request=request, fmt=fmt,
+                )
                 if rod or dover:
                     connections = [
                         cs.data_dict(
@@ -3225,13 +3442,13 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
                 users = []
                 connections = []
                 if rod or dover:
-                    for profile in Profile.objects.select_related('user').filter(
+                    profiles = list(Profile.objects.select_related('user').filter(
                             user__is_superuser=False,
                         ).order_by(
                             '-user__date_joined'
-                        ).distinct()[from_: from_ + number_]:
-                        users.append(profile.data_dict(request=request, fmt=fmt))
-                        user_pks.add(profile.user.pk)
+                        ).distinct()[from_: from_ + number_])
+                    users = Profile.data_dicts(profiles, request=request, fmt=fmt)
+                    user_pks.update(profile.user.pk for profile in profiles)
 
                     if request.user.is_authenticated and request.user.pk not in user_pks:
                         user_pks.add(request.user.pk)
@@ -3251,7 +3468,7 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
                             ).distinct()
                     ]
         else:
-            users = []
+            profiles = []
             if rod or dover:
                 for cs in CurrentState.objects.filter(q_connections).select_related(
                             'user_from__profile', 'user_to__profile',).distinct():
@@ -3262,19 +3479,33 @@ class ApiProfileGenesisAll(TelegramApiMixin, APIView):
                     ))
                     if cs.user_from.pk not in user_pks:
                         user_pks.add(cs.user_from.pk)
-                        users.append(cs.user_from.profile.data_dict(request=request, fmt=fmt))
+                        profiles.append(cs.user_from.profile)
                     if cs.user_to.pk not in user_pks:
                         user_pks.add(cs.user_to.pk)
-                        users.append(cs.user_to.profile.data_dict(request=request, fmt=fmt))
+                        profiles.append(cs.user_to.profile)
+            users = Profile.data_dicts(profiles, request=request, fmt=fmt)
 
         if fmt == '3d-force-graph':
             bot_username = self.get_bot_username()
             data = dict(bot_username=bot_username, nodes=users, links=connections)
         else:
             data = dict(users=users, connections=connections, trust_connections=[])
+        if columnar:
+            return ColumnarGraph.response(request, data)
         return Response(data=data, status=status.HTTP_200_OK)
 
-api_profile_genesis_all = cache_page(30)(ApiProfileGenesisAll.as_view())
+api_profile_genesis_all_cached = cache_page(30)(ApiProfileGenesisAll.as_view())
+
+def api_profile_genesis_all(request):
+    """
+    Всех и все связи для 3d-force-graph отдаем из снимка, если он есть, см. GraphSnapshot
+
+    Ответ из снимка мимо cache_page: там ETag и ответы 304
+    """
+    response = GraphSnapshot().response(request)
+    if response is None:
+        response = api_profile_genesis_all_cached(request)
+    return response
 
 
 class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiMixin, APIView):
@@ -3465,34 +3696,16 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
                 pass
             elif len(user_page_pks) == 1:
                 # Один пользователь не может иметь связей сам с собой
-                users = [
-                    p.data_dict(request) for p in Profile.objects.select_related(
-                        'user'
-                    ).filter(user__pk=user_page_pks[0])
-                ]
+                users = Profile.data_dicts(
+                    Profile.objects.select_related('user').filter(user__pk=user_page_pks[0]),
+                    request,
+                )
             else:
-                user_page_pks_string = ','.join([str(pk) for pk in user_page_pks])
-
-                # select path from find_group_genesis_tree(array[1167,1162,1089,484,429,426,395,331], 9)
-                # where path[array_length(path, 1)] = any(array[1167,1162,1089,484,429,426,395,331])
-                # and path[1] != path[array_length(path, 1)]
+                # Участники страницы и те, через кого они в родстве между собой.
+                # Как в postgresql функции find_group_genesis_tree(), но в графе процесса
                 #
-                sql = (
-                    'select path from find_group_genesis_tree('
-                        'array[%(user_page_pks_string)s], %(recursion_depth)s'
-                    ') '
-                    'where '
-                        'path[array_length(path, 1)] = any(array[%(user_page_pks_string)s]) '
-                        'and path[1] != path[array_length(path, 1)] '
-                ) % dict(user_page_pks_string=user_page_pks_string, recursion_depth=recursion_depth)
-
                 user_pks = set(user_page_pks)
-                with connection.cursor() as cursor:
-                    cursor.execute(sql)
-                    for rec in cursor.fetchall():
-                        path = rec[0]
-                        for user_pk in path[1:len(path)-1]:
-                            user_pks.add(user_pk)
+                user_pks.update(GenesisGraph.get().group_user_ids(user_page_pks, recursion_depth))
 
                 q_connections = Q(is_child=True)
                 q_connections &= Q(user_to__pk__in=user_pks) & Q(user_from__pk__in=user_pks)
@@ -3505,8 +3718,8 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
                     user = request.user
                     user_pks.add(int(request.user.pk))
 
-                for p in Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'):
-                    d = p.data_dict(request)
+                profiles = list(Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'))
+                for p, d in zip(profiles, Profile.data_dicts(profiles, request)):
                     d.update(
                         is_in_page = p.user.pk in user_page_pks,
                         is_in_group = p.user.pk in chat_user_pks,
@@ -3532,37 +3745,31 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
         if len(user_pks) != 2:
             raise ServiceException('Один или несколько uuid неверны или есть повтор среди заданных uuid')
 
-        # Строка запроса типа:
-        # select path from find_genesis_path_shortest(416, 455, 10)
-        # where path @> array [416, 455];
+        # Все, кто на кратчайших путях, как в postgresql функции
+        # find_genesis_path_shortest(), но в графе процесса
         #
-        sql = 'select path from find_genesis_path_shortest ' \
-              '(%(user_from_id)s, %(user_to_id)s, %(recursion_depth)s) ' \
-              'where path @> array [%(user_from_id)s, %(user_to_id)s]' % dict(
-            user_from_id=user_pks[0],
-            user_to_id=user_pks[1],
-            recursion_depth=recursion_depth,
+        user_pks = set(user_pks) | GenesisGraph.get().shortest_path_user_ids(
+            user_pks[0], user_pks[1], recursion_depth
         )
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
-            paths = [rec[0] for rec in cursor.fetchall()]
-        user_pks = set(user_pks)
-        for path in paths:
-            for user_id in path:
-                user_pks.add(user_id)
 
-        connections = []
         q_connections = Q(is_child=True)
         q_connections &= Q(user_to__pk__in=user_pks) & Q(user_from__pk__in=user_pks)
-        for cs in CurrentState.objects.filter(q_connections).select_related(
-                'user_from__profile', 'user_to__profile',
-            ).distinct():
-            connections.append(cs.data_dict(show_child=True, fmt=fmt))
+        if fmt == '3d-force-graph':
+            connections = CurrentState.graph_links(
+                CurrentState.objects.filter(q_connections),
+                kinds=(CurrentState.LINK_CHILD,),
+            )
+        else:
+            connections = []
+            for cs in CurrentState.objects.filter(q_connections).select_related(
+                    'user_from__profile', 'user_to__profile',
+                ).distinct():
+                connections.append(cs.data_dict(show_child=True, fmt=fmt))
 
-        users = [
-            p.data_dict(request, fmt=fmt, thumb=dict(mark_dead=True)) for p in \
-            Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability')
-        ]
+        users = Profile.data_dicts(
+            Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'),
+            request, fmt=fmt, thumb=dict(mark_dead=True),
+        )
         if fmt == '3d-force-graph':
             bot_username = self.get_bot_username()
             return dict(bot_username=bot_username, nodes=users, links=connections)
@@ -3599,42 +3806,20 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
         v_up = bool(request.GET.get('up'))
         v_down = bool(request.GET.get('down'))
         v_all = not v_up and not v_down
-        v_is_child = 'True' if v_down else 'False'
-        sql_req_dict = dict(
+        # Параметры поиска по графу родственных связей, см. GenesisGraph.tree()
+        #
+        tree_req_dict = dict(
                 user_id=user_q.pk,
                 recursion_depth=recursion_depth + (1 if v_all else 0),
-                v_all='True' if v_all else 'False',
-                v_is_child=v_is_child,
-        )
-        sql_req_str = (
-
-            # Вызов postgresql функции.
-            # Родственные связи, начиная с пользователя user_id
-            #  recursion_depth:
-            #      максимальное число итераций при проходе по дереву связей
-            #  v_all:
-            #      показывать ли все связи, то есть проходим и по потомкам,
-            #      и по предкам, получаем в т.ч. тетей, двоюродных и т.д.
-            #      Если True, то v_is_child роли не играет
-            #  v_is_child:
-            #      При v_all == False:
-            #          v_is_child == True:     проходим только по детям.
-            #          v_is_child == False:    проходим только по предкам.
-
-            'select * from find_genesis_tree('
-                '%(user_id)s,'
-                '%(recursion_depth)s,'
-                '%(v_all)s,'
-                '%(v_is_child)s'
-            ')'
+                v_all=v_all,
+                v_is_child=v_down,
         )
 
         pairs = []
         q_relations = (Q(is_father=True) | Q(is_mother=True)) & Q(user_to__isnull =False)
 
-        with connection.cursor() as cursor:
-            cursor.execute(sql_req_str % sql_req_dict)
-            recs = self.dictfetchall(cursor)
+        genesis_graph = GenesisGraph.get()
+        recs = genesis_graph.tree(**tree_req_dict)
         # Сейчас идем или:
         #   или     по всем,                    v_all==True
         #   или     только вверх,               v_all==False, v_up == True,     v_down = False
@@ -3699,11 +3884,9 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
             nodes_by_id[rec['user_to_id']]['down'] = down
 
         if not v_all and v_up and v_down:
-            # v_is_child сейчас 'True'. Потомков нашли. Ищем предков
-            sql_req_dict.update(v_is_child='False', recursion_depth=recursion_depth,)
-            with connection.cursor() as cursor:
-                cursor.execute(sql_req_str % sql_req_dict)
-                recs = self.dictfetchall(cursor)
+            # v_is_child сейчас True. Потомков нашли. Ищем предков
+            tree_req_dict.update(v_is_child=False, recursion_depth=recursion_depth,)
+            recs = genesis_graph.tree(**tree_req_dict)
             for rec in recs:
                 if not nodes_by_id.get(rec['user_from_id']):
                     nodes_by_id[rec['user_from_id']] = dict(
@@ -3735,18 +3918,14 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
 
         if v_all:
             # надо получить тех в куче по v_all, у кого прямое родство
-            sql_req_dict.update(v_all='False', recursion_depth=recursion_depth + 1)
-            sql_req_dict.update(v_is_child='True')
-            with connection.cursor() as cursor:
-                cursor.execute(sql_req_str % sql_req_dict)
-                recs = self.dictfetchall(cursor)
+            tree_req_dict.update(v_all=False, recursion_depth=recursion_depth + 1)
+            tree_req_dict.update(v_is_child=True)
+            recs = genesis_graph.tree(**tree_req_dict)
             for rec in recs:
                 nodes_by_id[rec['user_from_id']]['down'] = True
                 nodes_by_id[rec['user_to_id']]['down'] = True
-            sql_req_dict.update(v_is_child='False')
-            with connection.cursor() as cursor:
-                cursor.execute(sql_req_str % sql_req_dict)
-                recs = self.dictfetchall(cursor)
+            tree_req_dict.update(v_is_child=False)
+            recs = genesis_graph.tree(**tree_req_dict)
             for rec in recs:
                 nodes_by_id[rec['user_from_id']]['up'] = True
                 nodes_by_id[rec['user_to_id']]['up'] = True
@@ -3851,9 +4030,29 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
 
         return dict(nodes_by_id=nodes_by_id, root_node=root_node, bot_username = self.get_bot_username())
 
-    def get_tree(self, request, id_, recursion_depth, fmt='d3js'):
+    def get_tree_cached(self, request, id_, recursion_depth, fmt='d3js'):
+        """
+        get_tree() через ProfileCache
+        """
+        return ProfileCache.get_or_set(
+            'genesis_tree',
+            dict(
+                id=id_,
+                depth=recursion_depth,
+                fmt=fmt,
+                up=bool(request.GET.get('up')),
+                down=bool(request.GET.get('down')),
+                collapse=bool(request.GET.get('collapse')),
+                root=request.build_absolute_uri('/'),
+            ),
+            lambda: self.get_tree(request, id_, recursion_depth, fmt, with_user_ids=True),
+        )
+
+    def get_tree(self, request, id_, recursion_depth, fmt='d3js', with_user_ids=False):
         """
         Дерево родственных связей от пользователя
+
+        with_user_ids: вернуть (дерево, ид пользователей в дереве)
         """
         related = ('user', 'owner', 'ability',)
         if self.is_uuid(id_):
@@ -3864,46 +4063,21 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
         v_up = bool(request.GET.get('up'))
         v_down = bool(request.GET.get('down'))
         v_all = not v_up and not v_down
-        v_is_child = 'True' if v_down else 'False'
-        sql_req_dict = dict(
+        # Параметры поиска по графу родственных связей, см. GenesisGraph.tree()
+        #
+        tree_req_dict = dict(
                 user_id=user_q.pk,
                 recursion_depth=recursion_depth,
-                v_all='True' if v_all else 'False',
-                v_is_child=v_is_child,
+                v_all=v_all,
+                v_is_child=v_down,
         )
-        sql_req_str = (
-
-            # Вызов postgresql функции.
-            # Родственные связи, начиная с пользователя user_id
-            #  recursion_depth:
-            #      максимальное число итераций при проходе по дереву связей
-            #  v_all:
-            #      показывать ли все связи, то есть проходим и по потомкам,
-            #      и по предкам, получаем в т.ч. тетей, двоюродных и т.д.
-            #      Если True, то v_is_child роли не играет
-            #  v_is_child:
-            #      При v_all == False:
-            #          v_is_child == True:     проходим только по детям.
-            #          v_is_child == False:    проходим только по предкам.
-
-            'select * from find_genesis_tree('
-                '%(user_id)s,'
-                '%(recursion_depth)s,'
-                '%(v_all)s,'
-                '%(v_is_child)s'
-            ')'
-        )
-        recs = []
-        with connection.cursor() as cursor:
-            cursor.execute(sql_req_str % sql_req_dict)
-            recs += self.dictfetchall(cursor)
+        genesis_graph = GenesisGraph.get()
+        recs = genesis_graph.tree(**tree_req_dict)
 
         if not v_all and v_up and v_down:
-            # v_is_child сейчас 'True'. Потомков нашли. Ищем предков
-            sql_req_dict.update(v_is_child='False',)
-            with connection.cursor() as cursor:
-                cursor.execute(sql_req_str % sql_req_dict)
-                recs += self.dictfetchall(cursor)
+            # v_is_child сейчас True. Потомков нашли. Ищем предков
+            tree_req_dict.update(v_is_child=False,)
+            recs += genesis_graph.tree(**tree_req_dict)
 
         connections = []
         user_pks = set()
@@ -3929,11 +4103,13 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
                 default_avatar_in_media=PhotoModel.get_gendered_default_avatar(profile_q.gender),
                 mark_dead=profile_q.is_dead,
         ))
-        for p in Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'):
+        profiles = list(Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'))
+        data_dicts = Profile.data_dicts(profiles, request, fmt=fmt, thumb=dict(mark_dead=True))
+        for p, data_dict in zip(profiles, data_dicts):
             if p == profile_q and fmt=='3d-force-graph':
                 users.append(root_node)
             else:
-                users.append(p.data_dict(request, fmt=fmt, thumb=dict(mark_dead=True)))
+                users.append(data_dict)
             if fmt == 'd3js':
                 UserById[p.user.pk] = dict(uuid=p.uuid)
             elif fmt=='3d-force-graph' and collapse:
@@ -3970,9 +4146,10 @@ class ApiProfileGenesis(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiM
                 for user in users:
                     user['parents'] = UserById[user['id']]['parents']
             bot_username = self.get_bot_username()
-            return dict(bot_username=bot_username, nodes=users, links=connections, root_node=root_node)
+            result = dict(bot_username=bot_username, nodes=users, links=connections, root_node=root_node)
         else:
-            return dict(users=users, connections=connections, trust_connections=[])
+            result = dict(users=users, connections=connections, trust_connections=[])
+        return (result, user_pks) if with_user_ids else result
 
 api_profile_genesis = ApiProfileGenesis.as_view()
 
@@ -4005,6 +4182,12 @@ class ApiProfileTrust(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiMix
                 (в этом случае она таки ограничена, но немыслимо большИм для глубины рекурсии числом: 100)
             1 или более:
                 показать в рекурсии связи не дальше указанной глубины рекурсии
+                Для пути между 2 пользователями: наибольшее число шагов в пути
+        paths_count:
+            Для пути между 2 пользователями:
+            0 или отсутствие параметра: все кратчайшие пути;
+            1 или более: столько кратчайших путей, не обязательно одной длины,
+                но не больше settings.MAX_TRUST_PATHS_COUNT
     """
     # permission_classes = (IsAuthenticated,)
 
@@ -4026,24 +4209,22 @@ class ApiProfileTrust(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiMix
         if user_from_id == user_to_id:
             raise ServiceException('Есть повтор среди заданных uuid')
 
-        # Строка запроса типа:
-        # select path from find_trust_path_shortest(416, 455, 10)
-        # where path @> array [416, 455];
+        try:
+            paths_count = int(request.GET.get('paths_count') or 0)
+        except (TypeError, ValueError,):
+            raise ServiceException('Неверный параметр paths_count')
+        paths_count = min(paths_count, settings.MAX_TRUST_PATHS_COUNT)
+
+        # recursion_depth здесь: наибольшее число шагов в пути
         #
-        sql = 'select path from find_trust_path_shortest ' \
-              '(%(user_from_id)s, %(user_to_id)s, %(recursion_depth)s) ' \
-              'where path @> array [%(user_from_id)s, %(user_to_id)s]' % dict(
-            user_from_id=user_from_id,
-            user_to_id=user_to_id,
-            recursion_depth=recursion_depth,
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
-            paths = [rec[0] for rec in cursor.fetchall()]
-        user_pks = set()
-        for path in paths:
-            for user_id in path:
-                user_pks.add(user_id)
+        trust_graph = TrustGraph.get()
+        if paths_count > 0:
+            user_pks = set()
+            for path in trust_graph.k_shortest_paths(user_from_id, user_to_id, recursion_depth, paths_count):
+                user_pks.update(path)
+        else:
+            # Все кратчайшие пути, как в postgresql функции find_trust_path_shortest()
+            user_pks = trust_graph.shortest_path_user_ids(user_from_id, user_to_id, recursion_depth)
 
         connections = []
         q_connections = Q(
@@ -4067,9 +4248,10 @@ class ApiProfileTrust(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiMix
 
         user_pks.add(user_from_id)
         user_pks.add(user_to_id)
-        users = []
-        for profile in Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'):
-            users.append(profile.data_dict(request, fmt=fmt, thumb=dict(mark_dead=True)))
+        users = Profile.data_dicts(
+            Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'),
+            request, fmt=fmt, thumb=dict(mark_dead=True),
+        )
 
         if fmt == '3d-force-graph':
             bot_username = self.get_bot_username()
@@ -4127,10 +4309,11 @@ class ApiProfileTrust(GetTrustGenesisMixin, UuidMixin, SQL_Mixin, TelegramApiMix
                 d = cs.data_dict(show_attitude=True, fmt=fmt)
                 connections.append(d)
 
-        users = []
         user_pks.add(user_q.pk)
-        for profile in Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'):
-            users.append(profile.data_dict(request, fmt=fmt))
+        users = Profile.data_dicts(
+            Profile.objects.filter(user__pk__in=user_pks).select_related('user', 'ability'),
+            request, fmt=fmt,
+        )
 
         return dict(users=users, connections=connections,)
 
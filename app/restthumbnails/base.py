@@ -31,3 +31,8 @@ class ThumbnailBase(object):
     def key(self):
         return helpers.get_key(
             self.source, self.size_string, self.method, self.extension)
+
+    @property
+    def queued_key(self):
+        # Метка в кэше: thumbnail уже поставлен в очередь запросом к нему
+        return self.key + ':queued'
@@ -3,7 +3,7 @@ from logging import getLogger
 from restthumbnails import processors, exceptions
 from restthumbnails.base import ThumbnailBase
 
-import os
+import os, tempfile
 
 from django.conf import settings
 from django.core.files.base import ContentFile
@@ -52,6 +52,36 @@ class ThumbnailFile(ThumbnailFileBase):
     def _source_exists(self):
         return self.source_storage.exists(self.source)
 
+    def _save(self, content):
+        """
+        Записать thumbnail
+
+        FileSystemStorage пишет сразу в файл с конечным именем: запрос,
+        дождавшийся _exists(), мог бы отдать недописанный файл. Поэтому
+        пишем во временный файл в том же каталоге и переименовываем
+        (os.replace атомарен в пределах файловой системы)
+        """
+        try:
+            path = self.path
+        except NotImplementedError:
+            # Хранилище не на локальном диске
+            self.storage.save(self.name, content)
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            # mkstemp() создает файл с правами 0600
+            os.chmod(tmp_path, getattr(self.storage, 'file_permissions_mode', None) or 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
     @property
     def name(self):
         return self.file_signature % {
@@ -69,16 +99,20 @@ class ThumbnailFile(ThumbnailFileBase):
     def url(self):
         return self.storage.url(self.name)
 
+    @property
+    def is_allowed_size(self):
+        # work only with allowed sizes.
+        min_ = settings.THUMBNAILS_ALLOWED_SIZE_RANGE['min']
+        max_ = settings.THUMBNAILS_ALLOWED_SIZE_RANGE['max']
+        return min_ <= self.size[0] <= max_ or \
+               min_ <= self.size[1] <= max_
+
     def generate(self):
         if self._source_exists():
             if not self._exists():
-                # work only with allowed sizes.
-                min_ = settings.THUMBNAILS_ALLOWED_SIZE_RANGE['min']
-                max_ = settings.THUMBNAILS_ALLOWED_SIZE_RANGE['max']
-                if min_ <= self.size[0] <= max_ or \
-                   min_ <= self.size[1] <= max_:
-
-                    im = processors.get_image(self.source_storage.open(self.source))
+                if self.is_allowed_size:
+                    with self.source_storage.open(self.source) as source:
+                        im = processors.get_image(source, size=self.size, crop=self.method)
                     im = processors.scale_and_crop(
                         im, self.size, self.method,
                         crop_background=self.crop_background,
@@ -88,7 +122,7 @@ class ThumbnailFile(ThumbnailFileBase):
                     if getattr(im, 'mode', '').upper() == 'RGBA':
                         im = im.convert('RGB')
                     im = processors.save_image(im)
-                    self.storage.save(self.name, im)
+                    self._save(im)
                     return True
             return False
         raise exceptions.SourceDoesNotExist(self.source)
@@ -0,0 +1,137 @@
+# bench_smart_crop.py
+#
+# Замер времени crop="smart": processors._smart_crop_box() против
+# прежнего прохода, где энтропия каждого среза считалась в python
+# по списку из im.histogram(). Для каждого изображения сравниваются
+# и рамки обрезки.
+#
+# Изображения: случайный шум, шум на трети изображения и заданные
+# файлы (по умолчанию картинки из static_src/images), растянутые
+# до каждого из размеров. Обрезка до квадрата.
+#
+# Параметры:
+#   --sizes     Размеры, например 2000x600,1200x900,85x64
+#   --repeat    Сколько раз повторить замер, берется лучший
+#   files       Файлы изображений
+
+import os, glob, math, time, random
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from PIL import Image
+
+from restthumbnails import processors
+
+def smart_crop_box_slices(im, diff_x, diff_y):
+    """
+    Рамка crop="smart", как ее считал прежний scale_and_crop()
+    """
+
+    def image_entropy(im):
+        hist = im.histogram()
+        hist_size = float(sum(hist))
+        hist = [h / hist_size for h in hist]
+        return -sum([p * math.log(p, 2) for p in hist if p != 0])
+
+    def compare_entropy(start_slice, end_slice, slice, difference):
+        start_entropy = image_entropy(start_slice)
+        end_entropy = image_entropy(end_slice)
+        if end_entropy and abs(start_entropy / end_entropy - 1) < 0.01:
+            if difference >= slice * 2:
+                return slice, slice
+            half_slice = slice // 2
+            return half_slice, slice - half_slice
+        if start_entropy > end_entropy:
+            return 0, slice
+        else:
+            return slice, 0
+
+    source_x, source_y = im.size
+    left = top = 0
+    right, bottom = source_x, source_y
+    while diff_x:
+        slice = min(diff_x, max(diff_x // 5, 10))
+        start = im.crop((left, 0, left + slice, source_y))
+        end = im.crop((right - slice, 0, right, source_y))
+        add, remove = compare_entropy(start, end, slice, diff_x)
+        left += add
+        right -= remove
+        diff_x = diff_x - add - remove
+    while diff_y:
+        slice = min(diff_y, max(diff_y // 5, 10))
+        start = im.crop((0, top, source_x, top + slice))
+        end = im.crop((0, bottom - slice, source_x, bottom))
+        add, remove = compare_entropy(start, end, slice, diff_y)
+        top += add
+        bottom -= remove
+        diff_y = diff_y - add - remove
+    return (left, top, right, bottom)
+
+def noise_image(size, part=1, seed=1):
+    """
+    RGB изображение: случайный шум на доле part слева, дальше черное
+    """
+    rnd = random.Random(seed)
+    width, height = size
+    im = Image.new('RGB', size)
+    noise_width = max(1, int(width * part))
+    noise = Image.frombytes(
+        'RGB', (noise_width, height), rnd.randbytes(noise_width * height * 3)
+    )
+    im.paste(noise, (0, 0))
+    return im
+
+def real_image_files():
+    return sorted(glob.glob(os.path.join(settings.BASE_DIR, 'static_src', 'images', '*.jpg')))
+
+class Command(BaseCommand):
+    help = 'Benchmark smart crop box against the old slice by slice entropy loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2000x600,600x2000,1200x900,300x200,85x64',
+                            help='comma separated image sizes, WxH')
+        parser.add_argument('--repeat', type=int, default=5, help='take the best of this number of runs')
+        parser.add_argument('files', nargs='*', help='image files, default: static_src/images/*.jpg')
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            time_started = time.perf_counter()
+            result = func()
+            took = time.perf_counter() - time_started
+            if best is None or took < best[0]:
+                best = (took, result)
+        return best
+
+    def images(self, sizes, files):
+        for size in sizes:
+            yield 'noise', noise_image(size)
+            yield 'noise 1/3', noise_image(size, part=1/3.0)
+            for fname in files:
+                yield os.path.basename(fname), Image.open(fname).convert('RGB').resize(size)
+
+    def handle(self, *args, **kwargs):
+        sizes = [tuple(int(v) for v in s.split('x')) for s in kwargs['sizes'].split(',')]
+        files = kwargs['files'] or real_image_files()[:3]
+        repeat = kwargs['repeat']
+        total_old = total_new = 0
+        n_different = 0
+        for name, im in self.images(sizes, files):
+            source_x, source_y = im.size
+            square = min(im.size)
+            diff_x, diff_y = source_x - square, source_y - square
+            old = self.measure(lambda: smart_crop_box_slices(im, diff_x, diff_y), repeat)
+            new = self.measure(lambda: processors._smart_crop_box(im, diff_x, diff_y), repeat)
+            total_old += old[0]
+            total_new += new[0]
+            same = max(abs(a - b) for a, b in zip(old[1], new[1])) <= 1
+            if not same:
+                n_different += 1
+            print('%9s %-28s old %8.2f ms, new %7.2f ms, x%5.1f, box %s%s' % (
+                '%sx%s' % im.size, name[:28], old[0] * 1000, new[0] * 1000,
+                old[0] / new[0], new[1], '' if same else ' != %s' % (old[1],),
+            ))
+        print('Total: old %.1f ms, new %.1f ms, x%.1f, different boxes: %s' % (
+            total_old * 1000, total_new * 1000, total_old / total_new, n_different,
+        ))
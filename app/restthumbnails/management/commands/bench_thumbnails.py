@@ -0,0 +1,243 @@
+# bench_thumbnails.py
+#
+# Замер создания миниатюр, как в ThumbnailFile.generate(), из фото
+# реального размера: время на миниатюру и пиковая память для каждого
+# метода (crop, crop-<цвет>-frame-N, scale, smart), против прежнего
+# создания.
+#
+# Прежнее создание: файл копировался в память, изображение декодировалось
+# в полном размере, EXIF ориентация применялась к нему же, рамка
+# crop="smart" считалась энтропией каждого среза в python
+# (см. bench_smart_crop.py), JPEG кодировался дважды.
+#
+# Изображения по умолчанию генерируются во временном каталоге, похожими
+# на фото: плавные пятна с шумом. JPEG 4000x3000 (12 Мп, как с камеры
+# телефона), он же 3000x4000 с EXIF ориентацией 6 (повернуть), PNG
+# 2400x1600 и WebP 4000x3000. Или заданные файлы.
+#
+# WebP PIL не умеет декодировать в уменьшенном размере, как JPEG
+# (draft()), он декодируется целиком: время и память почти как прежде.
+# Но загруженные фото от PHOTO_QUALITY_MIN_SIZE пикселей хранятся
+# в JPEG (ThumbnailContentFile), так что WebP бывают только мелкими.
+#
+# Время: лучшее из --repeat. Память: пиковый RSS сверх RSS до создания
+# миниатюры (VmHWM после сброса через /proc/self/clear_refs), в отдельном
+# процессе (fork) на каждый замер, после malloc_trim(), чтобы не мешала
+# память, оставшаяся от предыдущих. Только Linux, иначе память
+# не замеряется.
+#
+# Параметры:
+#   --size      Размер миниатюры, по умолчанию 128x128
+#   --methods   Методы через запятую,
+#               по умолчанию crop,crop-black-frame-8,scale,smart
+#   --repeat    Сколько раз повторить замер времени, берется лучший
+#   --keep      Каталог, куда сохранить сгенерированные изображения.
+#               По умолчанию изображения временные
+#   files       Файлы изображений
+
+import os, time, random, shutil, ctypes, tempfile
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+from django.core.files.base import ContentFile
+
+from PIL import Image
+import piexif
+
+from restthumbnails import processors, helpers, defaults
+from restthumbnails.management.commands.bench_smart_crop import smart_crop_box_slices
+
+def photo_image(size, seed=1):
+    """
+    RGB изображение, похожее на фото: плавные цветные пятна и шум
+    """
+    rnd = random.Random(seed)
+    small = Image.frombytes('RGB', (16, 12), rnd.randbytes(16 * 12 * 3))
+    im = small.resize(size, resample=Image.BICUBIC)
+    noise = Image.effect_noise(size, 24).convert('RGB')
+    return Image.blend(im, noise, 0.2)
+
+def generate_images(directory):
+    """
+    Изображения для замера в directory, список имен файлов
+    """
+    result = []
+    im = photo_image((4000, 3000))
+    fname = os.path.join(directory, 'photo-4000x3000.jpg')
+    im.save(fname, format='JPEG', quality=92)
+    result.append(fname)
+    fname = os.path.join(directory, 'photo-3000x4000-exif6.jpg')
+    exif = piexif.dump({'0th': {piexif.ImageIFD.Orientation: 6}})
+    im.save(fname, format='JPEG', quality=92, exif=exif)
+    result.append(fname)
+    fname = os.path.join(directory, 'photo-2400x1600.png')
+    photo_image((2400, 1600), seed=2).save(fname, format='PNG')
+    result.append(fname)
+    fname = os.path.join(directory, 'photo-4000x3000.webp')
+    photo_image((4000, 3000), seed=3).save(fname, format='WEBP', quality=85)
+    result.append(fname)
+    return result
+
+def old_get_image(source):
+    """
+    Как было: копия файла в памяти, декодирование в полном размере
+    """
+    image = Image.open(BytesIO(source.read()))
+    image.load()
+    try:
+        exif_dict = piexif.load(image.info["exif"])
+    except (KeyError, AttributeError, ValueError,):
+        exif_dict = None
+    if exif_dict:
+        try:
+            orientation = exif_dict["0th"][piexif.ImageIFD.Orientation]
+        except KeyError:
+            orientation = None
+        image = processors._exif_orientation(image, orientation)
+    return image
+
+def old_save_image(image):
+    """
+    Как было: JPEG кодируется дважды, затем копируется в ContentFile
+    """
+    destination = BytesIO()
+    options = dict(quality=defaults.THUMBNAIL_QUALITY)
+    try:
+        image.save(destination, format='JPEG', optimize=1, **options)
+    except IOError:
+        pass
+    image.save(destination, format='JPEG', **options)
+    destination.seek(0)
+    return ContentFile(destination.read())
+
+def old_thumbnail(fname, size, method):
+    method, crop_background, frame = helpers.parse_method(method)
+    with open(fname, 'rb') as source:
+        im = old_get_image(source)
+    smart_crop_box = processors._smart_crop_box
+    processors._smart_crop_box = smart_crop_box_slices
+    try:
+        im = processors.scale_and_crop(im, size, method, crop_background=crop_background, frame=frame)
+    finally:
+        processors._smart_crop_box = smart_crop_box
+    im = processors.colorspace(im)
+    if getattr(im, 'mode', '').upper() == 'RGBA':
+        im = im.convert('RGB')
+    return old_save_image(im)
+
+def new_thumbnail(fname, size, method):
+    """
+    Как в ThumbnailFile.generate(), без записи в хранилище
+    """
+    method, crop_background, frame = helpers.parse_method(method)
+    with open(fname, 'rb') as source:
+        im = processors.get_image(source, size=size, crop=method)
+    im = processors.scale_and_crop(im, size, method, crop_background=crop_background, frame=frame)
+    im = processors.colorspace(im)
+    if getattr(im, 'mode', '').upper() == 'RGBA':
+        im = im.convert('RGB')
+    return processors.save_image(im)
+
+def proc_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    return None
+
+def peak_memory(func):
+    """
+    Пиковый RSS сверх начального при func(), в отдельном процессе, или None
+    """
+    if not hasattr(os, 'fork') or not os.path.exists('/proc/self/clear_refs'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        peak = -1
+        try:
+            os.close(read_fd)
+            try:
+                # Память, что освободил, но держит malloc, вернуть системе:
+                # иначе ее займут без роста RSS
+                ctypes.CDLL('libc.so.6').malloc_trim(0)
+            except (OSError, AttributeError):
+                pass
+            with open('/proc/self/clear_refs', 'w') as f:
+                # Сбросить VmHWM до текущего RSS
+                f.write('5')
+            rss = proc_status('VmRSS')
+            func()
+            peak = proc_status('VmHWM') - rss
+        finally:
+            os.write(write_fd, str(peak).encode())
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        peak = int(f.read() or -1)
+    os.waitpid(pid, 0)
+    return peak if peak >= 0 else None
+
+class Command(BaseCommand):
+    help = 'Benchmark thumbnail generation from real size photos: time and peak memory per method'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', default='128x128', help='thumbnail size, WxH')
+        parser.add_argument('--methods', default='crop,crop-black-frame-8,scale,smart',
+                            help='comma separated thumbnail methods')
+        parser.add_argument('--repeat', type=int, default=3, help='take the best of this number of runs')
+        parser.add_argument('--keep', help='directory to save generated images to')
+        parser.add_argument('files', nargs='*', help='image files, default: generated photos')
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            time_started = time.perf_counter()
+            result = func()
+            took = time.perf_counter() - time_started
+            if best is None or took < best[0]:
+                best = (took, result)
+        return best
+
+    def memory(self, peak):
+        return '%7.1f MB' % (peak / 1e6) if peak is not None else '      -   '
+
+    def handle(self, *args, **kwargs):
+        size = tuple(int(v) for v in kwargs['size'].split('x'))
+        methods = kwargs['methods'].split(',')
+        repeat = kwargs['repeat']
+        directory = None
+        files = kwargs['files']
+        if not files:
+            if kwargs['keep']:
+                os.makedirs(kwargs['keep'], exist_ok=True)
+                files = generate_images(kwargs['keep'])
+            else:
+                directory = tempfile.mkdtemp(prefix='bench_thumbnails')
+                files = generate_images(directory)
+        try:
+            total_old = total_new = 0
+            for fname in files:
+                with Image.open(fname) as im:
+                    print('%s: %s %sx%s %s, %.1f MB' % (
+                        os.path.basename(fname), im.format, im.size[0], im.size[1], im.mode,
+                        os.path.getsize(fname) / 1e6,
+                    ))
+                for method in methods:
+                    old = self.measure(lambda: old_thumbnail(fname, size, method), repeat)
+                    new = self.measure(lambda: new_thumbnail(fname, size, method), repeat)
+                    total_old += old[0]
+                    total_new += new[0]
+                    print('    %-20s old %8.1f ms, %s | new %7.1f ms, %s | x%5.1f, %6s bytes' % (
+                        method, old[0] * 1000,
+                        self.memory(peak_memory(lambda: old_thumbnail(fname, size, method))),
+                        new[0] * 1000,
+                        self.memory(peak_memory(lambda: new_thumbnail(fname, size, method))),
+                        old[0] / new[0], new[1].size,
+                    ))
+            print('Total: old %.1f ms, new %.1f ms, x%.1f' % (
+                total_old * 1000, total_new * 1000, total_old / total_new,
+            ))
+        finally:
+            if directory:
+                shutil.rmtree(directory)
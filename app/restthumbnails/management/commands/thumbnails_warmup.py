@@ -0,0 +1,65 @@
+# thumbnails_warmup.py
+#
+# Поставить в очередь генерации (см. restthumbnails/queue.py)
+# стандартный набор thumbnails, settings.THUMBNAILS_PREGENERATE,
+# для всех имеющихся фото и аватаров по умолчанию.
+# Уже сделанные thumbnails в очередь не ставятся.
+# Thumbnails делает ./manage.py thumbnails_worker
+#
+# Параметры:
+#   --high      Поставить в начало очереди, как только что загруженные фото
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.apps import apps
+
+from app.models import PhotoModel
+from restthumbnails.helpers import get_thumbnail
+from restthumbnails.queue import ThumbnailQueue
+
+class Command(BaseCommand):
+    help = 'Queue standard thumbnails of all photos in media'
+
+    # Столько элементов ставить в очередь за один запрос к redis
+    CHUNK_SIZE = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--high', action='store_true', help='queue with high priority')
+
+    def fnames(self):
+        yield PhotoModel.DEFAULT_AVATAR_IN_MEDIA
+        yield PhotoModel.DEFAULT_AVATAR_IN_MEDIA_MALE
+        yield PhotoModel.DEFAULT_AVATAR_IN_MEDIA_FEMALE
+        yield PhotoModel.DEFAULT_AVATAR_IN_MEDIA_NONE
+        for model in apps.get_models():
+            if issubclass(model, PhotoModel):
+                for fname in model.objects.exclude(photo='').exclude(photo__isnull=True). \
+                             values_list('photo', flat=True).iterator():
+                    yield fname
+
+    def handle(self, *args, **kwargs):
+        if not settings.THUMBNAILS_QUEUE_ON:
+            print('settings.THUMBNAILS_QUEUE_ON is not set')
+            exit()
+        r = ThumbnailQueue.connect()
+        queued = existing = 0
+        items = []
+        for fname in self.fnames():
+            for parms in settings.THUMBNAILS_PREGENERATE:
+                item = ThumbnailQueue.item_from_path(PhotoModel.image_thumb_path(fname, **parms))
+                if not item:
+                    continue
+                if get_thumbnail(**item)._exists():
+                    existing += 1
+                    continue
+                items.append(item)
+                if len(items) >= self.CHUNK_SIZE:
+                    ThumbnailQueue.put(items, high=kwargs['high'], r=r)
+                    queued += len(items)
+                    items = []
+        ThumbnailQueue.put(items, high=kwargs['high'], r=r)
+        queued += len(items)
+        print('Queued: %s, already generated: %s' % (queued, existing))
+        if not ThumbnailQueue.counts(r)['alive']:
+            print('./manage.py thumbnails_worker is not running')
+        r.close()
@@ -0,0 +1,37 @@
+# thumbnails_worker.py
+#
+# Делать thumbnails из очереди, см. restthumbnails/queue.py,
+# restthumbnails/worker.py. Запускать один процесс, например, через systemd
+#
+# Параметры:
+#   --once          Выйти, когда очередь опустеет
+#   --stats         Показать размеры очереди и выйти
+#   --workers       Сколько процессов, по умолчанию settings.THUMBNAILS_QUEUE_WORKERS
+#   --verbose       Сообщать об ошибках генерации
+
+from django.core.management.base import BaseCommand
+
+from restthumbnails.queue import ThumbnailQueue
+from restthumbnails.worker import ThumbnailWorker
+
+class Command(BaseCommand):
+    help = 'Generate queued thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit when queue is empty')
+        parser.add_argument('--stats', action='store_true', help='show queue sizes and exit')
+        parser.add_argument('--workers', type=int, default=None, help='number of processes')
+        parser.add_argument('--verbose', action='store_true', help='report failures')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['stats']:
+            r = ThumbnailQueue.connect()
+            print(', '.join('%s: %s' % (k, v) for k, v in ThumbnailQueue.counts(r).items()))
+            r.close()
+            return
+        worker = ThumbnailWorker(workers=kwargs['workers'], verbose=kwargs['verbose'])
+        try:
+            worker.run(once=kwargs['once'])
+        except KeyboardInterrupt:
+            pass
+        worker.print_stats()
@@ -38,7 +38,7 @@ except ImportError:
     import ImageChops
     import ImageFilter
 
-from django.core.files.base import ContentFile
+from django.core.files.base import File, ContentFile
 
 from restthumbnails import exceptions
 
@@ -93,25 +93,22 @@ def _exif_orientation(im, orientation=None):
 def _image_entropy(im):
     """
     Calculate the entropy of an image. Used for "smart cropping".
+
+    Image.entropy() computes the same sum of -p * log2(p) over im.histogram()
+    as a Python loop over the bins would, but in C.
     """
     if not isinstance(im, Image.Image):
         # Can only deal with PIL images. Fall back to a constant entropy.
         return 0
-    hist = im.histogram()
-    hist_size = float(sum(hist))
-    hist = [h / hist_size for h in hist]
-    return -sum([p * math.log(p, 2) for p in hist if p != 0])
+    return im.entropy()
 
 
-def _compare_entropy(start_slice, end_slice, slice, difference):
+def _compare_entropies(start_entropy, end_entropy, slice, difference):
     """
-    Calculate the entropy of two slices (from the start and end of an axis),
-    returning a tuple containing the amount that should be added to the start
-    and removed from the end of the axis.
-
+    Return a tuple containing the amount that should be added to the start
+    and removed from the end of the axis, given the entropy of two slices
+    (from the start and end of an axis).
     """
-    start_entropy = _image_entropy(start_slice)
-    end_entropy = _image_entropy(end_slice)
     if end_entropy and abs(start_entropy / end_entropy - 1) < 0.01:
         # Less than 1% difference, remove from both sides.
         if difference >= slice * 2:
@@ -123,7 +120,116 @@ def _compare_entropy(start_slice, end_slice, slice, difference):
     else:
         return slice, 0
 
-def get_image(source, exif_orientation=True, **options):
+
+def _smart_crop_axis(entropy, length, difference):
+    """
+    Incrementally remove slices with the least entropy from the edges of
+    an axis, until difference is removed. entropy(a, b) is the entropy of
+    the strip from a to b. Return the (start, end) of what remains.
+    """
+    start, end = 0, length
+    while difference:
+        slice = min(difference, max(difference // 5, 10))
+        add, remove = _compare_entropies(
+            entropy(start, start + slice), entropy(end - slice, end), slice, difference)
+        start += add
+        end -= remove
+        difference = difference - add - remove
+    return start, end
+
+
+def _smart_crop_box(im, diff_x, diff_y):
+    """
+    Box for crop="smart". Only the slices compared at each step are
+    cropped, and their entropy is computed in C (see _image_entropy()),
+    so the cost is about one histogram pass over the removed part.
+    """
+    source_x, source_y = im.size
+    left, right = 0, source_x
+    top, bottom = 0, source_y
+    if diff_x:
+        left, right = _smart_crop_axis(
+            lambda a, b: _image_entropy(im.crop((a, 0, b, source_y))),
+            source_x, diff_x,
+        )
+    if diff_y:
+        top, bottom = _smart_crop_axis(
+            lambda a, b: _image_entropy(im.crop((0, a, source_x, b))),
+            source_y, diff_y,
+        )
+    return (left, top, right, bottom)
+
+
+def _get_scale(source_size, size, crop=False):
+    """
+    Scale of the source image in scale_and_crop() for the requested size
+    """
+    source_x, source_y = [float(v) for v in source_size]
+    target_x, target_y = [float(v) for v in size]
+    our_crop = isinstance(crop, str) and crop.startswith('crop') and size[0] and size[1]
+    if our_crop:
+        return min(target_x / source_x, target_y / source_y)
+    elif crop or not target_x or not target_y:
+        return max(target_x / source_x, target_y / source_y)
+    else:
+        return min(target_x / source_x, target_y / source_y)
+
+
+def _reduce(image, size, crop, orientation):
+    """
+    Decode the image at the nearest power-of-two scale that is still not
+    smaller than scale_and_crop() needs for the requested size.
+
+    JPEG is decoded at the reduced scale with draft(), before load().
+    Other formats are loaded fully and then reduce()'d, which is much
+    cheaper than LANCZOS over the full resolution. Modes that reduce()
+    does not support are converted first, see _reducible().
+    """
+    source_x, source_y = image.size
+    if orientation in (5, 6, 7, 8):
+        # Size of the image after _exif_orientation()
+        scale = _get_scale((source_y, source_x), size, crop)
+    else:
+        scale = _get_scale((source_x, source_y), size, crop)
+    if scale >= 0.5:
+        image.load()
+        return image
+    needed = (int(math.ceil(source_x * scale)), int(math.ceil(source_y * scale)))
+    if image.format == 'JPEG':
+        image.draft(image.mode, needed)
+        image.load()
+    else:
+        image.load()
+        factor = 1
+        while source_x // (factor * 2) >= needed[0] and source_y // (factor * 2) >= needed[1]:
+            factor *= 2
+        if factor > 1 and hasattr(image, 'reduce'):
+            image = _reducible(image)
+            try:
+                image = image.reduce(factor)
+            except ValueError:
+                image = image.resize(
+                    (int(math.ceil(source_x / factor)), int(math.ceil(source_y / factor))),
+                    resample=Image.BOX)
+    return image
+
+
+def _reducible(image):
+    """
+    The image in a mode that reduce() supports: palette (P, PA) to RGB
+    or RGBA, bilevel (1) to L, 16-bit grayscale (I;16*) to I.
+    Other modes are returned as is.
+    """
+    if image.mode in ('P', 'PA'):
+        return image.convert('RGBA' if image.mode == 'PA' or _is_transparent(image) else 'RGB')
+    if image.mode == '1':
+        return image.convert('L')
+    if image.mode.startswith('I;16'):
+        return image.convert('I')
+    return image
+
+
+def get_image(source, exif_orientation=True, size=None, crop=False, **options):
     """
     Try to open the source file directly using PIL, ignoring any errors.
 
@@ -132,6 +238,12 @@ def get_image(source, exif_orientation=True, **options):
         If EXIF orientation data is present, perform any required reorientation
         before passing the data along the processing pipeline.
 
+    size, crop
+
+        Size and method of the thumbnail the image is opened for. If given,
+        the image is decoded at reduced resolution (see _reduce()), and
+        the EXIF orientation is applied after the reduction.
+
     Внесены изменения:
     Ориентация исходного снимка определяется пакетом piexif
 
@@ -139,14 +251,17 @@ def get_image(source, exif_orientation=True, **options):
     # Use a BytesIO wrapper because if the source is an incomplete file like
     # object, PIL may have problems with it. For example, some image types
     # require tell and seek methods that are not present on all storage
-    # File objects.
-
-    source = BytesIO(source.read())
+    # File objects. Seekable files (e.g. of FileSystemStorage) are read
+    # by PIL directly, without copying them to memory.
+    try:
+        seekable = source.seekable()
+    except (AttributeError, ValueError):
+        seekable = False
+    if not seekable:
+        source = BytesIO(source.read())
     image = Image.open(source)
-    # Fully load the image now to catch any problems with the image
-    # contents.
-    image.load()
 
+    orientation = None
     try:
         exif_dict = piexif.load(image.info["exif"])
     except (KeyError, AttributeError, ValueError,):
@@ -156,32 +271,41 @@ def get_image(source, exif_orientation=True, **options):
             orientation = exif_dict["0th"][piexif.ImageIFD.Orientation]
         except KeyError:
             orientation = None
+
+    # Fully load the image now to catch any problems with the image
+    # contents.
+    if size:
+        image = _reduce(image, size, crop, orientation)
+    else:
+        image.load()
+
+    if exif_orientation and orientation:
         image = _exif_orientation(image, orientation)
     return image
 
 
 def save_image(image, format='JPEG', **options):
     """
-    Save a PIL image to memory and return a BytesIO instance.
+    Save a PIL image to memory and return a File instance,
+    suitable for storage.save() without more copying.
     """
     destination = BytesIO()
     if format == 'JPEG':
         from restthumbnails import defaults
         options.setdefault('quality', defaults.THUMBNAIL_QUALITY)
+        if getattr(image, 'mode', '').upper() == 'RGBA':
+            image = image.convert('RGB')
         try:
-            if getattr(image, 'mode', '').upper() == 'RGBA':
-                image = image.convert('RGB')
             image.save(destination, format=format, optimize=1, **options)
         except IOError:
             # Try again, without optimization (PIL can't optimize an image
             # larger than ImageFile.MAXBLOCK, which is 64k by default)
-            pass
-    image.save(destination, format=format, **options)
-    if hasattr(destination, 'seek'):
-        destination.seek(0)
-    # FIXME: Copying to memory back and forth just because
-    # storage expects an object which implements a `chunks` method
-    return ContentFile(destination.read())
+            destination = BytesIO()
+            image.save(destination, format=format, **options)
+    else:
+        image.save(destination, format=format, **options)
+    destination.seek(0)
+    return File(destination, name='image.%s' % format.lower())
 
 
 def colorspace(im, bw=False, replace_alpha=False, **kwargs):
@@ -303,12 +427,7 @@ def scale_and_crop(
     target_x, target_y = [float(v) for v in size]
 
     our_crop =  crop.startswith('crop') and size[0] and size[1]
-    if our_crop:
-        scale = min(target_x / source_x, target_y / source_y)
-    elif crop or not target_x or not target_y:
-        scale = max(target_x / source_x, target_y / source_y)
-    else:
-        scale = min(target_x / source_x, target_y / source_y)
+    scale = _get_scale(im.size, size, crop)
 
     # Handle one-dimensional targets.
     if not target_x:
@@ -358,25 +477,7 @@ def scale_and_crop(
                         box[3] = source_y - (diff_y - offset)
             # See if the image should be "smart cropped".
             elif crop == 'smart':
-                left = top = 0
-                right, bottom = source_x, source_y
-                while diff_x:
-                    slice = min(diff_x, max(diff_x // 5, 10))
-                    start = im.crop((left, 0, left + slice, source_y))
-                    end = im.crop((right - slice, 0, right, source_y))
-                    add, remove = _compare_entropy(start, end, slice, diff_x)
-                    left += add
-                    right -= remove
-                    diff_x = diff_x - add - remove
-                while diff_y:
-                    slice = min(diff_y, max(diff_y // 5, 10))
-                    start = im.crop((0, top, source_x, top + slice))
-                    end = im.crop((0, bottom - slice, source_x, bottom))
-                    add, remove = _compare_entropy(start, end, slice, diff_y)
-                    top += add
-                    bottom -= remove
-                    diff_y = diff_y - add - remove
-                box = (left, top, right, bottom)
+                box = _smart_crop_box(im, diff_x, diff_y)
             # Finally, crop the image!
             if crop != 'scale':
                 im = im.crop(box)
@@ -414,7 +515,7 @@ def filters(im, detail=False, sharpen=False, **kwargs):
         
 def get_minimized_contentfile(source, minsize=0, quality=50):
     """
-    ContentFile фото с меньшим качеством, с сохранением exif
+    File (django) фото с меньшим качеством, с сохранением exif
     
     -   source,  любой объект, имеющий метод .read(),
         например, файловый объект из request.data
@@ -0,0 +1,109 @@
+"""
+Очередь генерации thumbnails
+
+Раньше thumbnail делался только при первом запросе к нему, а на
+одновременные запросы к тому же thumbnail, пока он делается, был
+ответ 404. Граф ссылается сразу на сотни разных thumbnails, и
+на холодной странице графа многие аватары не показывались.
+
+Теперь стандартный набор thumbnails (settings.THUMBNAILS_PREGENERATE)
+ставится в очередь при загрузке фото, см. PhotoModel.queue_thumbnails(),
+а для имеющихся фото ./manage.py thumbnails_warmup. Делает их пул
+процессов:
+
+    ./manage.py thumbnails_worker
+
+см. restthumbnails/worker.py.
+
+Списки в redis (settings.THUMBNAILS_QUEUE_REDIS_CONNECT):
+    high:   запросы к еще не сделанным thumbnails и только что
+            загруженные фото. Обработчик берет их раньше, чем low
+    low:    массовая генерация, thumbnails_warmup
+    alive:  не список, ключ с ограниченным временем жизни, его
+            обновляет работающий обработчик
+
+Если settings.THUMBNAILS_QUEUE_ON == False, redis недоступен или
+обработчик не запущен, thumbnail делается, как раньше, при запросе к нему.
+"""
+
+import re, json
+
+import redis
+
+from django.conf import settings
+
+from restthumbnails import defaults
+
+class ThumbnailQueue(object):
+
+    PREFIX = 'thumbnails_queue'
+
+    KEY_HIGH = PREFIX + ':high'
+    KEY_LOW = PREFIX + ':low'
+    KEY_ALIVE = PREFIX + ':alive'
+
+    # Через сколько секунд без обновления ключа alive
+    # считать обработчик очереди остановленным
+    #
+    ALIVE_TTL = 10
+
+    @classmethod
+    def connect(cls):
+        return redis.Redis(**settings.THUMBNAILS_QUEUE_REDIS_CONNECT)
+
+    @classmethod
+    def item_from_path(cls, path):
+        """
+        Элемент очереди: параметры restthumbnails.helpers.get_thumbnail()
+        из пути к thumbnail, как его строит PhotoModel.image_thumb_path(),
+        или None, если путь не к thumbnail
+        """
+        path = path[len(settings.THUMBNAILS_STORAGE_BASE_PATH):] \
+            if path.startswith(settings.THUMBNAILS_STORAGE_BASE_PATH) else path
+        m = re.search(defaults.URL_REGEX, path)
+        return m.groupdict() if m else None
+
+    @classmethod
+    def put(cls, items, high=False, r=None):
+        """
+        Поставить в очередь элементы items, см. item_from_path()
+
+        Возвращает True, если поставлено и обработчик очереди работает
+        """
+        if not settings.THUMBNAILS_QUEUE_ON or not items:
+            return False
+        try:
+            r_ = r or cls.connect()
+            r_.lpush(
+                cls.KEY_HIGH if high else cls.KEY_LOW,
+                *[json.dumps(item) for item in items]
+            )
+            alive = r_.exists(cls.KEY_ALIVE)
+            if not r:
+                r_.close()
+            return bool(alive)
+        except redis.RedisError:
+            return False
+
+    @classmethod
+    def is_served(cls):
+        """
+        Работает ли обработчик очереди
+        """
+        if not settings.THUMBNAILS_QUEUE_ON:
+            return False
+        try:
+            r = cls.connect()
+            alive = r.exists(cls.KEY_ALIVE)
+            r.close()
+            return bool(alive)
+        except redis.RedisError:
+            return False
+
+    @classmethod
+    def counts(cls, r):
+        return dict(
+            high=r.llen(cls.KEY_HIGH),
+            low=r.llen(cls.KEY_LOW),
+            alive=bool(r.exists(cls.KEY_ALIVE)),
+        )
@@ -0,0 +1,189 @@
+import os, math, shutil, stat, tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from PIL import Image
+
+from restthumbnails import processors
+from restthumbnails.files import ThumbnailFile
+from restthumbnails.views import ThumbnailView
+from restthumbnails import worker
+from restthumbnails.management.commands.bench_smart_crop import \
+    smart_crop_box_slices, noise_image, real_image_files
+
+class GetImageTest(SimpleTestCase):
+    """
+    get_image() с уменьшением при открытии (_reduce()) и дальнейшая
+    обработка, как в ThumbnailFile.generate(), для разных форматов
+    и режимов исходного изображения
+    """
+
+    SOURCE_SIZE = (1200, 900)
+    SIZE = (64, 64)
+
+    def source(self, mode, format, **options):
+        image = Image.linear_gradient('L').resize(self.SOURCE_SIZE)
+        if mode == 'I;16':
+            image = image.convert('I').point(lambda v: v * 256).convert('I;16')
+        elif mode == 'P':
+            image = image.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+        else:
+            image = image.convert(mode)
+        source = BytesIO()
+        image.save(source, format=format, **options)
+        source.seek(0)
+        return source
+
+    def thumbnail(self, source, crop='smart'):
+        im = processors.get_image(source, size=self.SIZE, crop=crop)
+        im = processors.scale_and_crop(im, self.SIZE, crop)
+        im = processors.colorspace(im)
+        processors.save_image(im)
+        return im
+
+    def check(self, source, mode_opened):
+        self.assertEqual(Image.open(source).mode, mode_opened)
+        source.seek(0)
+        for crop in ('smart', 'crop-white', 'scale'):
+            im = self.thumbnail(source, crop)
+            if crop == 'scale':
+                self.assertEqual(im.size, (85, 64))
+            else:
+                self.assertEqual(im.size, self.SIZE)
+            self.assertIn(im.mode, ('L', 'RGB', 'RGBA'))
+            source.seek(0)
+
+    def test_jpeg(self):
+        self.check(self.source('RGB', 'JPEG'), 'RGB')
+
+    def test_png_palette(self):
+        self.check(self.source('P', 'PNG'), 'P')
+
+    def test_png_palette_transparent(self):
+        self.check(self.source('P', 'PNG', transparency=0), 'P')
+
+    def test_gif(self):
+        self.check(self.source('P', 'GIF'), 'P')
+
+    def test_png_bilevel(self):
+        self.check(self.source('1', 'PNG'), '1')
+
+    def test_png_16bit(self):
+        self.check(self.source('I;16', 'PNG'), 'I;16')
+
+    def test_reduced(self):
+        # Уменьшено при открытии, но не меньше, чем нужно
+        for source in (self.source('P', 'GIF'), self.source('I;16', 'PNG')):
+            im = processors.get_image(source, size=self.SIZE, crop='smart')
+            self.assertEqual(im.size, (150, 113))
+
+class SmartCropTest(SimpleTestCase):
+    """
+    processors._smart_crop_box() дает ту же рамку, что и прежний
+    проход по срезам с энтропией, посчитанной в python
+    """
+
+    SIZES = ((400, 150), (150, 400), (300, 200), (85, 64), (64, 85), (90, 90))
+
+    def check(self, im):
+        source_x, source_y = im.size
+        for target in ((min(im.size),) * 2, (source_x // 2, source_y), (source_x, source_y // 3)):
+            diff_x, diff_y = source_x - target[0], source_y - target[1]
+            old = smart_crop_box_slices(im, diff_x, diff_y)
+            new = processors._smart_crop_box(im, diff_x, diff_y)
+            self.assertLessEqual(max(abs(a - b) for a, b in zip(old, new)), 1, (im.size, target))
+            self.assertEqual((new[2] - new[0], new[3] - new[1]), target)
+
+    def test_entropy(self):
+        im = noise_image((37, 23), part=0.5)
+        for mode in ('RGB', 'L', 'P', '1'):
+            image = im.convert(mode)
+            hist = image.histogram()
+            total = float(sum(hist))
+            expected = -sum((h / total) * math.log(h / total, 2) for h in hist if h)
+            self.assertAlmostEqual(processors._image_entropy(image), expected, places=9)
+
+    def test_noise(self):
+        for seed in range(3):
+            for size in self.SIZES:
+                self.check(noise_image(size, seed=seed))
+                self.check(noise_image(size, part=1/3.0, seed=seed))
+
+    def test_real(self):
+        fnames = real_image_files()
+        self.assertTrue(fnames)
+        for fname in fnames[:5]:
+            image = Image.open(fname).convert('RGB')
+            for size in self.SIZES:
+                self.check(image.resize(size))
+            self.check(image.convert('L').resize((300, 120)))
+
+class ThumbnailFileTest(SimpleTestCase):
+    """
+    Запись thumbnail через временный файл и постановка в очередь
+    один раз на thumbnail
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(
+            MEDIA_ROOT=os.path.join(self.root, 'media'),
+            THUMBNAILS_STORAGE_ROOT=os.path.join(self.root, 'thumb'),
+        )
+        self.settings.enable()
+        os.makedirs(os.path.join(self.root, 'media', 'photo'))
+        Image.linear_gradient('L').convert('RGB').resize((300, 200)).save(
+            os.path.join(self.root, 'media', 'photo', 'a.jpg')
+        )
+        cache.clear()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+        cache.clear()
+
+    def thumbnail(self):
+        return ThumbnailFile('photo/a.jpg', '64x64', 'crop', '.jpg')
+
+    def test_generate(self):
+        thumbnail = self.thumbnail()
+        self.assertFalse(thumbnail._exists())
+        self.assertTrue(thumbnail.generate())
+        self.assertTrue(thumbnail._exists())
+        self.assertEqual(Image.open(thumbnail.path).size, (64, 64))
+        self.assertEqual(stat.S_IMODE(os.stat(thumbnail.path).st_mode), 0o644)
+        self.assertEqual(os.listdir(os.path.dirname(thumbnail.path)), [os.path.basename(thumbnail.path)])
+
+    def test_save_failed(self):
+        # Недописанный thumbnail не появляется под своим именем
+        thumbnail = self.thumbnail()
+        with mock.patch('os.replace', side_effect=OSError):
+            with self.assertRaises(OSError):
+                thumbnail.generate()
+        self.assertFalse(thumbnail._exists())
+        self.assertEqual(os.listdir(os.path.dirname(thumbnail.path)), [])
+
+    def test_enqueue_once(self):
+        thumbnail = self.thumbnail()
+        view = ThumbnailView()
+        view.kwargs = dict(source='photo/a.jpg', size='64x64', method='crop', extension='.jpg')
+        with mock.patch('restthumbnails.views.ThumbnailQueue') as queue:
+            queue.put.return_value = True
+            queue.is_served.return_value = True
+            for i in range(3):
+                self.assertTrue(view.enqueue(thumbnail))
+            self.assertEqual(queue.put.call_count, 1)
+
+            # Обработчик закончил с thumbnail: его снова можно ставить
+            with mock.patch.object(worker, 'get_thumbnail', return_value=thumbnail):
+                self.assertEqual(worker.render(view.kwargs), 'generated')
+            os.unlink(thumbnail.path)
+            view.enqueue(thumbnail)
+            self.assertEqual(queue.put.call_count, 2)
+
+    @override_settings(THUMBNAILS_WAIT_TIMEOUT=10)
+    def test_wait_timeout(self):
+        self.assertEqual(ThumbnailView().wait_timeout, ThumbnailView.MAX_WAIT_TIMEOUT)
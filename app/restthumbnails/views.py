@@ -1,3 +1,5 @@
+import time
+
 from django import http
 from django.core.cache import cache
 from django.conf import settings
@@ -7,14 +9,46 @@ from django.views.generic import View
 from restthumbnails import defaults
 from restthumbnails.exceptions import ThumbnailError, SourceDoesNotExist
 from restthumbnails.helpers import get_thumbnail
+from restthumbnails.queue import ThumbnailQueue
 
 
 class ThumbnailView(View):
+    # Как часто проверять, не готов ли thumbnail, секунд
+    WAIT_INTERVAL = 0.05
+
+    # Дольше не ждем, сколько бы ни было в settings.THUMBNAILS_WAIT_TIMEOUT:
+    # ожидающий запрос занимает процесс сервера
+    MAX_WAIT_TIMEOUT = 0.5
+
     def __init__(self, *args, **kwargs):
         self.lock_timeout = defaults.LOCK_TIMEOUT
+        self.wait_timeout = min(
+            getattr(settings, 'THUMBNAILS_WAIT_TIMEOUT', 0),
+            self.MAX_WAIT_TIMEOUT
+        )
         self.sendfile = defaults.response_backend()
         super(ThumbnailView, self).__init__(*args, **kwargs)
 
+    def wait_for(self, thumbnail):
+        """
+        Подождать, пока thumbnail сделает кто-то другой
+        """
+        until = time.monotonic() + self.wait_timeout
+        while not thumbnail._exists():
+            if time.monotonic() >= until:
+                return False
+            time.sleep(self.WAIT_INTERVAL)
+        return True
+
+    def enqueue(self, thumbnail):
+        """
+        Поставить thumbnail в начало очереди, если его туда еще
+        не поставил другой запрос. Возвращает, работает ли обработчик
+        """
+        if cache.add(thumbnail.queued_key, True, self.lock_timeout):
+            return ThumbnailQueue.put([self.kwargs], high=True)
+        return ThumbnailQueue.is_served()
+
     def get(self, request, *args, **kwargs):
         # Return appropriate status code on invalid requests
         try:
@@ -25,11 +59,22 @@ class ThumbnailView(View):
             # the backend all the time.
             return http.HttpResponse(status=e.status, content=e)
 
+        if thumbnail._exists():
+            return self.sendfile(request, thumbnail)
+        if not thumbnail._source_exists():
+            raise http.Http404
+
+        # Если работает обработчик очереди, thumbnail делает он,
+        # раньше массовой генерации, см. restthumbnails/worker.py.
+        # Не дождались: делаем сами, если он еще не в работе
+        if thumbnail.is_allowed_size and \
+           self.enqueue(thumbnail) and self.wait_for(thumbnail):
+            return self.sendfile(request, thumbnail)
+
         # Make only one worker busy on this thumbnail by managing a lock
-        if cache.get(thumbnail.key) is None:
+        if cache.add(thumbnail.key, True, self.lock_timeout):
             no_source = False
             try:
-                cache.set(thumbnail.key, True, self.lock_timeout)
                 try:
                     thumbnail.generate()
                 except SourceDoesNotExist:
@@ -41,6 +86,10 @@ class ThumbnailView(View):
                 raise http.Http404
             return self.sendfile(request, thumbnail)
 
+        # Thumbnail делает другой запрос или обработчик очереди
+        if self.wait_for(thumbnail):
+            return self.sendfile(request, thumbnail)
+
         # Return 404 while there's a lock. Also, make sure user agents and
         # proxies don't cache this intermediate response.
         response = http.HttpResponse(status=404)
@@ -0,0 +1,128 @@
+"""
+Генерация thumbnails из очереди, см. restthumbnails/queue.py
+
+Запускается один процесс:
+
+    ./manage.py thumbnails_worker
+
+Thumbnails делает пул процессов (settings.THUMBNAILS_QUEUE_WORKERS).
+Из redis берется не больше элементов, чем свободных процессов в пуле,
+и каждый раз сначала из high, затем из low: запрос к еще не сделанному
+thumbnail ждет не дольше, чем делается один thumbnail, сколько бы
+ни стояло в low.
+
+Пока thumbnail делается, в кэше django та же блокировка
+(thumbnail.key), что ставит restthumbnails.views.ThumbnailView:
+один и тот же thumbnail не делается одновременно в обработчике
+и в запросе к нему. Запрос ставит thumbnail в очередь один раз,
+пока в кэше метка thumbnail.queued_key; обработчик снимает ее,
+закончив с thumbnail.
+
+Thumbnail пишется во временный файл и переименовывается, см.
+ThumbnailFile._save(): запрос не отдаст недописанный файл.
+"""
+
+import os, json
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connections
+
+from restthumbnails import defaults
+from restthumbnails.exceptions import ThumbnailError, SourceDoesNotExist
+from restthumbnails.helpers import get_thumbnail
+from restthumbnails.queue import ThumbnailQueue
+
+def init_process():
+    """
+    Соединения с базой и кэшем, унаследованные от родителя,
+    в процессе пула не используем
+    """
+    connections.close_all()
+    for c in caches.all():
+        c.close()
+
+def render(item):
+    """
+    Сделать thumbnail в процессе пула. Возвращает, что получилось
+    """
+    try:
+        thumbnail = get_thumbnail(**item)
+    except ThumbnailError:
+        return 'invalid'
+    try:
+        if thumbnail._exists():
+            return 'exists'
+        if not cache.add(thumbnail.key, True, defaults.LOCK_TIMEOUT):
+            return 'locked'
+        try:
+            generated = thumbnail.generate()
+        except SourceDoesNotExist:
+            return 'no_source'
+        finally:
+            cache.delete(thumbnail.key)
+        return 'generated' if generated else 'skipped'
+    finally:
+        # Если не получилось, следующий запрос к thumbnail снова поставит его в очередь
+        cache.delete(thumbnail.queued_key)
+
+class ThumbnailWorker(object):
+
+    # Сколько секунд ждать элемента очереди за один запрос к redis.
+    # Должно быть меньше ThumbnailQueue.ALIVE_TTL
+    #
+    POP_TIMEOUT = 1
+
+    def __init__(self, workers=None, verbose=False):
+        self.workers = workers or settings.THUMBNAILS_QUEUE_WORKERS or os.cpu_count() or 1
+        self.verbose = verbose
+        self.stats = dict()
+        self.r = None
+
+    def collect(self, futures):
+        """
+        Учесть сделанное, вернуть то, что еще в работе
+        """
+        done = set(f for f in futures if f.done())
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as excpt:
+                result = 'failed'
+                if self.verbose:
+                    print('Failed: %r' % excpt)
+            self.stats[result] = self.stats.get(result, 0) + 1
+        return futures - done
+
+    def run(self, once=False):
+        """
+        Делать thumbnails из очереди. once: выйти, когда очередь опустеет
+        """
+        self.r = ThumbnailQueue.connect()
+        futures = set()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_process) as pool:
+            try:
+                while True:
+                    self.r.set(ThumbnailQueue.KEY_ALIVE, os.getpid(), ex=ThumbnailQueue.ALIVE_TTL)
+                    if len(futures) >= self.workers:
+                        wait(futures, timeout=self.POP_TIMEOUT, return_when=FIRST_COMPLETED)
+                        futures = self.collect(futures)
+                        continue
+                    popped = self.r.brpop(
+                        [ThumbnailQueue.KEY_HIGH, ThumbnailQueue.KEY_LOW],
+                        timeout=self.POP_TIMEOUT,
+                    )
+                    if popped:
+                        futures.add(pool.submit(render, json.loads(popped[1])))
+                    futures = self.collect(futures)
+                    if once and not popped and not futures:
+                        break
+            finally:
+                self.r.delete(ThumbnailQueue.KEY_ALIVE)
+                wait(futures)
+                self.collect(futures)
+                self.r.close()
+
+    def print_stats(self):
+        print(', '.join('%s: %s' % (k, v) for k, v in sorted(self.stats.items())) or 'Nothing done')
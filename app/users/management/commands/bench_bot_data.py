@@ -0,0 +1,147 @@
+# bench_bot_data.py
+#
+# Замер времени ответа /api/profile_genesis/all?fmt=3d-force-graph
+# (ApiProfileGenesisAll, мимо cache_page и снимка графа): данные бота
+# из кэша, см. TelegramApiMixin.get_bot_data(), против прежнего
+# запроса getMe к телеграму на каждый вызов get_bot_username().
+#
+# Телеграм поддельный: http сервер на 127.0.0.1, отвечает на getMe
+# через --api-ms и считает запросы. Пользователи (--users) создаются
+# в транзакции, которая в конце откатывается.
+#
+# С кэшем данные бота устаревают через --ttl секунд (вместо
+# settings.TELEGRAM_BOT_DATA_TTL), чтобы за время замера они
+# обновлялись в фоне.
+#
+# Параметры:
+#   --requests  Сколько запросов в каждом замере, по умолчанию 200
+#   --users     Сколько пользователей в выдаче, по умолчанию 100
+#   --api-ms    Время ответа поддельного телеграма, по умолчанию 150
+#   --ttl       Время жизни данных бота в кэше, по умолчанию 1 секунда
+#   --port      Порт поддельного телеграма
+
+import time, json, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from django.conf import settings
+from django.db import transaction
+from django.test import RequestFactory
+from django.contrib.auth.models import User
+
+from users.models import TelegramApiMixin, Profile
+from contact.views import ApiProfileGenesisAll
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Поддельный телеграм: getMe
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, api_ms):
+        self.api_ms = api_ms
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', port), FakeTelegramHandler)
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.api_ms / 1000.0)
+        body = json.dumps(dict(ok=True, result=dict(
+            id=1, is_bot=True, first_name='Bench', username='bench_bot',
+        ))).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Command(BaseCommand):
+    help = 'Benchmark /api/profile_genesis/all?fmt=3d-force-graph with bot data from cache against getMe on each call'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='requests in each run')
+        parser.add_argument('--users', type=int, default=100, help='number of users in the response')
+        parser.add_argument('--api-ms', type=float, default=150, help='response time of the fake telegram')
+        parser.add_argument('--ttl', type=float, default=1, help='bot data time to live in cache, seconds')
+        parser.add_argument('--port', type=int, default=3092, help='port of the fake telegram')
+
+    def reset_bot_data(self):
+        TelegramApiMixin._bot_data = dict(data=None, expires=0)
+        cache.delete(TelegramApiMixin.BOT_DATA_CACHE_KEY)
+        cache.delete(TelegramApiMixin.BOT_DATA_CACHE_KEY + '_lock')
+
+    def measure(self, fake, n_requests):
+        factory = RequestFactory()
+        view = ApiProfileGenesisAll.as_view()
+        requests_before = fake.requests
+        latencies = []
+        username = None
+        for i in range(n_requests):
+            request = factory.get('/api/profile_genesis/all', dict(fmt='3d-force-graph', withalone='on'))
+            time_started = time.perf_counter()
+            response = view(request)
+            latencies.append((time.perf_counter() - time_started) * 1000)
+            username = response.data['bot_username']
+        return dict(
+            p50=percentile(latencies, 50),
+            p99=percentile(latencies, 99),
+            max=max(latencies),
+            getme=fake.requests - requests_before,
+            username=username,
+        )
+
+    def report(self, title, result):
+        print('%-24s p50 %8.2f ms, p99 %8.2f ms, max %8.2f ms, getMe: %4s, bot: %s' % (
+            title, result['p50'], result['p99'], result['max'], result['getme'], result['username'],
+        ))
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        stamp = int(time.time())
+        users = User.objects.bulk_create([
+            User(username='bench_%s_%s' % (stamp, i), first_name='Bench %s' % i)
+            for i in range(kwargs['users'])
+        ])
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+
+        fake = FakeTelegram(kwargs['port'], kwargs['api_ms'])
+        threading.Thread(target=fake.serve_forever, daemon=True).start()
+        api_telegram = TelegramApiMixin.API_TELEGRAM
+        ttl = settings.TELEGRAM_BOT_DATA_TTL
+        get_bot_data = TelegramApiMixin.get_bot_data
+        TelegramApiMixin.API_TELEGRAM = 'http://127.0.0.1:%s' % kwargs['port']
+        try:
+            print('Users: %s, requests: %s, getMe %s ms' % (kwargs['users'], kwargs['requests'], kwargs['api_ms']))
+
+            # Как было: getMe на каждый вызов
+            TelegramApiMixin.get_bot_data = TelegramApiMixin.fetch_bot_data
+            self.report('getMe on each call:', self.measure(fake, kwargs['requests']))
+            TelegramApiMixin.get_bot_data = get_bot_data
+
+            settings.TELEGRAM_BOT_DATA_TTL = kwargs['ttl']
+            self.reset_bot_data()
+            self.report('cache, cold start:', self.measure(fake, kwargs['requests']))
+            self.report('cache, warm:', self.measure(fake, kwargs['requests']))
+        finally:
+            TelegramApiMixin.get_bot_data = get_bot_data
+            TelegramApiMixin.API_TELEGRAM = api_telegram
+            settings.TELEGRAM_BOT_DATA_TTL = ttl
+            self.reset_bot_data()
+            fake.shutdown()
+            fake.server_close()
+        transaction.set_rollback(True)
@@ -0,0 +1,145 @@
+# bench_gedcom_import.py
+#
+# Замер импорта gedcom (ApiImportGedcom.do_import(), как в import_gedcom)
+# на сгенерированных файлах с заданным числом персон.
+#
+# Генератор, gedcom_generate(): персоны по порядку, у каждой, кроме
+# первых (основателей), родители -- семья из ранее созданных персон,
+# так что циклов родства нет. Соседние мужчина и женщина образуют
+# семью с вероятностью 0.8. У части персон даты рождения и смерти.
+#
+# Импорт в транзакции, которая в конце откатывается. Владелец,
+# с которым сливается первая персона файла, создается в ней же.
+# Отдельно замеряется только чтение файла (ged4py), без базы.
+#
+# Параметры:
+#   --individuals   Числа персон через запятую, по умолчанию 10000,100000
+#   --keep          Каталог, куда сохранить сгенерированные файлы.
+#                   По умолчанию файлы временные
+
+import os, time, random, tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users.models import CreateUserMixin
+from ged4py.parser import GedcomReader
+
+from users.views import ApiImportGedcom
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+FIRST_NAMES = dict(
+    M=('Иван', 'Петр', 'Сергей', 'Андрей', 'Николай', 'Алексей'),
+    F=('Мария', 'Анна', 'Елена', 'Ольга', 'Татьяна', 'Наталья'),
+)
+LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов')
+
+def gedcom_generate(f, n_individuals, seed=1):
+    """
+    Записать в f (файл, открытый на запись в двоичном режиме)
+    gedcom 5.5.1 c n_individuals персонами. Возвращает число семей
+    """
+    rnd = random.Random(seed)
+    founders = max(2, n_individuals // 10)
+    # [пол, famc, [fams, ...], год рождения]
+    persons = []
+    # [husb, wife, [chil, ...]]
+    families = []
+    for i in range(n_individuals):
+        sex = 'M' if i % 2 == 0 else 'F'
+        famc = None
+        year = 1700 + rnd.randrange(50)
+        if i >= founders and families:
+            famc = rnd.randrange(len(families))
+            families[famc][2].append(i)
+            year = persons[families[famc][0]][3] + 20 + rnd.randrange(20)
+        persons.append([sex, famc, [], year])
+        if sex == 'F' and rnd.random() < 0.8:
+            families.append([i - 1, i, []])
+            persons[i - 1][2].append(len(families) - 1)
+            persons[i][2].append(len(families) - 1)
+
+    def write(level, tag, value=''):
+        f.write(('%s %s%s\n' % (level, tag, ' ' + value if value else '')).encode('utf-8'))
+
+    write(0, 'HEAD')
+    write(1, 'SOUR', 'bench_gedcom_import')
+    write(1, 'GEDC')
+    write(2, 'VERS', '5.5.1')
+    write(2, 'FORM', 'LINEAGE-LINKED')
+    write(1, 'CHAR', 'UTF-8')
+    for i, (sex, famc, fams, year) in enumerate(persons):
+        write(0, '@I%s@' % (i + 1), 'INDI')
+        last_name = LAST_NAMES[i % len(LAST_NAMES)] + ('' if sex == 'M' else 'а')
+        write(1, 'NAME', '%s /%s/' % (rnd.choice(FIRST_NAMES[sex]), last_name))
+        write(1, 'SEX', sex)
+        if rnd.random() < 0.7:
+            write(1, 'BIRT')
+            write(2, 'DATE', '%s %s %s' % (rnd.randrange(1, 29), rnd.choice(MONTHS), year))
+        if year < 1950 and rnd.random() < 0.5:
+            write(1, 'DEAT', 'Y')
+            write(2, 'DATE', '%s' % (year + 30 + rnd.randrange(50)))
+        if famc is not None:
+            write(1, 'FAMC', '@F%s@' % (famc + 1))
+        for fam in fams:
+            write(1, 'FAMS', '@F%s@' % (fam + 1))
+    for n, (husb, wife, chil) in enumerate(families):
+        write(0, '@F%s@' % (n + 1), 'FAM')
+        write(1, 'HUSB', '@I%s@' % (husb + 1))
+        write(1, 'WIFE', '@I%s@' % (wife + 1))
+        for child in chil:
+            write(1, 'CHIL', '@I%s@' % (child + 1))
+    write(0, 'TRLR')
+    return len(families)
+
+class Command(CreateUserMixin, BaseCommand):
+    help = 'Benchmark gedcom import on generated files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--individuals', default='10000,100000',
+                            help='comma separated numbers of individuals')
+        parser.add_argument('--keep', help='directory to save generated files to')
+
+    def parse_file(self, fname):
+        """
+        Только чтение файла, как в do_import(), без записи в базу
+        """
+        import_gedcom = ApiImportGedcom()
+        time_started = time.time()
+        with GedcomReader(fname) as parser:
+            for indi in parser.records0('INDI'):
+                import_gedcom.indi_item(indi)
+        return time.time() - time_started
+
+    @transaction.atomic
+    def import_file(self, fname):
+        owner = self.create_user(first_name='bench_gedcom_import')
+        time_started = time.time()
+        with open(fname, 'rb') as f:
+            ApiImportGedcom().do_import(str(owner.profile.uuid), f, '@I1@')
+        took = time.time() - time_started
+        transaction.set_rollback(True)
+        return took
+
+    def handle(self, *args, **kwargs):
+        for n_individuals in [int(n) for n in kwargs['individuals'].split(',')]:
+            if kwargs['keep']:
+                fname = os.path.join(kwargs['keep'], 'bench_%s.ged' % n_individuals)
+            else:
+                fd, fname = tempfile.mkstemp(suffix='.ged')
+                os.close(fd)
+            try:
+                time_started = time.time()
+                with open(fname, 'wb') as f:
+                    n_families = gedcom_generate(f, n_individuals)
+                generated = time.time() - time_started
+                parsed = self.parse_file(fname)
+                took = self.import_file(fname)
+                print('%7s individuals, %7s families, %6.1f MB: generated %5.1f sec, '
+                      'parsed %6.1f sec, imported %6.1f sec, %6.0f individuals/sec' % (
+                    n_individuals, n_families, os.path.getsize(fname) / 1e6,
+                    generated, parsed, took, n_individuals / took,
+                ))
+            finally:
+                if not kwargs['keep']:
+                    os.unlink(fname)
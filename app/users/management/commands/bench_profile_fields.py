@@ -0,0 +1,165 @@
+# bench_profile_fields.py
+#
+# Замер запросов бота к /api/profile (ApiProfile) с fields= против
+# полного ответа: запросов к базе, время и размер ответа.
+#
+# Запросы, как от бота:
+#   -   POST с tg_token, tg_uid: Misc.post_tg_user(), без fields
+#       и с fields=data, как в KnownUsers.post_tg_user()
+#   -   GET tg_uid=..., GET username=...
+#   -   GET uuid=...: ответ строится get_by_uuid(), мимо ProfileCache,
+#       иначе видно лишь попадание в кэш
+# С fields: data, data,flags, data,tg_data, и полный ответ без fields.
+# Запросы через RequestFactory, прямо в представление, без middleware,
+# ответ отрисовывается, как при отдаче клиенту.
+#
+# Пользователь телеграма создается со всем, что входит в полный ответ:
+# отец, мать, --children детей, --wak желаний, возможностей, ключей.
+# Все в транзакции, которая в конце откатывается.
+#
+# Параметры:
+#   --requests  Сколько запросов каждого вида, по умолчанию 500
+#   --children  Сколько детей у пользователя, по умолчанию 3
+#   --wak       Сколько желаний, возможностей и ключей, по умолчанию 5
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction, connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework.renderers import JSONRenderer
+
+from users.models import Oauth, CreateUserMixin
+from users.views import ApiProfile
+from contact.models import CurrentState, Wish, Ability, Key, KeyType
+
+URL = '/api/profile'
+
+FIELDS = (None, 'data', 'data,flags', 'data,tg_data',)
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class Command(BaseCommand):
+    help = 'Benchmark bot calls to /api/profile with fields= against the full response: db queries and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='number of requests of each kind')
+        parser.add_argument('--children', type=int, default=3, help='number of children of the user')
+        parser.add_argument('--wak', type=int, default=5, help='number of wishes, abilities and keys of the user')
+
+    def fill(self, n_children, n_wak):
+        stamp = int(time.time())
+        creator = CreateUserMixin()
+        user = creator.create_user(last_name='Bench', first_name='Profile %s' % stamp)
+        oauth = Oauth.objects.create(
+            provider=Oauth.PROVIDER_TELEGRAM,
+            uid=str(8900000000 + stamp % 10 ** 8),
+            user=user,
+            last_name='Bench',
+            first_name='Profile',
+            username='bench_profile_%s' % stamp,
+        )
+        links = []
+        for is_father, first_name in ((True, 'Father'), (False, 'Mother')):
+            parent = creator.create_user(last_name='Bench', first_name=first_name)
+            links += [
+                CurrentState(user_from=user, user_to=parent, is_father=is_father, is_mother=not is_father),
+                CurrentState(user_from=parent, user_to=user, is_father=is_father, is_mother=not is_father, is_child=True),
+            ]
+        for i in range(n_children):
+            child = creator.create_user(last_name='Bench', first_name='Child %s' % i)
+            links += [
+                CurrentState(user_from=child, user_to=user, is_father=True),
+                CurrentState(user_from=user, user_to=child, is_father=True, is_child=True),
+            ]
+        CurrentState.objects.bulk_create(links)
+        Wish.objects.bulk_create([
+            Wish(owner=user, text='bench wish %s' % i, insert_timestamp=stamp)
+            for i in range(n_wak)
+        ])
+        Ability.objects.bulk_create([
+            Ability(owner=user, text='bench ability %s' % i, insert_timestamp=stamp)
+            for i in range(n_wak)
+        ])
+        Key.objects.bulk_create([
+            Key(owner=user, type_id=KeyType.OTHER_ID, value='bench key %s %s' % (stamp, i), insert_timestamp=stamp)
+            for i in range(n_wak)
+        ])
+        return user, oauth
+
+    def run(self, title, call, n_requests):
+        latencies = []
+        size = 0
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(n_requests):
+                time_started = time.perf_counter()
+                status_code, content = call()
+                latencies.append((time.perf_counter() - time_started) * 1000)
+                size = len(content)
+        if status_code != 200:
+            raise Exception('%s: %s %s' % (title, status_code, content[:200]))
+        print('%-40s p50 %6.2f ms, p99 %6.2f ms, %7s bytes, %5.1f db queries per request' % (
+            title + ':', percentile(latencies, 50), percentile(latencies, 99),
+            size, len(queries) / n_requests,
+        ))
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        factory = RequestFactory()
+        n = kwargs['requests']
+        user, oauth = self.fill(kwargs['children'], kwargs['wak'])
+        view = ApiProfile.as_view()
+
+        def view_call(make_request):
+            def call():
+                response = view(make_request())
+                response.render()
+                return response.status_code, response.content
+            return call
+
+        def post(fields):
+            data = dict(
+                tg_token=settings.TELEGRAM_BOT_TOKEN,
+                tg_uid=oauth.uid,
+                last_name=oauth.last_name,
+                first_name=oauth.first_name,
+                username=oauth.username,
+                activate='',
+                did_bot_start='',
+            )
+            if fields is not None:
+                data.update(fields=fields)
+            return view_call(lambda: factory.post(URL, data=data))
+
+        def get(fields, **params):
+            if fields is not None:
+                params.update(fields=fields)
+            return view_call(lambda: factory.get(URL, params))
+
+        def get_by_uuid(fields):
+            params = dict(uuid=str(user.profile.uuid))
+            if fields is not None:
+                params.update(fields=fields)
+
+            def call():
+                data, user_ids = ApiProfile().get_by_uuid(factory.get(URL, params))
+                return 200, JSONRenderer().render(data)
+            return call
+
+        for method, make_call in (
+            ('POST tg_uid', post),
+            ('GET tg_uid', lambda fields: get(fields, tg_uid=oauth.uid)),
+            ('GET username', lambda fields: get(fields, username=user.username)),
+            ('GET uuid, no cache', get_by_uuid),
+        ):
+            for fields in FIELDS:
+                title = '%s, %s' % (method, 'fields=%s' % fields if fields is not None else 'full')
+                self.run(title, make_call(fields), n)
+        transaction.set_rollback(True)
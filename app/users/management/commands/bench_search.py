@@ -0,0 +1,182 @@
+# bench_search.py
+#
+# Замер поиска пользователей, как в ApiProfile (query_person, query,
+# query_ability): по trigram индексу от Profile.search_name() и по
+# хранимому search_vector возможностей с GIN индексом, против прежних
+# iregex по имени и to_tsvector() по всем возможностям на каждый запрос.
+#
+# Пользователи (--users), профили и возможности (у доли --abilities
+# пользователей) создаются в транзакции, которая в конце откатывается.
+# 1 млн пользователей создаются несколько минут.
+#
+# Для каждого запроса: лучшее и медианное время из --repeat, число
+# найденных и использован ли индекс поиска, по EXPLAIN первой страницы
+# (--number). При малом числе пользователей postgres может обойтись
+# без индекса, тогда NO INDEX.
+#
+# Параметры:
+#   --users     Сколько пользователей, по умолчанию 1000000
+#   --abilities Доля пользователей с возможностями, по умолчанию 0.3
+#   --number    Размер страницы, по умолчанию 50
+#   --repeat    Сколько раз повторить каждый запрос
+
+import re, time, random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.query_utils import Q
+from django.db.models.functions import Collate, Lower
+from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchQuery, SearchVector, SearchRank
+
+from users.models import Profile
+from contact.models import Ability
+
+FIRST_NAMES = (
+    'Иван', 'Петр', 'Пётр', 'Сергей', 'Андрей', 'Фёдор', 'Федор', 'Николай', 'Алексей', 'Дмитрий',
+    'Мария', 'Анна', 'Алёна', 'Алена', 'Елена', 'Ольга', 'Татьяна', 'Наталья', 'Карина', 'Светлана',
+)
+LAST_NAMES = (
+    'Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов', 'Соловьёв', 'Бапинаев',
+    'Васильев', 'Зайцев', 'Павлов', 'Семёнов', 'Голубев', 'Виноградов', 'Богданов', 'Воробьёв',
+)
+ABILITY_WORDS = (
+    'ремонт квартир', 'программирование на python', 'уроки английского языка', 'стрижка собак',
+    'перевозка мебели', 'выпечка тортов', 'фотосъемка свадеб', 'репетитор по математике',
+    'настройка компьютеров', 'пошив одежды', 'садовые работы', 'массаж спины',
+)
+
+PERSON_QUERIES = ('иван', 'петров', 'алена', 'федор соловьев', 'бапин', 'нет такого')
+ABILITY_QUERIES = ('ремонт', 'python', 'уроки & английского', 'тортов | мебели', 'нет_такого')
+
+class Command(BaseCommand):
+    help = 'Benchmark user search by name and by abilities on indexes against the old full scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000, help='number of users')
+        parser.add_argument('--abilities', type=float, default=0.3, help='share of users with abilities')
+        parser.add_argument('--number', type=int, default=50, help='page size')
+        parser.add_argument('--repeat', type=int, default=5, help='runs of each query')
+
+    def fill(self, n_users, abilities, batch=10000):
+        stamp = int(time.time())
+        rnd = random.Random(1)
+        n_abilities = 0
+        for start in range(0, n_users, batch):
+            users = User.objects.bulk_create([
+                User(
+                    username='bench_%s_%s' % (stamp, i),
+                    first_name='%s %s' % (rnd.choice(LAST_NAMES), rnd.choice(FIRST_NAMES)),
+                )
+                for i in range(start, min(start + batch, n_users))
+            ])
+            Profile.objects.bulk_create([Profile(user=user) for user in users])
+            items = [
+                Ability(owner=user, text=rnd.choice(ABILITY_WORDS))
+                for user in users if rnd.random() < abilities
+            ]
+            Ability.objects.bulk_create(items)
+            n_abilities += len(items)
+        with connection.cursor() as cursor:
+            for table in ('auth_user', 'users_profile', Ability._meta.db_table):
+                cursor.execute('ANALYZE %s' % table)
+        return n_abilities
+
+    def order_by(self):
+        return [F('profile__dob').asc(nulls_first=True), Collate(Lower('first_name'), 'C')]
+
+    def q_active(self):
+        return Q(is_superuser=False) & (Q(is_active=True) | Q(profile__owner__isnull=False))
+
+    def person_old(self, query):
+        """
+        Как было: iregex по каждому слову с [её]
+        """
+        q = Q()
+        for word in query.split():
+            q &= Q(first_name__iregex=re.escape(word.lower().replace('ё', 'е')).replace('е', '[её]'))
+        return User.objects.filter(self.q_active(), q).select_related('profile'). \
+            order_by(*self.order_by()).distinct()
+
+    def person_new(self, query):
+        """
+        Как в ApiProfile: по Profile.search_name()
+        """
+        q = Q()
+        for word in query.split():
+            q &= Q(first_name_search__contains=Profile.search_name_str(word))
+        return User.objects.annotate(first_name_search=Profile.search_name('first_name')). \
+            filter(self.q_active(), q).select_related('profile').order_by(*self.order_by())
+
+    def ability_old(self, query):
+        """
+        Как было: to_tsvector() по всем возможностям
+        """
+        return User.objects.annotate(
+            search=SearchVector('ability__text', config='russian')
+        ).select_related('profile').filter(
+            self.q_active(), search=SearchQuery(query, search_type='raw', config='russian'),
+        ).order_by(*self.order_by()).distinct()
+
+    def ability_new(self, query):
+        """
+        Как в ApiProfile: по search_vector
+        """
+        search_query = SearchQuery(query, search_type='raw', config='russian')
+        found = Ability.objects.filter(search_vector=search_query)
+        rank = found.filter(owner=OuterRef('pk')).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank').values('rank')[:1]
+        return User.objects.filter(
+            self.q_active(), pk__in=found.values('owner_id')
+        ).annotate(search_rank=Subquery(rank)).select_related('profile').order_by(
+            F('search_rank').desc(), *self.order_by()
+        )
+
+    def measure(self, qs, number, repeat, index=None):
+        times = []
+        for i in range(repeat):
+            time_started = time.perf_counter()
+            page = list(qs[:number])
+            times.append(time.perf_counter() - time_started)
+        times.sort()
+        plan = qs[:number].explain()
+        return dict(
+            best=times[0] * 1000,
+            median=times[len(times) // 2] * 1000,
+            page=len(page),
+            index=index is None or index in plan,
+        )
+
+    def report(self, kind, query, old, new, total):
+        print('%-8s %-22s found %7s | old %9.1f ms (median %9.1f) | new %8.1f ms (median %8.1f)%s | x%.0f' % (
+            kind, repr(query), total, old['best'], old['median'], new['best'], new['median'],
+            '' if new['index'] else ' NO INDEX', old['best'] / new['best'] if new['best'] else 0,
+        ))
+        if old['page'] != new['page']:
+            print('    page size differs: old %s, new %s' % (old['page'], new['page']))
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        time_started = time.time()
+        n_abilities = self.fill(kwargs['users'], kwargs['abilities'])
+        print('Users: %s, abilities: %s, created in %.1f sec' % (
+            kwargs['users'], n_abilities, time.time() - time_started,
+        ))
+        number, repeat = kwargs['number'], kwargs['repeat']
+        for query in PERSON_QUERIES:
+            self.report(
+                'person', query,
+                self.measure(self.person_old(query), number, repeat),
+                self.measure(self.person_new(query), number, repeat, 'auth_user_first_name_trgm'),
+                self.person_new(query).count(),
+            )
+        for query in ABILITY_QUERIES:
+            self.report(
+                'ability', query,
+                self.measure(self.ability_old(query), number, repeat),
+                self.measure(self.ability_new(query), number, repeat, 'ability_search_vector_gin'),
+                self.ability_new(query).count(),
+            )
+        transaction.set_rollback(True)
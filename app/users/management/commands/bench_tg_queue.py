@@ -0,0 +1,181 @@
+# bench_tg_queue.py
+#
+# Нагрузочный тест отправки из очереди в телеграм, см. users/tg_queue_worker.py
+#
+# Запускается поддельный сервер Bot API (aiohttp, 127.0.0.1): отвечает
+# на sendMessage через --api-ms, на долю --error-429 запросов отвечает
+# 429 с retry_after, засекает время прихода каждого сообщения. В redis,
+# под своим префиксом, кладется --chats * --per-chat сообщений, и
+# TgQueueWorker отправляет их, пока очередь не опустеет.
+#
+# Задержка: от постановки в очередь до прихода в поддельный сервер.
+# Еще проверяется, что в каждый чат сообщения пришли по порядку и
+# не чаще settings.TG_QUEUE_CHAT_INTERVAL, и сколько запросов
+# к серверу было одновременно.
+#
+# Нужен запущенный redis (settings.TG_QUEUE_REDIS_CONNECT).
+#
+# Параметры:
+#   --chats             Сколько чатов, по умолчанию 300
+#   --per-chat          Сколько сообщений в каждый чат, по умолчанию 3
+#   --hot               Сколько сообщений еще в один чат, в начале очереди.
+#                       Прочие чаты не должны ждать, пока они уйдут
+#   --rate              Вместо settings.TG_QUEUE_RATE
+#   --chat-interval     Вместо settings.TG_QUEUE_CHAT_INTERVAL
+#   --api-ms            Время ответа поддельного сервера
+#   --error-429         Доля ответов 429
+#   --port              Порт поддельного сервера
+
+import time, json, random, asyncio
+
+from aiohttp import web
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from users.tg_queue import TgQueue
+from users.tg_queue_worker import TgQueueWorker
+
+PREFIX = 'bench_tg_queue'
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class FakeTelegram(object):
+    """
+    Поддельный сервер Bot API
+    """
+
+    def __init__(self, api_ms, error_429):
+        self.api_ms = api_ms
+        self.error_429 = error_429
+        self.random = random.Random(1)
+        # {chat_id: [(время прихода, номер сообщения), ...]}
+        self.received = dict()
+        self.requests = self.in_flight = self.in_flight_max = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        self.in_flight += 1
+        self.in_flight_max = max(self.in_flight_max, self.in_flight)
+        try:
+            data = await request.json()
+            if self.api_ms:
+                await asyncio.sleep(self.api_ms / 1000.0)
+            if self.random.random() < self.error_429:
+                return web.json_response(
+                    dict(ok=False, error_code=429, description='Too Many Requests',
+                         parameters=dict(retry_after=1)),
+                    status=429,
+                )
+            self.received.setdefault(data['chat_id'], []).append((time.time(), int(data['text'])))
+            return web.json_response(dict(ok=True, result=dict(message_id=1)))
+        finally:
+            self.in_flight -= 1
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+class Command(BaseCommand):
+    help = 'Load test of tg_queue_worker against a fake telegram server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=300, help='number of chats')
+        parser.add_argument('--per-chat', type=int, default=3, help='messages to each chat')
+        parser.add_argument('--hot', type=int, default=0, help='messages to one more chat, queued first')
+        parser.add_argument('--rate', type=float, default=settings.TG_QUEUE_RATE,
+            help='messages per second, instead of settings.TG_QUEUE_RATE')
+        parser.add_argument('--chat-interval', type=float, default=settings.TG_QUEUE_CHAT_INTERVAL,
+            help='seconds between messages to a chat, instead of settings.TG_QUEUE_CHAT_INTERVAL')
+        parser.add_argument('--api-ms', type=float, default=50, help='response time of the fake server')
+        parser.add_argument('--error-429', type=float, default=0, help='share of 429 responses')
+        parser.add_argument('--port', type=int, default=3091, help='port of the fake server')
+
+    def setup_queue(self):
+        TgQueue.KEY_PENDING = PREFIX + ':pending'
+        TgQueue.KEY_PROCESSING = PREFIX + ':processing'
+        TgQueue.KEY_DEAD = PREFIX + ':dead'
+        r = TgQueue.connect()
+        r.delete(TgQueue.KEY_PENDING, TgQueue.KEY_PROCESSING, TgQueue.KEY_DEAD)
+        return r
+
+    def put(self, r, chats, per_chat, hot):
+        """
+        Сообщения в очередь: сначала hot в чат 0, дальше вперемешку
+        по чатам. Возвращает {номер: время постановки}
+        """
+        queued = dict()
+        pipe = r.pipeline(transaction=False)
+        n = 0
+        chat_ids = [0] * hot + [chat_id for i in range(per_chat) for chat_id in range(1, chats + 1)]
+        for chat_id in chat_ids:
+            n += 1
+            item = TgQueue.make_item('sendMessage', dict(chat_id=chat_id, text=str(n)))
+            queued[n] = item['queued']
+            pipe.lpush(TgQueue.KEY_PENDING, json.dumps(item))
+        pipe.execute()
+        return queued
+
+    async def run(self, kwargs, queued):
+        fake = FakeTelegram(kwargs['api_ms'], kwargs['error_429'])
+        await fake.start(kwargs['port'])
+        worker = TgQueueWorker(api='http://127.0.0.1:%s' % kwargs['port'])
+        time_started = time.time()
+        try:
+            await worker.run(once=True)
+        finally:
+            await fake.stop()
+        return fake, worker, time.time() - time_started
+
+    def handle(self, *args, **kwargs):
+        settings.TG_QUEUE_RATE = kwargs['rate']
+        settings.TG_QUEUE_CHAT_INTERVAL = kwargs['chat_interval']
+        settings.TG_QUEUE_RETRY_DELAY = 1
+        r = self.setup_queue()
+        queued = self.put(r, kwargs['chats'], kwargs['per_chat'], kwargs['hot'])
+        fake, worker, took = asyncio.run(self.run(kwargs, queued))
+        r.delete(TgQueue.KEY_PENDING, TgQueue.KEY_PROCESSING, TgQueue.KEY_DEAD)
+        r.close()
+
+        latencies = []
+        out_of_order = too_often = 0
+        for chat_id, received in fake.received.items():
+            if chat_id:
+                latencies.extend(t - queued[n] for t, n in received)
+            for (t1, n1), (t2, n2) in zip(received, received[1:]):
+                if n2 < n1:
+                    out_of_order += 1
+                # Запрос засекается в worker до отправки, здесь -- по приходу
+                if t2 - t1 < settings.TG_QUEUE_CHAT_INTERVAL - 0.05:
+                    too_often += 1
+        sent = sum(len(received) for received in fake.received.values())
+        # Быстрее не дает ни общий предел, ни предел на чат
+        ideal = max(
+            len(queued) / settings.TG_QUEUE_RATE,
+            (max(kwargs['per_chat'], kwargs['hot']) - 1) * settings.TG_QUEUE_CHAT_INTERVAL,
+        )
+        print('Messages: %s to %s chats, %s to hot chat, rate %s/s, chat interval %s s, '
+              'api %s ms, 429: %s, concurrency %s' % (
+            len(queued) - kwargs['hot'], kwargs['chats'], kwargs['hot'],
+            settings.TG_QUEUE_RATE, settings.TG_QUEUE_CHAT_INTERVAL,
+            kwargs['api_ms'], kwargs['error_429'], settings.TG_QUEUE_CONCURRENCY,
+        ))
+        print('Sent: %s, dead: %s, retried: %s, requests: %s, max in flight: %s' % (
+            sent, worker.stats['dead'], worker.stats['retried'], fake.requests, fake.in_flight_max,
+        ))
+        print('Took %.2f sec (limit %.2f sec), %.1f messages/sec' % (took, ideal, sent / took if took else 0))
+        print('Latency sec, except hot chat: p50 %.2f, p95 %.2f, p99 %.2f, max %.2f' % (
+            percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+            max(latencies) if latencies else 0,
+        ))
+        print('Out of order: %s, sooner than chat interval: %s' % (out_of_order, too_often))
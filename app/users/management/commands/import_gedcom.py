@@ -8,11 +8,13 @@
 # Параметры:
 #   owner_uuid  Пользователь, который становится владельцем всех файлов
 #   filename    Файл в gedcom формате
-
-from io import BytesIO
+#   indi_to_merge   xref_id персоны в файле, которая сливается с владельцем
+#
+# Файл читается по одной персоне, пользователи и связи создаются порциями,
+# каждая в своей транзакции, см. ApiImportGedcom.do_import().
+# Ход импорта выводится на экран
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 
 from app.utils import ServiceException
 from users.views import ApiImportGedcom
@@ -25,25 +27,22 @@ class Command(BaseCommand):
         parser.add_argument('filename', type=str, help='/path/to/gedcom_file, gedcom file with family tree')
         parser.add_argument('indi_to_merge', type=str, help='gedcom file individual xref_id to be merged with owner')
 
-    @transaction.atomic
     def handle(self, *args, **kwargs):
         owner_uuid = kwargs['owner_uuid']
         filename = kwargs['filename']
         indi_to_merge = kwargs['indi_to_merge']
         try:
             f = open(filename, mode='rb')
-            bytes_io = f.read()
         except OSError:
             print("Failed to read '%s' file" % filename)
             exit()
-        f.close()
-        bytes_io = BytesIO(bytes_io)
 
         try:
             import_gedcom = ApiImportGedcom()
-            import_gedcom.do_import(owner_uuid, bytes_io, indi_to_merge)
+            import_gedcom.do_import(owner_uuid, f, indi_to_merge, progress=print)
             print('OK')
         except ServiceException as excpt:
-            transaction.set_rollback(True)
             print('ERROR: %s' % excpt.args[0])
+        finally:
+            f.close()
 
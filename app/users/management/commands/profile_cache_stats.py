@@ -0,0 +1,26 @@
+# profile_cache_stats.py
+#
+# Показать статистику кэша профилей (users/profile_cache.py):
+# попадания, промахи, ответы, не помещенные в кэш из-за
+# одновременной записи в базу
+#
+# Параметры:
+#   --reset     обнулить статистику после показа
+
+from django.core.management.base import BaseCommand
+
+from users.profile_cache import ProfileCache
+
+class Command(BaseCommand):
+    help = 'Show profile cache hits, misses and uncached responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='reset counters after showing')
+
+    def handle(self, *args, **kwargs):
+        stats = ProfileCache.stats(reset=kwargs['reset'])
+        total = stats['hits'] + stats['misses'] + stats['uncached']
+        print('hits: %s, misses: %s, uncached: %s, hit ratio: %s' % (
+            stats['hits'], stats['misses'], stats['uncached'],
+            '%.1f%%' % (stats['hits'] * 100.0 / total) if total else '-',
+        ))
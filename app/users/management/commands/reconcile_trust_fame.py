@@ -0,0 +1,27 @@
+# reconcile_trust_fame.py
+#
+# Сверить и исправить счетчики доверий, недоверий, знакомств
+# и известность (fame) в профилях с данными CurrentState.
+# Запускать периодически, например, раз в сутки по cron
+#
+# Параметры:
+#   --dry-run   только показать расхождения, не исправлять
+
+from django.core.management.base import BaseCommand
+
+from users.models import Profile
+
+class Command(BaseCommand):
+    help = 'Reconcile profiles trust, mistrust, acq counters and fame with CurrentState'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='report drift only, do not fix')
+
+    def handle(self, *args, **kwargs):
+        drifts = Profile.reconcile_trust_fame(fix=not kwargs['dry_run'])
+        for user_id, drift in drifts:
+            print('user_id %s: %s' % (
+                user_id,
+                ', '.join('%s %s -> %s' % (f, old, new) for f, (old, new) in drift.items()),
+            ))
+        print('Profiles with drift: %s%s' % (len(drifts), '' if kwargs['dry_run'] else ', fixed',))
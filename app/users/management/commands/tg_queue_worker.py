@@ -0,0 +1,45 @@
+# tg_queue_worker.py
+#
+# Отправлять сообщения в телеграм из очереди, см. users/tg_queue.py,
+# users/tg_queue_worker.py. Запускать один процесс, например, через systemd
+#
+# Параметры:
+#   --once          Выйти, когда очередь опустеет
+#   --stats         Показать размеры очереди и выйти
+#   --requeue-dead  Вернуть в очередь не отправленные и выйти
+#   --api           Адрес апи телеграма, по умолчанию settings.TG_QUEUE_API
+#   --verbose       Сообщать о не отправленных
+
+import asyncio
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from users.tg_queue import TgQueue
+from users.tg_queue_worker import TgQueueWorker
+
+class Command(BaseCommand):
+    help = 'Send queued telegram messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit when queue is empty')
+        parser.add_argument('--stats', action='store_true', help='show queue sizes and exit')
+        parser.add_argument('--requeue-dead', action='store_true', help='put dead messages back to queue and exit')
+        parser.add_argument('--api', type=str, default=settings.TG_QUEUE_API,
+            help='telegram api url, e.g. of a fake server for testing')
+        parser.add_argument('--verbose', action='store_true', help='report dead messages')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['stats'] or kwargs['requeue_dead']:
+            r = TgQueue.connect()
+            if kwargs['requeue_dead']:
+                print('Requeued: %s' % TgQueue.requeue_dead(r))
+            print(', '.join('%s: %s' % (k, v) for k, v in TgQueue.counts(r).items()))
+            r.close()
+            return
+        worker = TgQueueWorker(api=kwargs['api'], verbose=kwargs['verbose'])
+        try:
+            asyncio.run(worker.run(once=kwargs['once']))
+        except KeyboardInterrupt:
+            pass
+        worker.print_stats()
@@ -0,0 +1,23 @@
+# Поиск по имени: trigram индекс по выражению Profile.search_name()
+# от auth_user.first_name
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0057_remove_offer_desc_offer_tgdesc'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            """
+            CREATE INDEX IF NOT EXISTS auth_user_first_name_trgm
+            ON auth_user USING gin ((translate(lower(first_name), 'ё', 'е')) gin_trgm_ops);
+            """,
+            "DROP INDEX IF EXISTS auth_user_first_name_trgm;",
+        ),
+    ]
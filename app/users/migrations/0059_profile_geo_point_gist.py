@@ -0,0 +1,20 @@
+# Поиск профилей в прямоугольнике карты: GiST индекс по
+# point(longitude, latitude), см. app.models.GeoPointInRectangle
+
+from django.db import migrations
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0058_first_name_trgm'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            CREATE INDEX IF NOT EXISTS users_profile_geo_point_gist
+            ON users_profile USING gist (point(longitude, latitude));
+            """,
+            "DROP INDEX IF EXISTS users_profile_geo_point_gist;",
+        ),
+    ]
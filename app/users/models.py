@@ -1,12 +1,14 @@
 import datetime, string, random, os, binascii, time
 import urllib.request, urllib.error, urllib.parse
 from urllib.parse import urlencode
-import json, re, hashlib
+import json, re, hashlib, threading
 from uuid import uuid4, UUID
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models, transaction, IntegrityError
-from django.db.models import Sum, F, Prefetch
+from django.db.models import Sum, F, Count, Prefetch, prefetch_related_objects, Func, Value, CharField
+from django.db.models.functions import Greatest, Lower
 from django.db.models.query_utils import Q
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
@@ -23,6 +25,9 @@ from app.models import UnclearDateModelField, GenderMixin
 
 from app.models import BaseModelInsertUpdateTimestamp, BaseModelInsertTimestamp, PhotoModel, GeoPointAddressModel
 from app.utils import ServiceException
+from contact.graph import GenesisGraph, TrustGraph
+from users.profile_cache import ProfileCache
+from users.tg_queue import TgQueue
 
 class TgGroup(BaseModelInsertTimestamp):
     """
@@ -398,7 +403,39 @@ class Profile(PhotoModel, GeoPointAddressModel):
     def __str__(self):
         return self.user.first_name or str(self.pk)
 
-    def data_dict(self, request=None, fmt='d3js', thumb={}, short=False):
+    # Признаки в полном формате data_dict(), каждый -- запрос к базе,
+    # если не выбран заранее в prefetch_data_flags()
+    #
+    DATA_FLAGS = ('is_meetgame_admin', 'is_power', 'has_tgdesc', 'has_bank', 'r_sympa_username', )
+
+    # Части ответа /api/profile о пользователе, что можно запросить
+    # в параметре fields= (через запятую), и сколько запросов к базе
+    # стоит каждая, при выбранных вместе с профилем user, ability,
+    # owner, owner__profile:
+    #   data        data_dict() без признаков, есть всегда
+    #   <признак>   из DATA_FLAGS, flags: все признаки
+    #   parents     parents_dict(): родители и дети, с их признаками
+    #   wak         data_WAK(): желания, возможности, ключи
+    #   owner       owner_dict(): владелец, с его is_power
+    #   tg_data     аккаунты телеграма
+    # Без fields= ответ, как раньше, со всеми частями:
+    # 5 + 5 + 3 + 1 + 1 = 15 запросов. Боту обычно хватает fields=data,
+    # 0 запросов
+    #
+    PROJECTION_COST = dict(
+        data=0,
+        is_meetgame_admin=1,
+        is_power=1,
+        has_tgdesc=1,
+        has_bank=1,
+        r_sympa_username=1,
+        parents=5,
+        wak=3,
+        owner=1,
+        tg_data=1,
+    )
+
+    def data_dict(self, request=None, fmt='d3js', thumb={}, short=False, flags=DATA_FLAGS):
         user = self.user
         result = dict()
         if request:
@@ -449,8 +486,6 @@ class Profile(PhotoModel, GeoPointAddressModel):
                 middle_name=self.middle_name,
                 photo=photo,
                 is_notified=self.is_notified,
-                is_meetgame_admin=self.is_meetgame_admin(),
-                is_power = self.is_power(),
                 sum_thanks_count=self.sum_thanks_count,
                 fame=self.fame,
                 mistrust_count=self.mistrust_count,
@@ -469,24 +504,145 @@ class Profile(PhotoModel, GeoPointAddressModel):
                 dod=self.dod and self.dod.str_safe() or None,
                 comment=self.comment or '',
                 did_meet=self.did_meet,
-                has_tgdesc=self.tgdesc.exists(),
-                has_bank=self.has_bank(),
-                r_sympa_username=self.r_sympa.username if self.r_sympa else None,
             )
+            for flag in flags:
+                result[flag] = getattr(self, flag)()
+        return result
+
+    @classmethod
+    def parse_fields(cls, fields):
+        """
+        Множество частей ответа из параметра fields=, см. PROJECTION_COST,
+        или None, если fields не задан: ответ со всеми частями
+        """
+        if fields is None:
+            return None
+        result = set()
+        for field in fields.split(','):
+            field = field.strip()
+            if not field:
+                continue
+            if field == 'flags':
+                result.update(cls.DATA_FLAGS)
+            elif field in cls.PROJECTION_COST:
+                result.add(field)
+            else:
+                raise ServiceException('Неизвестное поле в fields: %s' % field)
         return result
 
+    def projected_dict(self, request, fields=None):
+        """
+        Данные пользователя для /api/profile: data_dict() и части
+        из fields (см. parse_fields()), по умолчанию все
+        """
+        if fields is None:
+            fields = set(self.PROJECTION_COST) | set(self.DATA_FLAGS)
+        data = self.data_dict(request, flags=[f for f in self.DATA_FLAGS if f in fields])
+        if 'parents' in fields:
+            data.update(self.parents_dict(request))
+        if 'wak' in fields:
+            data.update(self.data_WAK())
+        if 'owner' in fields:
+            data.update(self.owner_dict())
+        if 'tg_data' in fields:
+            data.update(tg_data=self.tg_data())
+        return data
+
+    @classmethod
+    def data_dicts(cls, profiles, request=None, fmt='d3js', thumb={}, short=False):
+        """
+        data_dict() для списка (queryset) профилей
+
+        Признаки полного формата (has_bank, is_power и т.п.) выбираются
+        не по запросу на каждый профиль, а несколькими запросами на всех,
+        см. prefetch_data_flags()
+        """
+        profiles = list(profiles)
+        if fmt != '3d-force-graph' and not short:
+            cls.prefetch_data_flags(profiles)
+        else:
+            prefetch_related_objects(profiles, 'user')
+        return [
+            profile.data_dict(request=request, fmt=fmt, thumb=thumb, short=short)
+            for profile in profiles
+        ]
+
+    @classmethod
+    def prefetch_data_flags(cls, profiles):
+        """
+        Заполнить у профилей признаки для data_dict(), без запроса на каждый профиль
+
+        Запросы: пользователи и способности (если не были выбраны ранее),
+        группы пользователей, реквизиты платежей, описания, взаимные симпатии.
+        """
+        if not profiles:
+            return
+        Key = get_model('contact', 'Key')
+        KeyType = get_model('contact', 'KeyType')
+        prefetch_related_objects(profiles, 'user', 'ability')
+        user_ids = [profile.user_id for profile in profiles]
+
+        groups_by_user_id = dict()
+        for user_id, group_id in User.groups.through.objects.filter(
+                user_id__in=user_ids,
+                group_id__in=(settings.GROUP_IDS['power_telegram'], settings.GROUP_IDS['meetgame_admin'],),
+            ).values_list('user_id', 'group_id'):
+            groups_by_user_id.setdefault(user_id, set()).add(group_id)
+        bank_user_ids = set(Key.objects.filter(
+                owner_id__in=user_ids, type_id=KeyType.BANKING_DETAILS_ID,
+            ).values_list('owner_id', flat=True))
+        tgdesc_profile_ids = set(Profile.tgdesc.through.objects.filter(
+                profile_id__in=[profile.pk for profile in profiles],
+            ).values_list('profile_id', flat=True))
+        r_sympa_ids = set(profile.r_sympa_id for profile in profiles if profile.r_sympa_id)
+        r_sympa_usernames = dict(
+            User.objects.filter(pk__in=r_sympa_ids).values_list('pk', 'username')
+        ) if r_sympa_ids else dict()
+
+        for profile in profiles:
+            groups = groups_by_user_id.get(profile.user_id, set())
+            profile._data_flags = dict(
+                is_power=settings.GROUP_IDS['power_telegram'] in groups,
+                is_meetgame_admin=settings.GROUP_IDS['meetgame_admin'] in groups,
+                has_bank=profile.user_id in bank_user_ids,
+                has_tgdesc=profile.pk in tgdesc_profile_ids,
+                r_sympa_username=r_sympa_usernames.get(profile.r_sympa_id),
+            )
+
+    def get_data_flag(self, flag):
+        """
+        Признак, выбранный заранее в prefetch_data_flags(), или None
+        """
+        return getattr(self, '_data_flags', {}).get(flag)
+
     def has_bank(self):
         """
         Имеет ли Реквизиты платежей
         """
+        if (result := self.get_data_flag('has_bank')) is not None:
+            return result
         Key = get_model('contact', 'Key')
         KeyType = get_model('contact', 'KeyType')
         return Key.objects.filter(owner=self.user, type__pk=KeyType.BANKING_DETAILS_ID).exists()
 
+    def has_tgdesc(self):
+        if (result := self.get_data_flag('has_tgdesc')) is not None:
+            return result
+        return self.tgdesc.exists()
+
+    def r_sympa_username(self):
+        if hasattr(self, '_data_flags'):
+            return self._data_flags['r_sympa_username']
+        return self.r_sympa.username if self.r_sympa else None
+
     def is_power(self):
+        if (result := self.get_data_flag('is_power')) is not None:
+            return result
         return self.user.groups.filter(pk=settings.GROUP_IDS['power_telegram']).exists()
 
     def is_meetgame_admin(self):
+        if (result := self.get_data_flag('is_meetgame_admin')) is not None:
+            return result
         return self.user.groups.filter(pk=settings.GROUP_IDS['meetgame_admin']).exists()
 
     def owner_dict(self, request=None):
@@ -553,6 +709,9 @@ class Profile(PhotoModel, GeoPointAddressModel):
 
         user = self.user
         user_from = profile_from.user
+        # Изменения связей отмечаем в CurrentState.update_timestamp,
+        # см. contact/snapshot.py
+        update_timestamp = int(time.time())
         Oauth.objects.filter(user=user_from).update(user=user)
 
         Journal.objects.filter(user_from=user_from).update(user_from=user)
@@ -569,13 +728,13 @@ class Profile(PhotoModel, GeoPointAddressModel):
                 with transaction.atomic():
                     thanks_count = cs.thanks_count
                     user_to = cs.user_to
-                    CurrentState.objects.filter(pk=cs.pk).update(user_from=user)
+                    CurrentState.objects.filter(pk=cs.pk).update(user_from=user, update_timestamp=update_timestamp)
             except IntegrityError:
                 CurrentState.objects.filter(pk=cs.pk).delete()
                 CurrentState.objects.filter(
                     user_from=user,
                     user_to=user_to
-                ).update(thanks_count=F('thanks_count') + thanks_count)
+                ).update(thanks_count=F('thanks_count') + thanks_count, update_timestamp=update_timestamp)
         CurrentState.objects.filter(user_from=user, user_to=user).delete()
 
         for cs in CurrentState.objects.filter(user_to=user_from):
@@ -583,27 +742,31 @@ class Profile(PhotoModel, GeoPointAddressModel):
                 with transaction.atomic():
                     thanks_count = cs.thanks_count
                     user_from_ = cs.user_from
-                    CurrentState.objects.filter(pk=cs.pk).update(user_to=user)
+                    CurrentState.objects.filter(pk=cs.pk).update(user_to=user, update_timestamp=update_timestamp)
             except IntegrityError:
                 CurrentState.objects.filter(pk=cs.pk).delete()
                 CurrentState.objects.filter(
                     user_from=user_from_,
                     user_to=user
-                ).update(thanks_count=F('thanks_count') + thanks_count)
+                ).update(thanks_count=F('thanks_count') + thanks_count, update_timestamp=update_timestamp)
         CurrentState.objects.filter(user_from=user, user_to=user).delete()
+        user_pks = (user.pk, user_from.pk,)
+        transaction.on_commit(lambda: GenesisGraph.users_changed(user_pks))
+        transaction.on_commit(lambda: TrustGraph.users_changed(user_pks))
+        ProfileCache.on_commit_users_changed(user_pks)
 
         for cs in CurrentState.objects.filter(user_from=user_from, anytext__isnull=False):
             try:
                 with transaction.atomic():
                     anytext = cs.anytext
                     thanks_count = cs.thanks_count
-                    CurrentState.objects.filter(pk=cs.pk).update(user_from=user)
+                    CurrentState.objects.filter(pk=cs.pk).update(user_from=user, update_timestamp=update_timestamp)
             except IntegrityError:
                 CurrentState.objects.filter(pk=cs.pk).delete()
                 CurrentState.objects.filter(
                     user_from=user,
                     anytext=anytext
-                ).update(thanks_count=F('thanks_count') + thanks_count)
+                ).update(thanks_count=F('thanks_count') + thanks_count, update_timestamp=update_timestamp)
 
         Wish.objects.filter(owner=user_from).update(owner=user)
 
@@ -701,6 +864,96 @@ class Profile(PhotoModel, GeoPointAddressModel):
         if do_save:
             self.save(update_fields=('sum_thanks_count',))
 
+    def add_sum_thanks_count(self, count):
+        """
+        Увеличить число благодарностей, без сохранения остальных полей профиля
+        """
+        Profile.objects.filter(pk=self.pk).update(sum_thanks_count=F('sum_thanks_count') + count)
+        self.sum_thanks_count += count
+
+    TRUST_FAME_FIELDS = ('trust_count', 'mistrust_count', 'acq_count', 'fame',)
+
+    @classmethod
+    def attitude_count_field(cls, attitude):
+        CurrentState = get_model('contact', 'CurrentState')
+        return {
+            CurrentState.TRUST: 'trust_count',
+            CurrentState.MISTRUST: 'mistrust_count',
+            CurrentState.ACQ: 'acq_count',
+        }.get(attitude)
+
+    def apply_attitude_delta(self, attitude_previous, attitude):
+        """
+        Изменить счетчики доверий, недоверий, знакомств и известность (fame)
+        при смене отношения к пользователю с attitude_previous на attitude
+
+        Вместо пересчета по CurrentState, см. recount_trust_fame():
+        -1 к счетчику прежнего отношения, +1 к счетчику нового,
+        одним update с F() выражениями. Вызывать, когда запись
+        CurrentState отношения заблокирована (select_for_update),
+        тогда attitude_previous верно. Расхождения, если они все же
+        накопятся, исправляет reconcile_trust_fame().
+        """
+        if attitude_previous == attitude:
+            return
+        updates = dict()
+        fame_delta = 0
+        field = self.attitude_count_field(attitude_previous)
+        if field:
+            updates[field] = Greatest(F(field) - 1, 0)
+            fame_delta -= 1
+        field = self.attitude_count_field(attitude)
+        if field:
+            updates[field] = F(field) + 1
+            fame_delta += 1
+        if fame_delta:
+            updates['fame'] = Greatest(F('fame') + fame_delta, 0)
+        if updates:
+            Profile.objects.filter(pk=self.pk).update(**updates)
+            self.refresh_from_db(fields=self.TRUST_FAME_FIELDS)
+
+    @classmethod
+    def reconcile_trust_fame(cls, fix=True):
+        """
+        Пересчитать счетчики доверий и известность у всех профилей
+
+        Один запрос с GROUP BY по CurrentState, сравнение с профилями.
+        Возвращает список расхождений:
+            (user_id, {поле: (в профиле, по CurrentState)})
+        Если fix, пересчитать профили с расхождениями, каждый заново,
+        чтоб не записать устаревшее при одновременных изменениях.
+        """
+        CurrentState = get_model('contact', 'CurrentState')
+        counts = dict()
+        for rec in CurrentState.objects.filter(
+                    is_reverse=False,
+                    user_to__isnull=False,
+                    attitude__isnull=False,
+                ).values('user_to_id').annotate(
+                    trust_count=Count('pk', filter=Q(attitude=CurrentState.TRUST)),
+                    mistrust_count=Count('pk', filter=Q(attitude=CurrentState.MISTRUST)),
+                    acq_count=Count('pk', filter=Q(attitude=CurrentState.ACQ)),
+                ):
+            rec['fame'] = rec['trust_count'] + rec['mistrust_count'] + rec['acq_count']
+            counts[rec['user_to_id']] = rec
+        drifts = []
+        for user_id, *values in Profile.objects.values_list(
+                    'user_id', *cls.TRUST_FAME_FIELDS
+                ).iterator(chunk_size=2000):
+            rec = counts.get(user_id, dict())
+            drift = dict()
+            for f, value in zip(cls.TRUST_FAME_FIELDS, values):
+                if value != rec.get(f, 0):
+                    drift[f] = (value, rec.get(f, 0),)
+            if drift:
+                drifts.append((user_id, drift,))
+        if fix:
+            for profile in Profile.objects.select_related('user').filter(
+                    user_id__in=[user_id for user_id, drift in drifts]
+                ):
+                profile.recount_trust_fame()
+        return drifts
+
     def recount_trust_fame(self, do_save=True):
         CurrentState = get_model('contact', 'CurrentState')
         user = self.user
@@ -735,16 +988,38 @@ class Profile(PhotoModel, GeoPointAddressModel):
         result = re.sub(r'\s{2,}', ' ', result)
         return result or 'Без имени'
 
+    @classmethod
+    def search_name(cls, field='first_name'):
+        """
+        Выражение для поиска по имени: нижний регистр, ё -> е
+
+        По этому же выражению от auth_user.first_name построен
+        trigram индекс, см. миграцию users 0058_first_name_trgm.
+        При поиске по такому выражению, с like '%слово%',
+        используется индекс
+        """
+        return Func(Lower(field), Value('ё'), Value('е'), function='translate', output_field=CharField())
+
+    @classmethod
+    def search_name_str(cls, s):
+        """
+        Строка поиска, приведенная как search_name()
+        """
+        return s.lower().replace('ё', 'е')
+
     def parents_dict(self, request):
         """
         Вернуть папу, маму и детей из CurrentState
         """
         result = dict(father=None, mother=None, children=[])
         q = Q(user_to__isnull=False) & (Q(is_father=True) | Q(is_mother=True))
-        for parent_link in self.user.currentstate_user_from_set.filter(q). \
+        parent_links = list(self.user.currentstate_user_from_set.filter(q). \
                            select_related('user_to', 'user_to__profile', 'user_to__profile__ability'). \
-                           order_by(F('user_to__profile__dob').asc(nulls_first=True)).distinct():
-            human = parent_link.user_to.profile.data_dict(request)
+                           order_by(F('user_to__profile__dob').asc(nulls_first=True)).distinct())
+        humans = Profile.data_dicts(
+            [parent_link.user_to.profile for parent_link in parent_links], request
+        )
+        for parent_link, human in zip(parent_links, humans):
             if parent_link.is_child:
                 result['children'].append(human)
             elif parent_link.is_father:
@@ -1008,19 +1283,29 @@ class TelegramApiMixin(object):
             pass
         return success
 
+    def __send(self, func, parms):
+        """
+        Отправить в телеграм: поставить в очередь (users/tg_queue.py)
+        после commit транзакции, а если очередь отключена, то сразу.
+        Если redis недоступен, отправить после commit
+        """
+        url = self.__get_url_parms(func)
+        parms = parms.copy()
+        if TgQueue.put(func, parms, fallback=lambda: self.__make_request(url, parms)):
+            return True
+        return self.__make_request(url, parms)
 
     def send_to_telegram(self, message, user=None, telegram_uid=None, options={}):
         success = False
         uids = self.__get_tg_ids(user, telegram_uid)
         if uids:
-            url = self.__get_url_parms('sendMessage')
             options_ = options.copy()
             if not options_.get('parse_mode'):
                 options_.update(parse_mode='html')
             options_.update(text=message)
             for uid in uids:
                 options_.update(chat_id=uid)
-                sent = self.__make_request(url, options_)
+                sent = self.__send('sendMessage', options_)
                 if sent:
                     success = True
         return success
@@ -1030,11 +1315,10 @@ class TelegramApiMixin(object):
         uids = self.__get_tg_ids(user)
         if uids:
             options_ = options.copy()
-            url = self.__get_url_parms('copyMessage')
             options_.update(message_id=message_id, from_chat_id=from_chat_id)
             for uid in uids:
                 options_.update(chat_id=uid)
-                sent = self.__make_request(url, options_)
+                sent = self.__send('copyMessage', options_)
                 if sent:
                     success = True
         return success
@@ -1059,7 +1343,6 @@ class TelegramApiMixin(object):
                     if sent:
                         success = True
                 else:
-                    url = self.__get_url_parms('sendMediaGroup')
                     media=[
                             {
                                 'type': m['file_type'],
@@ -1072,7 +1355,7 @@ class TelegramApiMixin(object):
                     options_.update(media=media)
                     for uid in uids:
                         options_.update(chat_id=uid)
-                        sent = self.__make_request(url, parms=options_)
+                        sent = self.__send('sendMediaGroup', options_)
                         if sent:
                             success = True
         return success
@@ -1109,9 +1392,20 @@ class TelegramApiMixin(object):
 
         return result
 
-    def get_bot_data(self):
+    # Данные бота (getMe) храним в памяти процесса и в кэше django,
+    # общем для всех процессов. В кэше django запись бессрочная:
+    # это последнее известное значение, а его свежесть определяет
+    # 'expires', см. settings.TELEGRAM_BOT_DATA_TTL
+    #
+    BOT_DATA_CACHE_KEY = 'telegram_bot_data'
+    # Через сколько секунд повторить запрос к телеграму, если он не ответил
+    BOT_DATA_RETRY = 60
+    _bot_data = dict(data=None, expires=0)
+    _bot_data_lock = threading.Lock()
+
+    def fetch_bot_data(self):
         """
-        Получить данные бота
+        Получить данные бота непосредственно из телеграма
         """
         result = None
         url = '%s/bot%s/getMe' % (self.API_TELEGRAM, settings.TELEGRAM_BOT_TOKEN)
@@ -1125,10 +1419,72 @@ class TelegramApiMixin(object):
                     result = data['result']
             except (KeyError, ValueError):
                 pass
-        except (urllib.error.URLError, ):
+        except (urllib.error.URLError, OSError, ):
             pass
         return result
 
+    def refresh_bot_data(self):
+        """
+        Получить данные бота из телеграма и положить их в кэши
+
+        Если телеграм не ответил, остается последнее известное значение
+        """
+        data = self.fetch_bot_data()
+        now = time.time()
+        if data:
+            bot_data = dict(data=data, expires=now + settings.TELEGRAM_BOT_DATA_TTL)
+            cache.set(self.BOT_DATA_CACHE_KEY, bot_data, None)
+        else:
+            bot_data = dict(
+                data=TelegramApiMixin._bot_data['data'],
+                expires=now + self.BOT_DATA_RETRY,
+            )
+        TelegramApiMixin._bot_data = bot_data
+        return bot_data['data']
+
+    def refresh_bot_data_background(self):
+        """
+        Обновить данные бота в отдельном потоке, не дожидаясь телеграма
+
+        Обновляет один поток в процессе и один процесс из всех
+        """
+        if not TelegramApiMixin._bot_data_lock.acquire(blocking=False):
+            return
+        if not cache.add(self.BOT_DATA_CACHE_KEY + '_lock', True, self.API_TIMEOUT + 5):
+            TelegramApiMixin._bot_data_lock.release()
+            return
+
+        def refresh():
+            try:
+                self.refresh_bot_data()
+            finally:
+                cache.delete(self.BOT_DATA_CACHE_KEY + '_lock')
+                TelegramApiMixin._bot_data_lock.release()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_bot_data(self):
+        """
+        Получить данные бота
+
+        Берутся из кэша. Если данные устарели, возвращаются последние
+        известные, а обновляются они в фоне. Ждем ответа телеграма,
+        только если о боте еще ничего не известно
+        """
+        now = time.time()
+        bot_data = TelegramApiMixin._bot_data
+        if bot_data['expires'] > now:
+            return bot_data['data']
+        shared = cache.get(self.BOT_DATA_CACHE_KEY)
+        if shared and shared['data']:
+            TelegramApiMixin._bot_data = bot_data = shared
+            if shared['expires'] > now:
+                return shared['data']
+        if not bot_data['data']:
+            return self.refresh_bot_data()
+        self.refresh_bot_data_background()
+        return bot_data['data']
+
     def get_bot_username(self):
         """
         Получить имя бота
@@ -0,0 +1,178 @@
+"""
+Общий (в redis, через django cache) кэш ответов апи о профилях
+
+Кэшируются ответы, которые собираются из многих запросов к базе:
+данные профиля по uuid (ApiProfile), дерево родни (ApiProfileGenesis).
+Ключ ответа: имя ответа и параметры запроса.
+
+Сброс. Вместе с ответом хранятся "поколения" всех пользователей,
+данные которых вошли в ответ (сам профиль, родители, дети, владелец...).
+После записи в базу, затрагивающей пользователей, вызывается
+users_changed(user_ids), после commit: у этих пользователей поколения
+меняются, и все ответы, куда они входят, становятся недействительны.
+
+Поколение: значение счетчика изменений (seq) на момент изменения.
+Счетчик только растет. Если во время построения ответа счетчик
+изменился, ответ не кэшируется: он мог быть построен по данным
+до изменения, а поколения взяты уже после.
+
+От лавины одновременных построений одного ответа: строит один,
+другие ждут его не дольше LOCK_WAIT секунд.
+
+Статистика попаданий: stats(), см. команду profile_cache_stats
+"""
+
+import time, hashlib, json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+class ProfileCache(object):
+
+    PREFIX = 'profile_cache'
+
+    # Сколько секунд строящий ответ держит блокировку
+    #
+    LOCK_TIMEOUT = 30
+
+    # Сколько секунд ждать ответ, который строит другой процесс,
+    # и с каким интервалом проверять
+    #
+    LOCK_WAIT = 5
+    LOCK_POLL = 0.05
+
+    STAT_NAMES = ('hits', 'misses', 'uncached',)
+
+    @classmethod
+    def key(cls, *args):
+        return ':'.join([cls.PREFIX] + [str(arg) for arg in args])
+
+    @classmethod
+    def seq_key(cls):
+        return cls.key('seq')
+
+    @classmethod
+    def gen_key(cls, user_id):
+        return cls.key('gen', user_id)
+
+    @classmethod
+    def current_seq(cls):
+        seq = cache.get(cls.seq_key())
+        if seq is None:
+            # Счетчик пропал (сброс redis): начинаем с момента времени,
+            # чтоб не повторить прежних значений
+            cache.add(cls.seq_key(), int(time.time() * 1000), None)
+            seq = cache.get(cls.seq_key(), 0)
+        return seq
+
+    @classmethod
+    def users_changed(cls, user_ids):
+        """
+        Данные пользователей user_ids изменены. Вызывать после commit:
+
+            transaction.on_commit(lambda: ProfileCache.users_changed(...))
+        """
+        user_ids = set(user_id for user_id in user_ids if user_id)
+        if not user_ids:
+            return
+        cls.current_seq()
+        try:
+            seq = cache.incr(cls.seq_key())
+        except ValueError:
+            cache.add(cls.seq_key(), int(time.time() * 1000), None)
+            seq = cache.incr(cls.seq_key())
+        cache.set_many(dict((cls.gen_key(user_id), seq) for user_id in user_ids), None)
+
+    @classmethod
+    def on_commit_users_changed(cls, user_ids):
+        user_ids = tuple(user_ids)
+        transaction.on_commit(lambda: cls.users_changed(user_ids))
+
+    @classmethod
+    def generations(cls, user_ids):
+        """
+        Поколения пользователей. Если у кого-то поколение пропало из кэша,
+        ставится текущее значение счетчика: оно не меньше любого прежнего
+        """
+        keys = dict((cls.gen_key(user_id), user_id) for user_id in user_ids)
+        gens = cache.get_many(keys.keys())
+        missing = [key for key in keys if key not in gens]
+        if missing:
+            seq = cls.current_seq()
+            for key in missing:
+                cache.add(key, seq, None)
+            gens.update(cache.get_many(missing))
+        return dict((keys[key], gen) for key, gen in gens.items())
+
+    @classmethod
+    def stat(cls, name):
+        try:
+            cache.incr(cls.key('stat', name))
+        except ValueError:
+            cache.add(cls.key('stat', name), 0, None)
+            try:
+                cache.incr(cls.key('stat', name))
+            except ValueError:
+                pass
+
+    @classmethod
+    def stats(cls, reset=False):
+        keys = [cls.key('stat', name) for name in cls.STAT_NAMES]
+        values = cache.get_many(keys)
+        result = dict((name, values.get(key, 0)) for name, key in zip(cls.STAT_NAMES, keys))
+        if reset:
+            cache.delete_many(keys)
+        return result
+
+    @classmethod
+    def valid(cls, entry):
+        if not entry:
+            return False
+        gens, data = entry
+        return cls.generations(gens.keys()) == gens
+
+    @classmethod
+    def get_or_set(cls, name, params, compute):
+        """
+        Ответ name с параметрами params из кэша или построенный compute()
+
+        compute() возвращает (ответ, user_ids пользователей,
+        данные которых вошли в ответ)
+        """
+        if not settings.PROFILE_CACHE_TIMEOUT:
+            data, user_ids = compute()
+            return data
+        key = cls.key(name, hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest())
+        entry = cache.get(key)
+        if cls.valid(entry):
+            cls.stat('hits')
+            return entry[1]
+
+        lock_key = key + ':lock'
+        locked = cache.add(lock_key, True, cls.LOCK_TIMEOUT)
+        if not locked:
+            # Строит другой процесс. Ждем
+            time_wait = time.time() + cls.LOCK_WAIT
+            while time.time() < time_wait:
+                time.sleep(cls.LOCK_POLL)
+                entry = cache.get(key)
+                if cls.valid(entry):
+                    cls.stat('hits')
+                    return entry[1]
+                if cache.get(lock_key) is None:
+                    break
+        try:
+            seq = cls.current_seq()
+            data, user_ids = compute()
+            gens = cls.generations(set(user_ids))
+            if cls.current_seq() == seq:
+                cache.set(key, (gens, data), settings.PROFILE_CACHE_TIMEOUT)
+                cls.stat('misses')
+            else:
+                # Во время построения была запись в базу
+                cls.stat('uncached')
+        finally:
+            if locked:
+                cache.delete(lock_key)
+        return data
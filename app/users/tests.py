@@ -1,3 +1,102 @@
+from unittest import mock
+
 from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+
+from contact.models import Key, KeyType
+from users.models import Profile, CreateUserMixin
+from users.views import ApiUserPoints
+from wote.models import Video, Vote
+
+class ProfileDataDictsTest(TestCase):
+    """
+    Profile.data_dicts(): число запросов не зависит от числа профилей,
+    ответ тот же, что у data_dict() для каждого профиля
+    """
+
+    def make_profiles(self, n):
+        creator = CreateUserMixin()
+        users = [creator.create_user(first_name='Test %s' % i) for i in range(n)]
+        power, created_ = Group.objects.get_or_create(
+            pk=settings.GROUP_IDS['power_telegram'],
+            defaults=dict(name='power_telegram'),
+        )
+        users[0].groups.add(power)
+        banking, created_ = KeyType.objects.get_or_create(
+            pk=KeyType.BANKING_DETAILS_ID,
+            defaults=dict(title='banking_details'),
+        )
+        Key.objects.create(owner=users[-1], type=banking, value='1234')
+        return users
+
+    def queryset(self):
+        return Profile.objects.select_related('user', 'ability').filter(
+            user__first_name__startswith='Test '
+        ).order_by('pk')
+
+    def test_num_queries(self):
+        # Профили, группы, ключи, описания: 4 запроса на любое число профилей
+        #
+        for n in (2, 20):
+            Profile.objects.all().delete()
+            User.objects.filter(is_superuser=False).delete()
+            self.make_profiles(n)
+            with self.assertNumQueries(4):
+                data = Profile.data_dicts(self.queryset())
+            self.assertEqual(len(data), n)
+
+    def test_same_as_data_dict(self):
+        self.make_profiles(5)
+        expected = [p.data_dict() for p in self.queryset()]
+        self.assertEqual(Profile.data_dicts(self.queryset()), expected)
+        self.assertTrue(expected[0]['is_power'])
+        self.assertTrue(expected[-1]['has_bank'])
+
+class ApiUserPointsTest(TestCase):
+    """
+    popup по запросу (lazy_popup, затем popup_uuid) тот же, что сразу
+    в точке, в т.ч. с голосами по видео
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(ApiUserPoints, 'get_bot_username', return_value='testbot')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        creator = CreateUserMixin()
+        users = [creator.create_user(first_name='Test %s' % i) for i in range(3)]
+        for i, user in enumerate(users):
+            Profile.objects.filter(user=user).update(latitude=50 + i, longitude=30 + i)
+        video = Video.objects.create(creator=users[0], source=Video.SOURCE_YOUTUBE, videoid='test')
+        Vote.objects.create(user=users[0], video=video, button=Vote.VOTE_YES)
+        Vote.objects.create(user=users[1], video=video, button=Vote.VOTE_NO)
+        Vote.objects.create(user=users[1], video=video, time=10, button=Vote.VOTE_YES)
+
+    def get(self, **parms):
+        response = self.client.get('/api/user/points', parms)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def check_lazy(self, **parms):
+        points = self.get(**parms)['points']
+        lazy = self.get(lazy_popup='on', **parms)['points']
+        self.assertTrue(points)
+        self.assertEqual(len(lazy), len(points))
+        for point, lazy_point in zip(points, lazy):
+            self.assertNotIn('popup', lazy_point)
+            popup = self.get(popup_uuid=lazy_point['uuid'], **parms)
+            self.assertEqual(popup['popup'], point['popup'])
+            self.assertEqual(popup['title'], point['title'])
+
+    def test_participants(self):
+        self.check_lazy(participants='on')
+
+    def test_video(self):
+        self.check_lazy(videoid='test', source=Video.SOURCE_YOUTUBE)
 
-# Create your tests here.
+    def test_clusters_zoom(self):
+        response = self.client.get('/api/user/points/clusters', dict(
+            lat_south=49, lat_north=53, lng_west=29, lng_east=33, zoom=5000,
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(cluster['count'] for cluster in response.json()['clusters']), 3)
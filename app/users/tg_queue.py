@@ -0,0 +1,114 @@
+"""
+Очередь исходящих сообщений в телеграм
+
+Раньше TelegramApiMixin.send_to_telegram() и т.п. слали сообщения
+прямо из обработчика запроса к апи, по запросу к телеграму на каждого
+получателя, и запрос к апи (например, благодарность) мог ждать телеграм
+секундами. Теперь сообщения кладутся в redis (settings.TG_QUEUE_REDIS_CONNECT),
+а отправляет их отдельный процесс:
+
+    ./manage.py tg_queue_worker
+
+см. users/tg_queue_worker.py.
+
+Списки в redis:
+    pending:        ждут отправки. Кладем слева, берем справа
+    processing:     взяты обработчиком, еще не отправлены. Если обработчик
+                    упал, при следующем запуске возвращаются в pending
+    dead:           не отправленные: телеграм отказал (бот заблокирован,
+                    нет такого чата) или исчерпаны повторы
+
+Сообщение кладется в очередь после commit транзакции, в которой
+оно сделано: если транзакция откатится, сообщение не уйдет.
+
+Если settings.TG_QUEUE_ON == False или redis недоступен, сообщение
+отправляется, как раньше, сразу (или после commit).
+"""
+
+import time, json, threading
+from uuid import uuid4
+
+import redis
+
+from django.conf import settings
+from django.db import transaction
+
+class TgQueue(object):
+
+    PREFIX = 'tg_queue'
+
+    KEY_PENDING = PREFIX + ':pending'
+    KEY_PROCESSING = PREFIX + ':processing'
+    KEY_DEAD = PREFIX + ':dead'
+
+    # Соединения с redis процесса, общие для всех запросов
+    #
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls):
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = redis.ConnectionPool(**settings.TG_QUEUE_REDIS_CONNECT)
+        return redis.Redis(connection_pool=cls._pool)
+
+    @classmethod
+    def make_item(cls, method, parms):
+        """
+        Элемент очереди: метод апи телеграма (sendMessage, copyMessage...)
+        и его параметры. Токен бота в redis не храним
+        """
+        return dict(
+            id=uuid4().hex,
+            method=method,
+            parms=parms,
+            chat_id=parms.get('chat_id'),
+            attempt=0,
+            queued=time.time(),
+        )
+
+    @classmethod
+    def put(cls, method, parms, fallback=None):
+        """
+        Поставить сообщение в очередь после commit текущей транзакции
+
+        Возвращает False, если очередь отключена. Если при commit
+        redis недоступен, вызывается fallback(), если задан
+        """
+        if not settings.TG_QUEUE_ON:
+            return False
+        raw = json.dumps(cls.make_item(method, parms))
+
+        def push():
+            try:
+                cls.connect().lpush(cls.KEY_PENDING, raw)
+            except redis.RedisError:
+                if fallback:
+                    fallback()
+
+        transaction.on_commit(push)
+        return True
+
+    @classmethod
+    def counts(cls, r):
+        return dict(
+            pending=r.llen(cls.KEY_PENDING),
+            processing=r.llen(cls.KEY_PROCESSING),
+            dead=r.llen(cls.KEY_DEAD),
+        )
+
+    @classmethod
+    def requeue_dead(cls, r):
+        """
+        Вернуть не отправленные в очередь, с начальным числом попыток
+        """
+        n = 0
+        while raw := r.rpop(cls.KEY_DEAD):
+            dead = json.loads(raw)
+            item = dead['item']
+            item['attempt'] = 0
+            r.lpush(cls.KEY_PENDING, json.dumps(item))
+            n += 1
+        return n
@@ -0,0 +1,210 @@
+"""
+Отправка сообщений из очереди в телеграм, см. users/tg_queue.py
+
+Запускается один процесс:
+
+    ./manage.py tg_queue_worker
+
+Ограничения телеграма: не больше ~30 сообщений в секунду всего
+(settings.TG_QUEUE_RATE), не больше одного в секунду в один чат
+(settings.TG_QUEUE_CHAT_INTERVAL). На ответ 429 ждем,
+сколько скажет телеграм (retry_after).
+
+Порядок сообщений в один чат сохраняется: у каждого чата своя
+очередь в памяти и своя задача asyncio, которая ее отправляет.
+Разные чаты отправляются одновременно, но не больше
+settings.TG_QUEUE_CONCURRENCY запросов к телеграму. Место под запрос
+занимается только на сам запрос: сообщение, которое ждет своей
+очереди в чат или повтора, места не держит. Из redis берется
+не больше settings.TG_QUEUE_HELD_MAX сообщений сразу.
+
+Повторы: при ошибке сети, 5xx, 429, не больше settings.TG_QUEUE_RETRIES,
+с растущей задержкой. Прочие отказы телеграма (400, 403: бот
+заблокирован...) не повторяются. Не отправленные уходят в список dead,
+не больше settings.TG_QUEUE_DEAD_MAX последних.
+"""
+
+import time, json, asyncio
+
+import aiohttp
+from redis import asyncio as aioredis
+
+from django.conf import settings
+
+from users.tg_queue import TgQueue
+
+class RateLimiter(object):
+    """
+    Не чаще rate раз в секунду, с возможной паузой (429)
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.pause_until = 0.0
+
+    def pause(self, seconds):
+        self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_time, self.pause_until)
+        self.next_time = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class TgQueueWorker(object):
+
+    # Сколько секунд ждать сообщения в pending за один запрос к redis
+    #
+    POP_TIMEOUT = 1
+
+    def __init__(self, api=None, verbose=False):
+        self.api = api or settings.TG_QUEUE_API
+        self.verbose = verbose
+        self.limiter = RateLimiter(settings.TG_QUEUE_RATE)
+        # {chat_id: asyncio.Queue()}, очереди чатов, у которых есть задача отправки
+        self.chats = dict()
+        # {chat_id: время, не раньше которого слать в чат}
+        self.chat_next = dict()
+        # Запросы к телеграму в работе
+        self.slots = asyncio.Semaphore(settings.TG_QUEUE_CONCURRENCY)
+        # Сообщения, взятые из redis: отправляются, ждут своей очереди в чат или повтора
+        self.held = asyncio.Semaphore(settings.TG_QUEUE_HELD_MAX)
+        self.stats = dict(sent=0, retried=0, dead=0, latency_sum=0.0, latency_max=0.0)
+        self.r = self.session = None
+
+    def url(self, method):
+        return '%s/bot%s/%s' % (self.api, settings.TELEGRAM_BOT_TOKEN, method)
+
+    async def recover(self):
+        """
+        Вернуть в pending, что осталось в processing от прежнего запуска
+        """
+        n = 0
+        while await self.r.lmove(TgQueue.KEY_PROCESSING, TgQueue.KEY_PENDING, 'LEFT', 'RIGHT'):
+            n += 1
+        return n
+
+    async def send(self, item):
+        """
+        Запрос к телеграму. Возвращает (отправлено, повторить, задержка повтора, ошибка)
+        """
+        delay = settings.TG_QUEUE_RETRY_DELAY * 2 ** item['attempt']
+        try:
+            async with self.session.post(self.url(item['method']), json=item['parms']) as resp:
+                status = resp.status
+                try:
+                    response = await resp.json(content_type=None)
+                except ValueError:
+                    response = dict()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as excpt:
+            return False, True, delay, repr(excpt)
+        if status == 200:
+            return True, False, 0, None
+        error = '%s: %s' % (status, response.get('description', ''))
+        if status == 429:
+            retry_after = (response.get('parameters') or {}).get('retry_after') or delay
+            self.limiter.pause(retry_after)
+            return False, True, retry_after, error
+        return False, status >= 500, delay, error
+
+    async def done(self, raw, item, error=None):
+        if error:
+            self.stats['dead'] += 1
+            await self.r.lpush(TgQueue.KEY_DEAD, json.dumps(dict(item=item, error=error, time=time.time())))
+            await self.r.ltrim(TgQueue.KEY_DEAD, 0, settings.TG_QUEUE_DEAD_MAX - 1)
+            if self.verbose:
+                print('Dead: chat %s, %s: %s' % (item['chat_id'], item['method'], error))
+        else:
+            latency = time.time() - item['queued']
+            self.stats['sent'] += 1
+            self.stats['latency_sum'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        await self.r.lrem(TgQueue.KEY_PROCESSING, 1, raw)
+
+    async def process(self, raw, item):
+        chat_id = item['chat_id']
+        while True:
+            wait = self.chat_next.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # Пауза после 429 (limiter) общая: пока она идет, не отправить
+            # ничего и в другие чаты
+            async with self.slots:
+                await self.limiter.acquire()
+                self.chat_next[chat_id] = time.monotonic() + settings.TG_QUEUE_CHAT_INTERVAL
+                sent, retry, delay, error = await self.send(item)
+            if sent:
+                await self.done(raw, item)
+                return
+            item['attempt'] += 1
+            if not retry or item['attempt'] > settings.TG_QUEUE_RETRIES:
+                await self.done(raw, item, error)
+                return
+            self.stats['retried'] += 1
+            self.chat_next[chat_id] = time.monotonic() + delay
+
+    async def chat_task(self, chat_id):
+        queue = self.chats[chat_id]
+        try:
+            while not queue.empty():
+                raw, item = queue.get_nowait()
+                try:
+                    await self.process(raw, item)
+                finally:
+                    self.held.release()
+        finally:
+            del self.chats[chat_id]
+            if self.chat_next.get(chat_id, 0) < time.monotonic():
+                self.chat_next.pop(chat_id, None)
+
+    def dispatch(self, raw, item):
+        chat_id = item['chat_id']
+        if chat_id in self.chats:
+            self.chats[chat_id].put_nowait((raw, item))
+        else:
+            self.chats[chat_id] = asyncio.Queue()
+            self.chats[chat_id].put_nowait((raw, item))
+            asyncio.create_task(self.chat_task(chat_id))
+
+    def print_stats(self):
+        sent = self.stats['sent']
+        print('Sent: %s, retried: %s, dead: %s, latency avg %.2f sec, max %.2f sec' % (
+            sent, self.stats['retried'], self.stats['dead'],
+            self.stats['latency_sum'] / sent if sent else 0, self.stats['latency_max'],
+        ))
+
+    async def run(self, once=False):
+        """
+        Отправлять, пока не прервут. once: пока pending не опустеет
+        """
+        self.r = aioredis.Redis(**settings.TG_QUEUE_REDIS_CONNECT)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.TG_QUEUE_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(total=settings.TG_QUEUE_TIMEOUT),
+        )
+        try:
+            recovered = await self.recover()
+            if recovered and self.verbose:
+                print('Recovered from processing: %s' % recovered)
+            while True:
+                await self.held.acquire()
+                raw = await self.r.blmove(
+                    TgQueue.KEY_PENDING, TgQueue.KEY_PROCESSING, self.POP_TIMEOUT, 'RIGHT', 'LEFT',
+                )
+                if raw is None:
+                    self.held.release()
+                    if once and not self.chats:
+                        break
+                    continue
+                try:
+                    item = json.loads(raw)
+                except ValueError:
+                    self.held.release()
+                    await self.r.lrem(TgQueue.KEY_PROCESSING, 1, raw)
+                    continue
+                self.dispatch(raw, item)
+        finally:
+            await self.session.close()
+            await self.r.aclose()
@@ -11,8 +11,8 @@ from django.db import transaction, IntegrityError, connection
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db.models.query_utils import Q
-from django.db.models import Prefetch, F
-from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db.models import Prefetch, F, OuterRef, Subquery
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.db.utils import ProgrammingError
 from django.core.validators import URLValidator
 from django.views.generic.base import View
@@ -27,7 +27,7 @@ from rest_framework import status
 from rest_framework.exceptions import NotAuthenticated, NotFound, PermissionDenied
 
 from app.utils import ServiceException, SkipException, FrontendMixin, FromToCountMixin
-from app.models import UnclearDate, PhotoModel, GenderMixin
+from app.models import UnclearDate, PhotoModel, GenderMixin, GeoPointModel
 
 from django.contrib.auth.models import User
 from users.models import Oauth, CreateUserMixin, IncognitoUser, Profile, TgGroup, \
@@ -36,6 +36,8 @@ from users.models import Oauth, CreateUserMixin, IncognitoUser, Profile, TgGroup
     OfferRefJournal, OfferRefState, ApiDonateUser
 from contact.models import Key, KeyType, CurrentState, OperationType, Wish, Ability, \
                            ApiAddOperationMixin, Journal, TgMessageJournal
+from contact.graph import GenesisGraph, TrustGraph
+from users.profile_cache import ProfileCache
 from wote.models import Video, Vote
 
 class ApiTokenAuthDataMixin(object):
@@ -873,6 +875,10 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
             получить данные по одному пользователю по его username
         с параметром tg_uid=...
             получить данные по пользователю телеграма
+        с параметрами uuid, username, tg_uid возможен параметр fields=...:
+            какие части данных пользователя включать в ответ,
+            через запятую, см. Profile.PROJECTION_COST. Например,
+            fields=data: только данные профиля, без признаков, родни и т.п.
         с параметром tg_uids=...
             получить данные по пользователям телеграма, список с разделителями
             запятой, более короткая выборка, нежели по одному tg_uid
@@ -950,6 +956,9 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                         скачать фото, записать в фото профиля.
                     activate
                         активировать пользователя, если был обезличен
+                    fields
+                        какие части данных пользователя включать в ответ,
+                        как в GET
 
         * Добавить родственника.
             - если из телеграм бота, обязательны:
@@ -1025,6 +1034,25 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
             raise ServiceException(f'Дата рождения: {dob}, позже даты смерти: {dod}')
         return dob, dod
 
+    def get_by_uuid(self, request):
+        """
+        Данные пользователя по uuid, для ProfileCache:
+        (данные, ид пользователей, данные которых вошли)
+        """
+        user, profile = self.check_user_uuid(
+            request.GET['uuid'],
+            related=('user', 'ability','owner','owner__profile'),
+        )
+        data = profile.projected_dict(request, Profile.parse_fields(request.GET.get('fields')))
+        if request.GET.get('with_owner_tg_data') and profile.owner and 'owner' in data:
+            data['owner'].update(tg_data=profile.owner.profile.tg_data())
+        user_ids = [user.pk, profile.owner_id, profile.r_sympa_id]
+        for parent in (data.get('father'), data.get('mother'),):
+            if parent:
+                user_ids.append(parent['user_id'])
+        user_ids += [child['user_id'] for child in data.get('children', [])]
+        return data, user_ids
+
     def get(self, request):
         try:
             data = dict()
@@ -1036,36 +1064,35 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                 except Oauth.DoesNotExist:
                     raise ServiceException('Telegram user with uid=%s not found' % request.GET['tg_uid'])
                 profile = oauth.user.profile
-                data = profile.data_dict(request)
-                data.update(tg_data=profile.tg_data())
+                fields = Profile.parse_fields(request.GET.get('fields'))
+                if fields is None:
+                    fields = set(Profile.DATA_FLAGS) | set(('tg_data',))
+                data = profile.projected_dict(request, fields)
             elif request.GET.get('uuid'):
-                user, profile = self.check_user_uuid(
-                    request.GET['uuid'],
-                    related=('user', 'ability','owner','owner__profile'),
+                fields = Profile.parse_fields(request.GET.get('fields'))
+                data = ProfileCache.get_or_set(
+                    'profile',
+                    dict(
+                        uuid=request.GET['uuid'],
+                        with_owner_tg_data=bool(request.GET.get('with_owner_tg_data')),
+                        fields=None if fields is None else sorted(fields),
+                        root=request.build_absolute_uri('/'),
+                    ),
+                    lambda: self.get_by_uuid(request),
                 )
-                data = profile.data_dict(request)
-                data.update(profile.parents_dict(request))
-                data.update(profile.data_WAK())
-                data.update(profile.owner_dict())
-                data.update(tg_data=profile.tg_data())
-                if request.GET.get('with_owner_tg_data') and profile.owner:
-                    data['owner'].update(tg_data=profile.owner.profile.tg_data())
             elif request.GET.get('username'):
                 user, profile = self.check_user_username(
                     request.GET['username'],
                     related=('user', 'ability','owner','owner__profile'),
                 )
-                data = profile.data_dict(request)
-                data.update(profile.parents_dict(request))
-                data.update(profile.data_WAK())
-                data.update(profile.owner_dict())
-                data.update(tg_data=profile.tg_data())
-                if request.GET.get('with_owner_tg_data') and profile.owner:
+                data = profile.projected_dict(request, Profile.parse_fields(request.GET.get('fields')))
+                if request.GET.get('with_owner_tg_data') and profile.owner and 'owner' in data:
                     data['owner'].update(tg_data=profile.owner.profile.tg_data())
             elif request.GET.get('tg_uids'):
                 data = []
                 uids = request.GET['tg_uids'].split(',')
                 user_pks = set()
+                oauths = []
                 for oauth in Oauth.objects.select_related(
                             'user', 'user__profile'
                         ).filter(
@@ -1075,11 +1102,12 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                     user = oauth.user
                     if user.pk not in user_pks:
                         # Учтём возможные два тг аккаунта у одного юзера
-                        profile = user.profile
-                        item = profile.data_dict(request)
-                        item.update(tg_data=dict(tg_uid=oauth.uid, tg_username=oauth.username,))
-                        data.append(item)
+                        oauths.append(oauth)
                         user_pks.add(user.pk)
+                items = Profile.data_dicts([oauth.user.profile for oauth in oauths], request)
+                for oauth, item in zip(oauths, items):
+                    item.update(tg_data=dict(tg_uid=oauth.uid, tg_username=oauth.username,))
+                    data.append(item)
             elif request.GET.get('tg_username'):
                 data = []
                 usernames = request.GET['tg_username'].split(',')
@@ -1088,20 +1116,21 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                 for username in usernames:
                     q |= Q(username__iexact=username)
                 q &= Q(provider=Oauth.PROVIDER_TELEGRAM)
+                profiles = []
                 for oauth in Oauth.objects.select_related(
                             'user', 'user__profile'
                     ).filter(q):
                     user = oauth.user
                     if user.pk not in user_pks:
                         # Учтём возможные два тг аккаунта у одного юзера
-                        profile = user.profile
-                        item = profile.data_dict(request)
-                        item.update(profile.parents_dict(request))
-                        item.update(profile.data_WAK())
-                        item.update(profile.owner_dict())
-                        item.update(tg_data=profile.tg_data())
-                        data.append(item)
+                        profiles.append(user.profile)
                         user_pks.add(user.pk)
+                for profile, item in zip(profiles, Profile.data_dicts(profiles, request)):
+                    item.update(profile.parents_dict(request))
+                    item.update(profile.data_WAK())
+                    item.update(profile.owner_dict())
+                    item.update(tg_data=profile.tg_data())
+                    data.append(item)
             elif request.GET.get('query_ability') or \
                  request.GET.get('query_wish') or \
                  request.GET.get('query_person') or \
@@ -1110,10 +1139,12 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                 if request.GET.get('query_ability'):
                     query = request.GET['query_ability']
                     fields = ('ability__text',)
+                    model = Ability
                     mode = 'fulltext'
                 elif request.GET.get('query_wish'):
                     query = request.GET['query_wish']
                     fields = ('wish__text',)
+                    model = Wish
                     mode = 'fulltext'
                 elif request.GET.get('query_person'):
                     query = request.GET['query_person']
@@ -1134,15 +1165,16 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                         sep = ' & ' if operation == 'and' else ' | '
                         query = sep.join(words)
                     else:
-                        # icontains
+                        # icontains, по выражению Profile.search_name(),
+                        # для которого есть trigram индекс
                         for i, word in enumerate(words):
-                            words[i] = re.escape(words[i].lower().replace('ё', 'е')).replace('е','[её]')
+                            words[i] = Profile.search_name_str(words[i])
                             for j, field in enumerate(fields):
-                                dict_regex = {('%s__iregex' % fields[j]): words[i]}
+                                dict_contains = {('%s_search__contains' % fields[j]): words[i]}
                                 if j == 0:
-                                    q_word = Q(**dict_regex)
+                                    q_word = Q(**dict_contains)
                                 else:
-                                    q_word |= Q(**dict_regex)
+                                    q_word |= Q(**dict_contains)
                             if i == 0:
                                 q_icontains = q_word
                             else:
@@ -1165,25 +1197,31 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                     try:
                         q_active = Q(is_superuser=False) & (Q(is_active=True) | Q(profile__owner__isnull=False))
                         select_related = ('profile',)
+                        # Collate & Lower: чтоб 'Бапинаева Карина' не была рашьше 'Бапинаев Сулейман'
+                        order_by = [F('profile__dob').asc(nulls_first=True), Collate(Lower('first_name'), 'C')]
                         if mode == 'fulltext':
-                            search_vector = SearchVector(*fields, config='russian')
+                            # По хранимому search_vector с GIN индексом. Сначала
+                            # наиболее подходящие: по наибольшему рангу из
+                            # возможностей (желаний) пользователя
                             search_query = SearchQuery(query, search_type="raw", config='russian')
-                            users = User.objects.annotate(
-                                search=search_vector
-                            ).select_related(*select_related).filter(q_active, search=search_query)
+                            found = model.objects.filter(search_vector=search_query)
+                            rank = found.filter(owner=OuterRef('pk')).annotate(
+                                rank=SearchRank(F('search_vector'), search_query)
+                            ).order_by('-rank').values('rank')[:1]
+                            users = User.objects.filter(
+                                q_active, pk__in=found.values('owner_id')
+                            ).annotate(search_rank=Subquery(rank)).select_related(*select_related)
+                            order_by.insert(0, F('search_rank').desc())
                         else:
                             # icontains
-                            users = User.objects.filter(q_active, q_icontains
-                            ).select_related(*select_related)
-                        # Collate & Lower: чтоб 'Бапинаева Карина' не была рашьше 'Бапинаев Сулейман'
-                        users = users.order_by(
-                                F('profile__dob').asc(nulls_first=True), Collate(Lower('first_name'), 'C')
-                            ).distinct()
+                            users = User.objects.annotate(**{
+                                '%s_search' % field: Profile.search_name(field) for field in fields
+                            }).filter(q_active, q_icontains).select_related(*select_related)
+                        users = users.order_by(*order_by)
                         if number:
                             users = users[from_:from_ + number]
-                        for user in users:
-                            profile = user.profile
-                            item = profile.data_dict(request)
+                        profiles = [user.profile for user in users]
+                        for profile, item in zip(profiles, Profile.data_dicts(profiles, request)):
                             if thumb_size:
                                 item.update(thumb_url=profile.choose_thumb(
                                     request, width=thumb_size, height=thumb_size,
@@ -1204,8 +1242,8 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                 users_selected = Profile.objects.filter(q_uuid_owner). \
                     select_related('user', 'ability',). \
                     order_by(F('dob').asc(nulls_first=True), Collate(Lower('user__first_name'), 'C'))
-                for profile in users_selected:
-                    data_item = profile.data_dict(request)
+                users_selected = list(users_selected)
+                for profile, data_item in zip(users_selected, Profile.data_dicts(users_selected, request)):
                     data_item.update(profile.owner_dict())
                     data.append(data_item)
             else:
@@ -1224,7 +1262,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                     select_related('user', 'ability',).order_by(
                         '-user__date_joined',
                     )[from_:from_ + number_]
-                data = my_data + [p.data_dict(request) for p in users_selected]
+                data = my_data + Profile.data_dicts(users_selected, request)
             status_code = status.HTTP_200_OK
         except ServiceException as excpt:
             data = dict(message=excpt.args[0])
@@ -1245,6 +1283,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
             )
             profile.delete_from_media()
             profile.photo.save(getattr(request.data['photo'], 'name', PhotoModel.DEFAULT_FNAME), photo)
+            PhotoModel.queue_thumbnails(profile.photo.name)
 
     def post_tg_data(self, request):
         """
@@ -1304,11 +1343,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
             user.is_active = True
             user.save()
 
-        data.update(profile.data_dict(request))
-        data.update(profile.parents_dict(request))
-        data.update(tg_data=profile.tg_data())
-        data.update(profile.owner_dict())
-        data.update(profile.data_WAK())
+        data.update(profile.projected_dict(request, Profile.parse_fields(request.data.get('fields'))))
         return data
 
     @transaction.atomic
@@ -1318,6 +1353,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
             status_code = status.HTTP_200_OK
             if request.data.get('tg_token') and request.data.get('tg_uid'):
                 data = self.post_tg_data(request)
+                ProfileCache.on_commit_users_changed((data.get('user_id'),))
                 raise SkipException
 
             # Запрос на создание owned user из телеграма ?:
@@ -1436,6 +1472,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
 
             profile = user.profile
             self.save_photo(request, profile)
+            ProfileCache.on_commit_users_changed((user.pk,))
             fmt = request.data.get('fmt')
             if link_id and fmt == '3d-force-graph':
                 data = profile.data_dict(request, fmt=fmt, thumb=dict(mark_dead=True))
@@ -1596,6 +1633,7 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
 
             user.save()
             profile.save()
+            ProfileCache.on_commit_users_changed((user.pk,))
             data = profile.data_dict(request)
             data.update(profile.parents_dict(request))
             data.update(profile.data_WAK())
@@ -1658,6 +1696,11 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
                 if not request.user.is_authenticated:
                     raise NotAuthenticated
                 user, profile = self.check_user_or_owned_uuid(request, need_uuid=False)
+            user_pk = user.pk
+            transaction.on_commit(lambda: GenesisGraph.users_changed((user_pk,)))
+            if profile.owner:
+                transaction.on_commit(lambda: TrustGraph.users_changed((user_pk,)))
+            ProfileCache.on_commit_users_changed((user_pk, profile.r_sympa_id,))
             if profile.owner:
                 profile.tgdesc.all().delete()
                 profile.delete()
@@ -1692,7 +1735,10 @@ class ApiProfile(CreateUserMixin, UuidMixin, GenderMixin, FrontendMixin, Telegra
 
                 CurrentState.objects.filter(
                     (Q(user_from=user) | Q(user_to=user)) & (Q(is_father=True) | Q(is_mother=True))
-                ).update(is_father=False, is_mother=False, is_child=False)
+                ).update(
+                    is_father=False, is_mother=False, is_child=False,
+                    update_timestamp=int(time.time()),
+                )
 
                 for oauth in Oauth.objects.filter(user=user):
                     for f in ('last_name', 'first_name', 'display_name', 'email', 'photo', 'username'):
@@ -2100,6 +2146,21 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
         owned          (on или пусто)
                         показать не активных пользователей (например, родственников, точнее
                         owned профили)
+            Вместе с participants и/или owned возможны:
+                lat_south, lat_north, lng_west, lng_east:
+                        только те, кто в прямоугольнике карты
+                lazy_popup
+                        on или другое не пустое: у точек нет popup, вместо него uuid.
+                        popup точки: запрос с popup_uuid.
+                        Так же и при offer_id, videoid
+
+        popup_uuid      uuid пользователя, вернуть только popup и title его точки:
+                        {"uuid": .., "title": .., "popup": ..}
+                        Вместе с теми же offer_id или videoid (source, from, to),
+                        chat_id, uuid, что в запросе точек: popup с ответом
+                        на опрос, голосами по видео, рамкой фото, как у точки
+
+    Для карты с множеством пользователей см. ApiUserPointsClusters
 
     Пример выходных данных:
     {
@@ -2271,6 +2332,202 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
             link_on_map=link_on_map,
         )
 
+    def get_rectangle(self, request):
+        """
+        Прямоугольник карты из параметров запроса или None
+        """
+        try:
+            return (
+                float(request.GET.get('lat_south')),
+                float(request.GET.get('lat_north')),
+                float(request.GET.get('lng_west')),
+                float(request.GET.get('lng_east')),
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def load_offer(self, offer_id):
+        """
+        Опрос offer_id: (offer, offer_dict, тексты ответов)
+        """
+        offer = Offer.objects.select_related('owner', 'owner__profile').get(uuid=offer_id)
+        offer_dict = offer.data_dict(request=None, user_ids_only=True)
+        answers = [answer['answer'] for answer in offer_dict['answers']]
+        answers[0] = 'не ответил(а)'
+        return offer, offer_dict, answers
+
+    def offer_reply(self, offer_dict, answers, user_pk):
+        """
+        Ответ(ы) пользователя на опрос: номера ответов, рамка фото,
+        текст ответа, шаблон title и html ответа для popup
+        """
+        answer_numbers = offer_dict['user_answered'].get(user_pk, dict(answers=[0]))['answers']
+        frame = self.OFFER_PHOTO_FRAME
+        if len(answer_numbers) == 1:
+            answer_color = settings.OFFER_ANSWER_COLOR_MAP[answer_numbers[0]]
+            method = 'crop-%s-frame-%s' % (answer_color, frame, )
+            answer_text = answers[answer_numbers[0]]
+            title_template = '%(full_name)s: %(answer_text)s'
+        else:
+            # Здесь только много ответов
+            method = 'crop-%s-frame-%s' % ('gray', frame, )
+            answer_text = '<br />' + '<br />'.join(
+                [' &nbsp;&nbsp;' + offer_dict['answers'][n]['answer'] for n in answer_numbers]
+            )
+            title_template = '%(full_name)s'
+        offer_reply_html = (
+            '<tr>'
+                '<td colspan=2>'
+                'Ответ%s: %s'
+                '</td>'
+            '</tr>'
+        ) % (
+            'ы' if len(answer_numbers) > 1 else '',
+            answer_text
+        )
+        return dict(
+            answer_numbers=answer_numbers,
+            frame=frame,
+            method=method,
+            answer_text=answer_text,
+            title_template=title_template,
+            offer_reply_html=offer_reply_html,
+        )
+
+    def video_q(self, request, source, videoid):
+        """
+        Голоса по видео, с учетом from, to
+        """
+        q_video = Q(
+            video__source=source,
+            video__videoid=videoid,
+        )
+        from_, to_ = self.get_from_to(request.GET, 'from', 'to')
+        if from_ is not None:
+            q_video &= Q(time__gte=from_)
+        if to_ is not None:
+            q_video &= Q(time__lte=to_)
+        return q_video
+
+    def video_reply(self, full_name, votes, votes_names):
+        """
+        Голос(а) пользователя по видео: рамка фото, title
+        и html голосов для popup
+        """
+        if len(votes) == 1:
+            vote = votes[0]
+            vote_color = Vote.VOTES_IMAGE[vote]['color']
+            frame = self.VOTE_PHOTO_FRAME
+            method = 'crop-%s-frame-%s' % (vote_color, frame, )
+            votes_text = votes_names[vote]
+            title = '%s: %s' % (full_name, votes_text)
+        else:
+            votes.sort(key=lambda v: Vote.VOTES_IMAGE[v]['sort_order'])
+            frame = 0
+            method = 'crop'
+            votes_text = ', '.join([votes_names[vote] for vote in votes])
+            title = full_name
+        video_reply_html = (
+            '<tr>'
+                '<td colspan=2>'
+                'Голос%s: %s'
+                '</td>'
+            '</tr>'
+        ) % (
+            'а' if len(votes) > 1 else '',
+            votes_text
+        )
+        return dict(frame=frame, method=method, title=title, video_reply_html=video_reply_html)
+
+    def get_popup(self, request, popup):
+        """
+        popup и title точки пользователя popup_uuid, по запросу с карты
+
+        Те же, что были бы у точки при запросе точек с теми же
+        offer_id, videoid (source, from, to), chat_id, uuid
+        """
+        try:
+            found_user, profile = self.check_user_uuid(request.GET['popup_uuid'], related=('user',))
+        except ServiceException:
+            raise NotFound
+        url_profile = self.profile_url(request, profile, fmt=self.FMT)
+        if self.bot_username:
+            url_deeplink = self.get_deeplink(profile.user, self.bot_username)
+        else:
+            url_deeplink = url_profile
+        offer_reply_html = video_reply_html = answer_text = ''
+        title_template = '%(full_name)s (%(trust_count)s)'
+        title = None
+        thumb_size_popup = self.THUMB_SIZE_POPUP
+        link_on_map_parm = 'uuid'
+        if request.GET.get('offer_id'):
+            try:
+                offer, offer_dict, answers = self.load_offer(request.GET['offer_id'])
+            except (ValueError, Offer.DoesNotExist,):
+                raise NotFound
+            reply = self.offer_reply(offer_dict, answers, profile.user.pk)
+            frame, method = reply['frame'], reply['method']
+            offer_reply_html = reply['offer_reply_html']
+            answer_text = reply['answer_text']
+            title_template = reply['title_template']
+            link_on_map_parm = 'uuid_trustees'
+        elif request.GET.get('videoid'):
+            votes = list(Vote.objects.filter(
+                self.video_q(request, request.GET.get('source', 'yt'), request.GET['videoid']),
+                user=profile.user,
+            ).values_list('button', flat=True).distinct())
+            if not votes:
+                raise NotFound
+            reply = self.video_reply(profile.user.first_name, votes, dict(Vote.VOTES))
+            frame, method = reply['frame'], reply['method']
+            video_reply_html = reply['video_reply_html']
+            title = reply['title']
+            link_on_map_parm = 'uuid_trustees'
+        else:
+            if request.GET.get('chat_id'):
+                link_on_map_parm = 'uuid_trustees'
+            if profile.is_dead or profile.dod:
+                frame = self.DEAD_PHOTO_FRAME
+                method = f'crop-black-frame-{frame}'
+            elif request.GET.get('uuid') == request.GET['popup_uuid']:
+                frame = self.FOUND_USER_PHOTO_FRAME
+                method = f'crop-blue-frame-{frame}'
+            else:
+                frame = 0
+                method = 'crop'
+        if profile.latitude is not None and profile.longitude is not None:
+            link_on_map = '<a href="%s/?%s=%s" target="_blank">На карте</a><br />' % (
+                settings.MAP_URL, link_on_map_parm, profile.uuid,
+            )
+        else:
+            link_on_map = ''
+        dict_user = dict(
+            full_name=profile.user.first_name,
+            username=profile.user.username,
+            trust_count=profile.trust_count,
+            acq_count=profile.acq_count,
+            url_deeplink=url_deeplink,
+            url_profile=url_profile,
+            url_photo_popup=profile.choose_thumb(
+                request,
+                method=method,
+                width=self.THUMB_SIZE_POPUP + frame * 2,
+                height=self.THUMB_SIZE_POPUP + frame * 2,
+                put_default_avatar=True,
+                default_avatar_in_media=PhotoModel.get_gendered_default_avatar(profile.gender)
+            ),
+            thumb_size_popup=thumb_size_popup,
+            offer_reply_html=offer_reply_html,
+            answer_text=answer_text,
+            video_reply_html=video_reply_html,
+            link_on_map=link_on_map,
+        )
+        return dict(
+            uuid=str(profile.uuid),
+            title=title or title_template % dict_user,
+            popup=popup % dict_user,
+        )
+
     def get(self, request):
 
         bot_username = self.get_bot_username()
@@ -2318,6 +2575,9 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
             '%(offer_reply_html)s%(video_reply_html)s'
             '</table>'
         )
+        if request.GET.get('popup_uuid'):
+            return Response(data=self.get_popup(request, popup), status=status.HTTP_200_OK)
+        lazy_popup = bool(request.GET.get('lazy_popup'))
         if request.GET.get('uuid'):
             try:
                 found_user, found_profile = self.check_user_uuid(request.GET['uuid'], related=('user',))
@@ -2435,24 +2695,12 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
             q_meet = Q(did_meet__isnull=False, gender__isnull=False)
             if not meet_admin:
                 q_meet &= Q(r_sympa__isnull=True)
-            in_rectangle = False
-            try:
-                # это для обновлении легенды, когда меняются границы карты
-                #
-                lat_south = float(request.GET.get('lat_south'))
-                lat_north = float(request.GET.get('lat_north'))
-                lng_west = float(request.GET.get('lng_west'))
-                lng_east = float(request.GET.get('lng_east'))
-                in_rectangle = True
-            except (TypeError, ValueError):
-                pass
+            # это для обновлении легенды, когда меняются границы карты
+            #
+            rectangle = self.get_rectangle(request)
+            in_rectangle = bool(rectangle)
             if in_rectangle:
-                q_rectangle = Q(
-                    latitude__gte=lat_south,
-                    latitude__lte=lat_north,
-                    longitude__gte=lng_west,
-                    longitude__lte=lng_east,
-                )
+                q_rectangle = Q(GeoPointModel.in_rectangle(*rectangle))
                 q_meet &= q_rectangle
             else:
                 q_meet &= Q(latitude__isnull=False, longitude__isnull=False)
@@ -2621,32 +2869,12 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                         Q(is_sympa_confirmed=True, is_sympa_reverse=False) |
                         Q(is_hide_meet=True)
                     )
-                links = []
-                for cs in CurrentState.objects.filter(q_connections).filter(
+                links = CurrentState.graph_links(
+                    CurrentState.objects.filter(q_connections).filter(
                         user_from__in=user_pks, user_to__in=user_pks,
-                        ).select_related(
-                            'user_from__profile', 'user_to__profile',
-                        ).distinct():
-                    link_pattern = dict(
-                        source=cs.user_from.pk,
-                        target=cs.user_to.pk,
-                    )
-                    if cs.attitude is not None and not cs.is_reverse:
-                        link = link_pattern.copy()
-                        link.update(attitude=cs.attitude)
-                        links.append(link)
-                    if cs.is_invite_meet and not cs.is_invite_meet_reverse:
-                        link = link_pattern.copy()
-                        link.update(is_invite_meet=True)
-                        links.append(link)
-                    if cs.is_sympa and not cs.is_sympa_reverse and cs.is_sympa_confirmed:
-                        link = link_pattern.copy()
-                        link.update(is_sympa=True)
-                        links.append(link)
-                    if cs.is_hide_meet:
-                        link = link_pattern.copy()
-                        link.update(is_hide_meet=True)
-                        links.append(link)
+                    ),
+                    kinds=CurrentState.LINK_KINDS_MEET,
+                )
                 graph = dict(nodes=nodes, links=links)
 
                 len_m = len(list_m)
@@ -2733,13 +2961,10 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
 
         elif offer_id:
             try:
-                offer = Offer.objects.select_related('owner', 'owner__profile').get(uuid=offer_id)
+                offer, offer_dict, answers = self.load_offer(offer_id)
                 q = Q(offer_answers__offer__uuid=offer_id)
                 qs = Profile.objects.filter(q).select_related('user').distinct()
-                offer_dict = offer.data_dict(request=None, user_ids_only=True)
                 offer_question = offer_dict['question']
-                answers = [answer['answer'] for answer in offer_dict['answers']]
-                answers[0] = 'не ответил(а)'
                 if bot_username:
                     offer_deeplink = 'https://t.me/%s?start=offer-%s' % (bot_username, offer.uuid)
             except (ValueError, Offer.DoesNotExist,):
@@ -2916,15 +3141,7 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                 video_title = '<a href="%s" target="_blank">Голосование по видео</a>' % video_title
             else:
                 video_title = 'Голосование по видео: <i>%s</i>' % video_title
-            q_video = Q(
-                video__source=source,
-                video__videoid=videoid,
-            )
-            from_, to_ = self.get_from_to(request.GET, 'from', 'to')
-            if from_ is not None:
-                q_video &= Q(time__gte=from_)
-            if to_ is not None:
-                q_video &= Q(time__lte=to_)
+            q_video = self.video_q(request, source, videoid)
             n_ind = 0
             for rec in Vote.objects.filter(q_video
                 ).select_related(
@@ -2973,30 +3190,9 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                         url_deeplink = self.get_deeplink_by_username(user_data['username'], bot_username)
                     else:
                         url_deeplink = url_profile
-                    votes = user_data['votes']
-                    if len(votes) == 1:
-                        vote = votes[0]
-                        vote_color = Vote.VOTES_IMAGE[vote]['color']
-                        frame = self.VOTE_PHOTO_FRAME
-                        method = 'crop-%s-frame-%s' % (vote_color, frame, )
-                        votes_text = votes_names[vote]
-                        title = '%s: %s' % (user_data['full_name'], votes_text)
-                    else:
-                        votes.sort(key=lambda v: Vote.VOTES_IMAGE[v]['sort_order'])
-                        frame = 0
-                        method = 'crop'
-                        votes_text = ', '.join([votes_names[vote] for vote in votes])
-                        title = user_data['full_name']
-                    video_reply_html = (
-                        '<tr>'
-                            '<td colspan=2>'
-                            'Голос%s: %s'
-                            '</td>'
-                        '</tr>'
-                    ) % (
-                        'а' if len(votes) > 1 else '',
-                        votes_text
-                    )
+                    reply = self.video_reply(user_data['full_name'], user_data['votes'], votes_names)
+                    frame, method, title = reply['frame'], reply['method'], reply['title']
+                    video_reply_html = reply['video_reply_html']
                     if user_data['latitude'] and user_data['longitude']:
                         link_on_map = '<a href="%s/?uuid_trustees=%s" target="_blank">На карте</a><br />' % (
                             settings.MAP_URL, user_data['uuid']
@@ -3022,7 +3218,7 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                         offer_reply_html=offer_reply_html,
                         link_on_map=link_on_map,
                     )
-                    points.append(dict(
+                    point = dict(
                         latitude=user_data['latitude'],
                         longitude=user_data['longitude'],
                         title=title,
@@ -3036,8 +3232,12 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                             default_avatar_in_media=PhotoModel.get_gendered_default_avatar(user_data['gender'])
                         ),
                         size_icon=self.THUMB_SIZE_ICON + frame * 2,
-                        popup=popup_,
-                    ))
+                    )
+                    if lazy_popup:
+                        point.update(uuid=str(user_data['uuid']))
+                    else:
+                        point.update(popup=popup_)
+                    points.append(point)
             frame = self.VOTE_PHOTO_FRAME * 2
             legend = '<br><table style="border-spacing: 0;border-bottom: 2px solid black;">'
             vote_ts = [('', 'подал(а)<br/>несколько голосов')] + list(Vote.VOTES)
@@ -3135,6 +3335,8 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                     else:
                         q_or |= qq
                 q &= q_or
+                if rectangle := self.get_rectangle(request):
+                    q &= Q(GeoPointModel.in_rectangle(*rectangle))
                 if found_coordinates:
                     q |= Q(pk=found_profile.pk)
                 qs = Profile.objects.filter(q).select_related('user').distinct()
@@ -3166,7 +3368,11 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
             else:
                 link_on_map = ''
             if offer_question:
-                answer_numbers = offer_dict['user_answered'].get(profile.user.pk, dict(answers=[0]))['answers']
+                reply = self.offer_reply(offer_dict, answers, profile.user.pk)
+                answer_numbers = reply['answer_numbers']
+                frame, method = reply['frame'], reply['method']
+                answer_text, title_template = reply['answer_text'], reply['title_template']
+                offer_reply_html = reply['offer_reply_html']
                 user_data = dict(
                     full_name = profile.user.first_name,
                     username=profile.user.username,
@@ -3176,23 +3382,12 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                     url_profile=url_profile,
                     link_on_map=link_on_map
                 )
-                frame = self.OFFER_PHOTO_FRAME
                 if len(answer_numbers) == 1:
-                    answer_color = settings.OFFER_ANSWER_COLOR_MAP[answer_numbers[0]]
-                    method = 'crop-%s-frame-%s' % (answer_color, frame, )
-                    answer_text = answers[answer_numbers[0]]
-                    title_template = '%(full_name)s: %(answer_text)s'
                     if answer_numbers[0]:
                         answer_to_users[answer_numbers[0]].append(user_data)
                     else:
                         answer_to_users[-1].append(user_data)
                 else:
-                    # Здесь только много ответов
-                    method = 'crop-%s-frame-%s' % ('gray', frame, )
-                    answer_text = '<br />' + '<br />'.join(
-                        [' &nbsp;&nbsp;' + offer_dict['answers'][n]['answer'] for n in answer_numbers]
-                    )
-                    title_template = '%(full_name)s'
                     answer_to_users[0].append(user_data)
                 user_data['photo'] = profile.choose_thumb(
                         request,
@@ -3202,16 +3397,6 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                         put_default_avatar=True,
                         default_avatar_in_media=PhotoModel.get_gendered_default_avatar(profile.gender)
                 )
-                offer_reply_html = (
-                    '<tr>'
-                        '<td colspan=2>'
-                        'Ответ%s: %s'
-                        '</td>'
-                    '</tr>'
-                ) % (
-                    'ы' if len(answer_numbers) > 1 else '',
-                    answer_text
-                )
                 user_data['offer_reply_html'] = offer_reply_html if len(answer_numbers) > 1 else ''
             else:
                 if profile.is_dead or profile.dod:
@@ -3252,8 +3437,11 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
                         latitude=profile.latitude,
                         longitude=profile.longitude,
                         title=title_template % dict_user,
-                        popup=popup % dict_user,
                     )
+                    if lazy_popup:
+                        point.update(uuid=str(profile.uuid))
+                    else:
+                        point.update(popup=popup % dict_user)
                     if (found_coordinates and profile == found_profile) or \
                     (offer_question and offer_dict['owner']['user_id'] == profile.user.pk):
                         point.update(
@@ -3369,99 +3557,312 @@ class ApiUserPoints(FromToCountMixin, FrontendMixin, TelegramApiMixin, UuidMixin
 
 api_user_points = ApiUserPoints.as_view()
 
+class ApiUserPointsClusters(ApiUserPoints):
+    """
+    Точки пользователей на карте, сгруппированные в кластеры
+
+    Для карты всех пользователей: сколько бы их ни было, возвращается
+    не больше settings.MAP_CLUSTER_MAX_CELLS кластеров. Кластер:
+    пользователи в квадрате сетки, размер квадрата зависит от масштаба
+    карты. Группировка в базе, в прямоугольнике карты по GiST индексу.
+
+    На входе:
+        lat_south, lat_north, lng_west, lng_east:
+                        координаты области, в которой карта, обязательно
+        zoom            масштаб карты, как в leaflet: 0 - весь мир, по умолчанию 0
+        participants    (on или пусто) только активные пользователи
+        owned           (on или пусто) только не активные пользователи
+                        (например, родственники).
+                        Если ни participants, ни owned, то все
+
+    Пример выходных данных:
+    {
+        "clusters": [
+            {
+                "latitude": 54.208471,      // центр точек кластера
+                "longitude": 28.500346,
+                "count": 25,                // число пользователей в кластере
+            },
+            {
+                // Кластер из одного пользователя
+                "latitude": 54.208471,
+                "longitude": 28.500346,
+                "count": 1,
+                "uuid": "cf047bf6-ade6-4167-82e1-a266b43b96e0",
+                "title": "Eugene S (0)",
+                "icon": "http://api.x.org/thumb/profile-photo/2023/04/12/1484/photo.jpg/32x32~crop~12.jpg",
+                "size_icon": 32
+                // popup: запрос к api/user/points?popup_uuid=<uuid>
+            },
+            ...
+        ]
+    }
+    """
+
+    # Больше не бывает в leaflet. И 2 ** zoom не переполнит float
+    #
+    MAX_ZOOM = 22
+
+    def get(self, request):
+        self.request = request
+        rectangle = self.get_rectangle(request)
+        if not rectangle:
+            return Response(data=dict(message='Не задан прямоугольник карты'), status=400)
+        lat_south, lat_north, lng_west, lng_east = rectangle
+        try:
+            zoom = min(max(0, int(request.GET.get('zoom') or 0)), self.MAX_ZOOM)
+        except (TypeError, ValueError,):
+            zoom = 0
+
+        q = Q(latitude__isnull=False, longitude__isnull=False) & Q(GeoPointModel.in_rectangle(*rectangle))
+        if request.GET.get('participants') and not request.GET.get('owned'):
+            q &= Q(owner__isnull=True)
+        elif request.GET.get('owned') and not request.GET.get('participants'):
+            q &= Q(owner__isnull=False)
+
+        # Квадрат сетки: часть тайла карты 256x256 при таком zoom.
+        # Если квадратов в прямоугольнике слишком много, укрупняем
+        #
+        cell_size = 360.0 / (2 ** zoom) / settings.MAP_CLUSTER_CELLS_PER_TILE
+        while (abs(lat_north - lat_south) / cell_size + 1) * (abs(lng_east - lng_west) / cell_size + 1) > \
+              settings.MAP_CLUSTER_MAX_CELLS:
+            cell_size *= 2
+
+        clusters = GeoPointModel.clusters(Profile.objects.filter(q), cell_size)
+        single_pks = [cluster['pk'] for cluster in clusters if cluster['pk']]
+        profiles = dict(
+            (profile.pk, profile) for profile in \
+                Profile.objects.filter(pk__in=single_pks).select_related('user')
+        )
+        for cluster in clusters:
+            profile = profiles.get(cluster.pop('pk'))
+            if profile:
+                if profile.is_dead or profile.dod:
+                    frame = self.DEAD_PHOTO_FRAME
+                    method = f'crop-black-frame-{frame}'
+                else:
+                    frame = 0
+                    method = 'crop'
+                cluster.update(
+                    uuid=str(profile.uuid),
+                    title='%s (%s)' % (profile.user.first_name, profile.trust_count,),
+                    icon=profile.choose_thumb(
+                        request,
+                        method=method,
+                        width=self.THUMB_SIZE_ICON + frame * 2,
+                        height=self.THUMB_SIZE_ICON + frame * 2,
+                        put_default_avatar=True,
+                        default_avatar_in_media=PhotoModel.get_gendered_default_avatar(profile.gender)
+                    ),
+                    size_icon=self.THUMB_SIZE_ICON + frame * 2,
+                )
+        return Response(data=dict(clusters=clusters), status=status.HTTP_200_OK)
+
+api_user_points_clusters = ApiUserPointsClusters.as_view()
+
 class ApiImportGedcom(ApiAddOperationMixin, UuidMixin, CreateUserMixin, APIView):
 
-    def do_import(self, owner_uuid, bytes_io, indi_to_merge):
+    # Сколько записей создавать за один запрос к базе
+    #
+    BULK_CHUNK_SIZE = 1000
+
+    def do_import(self, owner_uuid, gedcom_file, indi_to_merge, progress=None):
         """
         Импорт из gedcom файла
 
         owner_uuid:         uuid владельца импорируемых персон
-        bytes_io:           считанный в BytesIO gedcom файл
+        gedcom_file:        gedcom файл: имя файла или файл, открытый
+                            на чтение в двоичном режиме
         indi_to_merge:      в файле может быть владелец,
                             его сливаем с пользователем c owner_uuid
+        progress:           функция (строка), куда сообщать о ходе импорта
+
+        Файл читается по одной персоне. Пользователи, профили, родственные
+        связи и записи журнала создаются порциями по BULK_CHUNK_SIZE,
+        каждая порция в своей транзакции (или точке сохранения, если
+        импорт вызван в транзакции). В памяти между порциями только
+        user_id персон и ссылки на их родителей. Если импорт не удался,
+        уже созданные им пользователи удаляются.
         """
         owner, owner_profile = self.check_user_uuid(owner_uuid, related=[])
         if owner_profile.owner:
             raise ServiceException('Допускается owner_id только активного пользователя')
 
-        with GedcomReader(bytes_io) as parser:
-
-            #   (ged)xref_id:
-            #       first_name, first_name, gender, dob, dod, is_dead
-            #       father_xref_id
-            #       mother_xref_id
-            #
-            indis = dict()
-
-            for indi in parser.records0('INDI'):
-                xref_id = indi.xref_id
-                first_name = indi.name.format() or ''
-                gender = indi.sub_tag_value('SEX')
-                if gender:
-                    gender = gender.lower()
-                    if gender not in (GenderMixin.GENDER_MALE, GenderMixin.GENDER_FEMALE):
-                        gender = None
-                dob = indi.sub_tag_value('BIRT/DATE') or None
-                if dob:
-                    dob = UnclearDate.from_str_safe(str(dob), format='d M y')
-                is_dead = bool(indi.sub_tag_value('DEAT'))
-                dod = indi.sub_tag_value('DEAT/DATE') or None
-                if dod:
-                    dod = UnclearDate.from_str_safe(str(dod), format='d M y')
-                    is_dead = True
-                item = dict(
-                    first_name=first_name,
-                    gender=gender,
-                    dob=dob,
-                    is_dead=is_dead,
-                    dod=dod,
-                    father_xref_id=indi.father and indi.father.xref_id or None,
-                    mother_xref_id=indi.mother and indi.mother.xref_id or None,
-                )
-                indis[xref_id] = item
+        # xref_id: user_id
+        user_ids = dict()
+        # (user_id, father_xref_id, mother_xref_id)
+        parents = []
+        try:
+            with GedcomReader(gedcom_file) as parser:
+                chunk = []
+                for indi in parser.records0('INDI'):
+                    chunk.append(self.indi_item(indi))
+                    if len(chunk) >= self.BULK_CHUNK_SIZE:
+                        self.bulk_create_users(chunk, owner, user_ids, parents, progress)
+                        chunk = []
+                if chunk:
+                    self.bulk_create_users(chunk, owner, user_ids, parents, progress)
+
+            if indi_to_merge not in user_ids:
+                raise ServiceException('В gedcom данных не обнаружен человек, который будет владельцем')
+            self.bulk_create_parents(user_ids, parents, progress)
+
+            with transaction.atomic():
+                user_to_merge = User.objects.select_related('profile').get(pk=user_ids[indi_to_merge])
+                owner.profile.merge(user_to_merge.profile)
+        except Exception:
+            if not transaction.get_connection().in_atomic_block:
+                # Иначе откатится вызвавшая импорт транзакция
+                self.delete_users(list(user_ids.values()))
+            raise
+        transaction.on_commit(lambda: GenesisGraph.graph_changed())
+        if progress:
+            progress('Владелец слит с персоной %s' % indi_to_merge)
+
+    def indi_item(self, indi):
+        """
+        Данные персоны из gedcom записи INDI
+        """
+        first_name = indi.name.format() or ''
+        gender = indi.sub_tag_value('SEX')
+        if gender:
+            gender = gender.lower()
+            if gender not in (GenderMixin.GENDER_MALE, GenderMixin.GENDER_FEMALE):
+                gender = None
+        dob = indi.sub_tag_value('BIRT/DATE') or None
+        if dob:
+            dob = UnclearDate.from_str_safe(str(dob), format='d M y')
+        is_dead = bool(indi.sub_tag_value('DEAT'))
+        dod = indi.sub_tag_value('DEAT/DATE') or None
+        if dod:
+            dod = UnclearDate.from_str_safe(str(dod), format='d M y')
+            is_dead = True
+        return dict(
+            xref_id=indi.xref_id,
+            first_name=first_name,
+            gender=gender,
+            dob=dob,
+            is_dead=is_dead,
+            dod=dod,
+            father_xref_id=indi.father and indi.father.xref_id or None,
+            mother_xref_id=indi.mother and indi.mother.xref_id or None,
+        )
 
-        if indi_to_merge not in indis:
-            raise ServiceException('В gedcom данных не обнаружен человек, который будет владельцем')
+    def new_usernames(self, count):
+        """
+        count случайных username, которых еще нет в базе, как в create_user()
+        """
+        random.seed()
+        chars = string.ascii_lowercase + string.digits + string.ascii_uppercase
+        usernames = set()
+        while len(usernames) < count:
+            while len(usernames) < count:
+                usernames.add(''.join(random.choice(chars) for x in range(10)))
+            usernames -= set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        return list(usernames)
+
+    def bulk_create_users(self, items, owner, user_ids, parents, progress=None):
+        """
+        Создать пользователей и профили для порции персон items
 
-        for key in indis:
-            item = indis[key]
-            # Сначала создать пользователей, потом родительские связи
-            user = self.create_user(
-                first_name=item['first_name'] or 'Без имени',
-                owner=owner,
-                dob=item['dob'],
-                is_dead=item['is_dead'],
-                dod=item['dod'],
-                is_active=False,
-                gender=item['gender'],
-            )
-            item.update(user_id=user.pk)
+        Дополняет user_ids и parents, см. do_import()
+        """
+        for attempt in range(100):
+            users = [
+                User(
+                    username=username,
+                    last_name='',
+                    first_name=Profile.make_first_name('', item['first_name'] or 'Без имени'),
+                    email='',
+                    is_active=False,
+                ) for item, username in zip(items, self.new_usernames(len(items)))
+            ]
+            try:
+                with transaction.atomic():
+                    users = User.objects.bulk_create(users)
+                    Profile.objects.bulk_create([
+                        Profile(
+                            user=user,
+                            middle_name='',
+                            owner=owner,
+                            dob=item['dob'],
+                            is_dead=item['is_dead'] or bool(item['dod']),
+                            dod=item['dod'],
+                            gender=item['gender'],
+                        ) for item, user in zip(items, users)
+                    ])
+                break
+            except IntegrityError:
+                # Кто-то успел занять один из username
+                continue
+        else:
+            raise ServiceException(self.MSG_FAILED_CREATE_USER)
+        for item, user in zip(items, users):
+            user_ids[item['xref_id']] = user.pk
+            if item['father_xref_id'] or item['mother_xref_id']:
+                parents.append((user.pk, item['father_xref_id'], item['mother_xref_id'],))
+        if progress:
+            progress('Создано пользователей: %s' % len(user_ids))
+
+    def bulk_create_parents(self, user_ids, parents, progress=None):
+        """
+        Родственные связи между новыми пользователями
 
-        for key in indis:
-            item = indis[key]
-            if item['father_xref_id']:
-                user_from = User.objects.select_related('profile').get(pk=item['user_id'])
-                user_to = User.objects.select_related('profile').get(pk=indis[item['father_xref_id']]['user_id'])
-                self.add_operation(
-                    user_from,
-                    user_to.profile,
-                    operationtype_id = OperationType.SET_FATHER,
-                    comment = None,
-                    insert_timestamp = int(time.time()),
-                )
-            if item['mother_xref_id']:
-                user_from = User.objects.select_related('profile').get(pk=item['user_id'])
-                user_to = User.objects.select_related('profile').get(pk=indis[item['mother_xref_id']]['user_id'])
-                self.add_operation(
-                    user_from,
-                    user_to.profile,
-                    operationtype_id = OperationType.SET_MOTHER,
-                    comment = None,
-                    insert_timestamp = int(time.time()),
-                )
+        Как add_operation() с SET_FATHER, SET_MOTHER: записи CurrentState
+        ребенок -> родитель и родитель -> ребенок (is_child), записи в журнал.
+        Пользователи новые, поэтому без проверок на уже имеющихся родителей.
+        """
+        timestamp = int(time.time())
+        # (ребенок, родитель) уже созданных связей
+        pairs = set()
+        for i in range(0, len(parents), self.BULK_CHUNK_SIZE):
+            links = []
+            journals = []
+            for child_id, father_xref_id, mother_xref_id in parents[i:i + self.BULK_CHUNK_SIZE]:
+                for xref_id, is_father, operationtype_id in (
+                        (father_xref_id, True, OperationType.SET_FATHER,),
+                        (mother_xref_id, False, OperationType.SET_MOTHER,),
+                    ):
+                    if not xref_id:
+                        continue
+                    parent_id = user_ids[xref_id]
+                    if (parent_id, child_id,) in pairs:
+                        raise ServiceException('Два человека не могут быть оба родителями по отношению друг к другу')
+                    if (child_id, parent_id,) in pairs:
+                        continue
+                    pairs.add((child_id, parent_id,))
+                    for user_from_id, user_to_id, is_child in (
+                            (child_id, parent_id, False,),
+                            (parent_id, child_id, True,),
+                        ):
+                        links.append(CurrentState(
+                            user_from_id=user_from_id,
+                            user_to_id=user_to_id,
+                            is_father=is_father,
+                            is_mother=not is_father,
+                            is_child=is_child,
+                            insert_timestamp=timestamp,
+                            update_timestamp=timestamp,
+                        ))
+                    journals.append(Journal(
+                        user_from_id=child_id,
+                        user_to_id=parent_id,
+                        operationtype_id=operationtype_id,
+                        insert_timestamp=timestamp,
+                        comment=None,
+                    ))
+            with transaction.atomic():
+                CurrentState.objects.bulk_create(links)
+                Journal.objects.bulk_create(journals)
+            if progress:
+                progress('Создано родственных связей: %s' % len(pairs))
 
-        user_to_merge = User.objects.select_related('profile').get(pk=indis[indi_to_merge]['user_id'])
-        owner.profile.merge(user_to_merge.profile)
+    def delete_users(self, user_pks):
+        """
+        Удалить пользователей, созданных неудавшимся импортом
+        """
+        for i in range(0, len(user_pks), self.BULK_CHUNK_SIZE):
+            User.objects.filter(pk__in=user_pks[i:i + self.BULK_CHUNK_SIZE]).delete()
 
 api_import_gedcom = ApiImportGedcom.as_view()
 
@@ -3685,9 +4086,7 @@ class ApiBotPollResults(TelegramApiMixin, APIView):
                 attitude__isnull=False, is_reverse=False,
                 user_from__in=user_pks, user_to__in=user_pks
             )
-            for cs in CurrentState.objects.filter(q_connections).select_related(
-                        'user_from__profile', 'user_to__profile',).distinct():
-                links.append(dict(source=cs.user_from.pk, target=cs.user_to.pk, attitude=cs.attitude))
+            links += CurrentState.graph_links(CurrentState.objects.filter(q_connections))
 
             bot_username = self.get_bot_username()
             data.update(bot_username=bot_username, nodes=nodes, links=links)
@@ -4000,9 +4399,7 @@ class ApiOfferResults(TelegramApiMixin, APIView):
                 attitude__isnull=False, is_reverse=False,
                 user_from__in=user_pks, user_to__in=user_pks
             )
-            for cs in CurrentState.objects.filter(q_connections).select_related(
-                        'user_from__profile', 'user_to__profile',).distinct():
-                links.append(dict(source=cs.user_from.pk, target=cs.user_to.pk, attitude=cs.attitude))
+            links += CurrentState.graph_links(CurrentState.objects.filter(q_connections))
 
             bot_username = self.get_bot_username()
             data.update(bot_username=bot_username, nodes=nodes, links=links)
@@ -4651,29 +5048,6 @@ api_show_tgmsg_pack = ApiShowTgmsgPack.as_view()
 class ApiMeetgamers(TelegramApiMixin, APIView):
     permission_classes = (IsAuthenticated, )
 
-    def make_cs(self, cs, links):
-        link_pattern = dict(
-            source=cs.user_from.pk,
-            target=cs.user_to.pk,
-        )
-        if cs.attitude is not None and not cs.is_reverse:
-            link = link_pattern.copy()
-            link.update(attitude=cs.attitude)
-            links.append(link)
-        if cs.is_invite_meet and not cs.is_invite_meet_reverse:
-            link = link_pattern.copy()
-            link.update(is_invite_meet=True)
-            links.append(link)
-        if cs.is_sympa and not cs.is_sympa_reverse and cs.is_sympa_confirmed:
-            link = link_pattern.copy()
-            link.update(is_sympa=True)
-            links.append(link)
-        if cs.is_hide_meet:
-            link = link_pattern.copy()
-            link.update(is_hide_meet=True)
-            links.append(link)
-
-
     def get(self, request):
         fmt = '3d-force-graph'
 
@@ -4695,10 +5069,10 @@ class ApiMeetgamers(TelegramApiMixin, APIView):
                         Q(is_sympa_confirmed=True, is_sympa_reverse=False) 
                         # vd temporary exclude hide links
                         # | \ Q(is_hide_meet=True)
-                for cs in CurrentState.objects.filter(qs_cs
-                        ).distinct():
-                    user_pks.add(cs.user_from.pk)
-                    user_pks.add(cs.user_to.pk)
+                for user_from_id, user_to_id in CurrentState.objects.filter(qs_cs
+                        ).values_list('user_from_id', 'user_to_id').distinct():
+                    user_pks.add(user_from_id)
+                    user_pks.add(user_to_id)
             except User.DoesNotExist:
                 pass
             for profile in Profile.objects.select_related('user').filter(
@@ -4751,10 +5125,10 @@ class ApiMeetgamers(TelegramApiMixin, APIView):
             user_pks.add(request.user.pk)
             users.append(request.user.profile.data_dict(request=request, fmt=fmt))
 
-        for cs in CurrentState.objects.filter(
-                user_from__in=user_pks, user_to__in=user_pks,
-                ).distinct():
-            self.make_cs(cs, links)
+        links = CurrentState.graph_links(
+            CurrentState.objects.filter(user_from__in=user_pks, user_to__in=user_pks),
+            kinds=CurrentState.LINK_KINDS_MEET,
+        )
 
         bot_username = self.get_bot_username()
         data = dict(bot_username=bot_username, nodes=users, links=links)
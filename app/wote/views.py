@@ -16,6 +16,7 @@ from app.utils import ServiceException, FromToCountMixin
 
 from users.models import Profile, TelegramApiMixin
 from contact.models import CurrentState
+from contact.columnar import ColumnarGraph
 from wote.models import Video, Vote
 
 class ApiWoteVideoMixin(object):
@@ -291,6 +292,7 @@ class ApiVoteGraph(FromToCountMixin, TelegramApiMixin, APIView):
         Возможны еще параметры:
             from:   с такой секунды видео начинать
             to:     по какую секунду видео показывать
+            fmt:    columnar: в колоночном формате, см. contact/columnar.py
 
         Возвращает json (пример):
         {
@@ -416,12 +418,12 @@ class ApiVoteGraph(FromToCountMixin, TelegramApiMixin, APIView):
             attitude__isnull=False, is_reverse=False,
             user_from__in=user_pks, user_to__in=user_pks
         )
-        for cs in CurrentState.objects.filter(q_connections).select_related(
-                    'user_from__profile', 'user_to__profile',).distinct():
-            links.append(cs.data_dict(show_attitude=True, fmt='3d-force-graph'))
+        links += CurrentState.graph_links(CurrentState.objects.filter(q_connections), show_thanks=True)
 
         bot_username = self.get_bot_username()
         data.update(bot_username=bot_username, nodes=nodes, links=links)
+        if ColumnarGraph.get_fmt(request)[1]:
+            return ColumnarGraph.response(request, data)
         return Response(data=data, status=status.HTTP_200_OK)
 
 api_wote_vote_graph = ApiVoteGraph.as_view()
@@ -0,0 +1,142 @@
+# bench_api_client.py
+#
+# Замер запросов бота в апи: общая сессия HttpClient с пулом соединений
+# (как в Misc.api_request()) против прежней новой aiohttp сессии
+# на каждый запрос.
+#
+# Запускается поддельный апи (aiohttp, 127.0.0.1): отвечает json через
+# --api-ms и считает принятые соединения. --concurrency задач шлют
+# всего --calls запросов GET. Замер: запросов в секунду, задержка
+# и сколько соединений с апи открыто (по адресам клиентов).
+# Если задан --api-url, то запросы идут туда, без поддельного апи,
+# например в запущенный локально backend:
+#   --api-url http://127.0.0.1:8000/api/get_bot_data
+#
+#   ./ENV/bin/python bench_api_client.py --calls 5000 --concurrency 50
+
+import asyncio, argparse, time
+
+import aiohttp
+from aiohttp import web
+
+import settings
+from http_client import HttpClient
+
+PATH = '/api/bench'
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class FakeApi(object):
+    """
+    Поддельный апи
+    """
+
+    def __init__(self, api_ms):
+        self.api_ms = api_ms
+        # Адреса клиентов: у каждого соединения свой порт
+        self.peers = set()
+
+    @property
+    def connections(self):
+        return len(self.peers)
+
+    async def handle(self, request):
+        self.peers.add(request.transport.get_extra_info('peername'))
+        if self.api_ms:
+            await asyncio.sleep(self.api_ms / 1000.0)
+        return web.json_response(dict(uuid='8f5a3c0e-7d6b-4a8e-9c1f-2b3d4e5f6a7b', first_name='Bench'))
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_get(PATH, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def old_request(url):
+    """
+    Как прежний Misc.api_request(): новая сессия на каждый запрос
+    """
+    async with aiohttp.ClientSession(timeout=HttpClient.timeout()) as session:
+        async with session.request('GET', url) as resp:
+            return resp.status, await resp.json()
+
+async def new_request(url):
+    return await HttpClient.request('GET', url, metric=PATH)
+
+async def run_round(request, url, calls, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(calls))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            t0 = time.monotonic()
+            try:
+                status, response = await request(url)
+                if status != 200:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.monotonic() - t0) * 1000)
+
+    started = time.monotonic()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    took = time.monotonic() - started
+    return dict(
+        rate=calls / took,
+        errors=errors,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+    )
+
+async def main(args):
+    fake = None
+    url = args.api_url
+    if not url:
+        fake = FakeApi(args.api_ms)
+        await fake.start(args.port)
+        url = f'http://127.0.0.1:{args.port}{PATH}'
+    await HttpClient.start()
+    results = []
+    try:
+        for title, request in (('new session per call', old_request), ('shared HttpClient', new_request)):
+            connections = fake.connections if fake else 0
+            result = await run_round(request, url, args.calls, args.concurrency)
+            result.update(title=title, connections=fake.connections - connections if fake else None)
+            results.append(result)
+    finally:
+        HttpClient.metrics = dict()
+        await HttpClient.stop()
+        if fake:
+            await fake.stop()
+    print(
+        f'{args.calls} calls to {url}, concurrency {args.concurrency}, '
+        f'connector {settings.HTTP_CONNECTOR}'
+    )
+    print('                       calls/s  errors   p50 ms   p99 ms  connections')
+    for r in results:
+        print(
+            f'{r["title"]:22} {r["rate"]:8.0f} {r["errors"]:7} {r["p50"]:8.1f} {r["p99"]:8.1f} '
+            f'{r["connections"] if r["connections"] is not None else "-":>12}'
+        )
+
+parser = argparse.ArgumentParser(description='Benchmark bot calls to the api: shared HttpClient session against a session per call')
+parser.add_argument('--calls', type=int, default=5000, help='number of calls in each round')
+parser.add_argument('--concurrency', type=int, default=50, help='number of concurrent callers')
+parser.add_argument('--api-ms', type=float, default=5, help='response time of the fake api')
+parser.add_argument('--api-url', help='call this url instead of the fake api')
+parser.add_argument('--port', type=int, default=3083, help='port of the fake api')
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,298 @@
+# bench_group_replay.py
+#
+# Воспроизведение потока сообщений оживленной группы через регистрацию
+# автора, как в handler_group.process_group_message(): запросов в апи
+# на сообщение, доля попаданий в кэш KnownUsers, сообщений в секунду
+# и задержка, против прежней регистрации без кэша.
+#
+# На каждое сообщение:
+#   -   как было: Misc.post_tg_user() и TgGroupMember.add(),
+#       POST /api/profile и POST /api/bot/groupmember
+#   -   как теперь: KnownUsers.post_tg_user() и KnownUsers.add_member(),
+#       в апи, только если автора или его членства в группе нет в кэше
+# Сообщения от 777000 (канал группы) и от ботов пропускаются, как
+# в обработчике.
+#
+# Поток: файл --stream, по обновлению (update) или сообщению (message)
+# телеграма в json на строку, как их отдает getUpdates или пишет лог
+# бота. Нужны chat (id, title, type) и from. Без --stream поток
+# генерируется: --messages сообщений в --groups группах от --posters
+# авторов, немногие пишут много, большинство изредка; доля --renames
+# сообщений после смены имени автора. --record: записать
+# сгенерированный поток в файл, чтобы воспроизводить его же.
+#
+# Апи поддельный (aiohttp, 127.0.0.1): отвечает через --api-ms
+# и считает запросы. --concurrency задач разбирают поток по порядку,
+# как aiogram обрабатывает обновления задачами.
+#
+# Поток воспроизводится быстрее, чем шел, время сообщений (date) не
+# соблюдается. Поэтому и в прежней регистрации POST /api/bot/groupmember
+# бывает раз на автора в группе: повторы в течение 5 минут отсекает
+# group_member_dedup в TgGroupMember.add(). В настоящем потоке, что
+# длится часами, таких запросов больше. Время жизни ключей KnownUsers
+# (часы, сутки) тоже не истекает.
+#
+# Нужен запущенный redis (settings.REDIS_CONNECT). Ключи кэша
+# KnownUsers теста -- под своим префиксом, в начале каждого прохода
+# и в конце удаляются. Удаляются и ключи group_member_dedup:
+# TgGroupMember.add() ставит их на 5 минут.
+#
+#   ./ENV/bin/python bench_group_replay.py --messages 20000 --posters 2000 --api-ms 20
+#   ./ENV/bin/python bench_group_replay.py --stream updates.json
+
+import asyncio, argparse, json, random, time
+
+from aiohttp import web
+from aiogram.types import User
+
+import settings
+from http_client import HttpClient
+from redis_client import RedisClient
+from common import Misc, TgGroupMember, KnownUsers
+
+PREFIX = 'bench_group_replay~'
+# Сообщения от этого пользователя -- из канала, привязанного к группе
+CHANNEL_TG_UID = 777000
+
+FIRST_NAMES = ('Иван', 'Петр', 'Сергей', 'Андрей', 'Мария', 'Анна', 'Елена', 'Ольга')
+LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов', '')
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def stream_generate(n_messages, n_groups, n_posters, renames, seed=1):
+    """
+    Поток сообщений в группах, как в json обновлений телеграма
+    """
+    rnd = random.Random(seed)
+    # Не пересекаются с настоящими tg_uid и chat_id
+    posters = [
+        dict(
+            id=8900000000 + i,
+            is_bot=rnd.random() < 0.01,
+            first_name=rnd.choice(FIRST_NAMES),
+            last_name=rnd.choice(LAST_NAMES),
+            username='bench%s' % i if rnd.random() < 0.7 else None,
+        ) for i in range(n_posters)
+    ]
+    # Кто сколько пишет: немногие много, большинство изредка
+    weights = [1.0 / (i + 1) ** 1.1 for i in range(n_posters)]
+    chats = [
+        dict(id=-1008900000000 - i, title='Bench group %s' % i, type='supergroup')
+        for i in range(n_groups)
+    ]
+    # В каждой группе свои авторы, у некоторых авторов по несколько групп
+    chat_of = [rnd.randrange(n_groups) for i in range(n_posters)]
+    date = int(time.time()) - n_messages
+    result = []
+    for i in range(n_messages):
+        date += rnd.choice((0, 0, 1, 1, 2))
+        if rnd.random() < 0.02:
+            tg_user = dict(id=CHANNEL_TG_UID, is_bot=False, first_name='Telegram')
+            chat = rnd.choice(chats)
+        else:
+            n = rnd.choices(range(n_posters), weights=weights)[0]
+            tg_user = posters[n]
+            if rnd.random() < renames:
+                tg_user['first_name'] = rnd.choice(FIRST_NAMES)
+                tg_user['last_name'] = rnd.choice(LAST_NAMES)
+            chat = chats[chat_of[n] if rnd.random() < 0.9 else rnd.randrange(n_groups)]
+        result.append(dict(message_id=i + 1, date=date, chat=chat, **{'from': dict(tg_user)}))
+    return result
+
+def stream_read(fname):
+    """
+    Сообщения в группах из файла обновлений или сообщений, json на строку
+    """
+    result = []
+    with open(fname) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            message = message.get('message', message)
+            if message.get('from') and message.get('chat', {}).get('type') in ('group', 'supergroup'):
+                result.append(message)
+    return result
+
+
+class FakeApi(object):
+    """
+    Поддельный апи: /api/profile и /api/bot/groupmember
+    """
+
+    def __init__(self, api_ms):
+        self.api_ms = api_ms
+        self.calls = dict()
+
+    async def reply(self, request, data):
+        path = request.path
+        self.calls[path] = self.calls.get(path, 0) + 1
+        if self.api_ms:
+            await asyncio.sleep(self.api_ms / 1000.0)
+        return web.json_response(data)
+
+    async def profile(self, request):
+        form = await request.post()
+        return await self.reply(request, dict(
+            uuid='8f5a3c0e-7d6b-4a8e-9c1f-%012d' % (int(form['tg_uid']) % 10 ** 12),
+            first_name=form['first_name'],
+            username=form['username'],
+            created=False,
+            trust_count=0,
+            mistrust_count=0,
+        ))
+
+    async def group_member(self, request):
+        return await self.reply(request, dict())
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/api/profile', self.profile)
+        app.router.add_post('/api/bot/groupmember', self.group_member)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def old_register(tg_user, chat):
+    """
+    Как было: в апи на каждое сообщение
+    """
+    await Misc.post_tg_user(tg_user, did_bot_start=False)
+    await TgGroupMember.add(
+        group_chat_id=chat['id'],
+        group_title=chat.get('title'),
+        group_type=chat['type'],
+        user_tg_uid=tg_user.id,
+    )
+
+async def new_register(tg_user, chat):
+    await KnownUsers.post_tg_user(tg_user)
+    await KnownUsers.add_member(
+        group_chat_id=chat['id'],
+        group_title=chat.get('title'),
+        group_type=chat['type'],
+        user_tg_uid=tg_user.id,
+    )
+
+async def clear_keys(stream):
+    r = RedisClient.get()
+    keys = [KnownUsers.STATS_KEY]
+    for message in stream:
+        tg_uid, chat_id = message['from']['id'], message['chat']['id']
+        keys.append(KnownUsers.user_key(tg_uid))
+        keys.append(KnownUsers.member_key(chat_id, tg_uid))
+        keys.append(f"group_member_dedup:{chat_id}:{tg_uid}")
+    keys = list(set(keys))
+    for i in range(0, len(keys), 1000):
+        await r.delete(*keys[i:i + 1000])
+
+async def replay(register, stream, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(stream)
+
+    async def handler():
+        nonlocal errors
+        for message in counter:
+            tg_user = User(**message['from'])
+            if tg_user.id == CHANNEL_TG_UID or tg_user.is_bot:
+                continue
+            t0 = time.monotonic()
+            try:
+                await register(tg_user, message['chat'])
+            except Exception:
+                errors += 1
+            latencies.append((time.monotonic() - t0) * 1000)
+
+    started = time.monotonic()
+    await asyncio.gather(*[handler() for i in range(concurrency)])
+    took = time.monotonic() - started
+    return dict(
+        handled=len(latencies),
+        rate=len(latencies) / took,
+        errors=errors,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+    )
+
+async def main(args):
+    if args.stream:
+        stream = stream_read(args.stream)
+    else:
+        stream = stream_generate(args.messages, args.groups, args.posters, args.renames)
+        if args.record:
+            with open(args.record, 'w') as f:
+                for message in stream:
+                    f.write(json.dumps(dict(message=message), ensure_ascii=False) + '\n')
+    if not stream:
+        print('No group messages in the stream')
+        return
+
+    KnownUsers.USER_PREFIX = PREFIX + KnownUsers.USER_PREFIX
+    KnownUsers.MEMBER_PREFIX = PREFIX + KnownUsers.MEMBER_PREFIX
+    KnownUsers.STATS_KEY = PREFIX + KnownUsers.STATS_KEY
+    settings.API_HOST = f'http://127.0.0.1:{args.port}'
+    fake = FakeApi(args.api_ms)
+    await fake.start(args.port)
+    await HttpClient.start()
+    RedisClient.start()
+    results = []
+    try:
+        for title, register in (('old, api per message', old_register), ('KnownUsers cache', new_register)):
+            await clear_keys(stream)
+            fake.calls = dict()
+            result = await replay(register, stream, args.concurrency)
+            result.update(
+                title=title,
+                profile=fake.calls.get('/api/profile', 0),
+                member=fake.calls.get('/api/bot/groupmember', 0),
+                stats=await KnownUsers.stats() if register is new_register else None,
+            )
+            results.append(result)
+    finally:
+        try:
+            await clear_keys(stream)
+        finally:
+            HttpClient.metrics = dict()
+            await HttpClient.stop()
+            await RedisClient.stop()
+            await fake.stop()
+
+    print(
+        f'{len(stream)} messages, {len(set(m["from"]["id"] for m in stream))} posters, '
+        f'{len(set(m["chat"]["id"] for m in stream))} groups, '
+        f'api {args.api_ms} ms, concurrency {args.concurrency}'
+    )
+    print('                      handled   msg/s  errors   p50 ms   p99 ms  /api/profile  /groupmember  api/msg')
+    for r in results:
+        print(
+            f'{r["title"]:21} {r["handled"]:8} {r["rate"]:7.0f} {r["errors"]:7} {r["p50"]:8.1f} {r["p99"]:8.1f} '
+            f'{r["profile"]:13} {r["member"]:13} {(r["profile"] + r["member"]) / r["handled"]:8.2f}'
+        )
+        if r['stats']:
+            print('    hits: ' + ', '.join(
+                f'{what} {stats["hit"]}/{stats["hit"] + stats["miss"]} ({stats["hit_rate"]}%)'
+                for what, stats in r['stats'].items()
+            ))
+
+parser = argparse.ArgumentParser(description='Replay a busy group message stream: api calls with and without the KnownUsers cache')
+parser.add_argument('--stream', help='file with telegram updates or messages, json per line')
+parser.add_argument('--messages', type=int, default=20000, help='number of messages to generate')
+parser.add_argument('--groups', type=int, default=5, help='number of groups to generate')
+parser.add_argument('--posters', type=int, default=2000, help='number of posters to generate')
+parser.add_argument('--renames', type=float, default=0.001, help='share of messages after the poster changed name')
+parser.add_argument('--record', help='write the generated stream to this file')
+parser.add_argument('--concurrency', type=int, default=20, help='number of concurrent handlers')
+parser.add_argument('--api-ms', type=float, default=20, help='response time of the fake api')
+parser.add_argument('--port', type=int, default=3085, help='port of the fake api')
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
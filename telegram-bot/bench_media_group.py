@@ -0,0 +1,210 @@
+# bench_media_group.py
+#
+# Задержка цикла событий бота при наплыве сообщений с фото альбомами
+# (media group): обращения к redis через общий асинхронный пул
+# (RedisClient) против прежних синхронных redis.Redis() на каждое
+# обращение, которые останавливали цикл событий.
+#
+# На каждое сообщение, как в обработчиках бота, одновременно:
+#   -   проверка media_group_id, как в handler_bot.message_to_bot():
+#       было GET и SET, теперь SET NX
+#   -   Misc.redis_is_key_first_up() по ключу чат + media_group_id:
+#       было WATCH/GET/MULTI/SET/SET/EXEC, теперь INCR/EXPIRE/SET
+#       в одном MULTI/EXEC
+#
+# Прибывает --groups альбомов по --photos сообщений, все сразу.
+# Задержка цикла: насколько позже срока просыпается задача, которая
+# спит по --tick мс. Redis может быть "далеко": --redis-delay-ms
+# задержка в каждую сторону через прокси в отдельном потоке.
+#
+# Нужен запущенный redis (settings.REDIS_CONNECT). Ключи теста --
+# под своим префиксом, с коротким временем жизни.
+#
+#   ./ENV/bin/python bench_media_group.py --groups 50 --photos 10 --redis-delay-ms 1
+
+import asyncio, argparse, threading, time
+
+import redis
+
+import settings
+from redis_client import RedisClient
+
+PREFIX = 'bench_media_group~'
+TTL = 60
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class DelayProxy(object):
+    """
+    TCP прокси к redis с задержкой delay секунд в каждую сторону,
+    в своем потоке со своим циклом событий
+    """
+
+    def __init__(self, port, target_host, target_port, delay):
+        self.port = port
+        self.target = (target_host, target_port)
+        self.delay = delay
+        self.started = threading.Event()
+
+    async def pipe(self, reader, writer):
+        try:
+            while data := await reader.read(65536):
+                await asyncio.sleep(self.delay)
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        target_reader, target_writer = await asyncio.open_connection(*self.target)
+        await asyncio.gather(self.pipe(reader, target_writer), self.pipe(target_reader, writer))
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+        self.started.set()
+        async with server:
+            await self.stopped.wait()
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True).start()
+        self.started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+async def old_message(connect, media_group_id, key):
+    """
+    Как было: новое синхронное соединение на каждое обращение
+    """
+    show_response = True
+    if r := redis.Redis(**connect):
+        check_str = f'{PREFIX}{media_group_id}'
+        if r.get(check_str):
+            show_response = False
+        else:
+            r.set(name=check_str, value='1', ex=TTL)
+        r.close()
+    is_first = None
+    if r := redis.Redis(**connect):
+        key_time = f'{key}~time'
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    x = int(pipe.get(key) or 0)
+                    pipe.multi()
+                    pipe.set(key_time, str(time.time()), ex=TTL)
+                    pipe.set(key, x + 1, ex=TTL)
+                    pipe.execute()
+                    is_first = x == 0
+                    break
+                except redis.WatchError:
+                    continue
+        r.close()
+    return show_response, is_first
+
+async def new_message(connect, media_group_id, key):
+    """
+    Как теперь: общий пул RedisClient
+    """
+    r = RedisClient.get()
+    show_response = bool(await r.set(name=f'{PREFIX}{media_group_id}', value='1', ex=TTL, nx=True))
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.incr(key)
+        pipe.expire(key, TTL)
+        pipe.set(f'{key}~time', str(time.time()), ex=TTL)
+        value, expired_, set_ = await pipe.execute()
+    return show_response, int(value) <= 1
+
+async def monitor(tick, lags, stopped):
+    while not stopped.is_set():
+        t0 = time.monotonic()
+        await asyncio.sleep(tick)
+        lags.append((time.monotonic() - t0 - tick) * 1000)
+
+async def run_round(handler, connect, args, run):
+    lags = []
+    stopped = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(args.tick / 1000.0, lags, stopped))
+    await asyncio.sleep(args.tick / 1000.0 * 3)
+    lags.clear()
+    latencies = []
+
+    async def message(group, photo):
+        t0 = time.monotonic()
+        media_group_id = f'{run}~{group}'
+        result = await handler(connect, media_group_id, f'{PREFIX}{group}~{media_group_id}')
+        latencies.append((time.monotonic() - t0) * 1000)
+        return result
+
+    started = time.monotonic()
+    results = await asyncio.gather(*[
+        message(group, photo) for photo in range(args.photos) for group in range(args.groups)
+    ])
+    took = time.monotonic() - started
+    stopped.set()
+    await monitor_task
+    return dict(
+        took=took * 1000,
+        shown=sum(1 for show_response, is_first in results if show_response),
+        first=sum(1 for show_response, is_first in results if is_first),
+        lag_p50=percentile(lags, 50),
+        lag_p99=percentile(lags, 99),
+        lag_max=max(lags) if lags else 0,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+    )
+
+async def main(args):
+    connect = dict(settings.REDIS_CONNECT)
+    proxy = None
+    if args.redis_delay_ms:
+        proxy = DelayProxy(
+            args.proxy_port, connect.get('host', 'localhost'), connect.get('port', 6379),
+            args.redis_delay_ms / 1000.0,
+        )
+        proxy.start()
+        connect.update(host='127.0.0.1', port=args.proxy_port)
+    settings.REDIS_CONNECT = connect
+    RedisClient.start()
+    results = []
+    run = int(time.time())
+    try:
+        for title, handler in (('sync redis.Redis()', old_message), ('RedisClient pool', new_message)):
+            result = await run_round(handler, connect, args, f'{run}~{title}')
+            result.update(title=title)
+            results.append(result)
+    finally:
+        await RedisClient.stop()
+        if proxy:
+            proxy.stop()
+    print(
+        f'{args.groups} media groups x {args.photos} photos, all at once, '
+        f'redis delay {args.redis_delay_ms} ms each way, tick {args.tick} ms'
+    )
+    print('                     burst ms  shown  first  lag p50  lag p99  lag max   msg p50   msg p99')
+    for r in results:
+        print(
+            f'{r["title"]:20} {r["took"]:9.1f} {r["shown"]:6} {r["first"]:6} '
+            f'{r["lag_p50"]:8.1f} {r["lag_p99"]:8.1f} {r["lag_max"]:8.1f} {r["p50"]:9.1f} {r["p99"]:9.1f}'
+        )
+
+parser = argparse.ArgumentParser(description='Event loop lag under a media group burst: async redis pool against sync redis calls')
+parser.add_argument('--groups', type=int, default=50, help='number of media groups')
+parser.add_argument('--photos', type=int, default=10, help='messages in each media group')
+parser.add_argument('--tick', type=float, default=10, help='ms the lag monitor sleeps')
+parser.add_argument('--redis-delay-ms', type=float, default=0, help='delay each way to redis, through a proxy')
+parser.add_argument('--proxy-port', type=int, default=3084, help='port of the delaying proxy')
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,332 @@
+# bot_cluster.py
+#
+# Работа бота в несколько процессов (settings.BOT_MODE = 'webhook')
+#
+# В режиме polling один процесс опрашивает телеграм и держит состояния
+# FSM в памяти, больше одного процесса так не запустить. В режиме webhook:
+#
+#   -   front: aiohttp сервер на settings.WEBAPP_HOST:WEBAPP_PORT, куда
+#       телеграм шлет обновления (webhook). Каждое обновление кладется
+#       в список redis одного из settings.BOT_WORKERS обработчиков,
+#       по ид чата: все обновления из одного чата обрабатывает один
+#       и тот же обработчик, в порядке поступления
+#   -   worker N: берет обновления из своего списка и передает их
+#       в aiogram Dispatcher. Разные чаты обрабатываются одновременно,
+#       обновления одного чата -- по очереди. Состояния FSM в redis
+#       (RedisStorage), общие для всех обработчиков
+#
+# Взятое из списка обновление переносится (BLMOVE) в список обработки
+# этого обработчика и удаляется оттуда, когда обработано. Если процесс
+# обработчика упал, то при следующем запуске то, что осталось в списке
+# обработки, возвращается в начало его очереди: обновление не теряется,
+# но может быть обработано дважды. Поэтому worker N должен быть запущен
+# в одном экземпляре. Нужен redis 6.2 и новее
+#
+# Обработчики могут быть и на других машинах с тем же redis:
+#   ./bot_run.py front
+#   ./bot_run.py worker 0 ... ./bot_run.py worker <BOT_WORKERS - 1>
+# или все на одной машине:
+#   ./bot_run.py webhook
+# Тогда front запускает обработчики как процессы `<тот же скрипт> worker N`
+# и перезапускает упавшие, см. WorkerSupervisor. Обновления упавшего
+# обработчика ждут в его списке в redis, пока он не запустится снова
+#
+# Задачи по расписанию (settings.SCHEDULE_CRON) запускаются в каждом
+# обработчике, но выполняет каждый запуск только один из них,
+# кто первым поставит блокировку в redis, см. ScheduleLock
+
+import asyncio, json, time, sys, os
+
+from aiohttp import web
+
+import logging
+import settings
+from redis_client import RedisClient
+
+class UpdateQueue(object):
+    """
+    Списки обновлений от телеграма для обработчиков, в redis
+    """
+
+    PREFIX = 'bot_updates'
+    PROCESSING_SUFFIX = 'processing'
+    KEY_SEP = '~'
+
+    # Ключи, под которыми в обновлении телеграма бывает чат
+    #
+    CHAT_PATHS = (
+        ('message', 'chat'),
+        ('edited_message', 'chat'),
+        ('channel_post', 'chat'),
+        ('edited_channel_post', 'chat'),
+        ('callback_query', 'message', 'chat'),
+        ('my_chat_member', 'chat'),
+        ('chat_member', 'chat'),
+        ('chat_join_request', 'chat'),
+    )
+    # Если чата нет, то отправитель
+    #
+    FROM_PATHS = (
+        ('callback_query', 'from'),
+        ('inline_query', 'from'),
+        ('chosen_inline_result', 'from'),
+        ('shipping_query', 'from'),
+        ('pre_checkout_query', 'from'),
+        ('poll_answer', 'user'),
+    )
+
+    @classmethod
+    def key(cls, worker):
+        return f'{cls.PREFIX}{cls.KEY_SEP}{worker}'
+
+    @classmethod
+    def processing_key(cls, worker):
+        return f'{cls.key(worker)}{cls.KEY_SEP}{cls.PROCESSING_SUFFIX}'
+
+    @classmethod
+    def chat_id(cls, update):
+        """
+        Ид чата (или отправителя) обновления, по нему порядок обработки
+        """
+        for path in cls.CHAT_PATHS + cls.FROM_PATHS:
+            item = update
+            for name in path:
+                item = item.get(name) if isinstance(item, dict) else None
+            if isinstance(item, dict) and item.get('id') is not None:
+                return item['id']
+        return update.get('update_id', 0)
+
+    @classmethod
+    def worker_for(cls, update, workers):
+        return abs(int(cls.chat_id(update))) % workers
+
+
+class ScheduleLock(object):
+    """
+    Чтобы задача по расписанию, запущенная во всех обработчиках,
+    выполнялась одним из них
+
+    Блокировка ставится на задачу и минуту запуска, округленную до
+    ближайшей: часы машин могут немного расходиться
+    """
+
+    PREFIX = 'schedule_lock'
+    KEY_SEP = '~'
+    TTL = 300
+
+    @classmethod
+    def wrap(cls, name, proc):
+        async def run_once():
+            minute = int(round(time.time() / 60))
+            key = f'{cls.PREFIX}{cls.KEY_SEP}{name}{cls.KEY_SEP}{minute}'
+            try:
+                if not await RedisClient.get().set(key, '1', ex=cls.TTL, nx=True):
+                    logging.debug(f'Schedule {name}: runs in another process')
+                    return
+            except Exception as e:
+                logging.error(f'Schedule lock error: {str(e)}')
+                return
+            await proc()
+        return run_once
+
+
+class WorkerSupervisor(object):
+    """
+    Обработчики на машине front (режим webhook): процессы
+    `<тот же скрипт> worker N`. Упавший обработчик запускается снова,
+    с задержкой, которая растет, если он падает сразу после запуска
+    """
+
+    RESTART_DELAY = 1
+    RESTART_DELAY_MAX = 60
+    # Проработал столько секунд: задержка перезапуска снова RESTART_DELAY
+    #
+    STABLE_TIME = 60
+    # Сколько секунд ждать завершения обработчиков после terminate()
+    #
+    STOP_TIMEOUT = 10
+
+    def __init__(self, workers, command=None):
+        self.workers = workers
+        self.command = command or [sys.executable, os.path.abspath(sys.argv[0])]
+        # {worker: asyncio.subprocess.Process}
+        self.processes = dict()
+        self.restarts = 0
+
+    async def supervise(self, worker):
+        delay = self.RESTART_DELAY
+        while True:
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(*self.command, 'worker', str(worker))
+            except Exception as e:
+                logging.error(f'Bot worker {worker} failed to start: {str(e)}')
+            else:
+                self.processes[worker] = process
+                logging.info(f'Bot worker {worker} started, pid {process.pid}')
+                returncode = await process.wait()
+                logging.error(f'Bot worker {worker} exited with code {returncode}')
+            if time.monotonic() - started >= self.STABLE_TIME:
+                delay = self.RESTART_DELAY
+            logging.warning(f'Bot worker {worker} restarts in {delay} s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RESTART_DELAY_MAX)
+            self.restarts += 1
+
+    async def stop(self):
+        running = [process for process in self.processes.values() if process.returncode is None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            try:
+                await asyncio.wait_for(process.wait(), self.STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    async def run(self):
+        tasks = [asyncio.create_task(self.supervise(worker)) for worker in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.stop()
+
+
+async def serve_front(bot, dp, supervisor=None):
+    """
+    Принимать обновления от телеграма, раскладывать их обработчикам.
+    Если задан supervisor, то и запускать обработчики на этой машине
+    """
+    r = RedisClient.get()
+    supervisor_task = asyncio.create_task(supervisor.run()) if supervisor else None
+
+    async def handle(request):
+        if settings.WEBHOOK_SECRET and \
+           request.headers.get('X-Telegram-Bot-Api-Secret-Token') != settings.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            await r.lpush(
+                UpdateQueue.key(UpdateQueue.worker_for(update, settings.BOT_WORKERS)),
+                body,
+            )
+        except Exception as e:
+            # Телеграм повторит обновление позже
+            logging.error(f'Update queue error: {str(e)}')
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(settings.WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WEBAPP_HOST, settings.WEBAPP_PORT)
+    await site.start()
+    await bot.set_webhook(
+        url=settings.WEBHOOK_HOST + settings.WEBHOOK_PATH,
+        secret_token=settings.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f'Webhook front listens on {settings.WEBAPP_HOST}:{settings.WEBAPP_PORT}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if supervisor_task:
+            supervisor_task.cancel()
+            await asyncio.gather(supervisor_task, return_exceptions=True)
+        await runner.cleanup()
+
+
+class Worker(object):
+    """
+    Обработчик обновлений из своего списка в redis
+    """
+
+    # Сколько секунд ждать обновления за один запрос к redis
+    #
+    POP_TIMEOUT = 1
+
+    def __init__(self, bot, dp, worker):
+        self.bot = bot
+        self.dp = dp
+        self.key = UpdateQueue.key(worker)
+        self.key_processing = UpdateQueue.processing_key(worker)
+        # {chat_id: asyncio.Queue()}, очереди чатов, у которых есть задача обработки.
+        # В очереди (update, raw): обновление и как оно лежит в redis
+        self.chats = dict()
+        self.slots = asyncio.Semaphore(settings.BOT_WORKER_CONCURRENCY)
+        self.tasks = set()
+
+    async def process_chat(self, chat_id, queue):
+        try:
+            while not queue.empty():
+                update, raw = queue.get_nowait()
+                async with self.slots:
+                    try:
+                        await self.dp.feed_raw_update(self.bot, update)
+                    except Exception:
+                        logging.exception(f'Update {update.get("update_id")} failed')
+                # И упавшее в обработчике обновление не повторяем:
+                # упадет и в следующий раз
+                await self.done(raw)
+        finally:
+            del self.chats[chat_id]
+
+    async def done(self, raw):
+        """
+        Убрать обработанное обновление из списка обработки
+        """
+        try:
+            await RedisClient.get().lrem(self.key_processing, 1, raw)
+        except Exception as e:
+            logging.error(f'Update queue error: {str(e)}')
+
+    async def requeue(self, r):
+        """
+        Вернуть в начало очереди то, что осталось в списке обработки
+        от прошлого запуска, в прежнем порядке
+        """
+        n = 0
+        while await r.lmove(self.key_processing, self.key, src='LEFT', dest='RIGHT'):
+            n += 1
+        if n:
+            logging.warning(f'Bot worker requeued {n} unfinished updates to {self.key}')
+
+    async def run(self):
+        r = RedisClient.get()
+        logging.info(f'Bot worker reads {self.key}')
+        await self.requeue(r)
+        while True:
+            try:
+                raw = await r.blmove(
+                    self.key, self.key_processing, self.POP_TIMEOUT, src='RIGHT', dest='LEFT',
+                )
+            except Exception as e:
+                logging.error(f'Update queue error: {str(e)}')
+                await asyncio.sleep(self.POP_TIMEOUT)
+                continue
+            if raw is None:
+                continue
+            try:
+                update = json.loads(raw)
+            except ValueError:
+                logging.error(f'Invalid update in {self.key}: {raw!r}')
+                await self.done(raw)
+                continue
+            chat_id = UpdateQueue.chat_id(update)
+            queue = self.chats.get(chat_id)
+            if queue is None:
+                queue = self.chats[chat_id] = asyncio.Queue()
+                queue.put_nowait((update, raw))
+                task = asyncio.create_task(self.process_chat(chat_id, queue))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            else:
+                queue.put_nowait((update, raw))
@@ -0,0 +1,276 @@
+# bot_loadtest.py
+#
+# Нагрузочный тест работы бота в несколько процессов, см. bot_cluster.py
+#
+# Запускаются:
+#   -   поддельный сервер Bot API телеграма (aiohttp, 127.0.0.1): отвечает
+#       на getMe, setWebhook, sendMessage и засекает, когда пришел ответ
+#       на каждое обновление
+#   -   front из bot_cluster.serve_front(), как в режиме webhook
+#   -   N процессов bot_cluster.Worker с простым обработчиком: подождать
+#       --handler-ms (как будто обращение к апи) и ответить в чат
+#       тем же текстом
+#
+# Генератор шлет во front --rate обновлений в секунду из --chats чатов
+# в течение --duration секунд. Задержка: от отправки обновления во front
+# до прихода sendMessage с ответом на него в поддельный сервер. Замер для
+# каждого числа обработчиков из --workers. Еще проверяется, что ответы
+# в каждом чате пришли в порядке обновлений.
+#
+# Нужен запущенный redis (settings.REDIS_CONNECT). Списки обновлений
+# теста -- под своим префиксом, не те, что у работающего бота.
+#
+#   ./ENV/bin/python bot_loadtest.py --workers 1,2,4 --rate 300 --duration 10
+
+import asyncio, argparse, logging, multiprocessing, time
+
+from aiohttp import web, ClientSession, TCPConnector
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.aiohttp import AiohttpSession
+
+import settings
+from redis_client import RedisClient
+import bot_cluster
+from bot_cluster import UpdateQueue, Worker
+
+TOKEN = '123456:loadtest'
+QUEUE_PREFIX = 'bot_loadtest_updates'
+
+def make_bot(api_port):
+    return Bot(
+        token=TOKEN,
+        session=AiohttpSession(
+            api=TelegramAPIServer.from_base(f'http://127.0.0.1:{api_port}'),
+    ))
+
+def setup_settings(workers, front_port):
+    # Журнал на каждое обновление и запрос сам по себе нагрузка
+    logging.getLogger().setLevel(logging.WARNING)
+    settings.BOT_WORKERS = workers
+    settings.WEBAPP_HOST = '127.0.0.1'
+    settings.WEBAPP_PORT = front_port
+    settings.WEBHOOK_HOST = f'http://127.0.0.1:{front_port}'
+    settings.WEBHOOK_PATH = '/'
+    settings.WEBHOOK_SECRET = None
+    UpdateQueue.PREFIX = QUEUE_PREFIX
+
+
+class FakeTelegram(object):
+    """
+    Поддельный сервер Bot API
+    """
+
+    def __init__(self):
+        self.message_id = 0
+        # {update_id: время прихода ответа}
+        self.answered = dict()
+        # {chat_id: [update_id, ...]} в порядке прихода ответов
+        self.order = dict()
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        if method == 'getme':
+            result = dict(id=1, is_bot=True, first_name='Loadtest', username='loadtest_bot')
+        elif method == 'sendmessage':
+            received = time.time()
+            chat_id = int(data['chat_id'])
+            update_id = int(data['text'].split()[0])
+            self.answered[update_id] = received
+            self.order.setdefault(chat_id, []).append(update_id)
+            self.message_id += 1
+            result = dict(
+                message_id=self.message_id,
+                date=int(received),
+                chat=dict(id=chat_id, type='private'),
+                text=data['text'],
+            )
+        else:
+            result = True
+        return web.json_response(dict(ok=True, result=result))
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def run_worker(worker, workers, api_port, front_port, handler_ms, ready):
+    router = Router()
+
+    @router.message()
+    async def echo(message: Message):
+        await asyncio.sleep(handler_ms / 1000.0)
+        await message.answer(message.text)
+
+    async def main():
+        setup_settings(workers, front_port)
+        bot = make_bot(api_port)
+        dp = Dispatcher()
+        dp.include_router(router)
+        ready.set()
+        try:
+            await Worker(bot, dp, worker).run()
+        finally:
+            await bot.session.close()
+            await RedisClient.stop()
+
+    asyncio.run(main())
+
+
+def make_update(update_id, chat_id, sent):
+    return dict(
+        update_id=update_id,
+        message=dict(
+            message_id=update_id,
+            date=int(sent),
+            chat=dict(id=chat_id, type='private'),
+            **{'from': dict(id=chat_id, is_bot=False, first_name='Load')},
+            text=f'{update_id} {sent}',
+    ))
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+async def clear_queues(workers):
+    r = RedisClient.get()
+    for worker in range(workers):
+        await r.delete(UpdateQueue.key(worker), UpdateQueue.processing_key(worker))
+
+async def run_round(args, workers):
+    setup_settings(workers, args.front_port)
+    await clear_queues(max(args.workers))
+    fake = FakeTelegram()
+    await fake.start(args.api_port)
+    bot = make_bot(args.api_port)
+    dp = Dispatcher()
+    front = asyncio.create_task(bot_cluster.serve_front(bot, dp))
+    # spawn: обработчикам не нужны ни цикл событий, ни пул redis этого процесса
+    context = multiprocessing.get_context('spawn')
+    ready = [context.Event() for worker in range(workers)]
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(worker, workers, args.api_port, args.front_port, args.handler_ms, ready[worker]),
+            daemon=True,
+        ) for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Пусть обработчики запустятся: импорт aiogram может занять секунды
+    loop = asyncio.get_running_loop()
+    for event in ready:
+        await loop.run_in_executor(None, event.wait, args.warmup)
+
+    sent = dict()
+    errors = 0
+    url = f'http://127.0.0.1:{args.front_port}/'
+    async with ClientSession(connector=TCPConnector(limit=200)) as session:
+
+        async def post(update_id, chat_id):
+            nonlocal errors
+            t0 = time.time()
+            sent[update_id] = t0
+            try:
+                async with session.post(url, json=make_update(update_id, chat_id, t0)) as response:
+                    if response.status != 200:
+                        errors += 1
+            except Exception:
+                errors += 1
+
+        total = int(args.rate * args.duration)
+        started = time.monotonic()
+        posts = []
+        for n in range(total):
+            delay = started + n / float(args.rate) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            posts.append(asyncio.create_task(post(n + 1, 1000 + n % args.chats)))
+        await asyncio.gather(*posts)
+        send_time = time.monotonic() - started
+
+        deadline = time.monotonic() + args.drain
+        while len(fake.answered) < len(sent) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    front.cancel()
+    try:
+        await front
+    except asyncio.CancelledError:
+        pass
+    await bot.session.close()
+    await fake.stop()
+
+    latencies = [
+        (fake.answered[update_id] - t0) * 1000
+        for update_id, t0 in sent.items() if update_id in fake.answered
+    ]
+    out_of_order = sum(
+        1 for ids in fake.order.values()
+        for a, b in zip(ids, ids[1:]) if a > b
+    )
+    return dict(
+        workers=workers,
+        sent=len(sent),
+        answered=len(latencies),
+        errors=errors,
+        out_of_order=out_of_order,
+        rate=len(sent) / send_time if send_time else 0,
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+        max=max(latencies) if latencies else 0,
+    )
+
+async def main(args):
+    RedisClient.start()
+    results = []
+    try:
+        for workers in args.workers:
+            results.append(await run_round(args, workers))
+            await asyncio.sleep(0.5)
+        await clear_queues(max(args.workers))
+    finally:
+        await RedisClient.stop()
+    print(
+        f'rate {args.rate}/s, {args.chats} chats, {args.duration} s, '
+        f'handler {args.handler_ms} ms, concurrency {settings.BOT_WORKER_CONCURRENCY}'
+    )
+    print('workers      sent  answered  errors  order  rate/s   p50 ms   p95 ms   p99 ms   max ms')
+    for r in results:
+        print(
+            f'{r["workers"]:7} {r["sent"]:9} {r["answered"]:9} {r["errors"]:7} {r["out_of_order"]:6} '
+            f'{r["rate"]:7.0f} {r["p50"]:8.1f} {r["p95"]:8.1f} {r["p99"]:8.1f} {r["max"]:8.1f}'
+        )
+
+parser = argparse.ArgumentParser(description='Load test of the webhook front and bot workers, see bot_cluster.py')
+parser.add_argument('--workers', type=lambda s: [int(v) for v in s.split(',')], default=[1, 2, 4],
+    help='comma separated numbers of workers to measure, default 1,2,4')
+parser.add_argument('--rate', type=int, default=200, help='updates per second')
+parser.add_argument('--duration', type=float, default=10, help='seconds to send updates')
+parser.add_argument('--chats', type=int, default=100, help='number of chats the updates come from')
+parser.add_argument('--handler-ms', type=float, default=20, help='time the handler waits, as for an api call')
+parser.add_argument('--api-port', type=int, default=3081, help='port of the fake Bot API server')
+parser.add_argument('--front-port', type=int, default=3082, help='port of the webhook front')
+parser.add_argument('--warmup', type=float, default=60, help='max seconds to wait for each worker to start')
+parser.add_argument('--drain', type=float, default=30, help='seconds to wait for answers after sending')
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
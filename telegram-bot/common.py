@@ -2,7 +2,7 @@
 #
 # Константы, функции и т.п., применяемые в handler_*/py
 
-import base64, re, datetime, time, copy, redis
+import base64, re, datetime, time, copy, json
 from urllib.parse import urlencode
 from uuid import UUID
 import qrcode
@@ -20,15 +20,14 @@ from aiogram.enums import ChatType
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.state import StatesGroup, State
 
-import aiohttp
 import logging
 import settings
+from http_client import HttpClient
+from redis_client import RedisClient
 
 import me
 dp, bot, bot_data = me.dp, me.bot, me.bot_data
 
-TIMEOUT = aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT)
-
 # Контексты, используемые в разных местах: обычно и в командах и в кнопках
 
 class FSMnewPerson(StatesGroup):
@@ -598,16 +597,15 @@ class Misc(object):
     @classmethod
     async def get_template(cls, template):
         status = response = None
-        async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-            try:
-                async with session.request(
-                    'GET',
-                    "%s/res/telegram-bot/%s.txt" % (settings.GRAPH_HOST, template),
-                ) as resp:
-                    status = resp.status
-                    response = await resp.text('UTF-8')
-            except:
-                pass
+        try:
+            status, response = await HttpClient.request(
+                'GET',
+                "%s/res/telegram-bot/%s.txt" % (settings.GRAPH_HOST, template),
+                metric='/res/telegram-bot',
+                response_type='text',
+            )
+        except:
+            pass
         return status, response
 
     @classmethod
@@ -721,25 +719,18 @@ class Misc(object):
             'json' или 'text'
         """
         status = response = None
-        async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-            try:
-                async with session.request(
-                    method.upper(),
-                    "%s%s" % (settings.API_HOST, path,),
-                    data=data,
-                    json=json,
-                    params=params,
-                ) as resp:
-                    status = resp.status
-                    if status < 500:
-                        if response_type == 'json':
-                            response = await resp.json()
-                        elif response_type == 'text':
-                            response = await resp.text('UTF-8')
-                    else:
-                        response = await resp.text('UTF-8')
-            except:
-                pass
+        try:
+            status, response = await HttpClient.request(
+                method,
+                "%s%s" % (settings.API_HOST, path,),
+                metric=path,
+                response_type=response_type,
+                data=data,
+                json=json,
+                params=params,
+            )
+        except:
+            pass
         return status, response
 
     @classmethod
@@ -959,9 +950,12 @@ class Misc(object):
         )
 
     @classmethod
-    async def post_tg_user(cls, tg_user_sender, activate=False, did_bot_start=True):
+    async def post_tg_user(cls, tg_user_sender, activate=False, did_bot_start=True, fields=None):
         """
         Получить данные и/или сформировать пользователя
+
+        fields: какие части данных пользователя нужны, например, 'data':
+        только профиль, без родни, ключей и т.п. По умолчанию все
         """
         payload_sender = dict(
             tg_token=settings.TOKEN,
@@ -973,6 +967,8 @@ class Misc(object):
             # Если пустой did_bot_start, то он не сбрасывается в профиле юзера
             did_bot_start='1' if did_bot_start else '',
         )
+        if fields is not None:
+            payload_sender.update(fields=fields)
         logging.debug('get_or_create tg_user by tg_uid in api, payload: %s' % cls.secret(payload_sender))
         status_sender, response_sender = await cls.api_request(
             path='/api/profile',
@@ -1629,24 +1625,26 @@ class Misc(object):
                 frame_width=PHOTO_FRAME_WIDTH,
             )
             status = photo = None
-            async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-                try:
-                    async with session.request('GET', thumbnail,) as response:
-                        status = response.status
-                        photo = Image.open(BytesIO(await response.read()))
-                except:
-                    pass
-                if status == 200 and photo:
-                    photo_width = PHOTO_WIDTH + PHOTO_FRAME_WIDTH * 2
-                    wpercent = photo_width / float(photo.size[0])
-                    photo_height = int((float(photo.size[1]) * float(wpercent)))
-                    if photo.size[0] != photo_width or photo.size[1] != photo_height:
-                        photo = photo.resize((photo_width, photo_height), Image.LANCZOS)
-                    pos = (
-                        (image.size[0] - photo.size[0]) // 2,
-                        (image.size[1] - photo.size[1]) // 2,
-                    )
-                    image.paste(photo, pos)
+            try:
+                status, response = await HttpClient.request(
+                    'GET', thumbnail,
+                    metric='/thumb',
+                    response_type='bytes',
+                )
+                photo = Image.open(BytesIO(response))
+            except:
+                pass
+            if status == 200 and photo:
+                photo_width = PHOTO_WIDTH + PHOTO_FRAME_WIDTH * 2
+                wpercent = photo_width / float(photo.size[0])
+                photo_height = int((float(photo.size[1]) * float(wpercent)))
+                if photo.size[0] != photo_width or photo.size[1] != photo_height:
+                    photo = photo.resize((photo_width, photo_height), Image.LANCZOS)
+                pos = (
+                    (image.size[0] - photo.size[0]) // 2,
+                    (image.size[1] - photo.size[1]) // 2,
+                )
+                image.paste(photo, pos)
 
         image.save(bytes_io, format='JPEG')
         return bytes_io
@@ -2376,22 +2374,12 @@ class Misc(object):
         Один раз применялась. Но оказалась не ошибка в aiogram api,
         а ошибка разработчика :)
         """
-        status = response = None
-        async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-            try:
-                async with session.request(
-                    'POST',
-                    f'https://api.telegram.org/bot{settings.TOKEN}/{method_name}',
-                    json=json,
-                ) as resp:
-                    status = resp.status
-                    response = await resp.json()
-                    if status < 500:
-                        response = await resp.json()
-                    else:
-                        response = await resp.text('UTF-8')
-            except:
-                raise
+        status, response = await HttpClient.request(
+            'POST',
+            f'https://api.telegram.org/bot{settings.TOKEN}/{method_name}',
+            metric=f'/tg/{method_name}',
+            json=json,
+        )
         return status, response
 
 
@@ -2443,19 +2431,16 @@ class Misc(object):
     @classmethod
     async def redis_wait_last_in_pack(cls, key):
         result = None
+        r = RedisClient.get()
+        key_time = f'{key}{Rcache.SEND_MULTI_MESSAGE_TIME_SUFFIX}'
         for i in range(Rcache.SEND_MULTI_MESSAGE_WAIT_RETRIES):
-            key_time = f'{key}{Rcache.SEND_MULTI_MESSAGE_TIME_SUFFIX}'
-            if r := redis.Redis(**settings.REDIS_CONNECT):
-                try:
-                    saved_time = float(r.get(key_time) or time.time())
-                    r.close()
-                    if time.time() - saved_time > settings.MULTI_MESSAGE_TIMEOUT:
-                        result = True
-                        break
-                    await asyncio.sleep(1)
-                except:
+            try:
+                saved_time = float(await r.get(key_time) or time.time())
+                if time.time() - saved_time > settings.MULTI_MESSAGE_TIMEOUT:
+                    result = True
                     break
-            else:
+                await asyncio.sleep(1)
+            except:
                 break
         else:
             result = True
@@ -2463,7 +2448,7 @@ class Misc(object):
 
 
     @classmethod
-    def redis_is_key_first_up(cls, key, ex=Rcache.SEND_MULTI_MESSAGE_EXPIRE):
+    async def redis_is_key_first_up(cls, key, ex=Rcache.SEND_MULTI_MESSAGE_EXPIRE):
         """
         Вызывающий эту функцию первым установил ключ key?
 
@@ -2475,36 +2460,22 @@ class Misc(object):
         будет достигнута: messsage.chat.id . media_group_id
 
         Заодно в redis ставится время, когда произошло событие
+
+        Счетчик увеличивается INCR в транзакции MULTI/EXEC, за один
+        обмен с redis, без повторов WATCH при одновременных вызовах
         """
         result = None
-        value = 0
-        is_first = None
-        if r := redis.Redis(**settings.REDIS_CONNECT):
-            key_time = f'{key}{Rcache.SEND_MULTI_MESSAGE_TIME_SUFFIX}'
-            try:
-                with r.pipeline() as pipe:
-                    while True:
-                        try:
-                            pipe.watch(key)
-                            x = int(pipe.get(key) or 0)
-                            pipe.multi()
-                            value = x + 1
-                            pipe.set(key_time, str(time.time()), ex=ex)
-                            pipe.set(key, value, ex=ex)
-                            pipe.execute()
-                            break
-                        except redis.WatchError as e:
-                            # https://learn.codesignal.com/preview/lessons/2765
-                            # if another client changes the key before the transaction is executed,
-                            # a redis.WatchError exception is raised,
-                            # and the transaction is retried - hence the continue statement.
-                            # Т.е.он снова выйдет на value = x + 1, но x к этому времени будет
-                            # уже больше.
-                            continue
-                r.close()
-                result = int(value) <= 1
-            except:
-                result = None
+        r = RedisClient.get()
+        key_time = f'{key}{Rcache.SEND_MULTI_MESSAGE_TIME_SUFFIX}'
+        try:
+            async with r.pipeline(transaction=True) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, ex)
+                pipe.set(key_time, str(time.time()), ex=ex)
+                value, expired_, set_ = await pipe.execute()
+            result = int(value) <= 1
+        except:
+            result = None
         return result
 
     redis_save_time = redis_is_key_first_up
@@ -2905,19 +2876,17 @@ class TgGroupMember(object):
 
         # для предотвращения повторного добавления одного и того же пользователя в ту же группу
         dedup_key = f"group_member_dedup:{group_chat_id}:{user_tg_uid}"
-        if r := redis.Redis(**settings.REDIS_CONNECT):
-            try:
-                # Пытаемся установить ключ с временем жизни 5 минут
-                # Если ключ уже существует (возвращает 0) - добавление уже обрабатывается
-                if not r.set(dedup_key, "1", ex=300, nx=True):
-                    logging.debug(f"Group member {user_tg_uid} in group {group_chat_id} already being processed, skipping")
-                    return 429, {"error": "Group member processing in progress"}
-                logging.debug(f"Group member {user_tg_uid} in group {group_chat_id} processing started")
-            except Exception as e:
-                logging.error(f"Redis dedup error: {str(e)}")
-                # В случае ошибки Redis продолжаем обработку
-            finally:
-                r.close()
+        r = RedisClient.get()
+        try:
+            # Пытаемся установить ключ с временем жизни 5 минут
+            # Если ключ уже существует (возвращает 0) - добавление уже обрабатывается
+            if not await r.set(dedup_key, "1", ex=300, nx=True):
+                logging.debug(f"Group member {user_tg_uid} in group {group_chat_id} already being processed, skipping")
+                return 429, {"error": "Group member processing in progress"}
+            logging.debug(f"Group member {user_tg_uid} in group {group_chat_id} processing started")
+        except Exception as e:
+            logging.error(f"Redis dedup error: {str(e)}")
+            # В случае ошибки Redis продолжаем обработку
 
         payload = cls.payload(group_chat_id, group_title, group_type, user_tg_uid)
         logging.debug('post group member, payload: %s' % Misc.secret(payload))
@@ -2932,6 +2901,7 @@ class TgGroupMember(object):
 
     @classmethod
     async def remove(cls, group_chat_id, group_title, group_type, user_tg_uid):
+        await KnownUsers.forget_member(group_chat_id, user_tg_uid)
         payload = cls.payload(group_chat_id, group_title, group_type, user_tg_uid)
         logging.debug('delete group member, payload: %s' % Misc.secret(payload))
         status, response = await Misc.api_request(
@@ -2944,15 +2914,173 @@ class TgGroupMember(object):
         return status, response
 
 
+class KnownUsers(object):
+    """
+    Кэш в redis пользователей, пишущих в группы, и их членства в группах
+
+    На каждое сообщение в группу бот регистрировал автора:
+    POST /api/profile (Misc.post_tg_user) и POST /api/bot/groupmember
+    (TgGroupMember.add), даже если автор писал секунды назад.
+    Теперь в redis:
+        -   USER_PREFIX + KEY_SEP + tg_uid:
+                имя, фамилия, username пользователя телеграма,
+                с которыми он внесен в апи. Сам профиль не кэшируется:
+                числа доверий, благодарностей в нем меняются в любой
+                момент. Живет settings.KNOWN_USER_TTL секунд. Если
+                пользователь сменил имя, фамилию или username,
+                он вносится в апи заново
+        -   MEMBER_PREFIX + KEY_SEP + chat_id + KEY_SEP + tg_uid:
+                название и тип группы, с которыми пользователь
+                внесен в апи как участник группы. Живет
+                settings.KNOWN_MEMBER_TTL секунд. Если у группы
+                другое название или тип, участник вносится заново
+        -   STATS_KEY: счетчики попаданий и промахов, см. stats()
+    """
+
+    USER_PREFIX = 'known_user'
+    MEMBER_PREFIX = 'known_member'
+    STATS_KEY = 'known_users_stats'
+    KEY_SEP = Rcache.KEY_SEP
+
+    @classmethod
+    def user_key(cls, tg_uid):
+        return f'{cls.USER_PREFIX}{cls.KEY_SEP}{tg_uid}'
+
+    @classmethod
+    def member_key(cls, group_chat_id, user_tg_uid):
+        return f'{cls.MEMBER_PREFIX}{cls.KEY_SEP}{group_chat_id}{cls.KEY_SEP}{user_tg_uid}'
+
+    @classmethod
+    def names(cls, tg_user):
+        return [tg_user.first_name or '', tg_user.last_name or '', tg_user.username or '']
+
+    @classmethod
+    async def count(cls, r, field):
+        try:
+            await r.hincrby(cls.STATS_KEY, field, 1)
+        except Exception as e:
+            logging.error(f"Redis known users stats error: {str(e)}")
+
+    @classmethod
+    async def post_tg_user(cls, tg_user_sender):
+        """
+        Misc.post_tg_user(tg_user_sender, did_bot_start=False, fields='data'),
+        если пользователь не в кэше или сменил имя.
+
+        Возвращает (status, profile). Если пользователь в кэше, то
+        (200, None): профиль, если он нужен, брать из апи, см. profile()
+        """
+        r = RedisClient.get()
+        key = cls.user_key(tg_user_sender.id)
+        names = cls.names(tg_user_sender)
+        try:
+            cached = await r.get(key)
+        except Exception as e:
+            logging.error(f"Redis known user error: {str(e)}")
+            cached = None
+        if cached == json.dumps(names):
+            await cls.count(r, 'user_hit')
+            return 200, None
+        await cls.count(r, 'user_miss')
+        status, profile = await Misc.post_tg_user(tg_user_sender, did_bot_start=False, fields='data')
+        if status == 200 and profile:
+            try:
+                await r.set(key, json.dumps(names), ex=settings.KNOWN_USER_TTL)
+            except Exception as e:
+                logging.error(f"Redis known user error: {str(e)}")
+        return status, profile
+
+    @classmethod
+    async def profile(cls, tg_user_sender, profile=None):
+        """
+        Профиль из ответа post_tg_user(), а если там его нет,
+        свежий из апи, с текущими числами доверий
+        """
+        if profile:
+            return 200, profile
+        return await Misc.post_tg_user(tg_user_sender, did_bot_start=False, fields='data')
+
+    @classmethod
+    async def add_member(cls, group_chat_id, group_title, group_type, user_tg_uid):
+        """
+        TgGroupMember.add(), если участник не в кэше
+        или у группы другое название, тип
+        """
+        r = RedisClient.get()
+        key = cls.member_key(group_chat_id, user_tg_uid)
+        value = json.dumps([group_title, group_type])
+        try:
+            cached = await r.get(key)
+        except Exception as e:
+            logging.error(f"Redis known member error: {str(e)}")
+            cached = None
+        if cached == value:
+            await cls.count(r, 'member_hit')
+            return 200, {}
+        await cls.count(r, 'member_miss')
+        status, response = await TgGroupMember.add(
+            group_chat_id=group_chat_id,
+            group_title=group_title,
+            group_type=group_type,
+            user_tg_uid=user_tg_uid,
+        )
+        if status == 200:
+            try:
+                await r.set(key, value, ex=settings.KNOWN_MEMBER_TTL)
+            except Exception as e:
+                logging.error(f"Redis known member error: {str(e)}")
+        return status, response
+
+    @classmethod
+    async def forget_member(cls, group_chat_id, user_tg_uid):
+        try:
+            await RedisClient.get().delete(cls.member_key(group_chat_id, user_tg_uid))
+        except Exception as e:
+            logging.error(f"Redis known member error: {str(e)}")
+
+    @classmethod
+    async def stats(cls):
+        """
+        Счетчики попаданий и промахов, доля попаданий в процентах
+        """
+        try:
+            counts = await RedisClient.get().hgetall(cls.STATS_KEY)
+        except Exception as e:
+            logging.error(f"Redis known users stats error: {str(e)}")
+            counts = {}
+        result = dict()
+        for what in ('user', 'member'):
+            hit = int(counts.get(f'{what}_hit', 0))
+            miss = int(counts.get(f'{what}_miss', 0))
+            result[what] = dict(
+                hit=hit,
+                miss=miss,
+                hit_rate=round(hit * 100.0 / (hit + miss), 1) if hit + miss else None,
+            )
+        return result
+
+
 class Schedule(object):
 
+    # Сколько ключей просматривать за один SCAN и удалять за один UNLINK
+    #
+    REDIS_SCAN_COUNT = 500
+
     @classmethod
     async def cron_remove_cards_in_group(cls):
         if not settings.GROUPS_WITH_CARDS:
             return
-        if r := redis.Redis(**settings.REDIS_CONNECT):
-            time_current = int(time.time())
-            for key in r.scan_iter(Rcache.CARD_IN_GROUP_PREFIX + '*'):
+        r = RedisClient.get()
+        time_current = int(time.time())
+        cursor = 0
+        while True:
+            cursor, keys = await r.scan(
+                cursor=cursor,
+                match=Rcache.CARD_IN_GROUP_PREFIX + '*',
+                count=cls.REDIS_SCAN_COUNT,
+            )
+            keys_to_unlink = []
+            for key in keys:
                 try:
                     (prefix, tm, chat_id, message_id) = key.split(Rcache.KEY_SEP)
                     tm = int(tm); chat_id = int(chat_id); message_id = int(message_id)
@@ -2964,14 +3092,17 @@ class Schedule(object):
                                     await bot.delete_message(chat_id=chat_id, message_id=message_id)
                                 except:
                                     pass
-                                r.expire(key, 10)
+                                keys_to_unlink.append(key)
                         except (ValueError, TypeError,):
-                            r.expire(key, 10)
+                            keys_to_unlink.append(key)
                     else:
-                        r.expire(key, 10)
+                        keys_to_unlink.append(key)
                 except ValueError:
-                    r.expire(key, 10)
-            r.close()
+                    keys_to_unlink.append(key)
+            if keys_to_unlink:
+                await r.unlink(*keys_to_unlink)
+            if not cursor:
+                break
 
 class TgDesc(object):
     """
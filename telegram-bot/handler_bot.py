@@ -5,7 +5,7 @@
 # Все команды в бот должны быть здесь. После команд в бот идет обработка
 # любого сообщения
 
-import re, redis
+import re
 from urllib.parse import urlparse
 
 from aiogram import Router, F, html
@@ -20,6 +20,7 @@ from aiogram.fsm.state import StatesGroup, State
 
 import logging
 import settings
+from redis_client import RedisClient
 
 from common import FSMnewPerson, FSMgeo, FSMdelete
 from common import Misc, KeyboardType, OperationType, Rcache, MeetId
@@ -524,20 +525,19 @@ async def message_to_bot(message: Message, state: FSMContext):
 
     show_response = True
     if message.media_group_id:
-        if r := redis.Redis(**settings.REDIS_CONNECT):
-            check_str = (
-                f'{Rcache.MEDIA_GROUP_PREFIX}'
-                f'{message.media_group_id}'
-            )
-            if r.get(check_str):
-                show_response = False
-            else:
-                r.set(
-                    name=check_str,
-                    value='1',
-                    ex=Rcache.MEDIA_GROUP_TTL,
-                )
-            r.close()
+        r = RedisClient.get()
+        check_str = (
+            f'{Rcache.MEDIA_GROUP_PREFIX}'
+            f'{message.media_group_id}'
+        )
+        # Одной командой: поставить, если еще нет
+        if not await r.set(
+                name=check_str,
+                value='1',
+                ex=Rcache.MEDIA_GROUP_TTL,
+                nx=True,
+            ):
+            show_response = False
     if not show_response:
         return
 
@@ -1472,7 +1472,7 @@ async def process_message_to_send(message: Message, state: FSMContext):
         f'{Rcache.SEND_MESSAGE_PREFIX}{Rcache.KEY_SEP}'
         f'{data["uuid_pack"]}'
     )
-    if not await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+    if not await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
         return
     profile_to = data['profile_to']; profile_from = data['profile_from']
 
@@ -1525,7 +1525,7 @@ async def process_message_to_send(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    if not await Misc.check_none_n_clear(Misc.redis_save_time(key), state):
+    if not await Misc.check_none_n_clear(await Misc.redis_save_time(key), state):
         return
     if not is_first:
         return
@@ -1633,7 +1633,7 @@ async def do_get_user_desc(message: Message, state: FSMContext):
         f'{Rcache.USER_DESC_PREFIX}{Rcache.KEY_SEP}'
         f'{data["uuid_pack"]}'
     )
-    if not await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+    if not await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
         return failed
     status, response = await Misc.put_user_properties(
         form_data=False,
@@ -1641,7 +1641,7 @@ async def do_get_user_desc(message: Message, state: FSMContext):
         is_first=is_first,
         tgdesc=TgDesc.from_message(message, data['uuid_pack'])
     )
-    if status != 200 or not await Misc.check_none_n_clear(Misc.redis_save_time(key), state):
+    if status != 200 or not await Misc.check_none_n_clear(await Misc.redis_save_time(key), state):
         return failed
     return status, response, is_first
 
@@ -1726,7 +1726,7 @@ async def process_message_thank_ask_money(message: Message, state: FSMContext):
         f'{Rcache.ASK_MONEY_PREFIX}{Rcache.KEY_SEP}'
         f'{data["uuid_pack"]}'
     )
-    if not await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+    if not await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
         return
     tgdesc_payload  = dict(
         tg_token=settings.TOKEN,
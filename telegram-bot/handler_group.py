@@ -2,7 +2,7 @@
 #
 # Команды и сообщения в группы и каналы
 
-import base64, re, hashlib, redis, time, tempfile, os
+import base64, re, hashlib, time, tempfile, os
 
 from aiogram import Router, F
 from aiogram.filters import Command
@@ -16,11 +16,12 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
 from youtube_upload import upload_video
 
-from common import Misc, KeyboardType, OperationType, TgGroup, TgGroupMember, Rcache
+from common import Misc, KeyboardType, OperationType, TgGroup, TgGroupMember, Rcache, KnownUsers
 from handler_offer import Offer
 
 import logging
 import settings
+from redis_client import RedisClient
 import me
 dp, bot, bot_data = me.dp, me.bot, me.bot_data
 
@@ -51,19 +52,17 @@ async def process_group_message(message: Message, state: FSMContext):
 
     # Добавляем ид сообщения в редис - чтобы не обрабатывать его повторно
     dedup_key = f"msg_dedup:{message.chat.id}:{message.message_id}"
-    if r := redis.Redis(**settings.REDIS_CONNECT):
-        try:
-            # Пытаемся установить ключ с временем жизни 5 минут
-            # Если ключ уже существует (возвращает 0) - сообщение уже обрабатывалось
-            if not r.set(dedup_key, "1", ex=300, nx=True):
-                logging.debug(f"Message {message.message_id} already processed, skipping")
-                return
-            logging.debug(f"Message {message.message_id} added to Redis")
-        except Exception as e:
-            logging.error(f"Redis dedup error: {str(e)}")
-            # В случае ошибки Redis продолжаем обработку
-        finally:
-            r.close()
+    r = RedisClient.get()
+    try:
+        # Пытаемся установить ключ с временем жизни 5 минут
+        # Если ключ уже существует (возвращает 0) - сообщение уже обрабатывалось
+        if not await r.set(dedup_key, "1", ex=300, nx=True):
+            logging.debug(f"Message {message.message_id} already processed, skipping")
+            return
+        logging.debug(f"Message {message.message_id} added to Redis")
+    except Exception as e:
+        logging.error(f"Redis dedup error: {str(e)}")
+        # В случае ошибки Redis продолжаем обработку
 
     if message.content_type in(
             ContentType.NEW_CHAT_PHOTO,
@@ -133,14 +132,14 @@ async def process_group_message(message: Message, state: FSMContext):
 
     # регистрируем пользователя в группе
     try:
-        status, response_from = await Misc.post_tg_user(tg_user_sender, did_bot_start=False)
-        await TgGroupMember.add(
+        status, response_from = await KnownUsers.post_tg_user(tg_user_sender)
+        await KnownUsers.add_member(
             group_chat_id=message.chat.id,
             group_title=message.chat.title,
             group_type=message.chat.type,
             user_tg_uid=tg_user_sender.id
         )
-        logging.debug("TEST: TgGroupMember.add")
+        logging.debug("TEST: KnownUsers.add_member")
     except Exception as e:
         logging.debug("ERROR: TgGroupMember.add")
         return
@@ -305,6 +304,7 @@ async def process_group_message(message: Message, state: FSMContext):
                 except (TelegramBadRequest, TelegramForbiddenError) as e:
                     logging.error(f"Failed to send error message: {str(e)}")
             else:
+                status, response_from = await KnownUsers.profile(tg_user_sender, response_from)
                 description = (
                     f'Профиль автора: {response_from["first_name"]}, '
                     f'{Misc.get_deeplink(response_from, https=True)}\n'
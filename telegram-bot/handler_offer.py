@@ -798,7 +798,7 @@ async def process_existing_offer_desc(message: Message, state: FSMContext):
             f'{Rcache.OFFER_DESC_PREFIX}{Rcache.KEY_SEP}'
             f'{data["uuid_pack"]}'
         )
-        if await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+        if await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
             status, response = await Offer.put_offer_properties(
                 username=data['username'],
                 offer_uuid=data['offer']['uuid'],
@@ -987,7 +987,7 @@ async def process_message_thank_office_choice(message: Message, state: FSMContex
         f'{Rcache.DONATE_OFFER_CHOICE}{Rcache.KEY_SEP}'
         f'{data["uuid_pack"]}'
     )
-    if not await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+    if not await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
         return
     tgdesc_payload  = dict(
         tg_token=settings.TOKEN,
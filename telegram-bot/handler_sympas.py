@@ -2,7 +2,7 @@
 #
 # Сallback реакции
 
-import re, base64, time, redis
+import re, base64, time
 from uuid import uuid4
 
 import asyncio
@@ -20,6 +20,7 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
 import logging
 import settings
+from redis_client import RedisClient
 
 from common import Misc, OperationType, KeyboardType, Rcache, TgDesc
 
@@ -375,24 +376,22 @@ async def cbq_sympa_set(callback: CallbackQuery, state: FSMContext):
         profile_from['username'] + Rcache.KEY_SEP + \
         profile_to['username']
     )
-    if r := redis.Redis(**settings.REDIS_CONNECT):
-        r_rec = r.get(r_key)
-        r.close()
-        if r_rec:
-            time_current = int(time.time())
-            tm_diff = int(r_rec) - time_current
-            if tm_diff > 0:
-                await bot.answer_callback_query(
-                    callback.id,
-                    text=(
-                        f'Вы можете снова установить симпатию к '
-                        f'{html.quote(profile_to["first_name"])} '
-                        f'только через {Misc.d_h_m_s(tm_diff)}'
-                    ),
-                    show_alert=True,
-                )
-                await callback.answer()
-                return
+    r_rec = await RedisClient.get().get(r_key)
+    if r_rec:
+        time_current = int(time.time())
+        tm_diff = int(r_rec) - time_current
+        if tm_diff > 0:
+            await bot.answer_callback_query(
+                callback.id,
+                text=(
+                    f'Вы можете снова установить симпатию к '
+                    f'{html.quote(profile_to["first_name"])} '
+                    f'только через {Misc.d_h_m_s(tm_diff)}'
+                ),
+                show_alert=True,
+            )
+            await callback.answer()
+            return
 
     if profile_from['r_sympa_username'] or profile_to['r_sympa_username']:
         if profile_from['r_sympa_username']:
@@ -474,14 +473,12 @@ async def cbq_sympa_set(callback: CallbackQuery, state: FSMContext):
                         'Отмечайте интересы на карте и ставьте симпатии чтобы найти взаимные'
                     )
                     reply_markup_to = InlineKeyboardMarkup(inline_keyboard=[ [Common.inline_btn_map()] ])
-                if r := redis.Redis(**settings.REDIS_CONNECT):
-                    time_current = int(time.time())
-                    r.set(
-                        r_key,
-                        str(time_current + Rcache.SET_NEXT_SYMPA_WAIT),
-                        ex=Rcache.SET_NEXT_SYMPA_WAIT,
-                    )
-                    r.close()
+                time_current = int(time.time())
+                await RedisClient.get().set(
+                    r_key,
+                    str(time_current + Rcache.SET_NEXT_SYMPA_WAIT),
+                    ex=Rcache.SET_NEXT_SYMPA_WAIT,
+                )
 
     if text_from:
         await Misc.remove_n_send_message(
@@ -602,13 +599,14 @@ async def cbq_get_sympa_donate(callback: CallbackQuery, state: FSMContext):
             text=text,
             reply_markup=reply_markup,
         )
+        # Данные FSM в redis (RedisStorage) хранятся в json:
+        # только ид, а не объекты aiogram
         await state.update_data(
             journal_id=journal_id,
             response_get_donate=response_get_donate,
-            # Это для того, если щелкнет Отказ от симпатии или Отказ от доната
-            callback=callback,
-            # Это для отравки доната
-            message=message,
+            # Это для отравки доната: сообщение, которое заменить
+            chat_id=message.chat.id if message else None,
+            message_id=message.message_id if message else None,
             uuid_pack=str(uuid4())
         )
     await callback.answer()
@@ -627,7 +625,7 @@ async def process_message_donate_after_sympa(message: Message, state: FSMContext
         f'{Rcache.ASK_MONEY_PREFIX}{Rcache.KEY_SEP}'
         f'{data["uuid_pack"]}'
     )
-    if not await Misc.check_none_n_clear(is_first := Misc.redis_is_key_first_up(key), state):
+    if not await Misc.check_none_n_clear(is_first := await Misc.redis_is_key_first_up(key), state):
         return
     tgdesc_payload  = dict(
         tg_token=settings.TOKEN,
@@ -681,7 +679,7 @@ async def process_message_donate_after_sympa(message: Message, state: FSMContext
             json=payload_send_pack,
         )
         if success:
-            if data.get('message'):
+            if data.get('message_id'):
                 text, reply_markup = Common.after_donate_or_not_donate(
                     user_m, user_f, data['journal_id'],
                     message_pre=(
@@ -689,8 +687,8 @@ async def process_message_donate_after_sympa(message: Message, state: FSMContext
                         f'Контакты запрошены. Ожидайте решения {html.quote(user_f["first_name"])} о передаче контактов.'
                 ))
                 await Misc.remove_n_send_message(
-                    chat_id=message.from_user.id,
-                    message_id=data['message'].message_id,
+                    chat_id=data.get('chat_id') or message.from_user.id,
+                    message_id=data['message_id'],
                     text=text,
                     reply_markup=reply_markup,
                 )
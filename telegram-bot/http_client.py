@@ -0,0 +1,128 @@
+# http_client.py
+#
+# Общая на весь бот aiohttp сессия для запросов в апи, к шаблонам,
+# фото и т.п.
+#
+# Сессия создается в main_() один раз, с пулом соединений
+# (keep-alive, ограничение соединений на хост, кэш DNS),
+# закрывается при завершении бота. Раньше на каждый запрос
+# открывалась новая сессия: новое соединение TCP (и TLS).
+#
+# Здесь же замеры времени запросов по путям апи, которые
+# пишутся в лог раз в settings.HTTP_METRICS_LOG_INTERVAL секунд
+# и при завершении бота.
+
+import time, asyncio
+import aiohttp
+import logging
+
+import settings
+
+class HttpClient(object):
+
+    session = None
+
+    # Замеры: {путь: [число запросов, ошибок, общее время, макс. время]}
+    #
+    metrics = dict()
+
+    @classmethod
+    def timeout(cls):
+        return aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT)
+
+    @classmethod
+    async def start(cls):
+        """
+        Создать сессию. Вызывается в main_()
+        """
+        if cls.session is None or cls.session.closed:
+            cls.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**settings.HTTP_CONNECTOR),
+                timeout=cls.timeout(),
+            )
+        return cls.session
+
+    @classmethod
+    async def stop(cls):
+        """
+        Закрыть сессию и соединения пула, сбросить замеры в лог
+        """
+        cls.log_metrics()
+        if cls.session is not None and not cls.session.closed:
+            await cls.session.close()
+            # Дать закрыться SSL соединениям, см. документацию aiohttp
+            await asyncio.sleep(0.25)
+        cls.session = None
+
+    @classmethod
+    async def get_session(cls):
+        """
+        Сессия. Если бот запущен не через main_(), создается здесь
+        """
+        if cls.session is None or cls.session.closed:
+            await cls.start()
+        return cls.session
+
+    @classmethod
+    def add_metric(cls, path, duration, ok=True):
+        metric = cls.metrics.setdefault(path, [0, 0, 0.0, 0.0])
+        metric[0] += 1
+        if not ok:
+            metric[1] += 1
+        metric[2] += duration
+        metric[3] = max(metric[3], duration)
+
+    @classmethod
+    def log_metrics(cls, reset=True):
+        """
+        Записать замеры в лог: путь, число, ошибки, среднее и макс. время, мс
+        """
+        if not cls.metrics:
+            return
+        for path in sorted(cls.metrics, key=lambda p: -cls.metrics[p][2]):
+            count, errors, total, maximum = cls.metrics[path]
+            logging.info('http %s: count %s, errors %s, avg %.1f ms, max %.1f ms' % (
+                path, count, errors, total / count * 1000, maximum * 1000,
+            ))
+        if reset:
+            cls.metrics = dict()
+
+    @classmethod
+    async def log_metrics_periodically(cls):
+        while True:
+            await asyncio.sleep(settings.HTTP_METRICS_LOG_INTERVAL)
+            cls.log_metrics()
+
+    @classmethod
+    async def request(cls, method, url, metric=None, response_type='json', **kwargs):
+        """
+        Запрос. Возвращает (status, ответ)
+
+        metric:         путь, по которому учитывать время запроса,
+                        если не задан, то url без параметров
+        response_type:  'json', 'text' или 'bytes'.
+                        При status >= 500 ответ всегда текст.
+        kwargs:         data, json, params, ... как в session.request()
+
+        Исключения не перехватываются, это делается там, откуда вызов
+        """
+        status = response = None
+        time_start = time.monotonic()
+        ok = False
+        session = await cls.get_session()
+        try:
+            async with session.request(method.upper(), url, **kwargs) as resp:
+                status = resp.status
+                if status < 500:
+                    if response_type == 'json':
+                        response = await resp.json()
+                    elif response_type == 'text':
+                        response = await resp.text('UTF-8')
+                    else:
+                        response = await resp.read()
+                else:
+                    response = await resp.text('UTF-8')
+            ok = status < 500
+        finally:
+            cls.add_metric(metric or url.split('?')[0], time.monotonic() - time_start, ok)
+        return status, response
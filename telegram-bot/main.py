@@ -1,7 +1,8 @@
-import asyncio
+import asyncio, argparse
 from aiogram import Bot, Dispatcher, enums
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 
 from aiogram.client.telegram import TelegramAPIServer
 from aiogram.client.session.aiohttp import AiohttpSession
@@ -11,10 +12,19 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import logging
 import settings
 import me
+from http_client import HttpClient
+from redis_client import RedisClient
 
-storage = MemoryStorage()
+def make_storage(mode):
+    """
+    Хранилище состояний FSM. В памяти процесса годится только
+    для одного процесса, в режиме polling
+    """
+    if mode == 'polling' and settings.FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    return RedisStorage(redis=RedisClient.get())
 
-async def main_():
+async def setup(mode):
     kwargs_bot = dict(
         token=settings.TOKEN,
         default=DefaultBotProperties(
@@ -27,7 +37,9 @@ async def main_():
                 api=TelegramAPIServer.from_base(settings.LOCAL_SERVER, is_local=True),
         ))
     bot = Bot(**kwargs_bot)
-    dp = Dispatcher(storage=storage)
+    await HttpClient.start()
+    RedisClient.start()
+    dp = Dispatcher(storage=make_storage(mode))
 
     me.bot = bot
     me.dp = dp
@@ -39,12 +51,30 @@ async def main_():
     from handler_sympas import router as router_sympas
     from handler_relatives import router as router_relatives
 
+    dp.include_routers(
+        router_bot,
+        router_callbacks,
+        router_group,
+        router_offer,
+        router_sympas,
+        router_relatives,
+    )
+    return bot, dp
+
+def start_schedule(mode):
+    """
+    Задачи по расписанию. Если процессов бота несколько,
+    каждый запуск задачи выполняет один из них
+    """
     schedule_start = False
     if settings.SCHEDULE_CRON:
         scheduler = AsyncIOScheduler()
         from common import Schedule
+        from bot_cluster import ScheduleLock
         for task in settings.SCHEDULE_CRON:
             if proc := getattr(Schedule, task, None):
+                if mode != 'polling':
+                    proc = ScheduleLock.wrap(task, proc)
                 try:
                     if scheduler.add_job(proc, 'cron', **settings.SCHEDULE_CRON[task]):
                         schedule_start = True
@@ -53,19 +83,42 @@ async def main_():
     if schedule_start:
         scheduler.start()
 
-    dp.include_routers(
-        router_bot,
-        router_callbacks,
-        router_group,
-        router_offer,
-        router_sympas,
-        router_relatives,
-    )
+async def main_(mode='polling', worker=0):
+    bot, dp = await setup(mode)
+    if mode not in ('front', 'webhook'):
+        start_schedule(mode)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(
-        bot,
-        polling_timeout=20,
-    )
+    metrics_task = None
+    if settings.HTTP_METRICS_LOG_INTERVAL:
+        metrics_task = asyncio.create_task(HttpClient.log_metrics_periodically())
+
+    try:
+        if mode in ('front', 'webhook'):
+            from bot_cluster import serve_front, WorkerSupervisor
+            # webhook: front и settings.BOT_WORKERS обработчиков на этой машине
+            supervisor = WorkerSupervisor(settings.BOT_WORKERS) if mode == 'webhook' else None
+            await serve_front(bot, dp, supervisor)
+        elif mode == 'worker':
+            from bot_cluster import Worker
+            await Worker(bot, dp, worker).run()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(
+                bot,
+                polling_timeout=20,
+            )
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+        await HttpClient.stop()
+        await RedisClient.stop()
+
+parser = argparse.ArgumentParser(description='Telegram bot, see bot_cluster.py for modes other than polling')
+parser.add_argument('mode', nargs='?', default=settings.BOT_MODE,
+    choices=('polling', 'webhook', 'front', 'worker'))
+parser.add_argument('worker', nargs='?', type=int, default=0, help='worker number, for mode worker')
+args = parser.parse_args()
+if args.mode == 'worker' and not 0 <= args.worker < settings.BOT_WORKERS:
+    parser.error('worker number must be from 0 to settings.BOT_WORKERS - 1')
 
-asyncio.run(main_())
+asyncio.run(main_(args.mode, args.worker))
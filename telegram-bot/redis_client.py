@@ -0,0 +1,48 @@
+# redis_client.py
+#
+# Общий на весь бот асинхронный пул соединений с redis
+#
+# Раньше в обработчиках сообщений создавалось синхронное соединение
+# redis.Redis(**settings.REDIS_CONNECT) на каждое обращение,
+# и каждое обращение к redis останавливало цикл событий aiogram.
+# Теперь пул создается в main_() один раз, закрывается
+# при завершении бота:
+#
+#   r = RedisClient.get()
+#   value = await r.get(key)
+#
+# Соединение после команды возвращается в пул само, r.close() не нужен.
+#
+# Пул ограничен (settings.REDIS_POOL). При наплыве обновлений обращений
+# к redis бывает больше, чем соединений: они ждут свободного соединения.
+
+from redis import asyncio as aioredis
+
+import settings
+
+class RedisClient(object):
+
+    pool = None
+
+    @classmethod
+    def start(cls):
+        """
+        Создать пул. Вызывается в main_()
+        """
+        if cls.pool is None:
+            cls.pool = aioredis.BlockingConnectionPool(**settings.REDIS_POOL, **settings.REDIS_CONNECT)
+        return cls.pool
+
+    @classmethod
+    async def stop(cls):
+        if cls.pool is not None:
+            await cls.pool.disconnect()
+        cls.pool = None
+
+    @classmethod
+    def get(cls):
+        """
+        Клиент redis на общем пуле. Если бот запущен не через main_(),
+        пул создается здесь
+        """
+        return aioredis.Redis(connection_pool=cls.start())
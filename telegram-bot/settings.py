@@ -17,6 +17,25 @@ WEBHOOK_HOST = 'https://bot.doverabot.ru'
 WEBHOOK_PATH = '/'
 WEBAPP_HOST = '127.0.0.1'
 WEBAPP_PORT = 3001
+# Секрет в заголовке X-Telegram-Bot-Api-Secret-Token запросов
+# телеграма к webhook. None: не проверять
+WEBHOOK_SECRET = None
+
+# Режим работы, см. bot_cluster.py:
+#   'polling':  один процесс опрашивает телеграм
+#   'webhook':  телеграм шлет обновления на WEBHOOK_HOST + WEBHOOK_PATH,
+#               их обрабатывают BOT_WORKERS процессов
+# Режим можно задать и в командной строке: ./bot_run.py webhook
+#
+BOT_MODE = 'polling'
+BOT_WORKERS = 1
+# Сколько обновлений одновременно в работе у одного обработчика
+BOT_WORKER_CONCURRENCY = 50
+
+# Где хранить состояния FSM в режиме polling: 'memory' или 'redis'
+# (REDIS_CONNECT). В режиме webhook всегда в redis
+#
+FSM_STORAGE = 'memory'
 
 import logging
 LOG_CONFIG = dict(
@@ -44,6 +63,25 @@ LOG_CONFIG = dict(
 #
 HTTP_TIMEOUT = 60
 
+# Пул соединений общей aiohttp сессии бота, см. http_client.py.
+# Параметры aiohttp.TCPConnector():
+#   limit               всего соединений
+#   limit_per_host      соединений к одному хосту (апи)
+#   ttl_dns_cache       сколько секунд помнить DNS
+#   keepalive_timeout   сколько секунд держать свободное соединение
+#
+HTTP_CONNECTOR = dict(
+    limit=100,
+    limit_per_host=30,
+    ttl_dns_cache=300,
+    keepalive_timeout=60,
+)
+
+# Раз в сколько секунд писать в лог замеры времени запросов
+# по путям апи. 0: только при завершении бота
+#
+HTTP_METRICS_LOG_INTERVAL = 3600
+
 # Сообщение из многих валит одно за другим.
 # Мы сначала одно за другим пишем в базу, потом просим апи
 # выдать полученное. Т.е. этот максимальное время на обработку одного
@@ -126,6 +164,21 @@ REDIS_CONNECT =dict(
     db=2,
     decode_responses=True,
 )
+# Общий пул соединений с redis, см. redis_client.py: не больше
+# max_connections соединений. Когда все заняты, обращение к redis ждет
+# свободного до timeout секунд, а не падает
+#
+REDIS_POOL = dict(
+    max_connections=100,
+    timeout=20,
+)
+
+# Сколько секунд бот помнит, что пользователь, писавший в группу,
+# внесен в апи и что он -- участник группы, см. common.KnownUsers.
+# Пока помнит, не обращается за этим в апи при каждом сообщении в группу
+#
+KNOWN_USER_TTL = 3600
+KNOWN_MEMBER_TTL = 86400
 
 # Время, после которого можно еще раз ставить симпатию
 #